@@ -18,6 +18,7 @@ from torchvision import transforms
 
 import library.model_util as model_util
 import library.train_util as train_util
+from library.image_size_index import probe_image_sizes
 from library.utils import setup_logging
 
 setup_logging()
@@ -106,6 +107,16 @@ def main(args):
             "min_bucket_reso and max_bucket_reso are ignored if bucket_no_upscale is set, because bucket reso is defined by image size automatically / bucket_no_upscaleが指定された場合は、bucketの解像度は画像サイズから自動計算されるため、min_bucket_resoとmax_bucket_resoは無視されます"
         )
 
+    # 画像サイズをヘッダから読み込み、全画像のbucketを一括で決めておく
+    logger.info("assigning buckets by image sizes in headers")
+    image_sizes = probe_image_sizes(image_paths, train_util.read_image_size)
+    valid_indices = [i for i, (w, h) in enumerate(image_sizes) if w > 0 and h > 0]
+    valid_sizes = np.array([image_sizes[i] for i in valid_indices], dtype=np.int64).reshape(-1, 2)
+    bucket_ids, resized_sizes, ar_errors = bucket_manager.select_buckets(valid_sizes[:, 0], valid_sizes[:, 1])
+    assigned_buckets = {}  # image path -> (image size, bucket reso, resized size, ar error)
+    for i, bucket_id, resized_size, ar_error in zip(valid_indices, bucket_ids.tolist(), resized_sizes.tolist(), ar_errors.tolist()):
+        assigned_buckets[image_paths[i]] = (tuple(image_sizes[i]), bucket_manager.resos[bucket_id], tuple(resized_size), ar_error)
+
     # 画像をひとつずつ適切なbucketに割り当てながらlatentを計算する
     img_ar_errors = []
 
@@ -152,7 +163,11 @@ def main(args):
 
         # 本当はこのあとの部分もDataSetに持っていけば高速化できるがいろいろ大変
 
-        reso, resized_size, ar_error = bucket_manager.select_bucket(image.width, image.height)
+        assigned = assigned_buckets.get(image_path)
+        if assigned is not None and assigned[0] == (image.width, image.height):
+            _, reso, resized_size, ar_error = assigned
+        else:
+            reso, resized_size, ar_error = bucket_manager.select_bucket(image.width, image.height)
         img_ar_errors.append(abs(ar_error))
         bucket_counts[reso] = bucket_counts.get(reso, 0) + 1
 
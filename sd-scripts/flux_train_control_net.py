@@ -99,6 +99,7 @@ def train(args):
         latents_caching_strategy = strategy_flux.FluxLatentsCachingStrategy(
             args.cache_latents_to_disk, args.vae_batch_size, args.skip_cache_check
         )
+        train_util.set_latents_cache_store_if_specified(args, latents_caching_strategy)
         strategy_base.LatentsCachingStrategy.set_strategy(latents_caching_strategy)
 
     # データセットを準備する
@@ -227,6 +228,7 @@ def train(args):
         text_encoder_caching_strategy = strategy_flux.FluxTextEncoderOutputsCachingStrategy(
             args.cache_text_encoder_outputs_to_disk, args.text_encoder_batch_size, False, False, args.apply_t5_attn_mask
         )
+        train_util.set_text_encoder_outputs_cache_options_if_specified(args, text_encoder_caching_strategy)
         strategy_base.TextEncoderOutputsCachingStrategy.set_strategy(text_encoder_caching_strategy)
 
         with accelerator.autocast():
@@ -298,7 +300,14 @@ def train(args):
         # Swap blocks between CPU and GPU to reduce memory usage, in forward and backward passes.
         # This idea is based on 2kpr's great work. Thank you!
         logger.info(f"enable block swap: blocks_to_swap={args.blocks_to_swap}")
-        flux.enable_block_swap(args.blocks_to_swap, accelerator.device)
+        flux.enable_block_swap(
+            args.blocks_to_swap,
+            accelerator.device,
+            args.blocks_to_swap_disk_dir,
+            args.blocks_to_swap_disk_prefetch_depth,
+            args.blocks_to_swap_max_prefetch,
+            args.blocks_to_swap_timeline,
+        )
         flux.move_to_device_except_swap_blocks(accelerator.device)  # reduce peak memory usage
         # ControlNet only has two blocks, so we can keep it on GPU
         # controlnet.enable_block_swap(args.blocks_to_swap, accelerator.device)
@@ -400,6 +409,7 @@ def train(args):
         collate_fn=collator,
         num_workers=n_workers,
         persistent_workers=args.persistent_data_loader_workers,
+        **train_util.get_data_loader_kwargs(args, n_workers),
     )
 
     # 学習ステップ数を計算する
@@ -583,6 +593,7 @@ def train(args):
 
     loss_recorder = train_util.LossRecorder()
     epoch = 0  # avoid error when max_train_steps is 0
+    data_wait_timer = train_util.DataLoaderWaitTimer()
     for epoch in range(num_train_epochs):
         accelerator.print(f"\nepoch {epoch+1}/{num_train_epochs}")
         current_epoch.value = epoch + 1
@@ -590,7 +601,7 @@ def train(args):
         for m in training_models:
             m.train()
 
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(data_wait_timer(train_dataloader)):
             current_step.value = global_step
 
             if args.blockwise_fused_optimizers:
@@ -758,6 +769,8 @@ def train(args):
                 logs = {"loss": current_loss}
                 train_util.append_lr_to_logs(logs, lr_scheduler, args.optimizer_type, including_unet=True)
 
+                logs.update(data_wait_timer.get_logs())
+
                 accelerator.log(logs, step=global_step)
 
             loss_recorder.add(epoch=epoch, step=step, loss=current_loss)
@@ -768,6 +781,8 @@ def train(args):
             if global_step >= args.max_train_steps:
                 break
 
+        data_wait_timer.log_summary()
+
         if len(accelerator.trackers) > 0:
             logs = {"loss/epoch": loss_recorder.moving_average}
             accelerator.log(logs, step=epoch + 1)
@@ -1,6 +1,6 @@
 import itertools
 import json
-from typing import Any, List, NamedTuple, Optional, Tuple, Union, Callable
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union, Callable
 import glob
 import importlib
 import importlib.util
@@ -53,7 +53,7 @@ import library.model_util as model_util
 import library.train_util as train_util
 import library.sdxl_model_util as sdxl_model_util
 import library.sdxl_train_util as sdxl_train_util
-from networks.lora import LoRANetwork
+from networks.lora import LoRADeltaCache, LoRANetwork
 import tools.original_control_net as original_control_net
 from tools.original_control_net import ControlNetInfo
 from library.original_unet import UNet2DConditionModel, InferUNet2DConditionModel
@@ -1501,6 +1501,36 @@ class BatchData(NamedTuple):
     ext: BatchDataExt
 
 
+class BatchPacker:
+    # 同じext（サイズ、steps、network multipliers等）のBatchDataを、プロンプトの順序に関わらず同じバッチにまとめる
+    # packs BatchData with the same ext into full batches regardless of the order of prompts.
+    # the output names are determined by base.step, so they are the same as without packing
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.groups: Dict[BatchDataExt, List[BatchData]] = {}
+
+    def __len__(self):
+        return sum(len(group) for group in self.groups.values())
+
+    def add(self, batch_data: BatchData) -> Optional[List[BatchData]]:
+        r"""
+        add batch_data to the group of its ext, and returns the group if it becomes full.
+        """
+        group = self.groups.setdefault(batch_data.ext, [])
+        group.append(batch_data)
+        if len(group) < self.batch_size:
+            return None
+        return self.groups.pop(batch_data.ext)
+
+    def flush(self) -> List[List[BatchData]]:
+        r"""
+        returns all partial groups in order of the first prompt in each group.
+        """
+        groups = list(self.groups.values())
+        self.groups.clear()
+        return groups
+
+
 class ListPrompter:
     def __init__(self, prompts: List[str]):
         self.prompts = prompts
@@ -1775,6 +1805,7 @@ def main(args):
         networks = []
         network_default_muls = []
         network_pre_calc = args.network_pre_calc
+        network_delta_cache = None
 
         # merge関連の引数を統合する
         if args.network_merge:
@@ -1834,15 +1865,28 @@ def main(args):
                     network.to(memory_format=torch.channels_last)
                 network.to(dtype).to(device)
 
-                if network_pre_calc:
-                    logger.info("backup original weights")
-                    network.backup_weights()
-
                 networks.append(network)
                 network_default_muls.append(network_mul)
             else:
                 network.merge_to(text_encoders, unet, weights_sd, dtype, device)
 
+        if network_pre_calc and args.network_delta_cache_size > 0:
+            if all(hasattr(network, "fuse_weights") for network in networks):
+                # the weights are restored by subtracting the deltas, no backup is needed
+                logger.info(
+                    f"fuse network weights with delta cache: {args.network_delta_cache_size}, {args.network_delta_cache_device}"
+                )
+                network_delta_cache = LoRADeltaCache(args.network_delta_cache_size, args.network_delta_cache_device)
+            else:
+                logger.warning(
+                    "some networks do not support fused weights. ignore network_delta_cache_size"
+                    " / 重みの融合に対応していないネットワークがあるため、network_delta_cache_sizeを無視します"
+                )
+        if network_pre_calc and network_delta_cache is None:
+            for network in networks:
+                logger.info("backup original weights")
+                network.backup_weights()
+
     else:
         networks = []
 
@@ -2264,6 +2308,14 @@ def main(args):
     os.makedirs(args.outdir, exist_ok=True)
     max_embeddings_multiples = 1 if args.max_embeddings_multiples is None else args.max_embeddings_multiples
 
+    # プロンプトの順序に関わらず同じパラメータのプロンプトをまとめてバッチにする
+    batch_packer = None
+    if args.pack_batches:
+        if args.interactive:
+            logger.warning("pack_batches is ignored in interactive mode / 対話モードではpack_batchesは無視されます")
+        else:
+            batch_packer = BatchPacker(args.batch_size)
+
     for gen_iter in range(args.n_iter):
         logger.info(f"iteration {gen_iter+1}/{args.n_iter}")
         if args.iter_same_seed:
@@ -2375,7 +2427,7 @@ def main(args):
             # このバッチの情報を取り出す
             (
                 return_latents,
-                (step_first, _, _, _, init_image, mask_image, _, guide_image, _, _),
+                (_, _, _, _, init_image, mask_image, _, guide_image, _, _),
                 (
                     width,
                     height,
@@ -2500,10 +2552,15 @@ def main(args):
                         n.set_current_generation(batch_size, num_sub_prompts, width, height, shared, unet.ds_ratio)
 
                 if not regional_network and network_pre_calc:
-                    for n in networks:
-                        n.restore_weights()
-                    for n in networks:
-                        n.pre_calculation()
+                    if network_delta_cache is not None:
+                        # only the networks with changed multipliers are updated
+                        for n in networks:
+                            n.fuse_weights(cache=network_delta_cache)
+                    else:
+                        for n in networks:
+                            n.restore_weights()
+                        for n in networks:
+                            n.pre_calculation()
                     logger.info("pre-calculation... done")
 
             images = pipe(
@@ -2575,7 +2632,7 @@ def main(args):
                         else:
                             fln = os.path.splitext(os.path.basename(init_images.filename))[0] + ".png"
                     elif args.sequential_file_name:
-                        fln = f"im_{highres_prefix}{step_first + i + 1:06d}.png"
+                        fln = f"im_{highres_prefix}{batch[i].base.step + 1:06d}.png"  # steps may not be contiguous if packed
                     else:
                         fln = f"im_{ts_str}_{highres_prefix}{i:03d}_{seed}.png"
 
@@ -2861,6 +2918,15 @@ def main(args):
                             logger.error(f"Exception in parsing / 解析エラー: {parg}")
                             logger.error(f"{ex}")
 
+                # Deep Shrink and Gradual Latent are set to the model, so generate the pending prompts before overriding
+                if (
+                    batch_packer is not None
+                    and (ds_depth_1 is not None or gl_timesteps is not None)
+                    and (pi == 0 or len(raw_prompts) > 1)
+                ):
+                    for packed_batch in batch_packer.flush():
+                        process_batch(packed_batch, highres_fix)
+
                 # override Deep Shrink
                 if ds_depth_1 is not None:
                     if ds_depth_1 < 0:
@@ -2975,6 +3041,13 @@ def main(args):
                         num_sub_prompts,
                     ),
                 )
+                if batch_packer is not None:
+                    packed_batch = batch_packer.add(b1)
+                    if packed_batch is not None:
+                        prev_image = process_batch(packed_batch, highres_fix)[0]
+                    global_step += 1
+                    continue
+
                 if len(batch_data) > 0 and batch_data[-1].ext != b1.ext:  # バッチ分割必要？
                     process_batch(batch_data, highres_fix)
                     batch_data.clear()
@@ -2991,6 +3064,9 @@ def main(args):
         if len(batch_data) > 0:
             process_batch(batch_data, highres_fix)
             batch_data.clear()
+        if batch_packer is not None:
+            for packed_batch in batch_packer.flush():
+                process_batch(packed_batch, highres_fix)
 
     logger.info("done!")
 
@@ -3161,6 +3237,11 @@ def setup_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="use same seed for all prompts in iteration if no seed specified / 乱数seedの指定がないとき繰り返し内はすべて同じseedを使う（プロンプト間の差異の比較用）",
     )
+    parser.add_argument(
+        "--pack_batches",
+        action="store_true",
+        help="make batches of prompts with the same size, steps, scale, network multipliers etc. regardless of the order of prompts (output file names are not changed) / プロンプトの順序に関わらず、サイズ、ステップ数、scale、ネットワークの適用率等が同じプロンプトをまとめてバッチにする（出力ファイル名は変わらない）",
+    )
     parser.add_argument(
         "--shuffle_prompts",
         action="store_true",
@@ -3217,6 +3298,25 @@ def setup_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="pre-calculate network for generation / ネットワークのあらかじめ計算して生成する",
     )
+    parser.add_argument(
+        "--network_delta_cache_size",
+        type=int,
+        default=0,
+        help="with --network_pre_calc, add and subtract the weight deltas of networks in place instead of restoring the backup,"
+        " and cache the deltas of this number of (network, multiplier). each entry takes as much memory as the weights"
+        " modified by the network / --network_pre_calc時に、バックアップから復元する代わりに"
+        "ネットワークの重みの差分をその場で加減算し、この数の（ネットワーク、倍率）の差分をキャッシュする。"
+        "各エントリはネットワークが変更する重みと同じだけのメモリを使用する",
+    )
+    parser.add_argument(
+        "--network_delta_cache_device",
+        type=str,
+        default="cpu",
+        help="device to keep the cached weight deltas on (default is cpu). the deltas are moved to the model device when fused."
+        " caching on the model device (e.g. cuda) is faster, but takes VRAM of network_delta_cache_size x the weights"
+        " modified by the network / 重みの差分をキャッシュするデバイス（デフォルトはcpu）。融合時にモデルのデバイスへ転送される。"
+        "モデルのデバイス（cudaなど）にキャッシュすると高速だが、network_delta_cache_size×ネットワークが変更する重みのVRAMを使用する",
+    )
     parser.add_argument(
         "--network_regional_mask_max_color_codes",
         type=int,
@@ -0,0 +1,284 @@
+# asynchronous checkpoint writer: saves checkpoints in a background thread while training continues
+# 学習を止めずにチェックポイントをバックグラウンドで保存する
+#
+# the savers of the models (save_weights of networks, save_stable_diffusion_checkpoint etc.) are called in the training
+# thread as before, within deferred_writes(writer). in the context, writes of safetensors files are replaced with:
+#
+#   snapshot (training thread) : copy the state dict to (pinned) CPU buffers. copies from GPU are asynchronous and
+#                                ordered on the current stream, so the next training steps do not change the snapshot
+#   write    (writer thread)   : wait for the copies, hash (if required) and write the file atomically
+#
+# other jobs such as removing old checkpoints (save_last_n_epochs/steps) and uploading to HuggingFace are run in the
+# writer thread in order of submission, so they always run after the checkpoints before them are written.
+# the number of snapshots alive is bounded by max_pending: saving blocks until a previous snapshot is written.
+
+import atexit
+import contextlib
+import os
+import queue
+import shutil
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+from safetensors.torch import save_file as safetensors_save_file
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCheckpointWriter:
+    r"""
+    writes safetensors files and runs other jobs in a background thread in order of submission.
+    exceptions in the background thread are raised from the next call of save_file, submit or flush.
+    jobs after a failed job are skipped, so old checkpoints are not removed when the new one is not written.
+    """
+
+    def __init__(self, max_pending: int = 1, use_pinned_memory: Optional[bool] = None) -> None:
+        assert max_pending >= 1, "max_pending must be 1 or more / max_pendingは1以上である必要があります"
+        if use_pinned_memory is None:
+            use_pinned_memory = torch.cuda.is_available()
+        self.max_pending = max_pending
+        self.use_pinned_memory = use_pinned_memory
+
+        self._snapshot_slots = threading.Semaphore(max_pending)
+        self._free_buffers: List[Dict[str, torch.Tensor]] = []  # reused to avoid allocating pinned memory every time
+        self._buffers_lock = threading.Lock()
+
+        self._jobs: queue.Queue = queue.Queue()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="AsyncCheckpointWriter", daemon=True)
+        self._thread.start()
+
+    # region background thread
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                job()
+            except BaseException as e:
+                logger.error(f"failed in background checkpoint writer / バックグラウンドのチェックポイント保存に失敗しました: {e}")
+                self._error = e
+            finally:
+                self._jobs.task_done()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError(
+                "background checkpoint writer failed / バックグラウンドのチェックポイント保存に失敗しました"
+            ) from self._error
+
+    # endregion
+
+    # region snapshot
+
+    def _allocate_buffers(self, tensors: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        with self._buffers_lock:
+            for i, buffers in enumerate(self._free_buffers):
+                if buffers.keys() == tensors.keys() and all(
+                    buffers[k].shape == v.shape and buffers[k].dtype == v.dtype for k, v in tensors.items()
+                ):
+                    return self._free_buffers.pop(i)
+
+        return {k: torch.empty(v.shape, dtype=v.dtype, pin_memory=self.use_pinned_memory) for k, v in tensors.items()}
+
+    def _release_buffers(self, buffers: Dict[str, torch.Tensor]):
+        with self._buffers_lock:
+            self._free_buffers.append(buffers)
+            if len(self._free_buffers) > self.max_pending:
+                self._free_buffers.pop(0)
+
+    def snapshot(self, tensors: Dict[str, torch.Tensor]):
+        r"""
+        copy tensors to CPU buffers. returns the buffers and the CUDA events to wait for the copies.
+        tensors on CPU are also copied, because they may share the storage with the parameters.
+        """
+        buffers = self._allocate_buffers(tensors)
+        devices = set()
+        with torch.no_grad():
+            for key, tensor in tensors.items():
+                tensor = tensor.detach()
+                if tensor.device.type == "cuda":
+                    devices.add(tensor.device)
+                buffers[key].copy_(tensor, non_blocking=self.use_pinned_memory)
+
+        events = []
+        for device in devices:
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(device))
+            events.append(event)
+        return buffers, events
+
+    # endregion
+
+    def save_file(
+        self, tensors: Dict[str, torch.Tensor], filename: str, metadata: Optional[Dict[str, str]] = None, with_hashes: bool = False
+    ):
+        r"""
+        snapshot the tensors and write them to a safetensors file in the background. metadata is copied, so the caller
+        can modify it after this call. with_hashes: add sshs_model_hash and sshs_legacy_hash to the metadata.
+        """
+        self._raise_if_failed()
+        metadata = dict(metadata) if metadata is not None else None
+
+        start_time = time.perf_counter()
+        self._snapshot_slots.acquire()  # wait for the previous checkpoints to limit memory usage
+        try:
+            buffers, events = self.snapshot(tensors)
+        except BaseException:
+            self._snapshot_slots.release()
+            raise
+        blocked_time = time.perf_counter() - start_time
+
+        def write():
+            try:
+                if self._error is not None:
+                    return  # skipped, release the buffers only
+                write_start_time = time.perf_counter()
+                for event in events:
+                    event.synchronize()
+
+                tmp_filename = f"{filename}.{os.getpid()}.tmp"
+                if with_hashes:
+                    from library import train_util
+
+                    train_util.save_safetensors_with_hashes(buffers, tmp_filename, metadata if metadata is not None else {})
+                else:
+                    safetensors_save_file(buffers, tmp_filename, metadata)
+                os.replace(tmp_filename, filename)
+
+                logger.info(
+                    f"checkpoint written in background / チェックポイントをバックグラウンドで保存しました: {filename}"
+                    + f" ({time.perf_counter() - write_start_time:.1f}s, training blocked {blocked_time:.1f}s)"
+                )
+            finally:
+                self._release_buffers(buffers)
+                self._snapshot_slots.release()
+
+        self._jobs.put(write)
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs):
+        r"""
+        run fn(*args, **kwargs) in the background after the jobs submitted before, e.g. uploading the checkpoint.
+        """
+        self._raise_if_failed()
+
+        def job():
+            if self._error is None:
+                fn(*args, **kwargs)
+
+        self._jobs.put(job)
+
+    def remove(self, path: str):
+        r"""
+        remove an old checkpoint file or directory in the background after the jobs submitted before.
+        """
+
+        def remove_path():
+            if os.path.isdir(path):
+                logger.info(f"removing old model: {path}")
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                logger.info(f"removing old checkpoint: {path}")
+                os.remove(path)
+
+        self.submit(remove_path)
+
+    def flush(self):
+        r"""
+        wait until all submitted jobs are finished.
+        """
+        if self._jobs.unfinished_tasks > 0:
+            logger.info("waiting for background checkpoint writer / バックグラウンドのチェックポイント保存を待機しています")
+        self._jobs.join()
+        self._raise_if_failed()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+        self._raise_if_failed()
+
+
+# region deferred writes
+
+_deferral = threading.local()
+
+
+@contextlib.contextmanager
+def deferred_writes(writer: Optional[AsyncCheckpointWriter]):
+    r"""
+    in this context, save_file and train_util.save_safetensors_with_hashes called in this thread are written by writer.
+    no-op if writer is None.
+    """
+    if writer is None:
+        yield
+        return
+
+    prev_writer = getattr(_deferral, "writer", None)
+    _deferral.writer = writer
+    try:
+        yield
+    finally:
+        _deferral.writer = prev_writer
+
+
+def get_deferring_writer() -> Optional[AsyncCheckpointWriter]:
+    return getattr(_deferral, "writer", None)
+
+
+def save_file(tensors: Dict[str, torch.Tensor], filename: str, metadata: Optional[Dict[str, str]] = None):
+    r"""
+    same as safetensors.torch.save_file, but written in the background within deferred_writes.
+    """
+    writer = get_deferring_writer()
+    if writer is not None:
+        writer.save_file(tensors, filename, metadata)
+    else:
+        safetensors_save_file(tensors, filename, metadata)
+
+
+# endregion
+
+# region writer for training scripts
+
+_checkpoint_writer: Optional[AsyncCheckpointWriter] = None
+
+
+def get_checkpoint_writer(args) -> Optional[AsyncCheckpointWriter]:
+    r"""
+    the writer shared in the process if --async_checkpoint_save is specified, otherwise None.
+    """
+    global _checkpoint_writer
+    if not getattr(args, "async_checkpoint_save", False):
+        return None
+    if _checkpoint_writer is None:
+        _checkpoint_writer = AsyncCheckpointWriter(args.async_checkpoint_max_pending)
+        atexit.register(close_checkpoint_writer)  # write pending checkpoints even if training is interrupted by an error
+        logger.info(
+            f"checkpoints are saved in background, max pending: {args.async_checkpoint_max_pending}"
+            + f" / チェックポイントをバックグラウンドで保存します。最大待機数: {args.async_checkpoint_max_pending}"
+        )
+    return _checkpoint_writer
+
+
+def close_checkpoint_writer():
+    r"""
+    flush barrier: wait for all checkpoints to be written, and stop the writer. call at the end of training.
+    """
+    global _checkpoint_writer
+    if _checkpoint_writer is not None:
+        writer = _checkpoint_writer
+        _checkpoint_writer = None
+        writer.close()
+
+
+# endregion
@@ -0,0 +1,164 @@
+# three-stage pipeline for caching latents (and other outputs of models)
+# キャッシュ処理用の三段パイプライン
+#
+#   prepare (worker threads): load, decode and resize images
+#   process (calling thread): encode by the model on the device, e.g. VAE
+#   write   (worker threads): save to disk
+#
+# the stages are connected by bounded queues. the prepare stage works ahead of the process stage, so the model does not
+# wait for image decoding, and the process stage does not wait for disk writes. the queues limit memory usage when a stage
+# is slower than others.
+
+import collections
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, Sequence
+
+from tqdm import tqdm
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineStageStats:
+    def __init__(self, name: str, num_workers: int) -> None:
+        self.name = name
+        self.num_workers = num_workers
+        self.num_batches = 0
+        self.num_items = 0
+        self.busy_time = 0.0  # sum of the time of all workers
+        self.wait_time = 0.0  # time waiting for the previous stage (input) or the next stage (output)
+        self._lock = threading.Lock()
+
+    def add(self, num_items: int, elapsed: float):
+        with self._lock:
+            self.num_batches += 1
+            self.num_items += num_items
+            self.busy_time += elapsed
+
+    def summary(self, wall_time: float) -> str:
+        throughput = self.num_items / self.busy_time * self.num_workers if self.busy_time > 0 else 0.0
+        utilization = self.busy_time / (wall_time * self.num_workers) if wall_time > 0 else 0.0
+        summary = (
+            f"{self.name}: {self.num_items} items in {self.num_batches} batches, {throughput:.1f} items/s"
+            + f" with {self.num_workers} worker(s), utilization {utilization * 100:.0f}%"
+        )
+        if self.wait_time > 0:
+            summary += f", waited {self.wait_time:.1f}s"
+        return summary
+
+
+class CachingPipeline:
+    r"""
+    runs prepare_fn(batch) in worker threads, process_fn(batch, prepared) in the calling thread and
+    write_fn(batch, processed) in worker threads, for each batch in order of the batches.
+
+    prepare_queue_size is the number of prepared batches waiting for the process stage, in addition to the batches
+    being prepared. write_queue_size is the number of processed batches waiting for or being written.
+    exceptions in any stage are raised from run.
+    """
+
+    def __init__(
+        self,
+        prepare_fn: Callable[[Any], Any],
+        process_fn: Callable[[Any, Any], Any],
+        write_fn: Callable[[Any, Any], None],
+        num_prepare_workers: Optional[int] = None,
+        num_write_workers: int = 2,
+        prepare_queue_size: int = 2,
+        write_queue_size: int = 4,
+        get_num_items: Callable[[Any], int] = len,
+    ) -> None:
+        if num_prepare_workers is None:
+            num_prepare_workers = get_num_prepare_workers()
+        self.prepare_fn = prepare_fn
+        self.process_fn = process_fn
+        self.write_fn = write_fn
+        self.num_prepare_workers = max(1, num_prepare_workers)
+        self.num_write_workers = max(1, num_write_workers)
+        self.prepare_queue_size = max(1, prepare_queue_size)
+        self.write_queue_size = max(1, write_queue_size)
+        self.get_num_items = get_num_items
+
+        self.prepare_stats = PipelineStageStats("prepare", self.num_prepare_workers)
+        self.process_stats = PipelineStageStats("process", 1)
+        self.write_stats = PipelineStageStats("write", self.num_write_workers)
+
+    def _prepare(self, batch):
+        start_time = time.perf_counter()
+        prepared = self.prepare_fn(batch)
+        self.prepare_stats.add(self.get_num_items(batch), time.perf_counter() - start_time)
+        return prepared
+
+    def _write(self, batch, processed):
+        start_time = time.perf_counter()
+        self.write_fn(batch, processed)
+        self.write_stats.add(self.get_num_items(batch), time.perf_counter() - start_time)
+
+    def run(self, batches: Sequence[Any], show_progress: bool = True):
+        if len(batches) == 0:
+            return
+
+        max_prepare_in_flight = self.num_prepare_workers + self.prepare_queue_size
+        prepare_executor = ThreadPoolExecutor(self.num_prepare_workers, thread_name_prefix="cache_prepare")
+        write_executor = ThreadPoolExecutor(self.num_write_workers, thread_name_prefix="cache_write")
+        prepare_queue = collections.deque()  # (batch, future of prepared)
+        write_queue = collections.deque()  # futures of write
+        batch_iter = iter(batches)
+
+        def fill_prepare_queue():
+            while len(prepare_queue) < max_prepare_in_flight:
+                batch = next(batch_iter, None)
+                if batch is None:
+                    break
+                prepare_queue.append((batch, prepare_executor.submit(self._prepare, batch)))
+
+        start_time = time.perf_counter()
+        try:
+            fill_prepare_queue()
+            for _ in tqdm(range(len(batches)), smoothing=0.1, disable=not show_progress):
+                batch, prepared_future = prepare_queue.popleft()
+
+                wait_start = time.perf_counter()
+                prepared = prepared_future.result()  # the model is idle while waiting here
+                self.process_stats.wait_time += time.perf_counter() - wait_start
+                fill_prepare_queue()
+
+                process_start = time.perf_counter()
+                processed = self.process_fn(batch, prepared)
+                self.process_stats.add(self.get_num_items(batch), time.perf_counter() - process_start)
+                del prepared
+
+                wait_start = time.perf_counter()
+                while len(write_queue) >= self.write_queue_size:
+                    write_queue.popleft().result()  # back pressure: writers are slower than the model
+                while len(write_queue) > 0 and write_queue[0].done():
+                    write_queue.popleft().result()  # raise exceptions early
+                self.write_stats.wait_time += time.perf_counter() - wait_start
+
+                write_queue.append(write_executor.submit(self._write, batch, processed))
+
+            while len(write_queue) > 0:
+                write_queue.popleft().result()
+        finally:
+            prepare_executor.shutdown(wait=True, cancel_futures=True)
+            write_executor.shutdown(wait=True)
+
+        self.log_summary(time.perf_counter() - start_time)
+
+    def log_summary(self, wall_time: float):
+        logger.info(f"caching pipeline finished in {wall_time:.1f}s / キャッシュ処理が{wall_time:.1f}秒で完了しました")
+        for stats in [self.prepare_stats, self.process_stats, self.write_stats]:
+            logger.info(f"  {stats.summary(wall_time)}")
+
+
+def get_num_prepare_workers() -> int:
+    # all processes on the node prepare batches at the same time in multi-GPU caching
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", "1"))
+    return max(1, min(8, (os.cpu_count() or 1) // max(1, local_world_size)))
@@ -106,6 +106,9 @@ class BaseDatasetParams:
     debug_dataset: bool = False
     validation_seed: Optional[int] = None
     validation_split: float = 0.0
+    image_size_index_file: Optional[str] = None
+    dataset_manifest_file: Optional[str] = None
+    bucket_batch_scheduler: str = "default"
 
 
 @dataclass
@@ -241,6 +244,9 @@ class ConfigSanitizer:
         "validation_split": float,
         "resolution": functools.partial(__validate_and_convert_scalar_or_twodim.__func__, int),
         "network_multiplier": float,
+        "image_size_index_file": str,
+        "dataset_manifest_file": str,
+        "bucket_batch_scheduler": str,
     }
 
     # options handled by argparse but not handled by user config
@@ -0,0 +1,298 @@
+# content-addressed latents cache shared across datasets and runs
+# 画像の内容をキーとする、データセットや学習をまたいで共有されるlatentsキャッシュ
+#
+# layout of the cache directory:
+#   content_hashes.json        : image path -> [mtime_ns, file size, content hash], to avoid hashing unchanged images again
+#   <xx>/<digest><suffix>      : cache file, e.g. 3f/3fa4...e1_sdxl.npz
+#
+# the digest is a hash of the image content, image size, bucket resolution, resized size (which decide the crop),
+# flip_aug, alpha_mask, the suffix of the strategy and the identity of the VAE. so the same image in different subsets,
+# reg folders or datasets is encoded only once, and moving or renaming a dataset does not invalidate the cache.
+# the identity of a model is the path, size and mtime of its checkpoint file if the loader records it, so the weights
+# are hashed only for the models without the file, e.g. loaded from Diffusers or modified after loading.
+#
+# the size of the cache directory can be bounded: least recently used files are removed after caching.
+# hits update mtime of the files, so mtime is used as the last used time.
+#
+# the text encoder outputs cache is keyed by the caption instead of the image: the digest is a hash of the normalized
+# caption, the identity of the text encoders, the shape of the tokens and the options of the strategy. images with the
+# same caption (class images, reg sets, tag-only captions) share one file, so the time to encode and the size of the
+# cache scale with the number of unique captions.
+
+import glob
+import hashlib
+import json
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import torch
+from tqdm import tqdm
+
+from library.image_size_index import get_max_workers_for_io
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+HASH_INDEX_FILE_NAME = "content_hashes.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+MODEL_SOURCE_ATTR = "_content_cache_model_source"
+
+
+def set_model_source(model: Optional[torch.nn.Module], path: Optional[str]):
+    r"""
+    record the checkpoint file which the weights of model are loaded from, so get_model_identity doesn't hash the
+    weights. call with None if the weights are modified after loading, e.g. by merging networks.
+    """
+    if model is not None:
+        setattr(model, MODEL_SOURCE_ATTR, os.path.abspath(path) if path is not None else None)
+
+
+def get_model_source_identity(model: torch.nn.Module) -> Optional[str]:
+    r"""
+    hash of the path, size and mtime of the checkpoint file of the model, and the names, shapes and dtypes of the
+    parameters and buffers. None if the checkpoint file is not recorded or doesn't exist.
+    """
+    path = getattr(model, MODEL_SOURCE_ATTR, None)
+    if path is None or not os.path.isfile(path):
+        return None
+    st = os.stat(path)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{path}|{st.st_size}|{st.st_mtime_ns};".encode("utf-8"))
+    for name, tensor in sorted(model.state_dict().items()):
+        h.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype};".encode("utf-8"))  # dtype changes the outputs
+    return h.hexdigest()
+
+
+def get_model_identity(model: torch.nn.Module) -> str:
+    r"""
+    identity of the checkpoint file of the model if it is recorded by set_model_source, otherwise hash of the names,
+    shapes, dtypes and values of the parameters and buffers of the model.
+    """
+    source_identity = get_model_source_identity(model)
+    if source_identity is not None:
+        return source_identity
+
+    h = hashlib.blake2b(digest_size=16)
+    with torch.no_grad():
+        for name, tensor in sorted(model.state_dict().items()):
+            h.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype};".encode("utf-8"))
+            data = tensor.detach().to("cpu").contiguous().reshape(-1)
+            h.update(data.view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+class ContentAddressedLatentsCache:
+    def __init__(self, cache_dir: str, max_size: Optional[int] = None) -> None:
+        r"""
+        max_size: max total size of the cache files in bytes, None for unlimited
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._index_path = os.path.join(cache_dir, HASH_INDEX_FILE_NAME)
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}  # abs path -> (mtime_ns, file size, content hash)
+        self._hashes_dirty = False
+        self._load_hashes(self._hashes)
+
+        self._model_identity: Optional[str] = None
+        self._model_ref: Optional[weakref.ref] = None  # the model of _model_identity
+
+    # region content hashes
+
+    def _load_hashes(self, hashes: dict):
+        if not os.path.isfile(self._index_path):
+            return
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                for path, entry in json.load(f).items():
+                    hashes[path] = tuple(entry)
+        except (OSError, ValueError) as e:
+            logger.warning(f"failed to load content hashes, ignored / 画像のハッシュの読み込みに失敗したため無視します: {e}")
+
+    def _save_hashes(self):
+        if not self._hashes_dirty:
+            return
+        hashes = {}
+        self._load_hashes(hashes)  # merge entries written by other processes
+        hashes.update(self._hashes)
+
+        tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({path: list(entry) for path, entry in hashes.items()}, f, ensure_ascii=False)
+        os.replace(tmp_path, self._index_path)
+        self._hashes = hashes
+        self._hashes_dirty = False
+
+    def get_content_hash(self, image_path: str) -> str:
+        key = os.path.abspath(image_path)
+        st = os.stat(image_path)
+        entry = self._hashes.get(key)
+        if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+
+        content_hash = hash_file(image_path)
+        self._hashes[key] = (st.st_mtime_ns, st.st_size, content_hash)
+        self._hashes_dirty = True
+        return content_hash
+
+    def prepare_content_hashes(self, image_paths: List[str]):
+        r"""
+        hash images which are new or changed since the last run in parallel, and save the hashes.
+        """
+        if len(image_paths) == 0:
+            return
+        logger.info("hashing image contents for latents cache / latentsキャッシュのために画像の内容をハッシュしています")
+        with ThreadPoolExecutor(get_max_workers_for_io(len(image_paths))) as executor:
+            for _ in tqdm(executor.map(self.get_content_hash, image_paths), total=len(image_paths)):
+                pass
+        self._save_hashes()
+
+    # endregion
+
+    def set_model(self, model: torch.nn.Module):
+        if self._model_ref is None or self._model_ref() is not model:
+            self._model_identity = get_model_identity(model)
+            self._model_ref = weakref.ref(model)
+            logger.info(f"model identity for latents cache / latentsキャッシュ用のモデルID: {self._model_identity}")
+
+    def get_latents_npz_path(
+        self,
+        image_path: str,
+        image_size: Tuple[int, int],
+        bucket_reso: Tuple[int, int],
+        resized_size: Tuple[int, int],
+        flip_aug: bool,
+        alpha_mask: bool,
+        suffix: str,
+    ) -> str:
+        assert self._model_identity is not None, "set_model must be called before / set_modelを先に呼び出す必要があります"
+        content_hash = self.get_content_hash(image_path)
+        key = (
+            f"{content_hash}|{self._model_identity}|{tuple(image_size)}|{tuple(bucket_reso)}|{tuple(resized_size)}"
+            + f"|{flip_aug}|{alpha_mask}|{suffix}"
+        )
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + suffix)
+
+    @staticmethod
+    def get_process_index(npz_path: str, num_processes: int) -> int:
+        r"""
+        the process to cache the file. same files are always cached by the same process, so they are not written
+        by multiple processes at the same time.
+        """
+        digest = os.path.basename(npz_path)[:8]
+        return int(digest, 16) % num_processes
+
+    def touch(self, npz_path: str):
+        # mark as recently used
+        try:
+            os.utime(npz_path)
+        except OSError:
+            pass  # e.g. in the sharded cache store or removed by another process
+
+    def evict(self, keep: Iterable[str] = ()):
+        r"""
+        remove least recently used files until the total size is within max_size. files in keep are never removed,
+        e.g. the files used by the current training.
+        """
+        if self.max_size is None:
+            return
+
+        keep: Set[str] = {os.path.abspath(path) for path in keep}
+        entries = []
+        total_size = 0
+        for path in glob.glob(os.path.join(glob.escape(self.cache_dir), "*", "*.npz")):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, path))
+            total_size += st.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        num_removed = 0
+        removed_size = 0
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if os.path.abspath(path) in keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            removed_size += size
+            num_removed += 1
+
+        logger.info(
+            f"removed {num_removed} least recently used files ({removed_size / 1024**2:.1f}MB) from latents cache"
+            + f" / latentsキャッシュから最近使われていないファイルを{num_removed}個（{removed_size / 1024**2:.1f}MB）削除しました"
+        )
+        if total_size > self.max_size:
+            logger.warning(
+                f"latents cache is larger than the max size, because the current training uses {total_size / 1024**2:.1f}MB"
+                + f" / 現在の学習で{total_size / 1024**2:.1f}MBを使用するため、latentsキャッシュが最大サイズを超えています"
+            )
+
+
+def normalize_caption(caption: str) -> str:
+    # tokenizers of CLIP and T5 ignore the leading, trailing and repeated whitespaces
+    return " ".join(caption.split())
+
+
+class ContentAddressedTextEncoderOutputsCache:
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._models_identity: Optional[str] = None
+        self._model_refs: Optional[List[Optional[weakref.ref]]] = None  # the models of _models_identity
+
+    def set_models(self, models: List[Optional[torch.nn.Module]]):
+        refs = self._model_refs
+        if refs is not None and len(refs) == len(models) and all(
+            (ref is None and model is None) or (ref is not None and ref() is model) for ref, model in zip(refs, models)
+        ):
+            return
+
+        h = hashlib.blake2b(digest_size=16)
+        for model in models:
+            h.update((get_model_identity(model) if model is not None else "None").encode("utf-8"))
+        self._models_identity = h.hexdigest()
+        self._model_refs = [weakref.ref(model) if model is not None else None for model in models]
+        logger.info(f"text encoders identity for outputs cache / text encoder出力キャッシュ用のモデルID: {self._models_identity}")
+
+    def get_outputs_npz_path(self, caption: str, tokens_shape: str, cache_params: str, suffix: str) -> str:
+        r"""
+        tokens_shape: shapes of the tokens, which depend on the max length of the tokenizers
+        cache_params: options of the strategy which change the outputs
+        """
+        assert self._models_identity is not None, "set_models must be called before / set_modelsを先に呼び出す必要があります"
+        key = f"{normalize_caption(caption)}|{self._models_identity}|{tokens_shape}|{cache_params}|{suffix}"
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + suffix)
+
+    get_process_index = staticmethod(ContentAddressedLatentsCache.get_process_index)
@@ -1,10 +1,24 @@
 from concurrent.futures import ThreadPoolExecutor
+import atexit
+import collections
+import contextlib
+import json
+import math
+import mmap
+import os
+import threading
 import time
-from typing import Optional
+from typing import Dict, Iterable, Optional
 import torch
 import torch.nn as nn
 
 from library.device_utils import clean_memory_on_device
+from library.utils import MemoryEfficientSafeOpen, mem_eff_save_file, setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def synchronize_device(device: torch.device):
@@ -71,18 +85,65 @@ def swap_weight_devices_no_cuda(device: torch.device, layer_to_cpu: nn.Module, l
         if hasattr(module_to_cpu, "weight") and module_to_cpu.weight is not None:
             weight_swap_jobs.append((module_to_cpu, module_to_cuda, module_to_cpu.weight.data, module_to_cuda.weight.data))
 
-    # device to cpu
+    # device to cpu. copy=True: the device may be CPU, the data must not be shared with the block to the device
     for module_to_cpu, module_to_cuda, cuda_data_view, cpu_data_view in weight_swap_jobs:
-        module_to_cpu.weight.data = cuda_data_view.data.to("cpu", non_blocking=True)
+        module_to_cpu.weight.data = cuda_data_view.data.to("cpu", non_blocking=True, copy=True)
 
-    synchronize_device()
+    synchronize_device(device)
 
     # cpu to device
     for module_to_cpu, module_to_cuda, cuda_data_view, cpu_data_view in weight_swap_jobs:
         cuda_data_view.copy_(module_to_cuda.weight.data, non_blocking=True)
         module_to_cuda.weight.data = cuda_data_view
 
-    synchronize_device()
+    synchronize_device(device)
+
+
+def swap_weight_devices_disk(
+    device: torch.device,
+    store: "DiskBlockStore",
+    block_idx_to_cpu: int,
+    layer_to_cpu: nn.Module,
+    block_idx_to_cuda: int,
+    layer_to_cuda: nn.Module,
+):
+    r"""
+    swap weights with the disk tier: the weights of layer_to_cpu are written back to the mapping (if they may have
+    been changed by training) and become views of it, and the weights of layer_to_cuda are paged in from the mapping
+    to the device memory released by layer_to_cpu.
+    """
+    assert layer_to_cpu.__class__ == layer_to_cuda.__class__
+
+    weight_swap_jobs = []
+    modules_to_cpu = {k: v for k, v in layer_to_cpu.named_modules()}
+    for module_to_cuda_name, module_to_cuda in layer_to_cuda.named_modules():
+        if hasattr(module_to_cuda, "weight") and module_to_cuda.weight is not None:
+            module_to_cpu = modules_to_cpu.get(module_to_cuda_name, None)
+            if (
+                module_to_cpu is not None
+                and module_to_cpu.weight.shape == module_to_cuda.weight.shape
+                and module_to_cpu.weight.dtype == module_to_cuda.weight.dtype
+            ):
+                weight_swap_jobs.append((module_to_cuda_name, module_to_cpu, module_to_cuda, module_to_cpu.weight.data))
+            elif module_to_cuda.weight.data.device.type != device.type:
+                module_to_cuda.weight.data = module_to_cuda.weight.data.to(device)
+
+    synchronize_device(device)
+
+    for name, module_to_cpu, module_to_cuda, device_data in weight_swap_jobs:
+        # device to disk
+        is_stored = device_data.data_ptr() == store.get_weight(block_idx_to_cpu, name).data_ptr()
+        store.swap_out_weight(block_idx_to_cpu, name, module_to_cpu.weight)
+
+        # disk to device, page faults are handled in this thread
+        if is_stored:
+            # the weight was not on the device, e.g. on CPU device before the first swap. do not overwrite the mapping
+            device_data = store.get_weight(block_idx_to_cuda, name).to(device, copy=True)
+        else:
+            device_data.copy_(store.get_weight(block_idx_to_cuda, name))
+        module_to_cuda.weight.data = device_data
+
+    synchronize_device(device)
 
 
 def weighs_to_device(layer: nn.Module, device: torch.device):
@@ -91,61 +152,399 @@ def weighs_to_device(layer: nn.Module, device: torch.device):
             module.weight.data = module.weight.data.to(device, non_blocking=True)
 
 
+class DiskBlockStore:
+    r"""
+    disk tier of block swapping: the weights of blocks are stored in a safetensors file mapped with a shared mapping.
+    the weights of blocks not on the device are views of the mapping, so the OS can evict the pages under memory
+    pressure instead of keeping them in CPU RAM, and reads them from the file on the next use.
+    """
+
+    def __init__(self, blocks: Dict[int, nn.Module], path: str):
+        self.path = path
+
+        tensors = []
+        for block_idx, block in blocks.items():
+            for name, module in block.named_modules():
+                if hasattr(module, "weight") and module.weight is not None:
+                    tensors.append((f"{block_idx}.{name}", module.weight.data))
+        mem_eff_save_file(tensors, path)
+        del tensors
+
+        with MemoryEfficientSafeOpen(path) as f:
+            header, header_size = f.header, f.header_size
+        with open(path, "r+b") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0)  # shared and writable, the file descriptor is duplicated
+
+        self.weights: Dict[int, Dict[str, torch.Tensor]] = {}
+        self.block_ranges: Dict[int, tuple[int, int]] = {}  # range of the data of each block in the file
+        for key, metadata in header.items():
+            if key == "__metadata__":
+                continue
+            block_idx, name = key.split(".", 1)
+            block_idx = int(block_idx)
+            dtype = MemoryEfficientSafeOpen._get_torch_dtype(metadata["dtype"])
+            start, end = [header_size + 8 + offset for offset in metadata["data_offsets"]]
+            if start == end:
+                weight = torch.empty(metadata["shape"], dtype=dtype)
+            else:
+                weight = torch.frombuffer(self.mmap, dtype=torch.uint8, count=end - start, offset=start)
+                weight = weight.view(dtype).reshape(metadata["shape"])
+            self.weights.setdefault(block_idx, {})[name] = weight
+
+            range_start, range_end = self.block_ranges.get(block_idx, (start, end))
+            self.block_ranges[block_idx] = (min(range_start, start), max(range_end, end))
+
+        # the file is not needed after mapping on POSIX. on Windows, it is removed at exit
+        try:
+            os.remove(path)
+        except OSError:
+            atexit.register(self._remove_file)
+
+    def _remove_file(self):
+        self.mmap = None
+        self.weights = {}
+        with contextlib.suppress(OSError):
+            os.remove(self.path)
+
+    def get_weight(self, block_idx: int, name: str) -> torch.Tensor:
+        return self.weights[block_idx][name]
+
+    def swap_out_weight(self, block_idx: int, name: str, weight: nn.Parameter):
+        r"""
+        make the weight a view of the mapping. trainable weights are written back, frozen weights are not changed
+        since they were read from the mapping, so they are just dropped.
+        """
+        stored = self.weights[block_idx][name]
+        if weight.data.data_ptr() == stored.data_ptr():
+            return
+        if weight.requires_grad:
+            stored.copy_(weight.data)
+        weight.data = stored
+
+    def swap_in_block(self, block_idx: int, block: nn.Module, device: torch.device):
+        r"""
+        copy the weights which are views of the mapping to the device, even if the device is CPU.
+        """
+        for name, module in block.named_modules():
+            stored = self.weights.get(block_idx, {}).get(name, None)
+            if stored is not None and module.weight.data.data_ptr() == stored.data_ptr():
+                module.weight.data = stored.to(device, copy=True)
+
+    def swap_out_block(self, block_idx: int, block: nn.Module):
+        for name, module in block.named_modules():
+            if hasattr(module, "weight") and module.weight is not None and name in self.weights.get(block_idx, {}):
+                self.swap_out_weight(block_idx, name, module.weight)
+
+    def prefetch(self, block_indices: Iterable[int]):
+        r"""
+        ask the OS to read the pages of the blocks ahead of use, asynchronously.
+        """
+        if not hasattr(mmap, "MADV_WILLNEED") or self.mmap is None:
+            return  # e.g. Windows
+        for block_idx in block_indices:
+            if block_idx not in self.block_ranges:
+                continue
+            start, end = self.block_ranges[block_idx]
+            aligned_start = start - start % mmap.PAGESIZE
+            self.mmap.madvise(mmap.MADV_WILLNEED, aligned_start, end - aligned_start)
+
+
+class PrefetchScheduler:
+    r"""
+    schedules the block transfers of an Offloader.
+
+    the compute time of a block (from the wait for the block to the submission of the next swap) and the transfer time
+    of a swap are measured, and the number of transfers in flight is limited to ceil(transfer time / compute time),
+    between 1 and max_depth. this is the number of transfers needed to hide the transfer latency behind the compute
+    (Little's law): if the transfer takes longer than the compute, one transfer at a time can never catch up.
+    transfers are started in order of submission, so the block needed first is always moved first.
+
+    if record_timeline is True, compute, transfer and wait (stall) times are recorded, and can be exported in Chrome
+    trace event format, which can be viewed by chrome://tracing or https://ui.perfetto.dev.
+    """
+
+    EMA_DECAY = 0.8
+
+    def __init__(self, max_depth: int, device: torch.device, record_timeline: bool = False, max_timeline_events: int = 200000):
+        assert max_depth >= 1, "max prefetch depth must be 1 or more / 最大先読み数は1以上である必要があります"
+        self.max_depth = max_depth
+        self.depth = 1
+        self.use_cuda_events = device.type == "cuda"
+        self.compute_time: Optional[float] = None  # EMA of the compute time of a block
+        self.transfer_time: Optional[float] = None  # EMA of the transfer time of a swap
+        self.max_in_flight = 0
+
+        self._cond = threading.Condition()
+        self._num_tickets = 0
+        self._next_ticket = 0  # ticket of the next transfer to start
+        self._in_flight = 0
+
+        self._compute_start = None  # (host time, CUDA event or None)
+        self._pending_computes = collections.deque()  # computes on CUDA which may not be finished yet
+
+        self.timeline = collections.deque(maxlen=max_timeline_events) if record_timeline else None
+        self._origin = time.perf_counter()
+        self._worker_tids: Dict[int, int] = {}
+
+    # region transfers, called in the worker threads
+
+    def new_ticket(self) -> int:
+        with self._cond:
+            ticket = self._num_tickets
+            self._num_tickets += 1
+            return ticket
+
+    def acquire(self, ticket: int):
+        with self._cond:
+            self._cond.wait_for(lambda: ticket == self._next_ticket and self._in_flight < self.depth)
+            self._next_ticket += 1
+            self._in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+            self._cond.notify_all()  # the next transfer may start if depth allows
+
+    def release(self, name: str, start_time: float, end_time: float):
+        with self._cond:
+            self._in_flight -= 1
+            self.transfer_time = self._ema(self.transfer_time, end_time - start_time)
+            self._update_depth()
+            if self.timeline is not None:
+                tid = self._worker_tids.setdefault(threading.get_ident(), 2 + len(self._worker_tids))
+                self._add_event(name, "transfer", start_time, end_time, tid)
+            self._cond.notify_all()
+
+    # endregion
+
+    # region compute and wait, called in the training thread
+
+    def compute_started(self):
+        event = None
+        if self.use_cuda_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+        self._compute_start = (time.perf_counter(), event)
+
+    def compute_ended(self, block_idx: int):
+        if self._compute_start is None:
+            return
+        start_time, start_event = self._compute_start
+        self._compute_start = None
+
+        if start_event is None:
+            self._add_compute(block_idx, start_time, time.perf_counter() - start_time)
+            return
+
+        # the kernels are launched asynchronously, so measure the time on the GPU without synchronizing
+        end_event = torch.cuda.Event(enable_timing=True)
+        end_event.record()
+        self._pending_computes.append((block_idx, start_time, start_event, end_event))
+        while self._pending_computes and self._pending_computes[0][3].query():
+            block_idx, start_time, start_event, end_event = self._pending_computes.popleft()
+            self._add_compute(block_idx, start_time, start_event.elapsed_time(end_event) / 1000)
+
+    def _add_compute(self, block_idx: int, start_time: float, elapsed: float):
+        with self._cond:
+            self.compute_time = self._ema(self.compute_time, elapsed)
+            self._update_depth()
+            if self.timeline is not None:
+                # on CUDA, the start is the launch time on the host, so the event is aligned only approximately
+                self._add_event(f"block {block_idx}", "compute", start_time, start_time + elapsed, 0)
+            self._cond.notify_all()
+
+    def record_wait(self, block_idx: int, start_time: float, end_time: float):
+        if self.timeline is not None:
+            with self._cond:
+                self._add_event(f"wait {block_idx}", "wait", start_time, end_time, 1, in_flight=self._in_flight)
+
+    # endregion
+
+    def _ema(self, value: Optional[float], sample: float) -> float:
+        return sample if value is None else self.EMA_DECAY * value + (1 - self.EMA_DECAY) * sample
+
+    def _update_depth(self):
+        if self.compute_time is None or self.transfer_time is None:
+            return
+        depth = min(self.max_depth, max(1, math.ceil(self.transfer_time / max(self.compute_time, 1e-6))))
+        if depth != self.depth:
+            self.depth = depth
+            if self.timeline is not None:
+                self.timeline.append(
+                    {"name": "prefetch depth", "ph": "C", "ts": self._to_us(time.perf_counter()), "pid": 0, "args": {"depth": depth}}
+                )
+
+    def _to_us(self, t: float) -> float:
+        return (t - self._origin) * 1e6
+
+    def _add_event(self, name: str, category: str, start_time: float, end_time: float, tid: int, **args):
+        event = {"name": name, "cat": category, "ph": "X", "ts": self._to_us(start_time), "dur": (end_time - start_time) * 1e6}
+        event.update({"pid": 0, "tid": tid})
+        if args:
+            event["args"] = args
+        self.timeline.append(event)
+
+    def export_timeline(self, path: str, name: str = "block swap"):
+        r"""
+        write the timeline in Chrome trace event format. tid 0: compute, 1: wait (stall), 2 or more: transfer workers.
+        """
+        with self._cond:
+            events = list(self.timeline) if self.timeline is not None else []
+            thread_names = {0: "compute", 1: "wait"}
+            thread_names.update({tid: f"transfer {tid - 2}" for tid in self._worker_tids.values()})
+        metadata = [{"name": "process_name", "ph": "M", "pid": 0, "args": {"name": name}}]
+        metadata += [{"name": "thread_name", "ph": "M", "pid": 0, "tid": tid, "args": {"name": n}} for tid, n in thread_names.items()]
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+        os.replace(tmp_path, path)
+
+
+def get_timeline_path(path: Optional[str], suffix: str) -> Optional[str]:
+    r"""
+    path of the timeline of one of the offloaders of a model, e.g. "timeline.json" -> "timeline_double.json".
+    """
+    if path is None:
+        return None
+    base, ext = os.path.splitext(path)
+    return f"{base}_{suffix}{ext or '.json'}"
+
+
 class Offloader:
     """
     common offloading class
     """
 
-    def __init__(self, num_blocks: int, blocks_to_swap: int, device: torch.device, debug: bool = False):
+    def __init__(
+        self,
+        num_blocks: int,
+        blocks_to_swap: int,
+        device: torch.device,
+        debug: bool = False,
+        max_prefetch_depth: int = 1,
+        timeline_path: Optional[str] = None,
+        stats_interval: int = 100,
+    ):
+        r"""
+        max_prefetch_depth: max number of block transfers in flight. the number is adjusted by the measured compute and
+            transfer times, see PrefetchScheduler. 1 moves one block at a time.
+        timeline_path: if specified, the timeline of the compute, transfer and wait times is recorded and written to this
+            file in Chrome trace event format at exit, not to slow down the training. call export_timeline to write it earlier.
+        stats_interval: the swap stats are logged and reset every this number of forwards, or every forward with debug.
+        """
         self.num_blocks = num_blocks
         self.blocks_to_swap = blocks_to_swap
         self.device = device
         self.debug = debug
+        self.timeline_path = timeline_path
+        self.stats_interval = stats_interval
 
-        self.thread_pool = ThreadPoolExecutor(max_workers=1)
+        self.thread_pool = ThreadPoolExecutor(max_workers=max_prefetch_depth)
         self.futures = {}
         self.cuda_available = device.type == "cuda"
-
-    def swap_weight_devices(self, block_to_cpu: nn.Module, block_to_cuda: nn.Module):
-        if self.cuda_available:
+        self.disk_store: Optional[DiskBlockStore] = None
+        self.scheduler = PrefetchScheduler(max_prefetch_depth, device, record_timeline=timeline_path is not None)
+        self._stats_lock = threading.Lock()
+        if timeline_path is not None:
+            atexit.register(self._export_timeline_at_exit)
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_forwards = 0
+        self.num_moves = 0
+        self.move_time = 0.0  # time of moving blocks in the worker thread
+        self.num_waits = 0
+        self.stall_time = 0.0  # time the compute waited for the blocks
+        self.max_stall_time = 0.0
+
+    def get_stats_summary(self) -> str:
+        summary = (
+            f"{self.num_forwards} forwards, moved {self.num_moves} times in {self.move_time:.2f}s,"
+            + f" stalled {self.stall_time:.2f}s in {self.num_waits} waits"
+            + f" (max {self.max_stall_time * 1000:.1f}ms)"
+        )
+        scheduler = self.scheduler
+        if scheduler.compute_time is not None and scheduler.transfer_time is not None:
+            summary += (
+                f", compute {scheduler.compute_time * 1000:.1f}ms/block, transfer {scheduler.transfer_time * 1000:.1f}ms/swap"
+                + f", prefetch depth {scheduler.depth}/{scheduler.max_depth}"
+            )
+        return summary
+
+    def export_timeline(self, path: Optional[str] = None):
+        path = path or self.timeline_path
+        if path is not None:
+            self.scheduler.export_timeline(path)
+
+    def _export_timeline_at_exit(self):
+        try:
+            self.export_timeline()
+            logger.info(f"Block swap timeline is written to {self.timeline_path}")
+        except OSError as e:
+            logger.warning(f"failed to write block swap timeline / ブロックスワップのタイムラインの書き込みに失敗しました: {e}")
+
+    def swap_weight_devices(self, block_to_cpu: nn.Module, block_to_cuda: nn.Module, block_idx_to_cpu: int, block_idx_to_cuda: int):
+        if self.disk_store is not None:
+            swap_weight_devices_disk(self.device, self.disk_store, block_idx_to_cpu, block_to_cpu, block_idx_to_cuda, block_to_cuda)
+        elif self.cuda_available:
             swap_weight_devices_cuda(self.device, block_to_cpu, block_to_cuda)
         else:
             swap_weight_devices_no_cuda(self.device, block_to_cpu, block_to_cuda)
 
-    def _submit_move_blocks(self, blocks, block_idx_to_cpu, block_idx_to_cuda):
-        def move_blocks(bidx_to_cpu, block_to_cpu, bidx_to_cuda, block_to_cuda):
-            if self.debug:
+    def _submit_move_blocks(self, blocks, block_idx_to_cpu, block_idx_to_cuda, prefetch_block_indices: Iterable[int] = ()):
+        def move_blocks(ticket, bidx_to_cpu, block_to_cpu, bidx_to_cuda, block_to_cuda):
+            self.scheduler.acquire(ticket)  # wait for the transfers before this one, up to the prefetch depth
+            start_time = time.perf_counter()
+            try:
+                # wait for the compute of block_to_cpu here, not to include it in the transfer time
+                synchronize_device(self.device)
                 start_time = time.perf_counter()
-                print(f"Move block {bidx_to_cpu} to CPU and block {bidx_to_cuda} to {'CUDA' if self.cuda_available else 'device'}")
-
-            self.swap_weight_devices(block_to_cpu, block_to_cuda)
-
+                if self.debug:
+                    print(f"Move block {bidx_to_cpu} to CPU and block {bidx_to_cuda} to {'CUDA' if self.cuda_available else 'device'}")
+
+                self.swap_weight_devices(block_to_cpu, block_to_cuda, bidx_to_cpu, bidx_to_cuda)
+                if self.disk_store is not None:
+                    self.disk_store.prefetch(prefetch_block_indices)
+            finally:
+                end_time = time.perf_counter()
+                self.scheduler.release(f"{bidx_to_cpu} <-> {bidx_to_cuda}", start_time, end_time)
+
+            with self._stats_lock:
+                self.num_moves += 1
+                self.move_time += end_time - start_time
             if self.debug:
-                print(f"Moved blocks {bidx_to_cpu} and {bidx_to_cuda} in {time.perf_counter()-start_time:.2f}s")
+                print(f"Moved blocks {bidx_to_cpu} and {bidx_to_cuda} in {end_time-start_time:.2f}s")
             return bidx_to_cpu, bidx_to_cuda  # , event
 
         block_to_cpu = blocks[block_idx_to_cpu]
         block_to_cuda = blocks[block_idx_to_cuda]
 
         self.futures[block_idx_to_cuda] = self.thread_pool.submit(
-            move_blocks, block_idx_to_cpu, block_to_cpu, block_idx_to_cuda, block_to_cuda
+            move_blocks, self.scheduler.new_ticket(), block_idx_to_cpu, block_to_cpu, block_idx_to_cuda, block_to_cuda
         )
 
     def _wait_blocks_move(self, block_idx):
         if block_idx not in self.futures:
+            self.scheduler.compute_started()
             return
 
         if self.debug:
             print(f"Wait for block {block_idx}")
-            start_time = time.perf_counter()
+        start_time = time.perf_counter()
 
         future = self.futures.pop(block_idx)
         _, bidx_to_cuda = future.result()
 
         assert block_idx == bidx_to_cuda, f"Block index mismatch: {block_idx} != {bidx_to_cuda}"
 
+        end_time = time.perf_counter()
+        stall_time = end_time - start_time
+        self.num_waits += 1
+        self.stall_time += stall_time
+        self.max_stall_time = max(self.max_stall_time, stall_time)
+        self.scheduler.record_wait(block_idx, start_time, end_time)
+        self.scheduler.compute_started()
         if self.debug:
-            print(f"Waited for block {block_idx}: {time.perf_counter()-start_time:.2f}s")
+            print(f"Waited for block {block_idx}: {stall_time:.2f}s")
 
 
 class ModelOffloader(Offloader):
@@ -153,8 +552,39 @@ class ModelOffloader(Offloader):
     supports forward offloading
     """
 
-    def __init__(self, blocks: list[nn.Module], num_blocks: int, blocks_to_swap: int, device: torch.device, debug: bool = False):
-        super().__init__(num_blocks, blocks_to_swap, device, debug)
+    def __init__(
+        self,
+        blocks: list[nn.Module],
+        num_blocks: int,
+        blocks_to_swap: int,
+        device: torch.device,
+        debug: bool = False,
+        disk_offload_dir: Optional[str] = None,
+        disk_prefetch_depth: int = 2,
+        max_prefetch_depth: int = 1,
+        timeline_path: Optional[str] = None,
+        stats_interval: int = 100,
+    ):
+        r"""
+        disk_offload_dir: if specified, the weights of the swapped blocks are backed by a memory-mapped file in
+            this directory instead of CPU RAM.
+        disk_prefetch_depth: number of blocks to read from the disk ahead of the next swap.
+        max_prefetch_depth, timeline_path, stats_interval: see Offloader.
+        """
+        super().__init__(num_blocks, blocks_to_swap, device, debug, max_prefetch_depth, timeline_path, stats_interval)
+        self.disk_prefetch_depth = disk_prefetch_depth
+
+        if disk_offload_dir is not None and blocks_to_swap:
+            # the blocks which are moved to CPU in forward or backward pass
+            swapped_indices = list(range(blocks_to_swap)) + list(range(num_blocks - blocks_to_swap, num_blocks))
+            os.makedirs(disk_offload_dir, exist_ok=True)
+            path = os.path.join(disk_offload_dir, f"block_swap_{os.getpid()}_{id(self):x}.safetensors")
+            print(f"Block swap: backing weights of {len(swapped_indices)} blocks by {path}")
+            self.disk_store = DiskBlockStore({i: blocks[i] for i in swapped_indices}, path)
+
+            # release CPU RAM of the weights. the blocks on the device are loaded from the mapping before forward
+            for i in swapped_indices:
+                self.disk_store.swap_out_block(i, blocks[i])
 
         # register backward hooks
         self.remove_handles = []
@@ -186,8 +616,11 @@ class ModelOffloader(Offloader):
             if self.debug:
                 print(f"Backward hook for block {block_index}")
 
+            self.scheduler.compute_ended(block_index)
             if swapping:
-                self._submit_move_blocks(blocks, block_idx_to_cpu, block_idx_to_cuda)
+                # the blocks to the device in the next hooks: block_idx_to_cuda - 1, - 2, ...
+                prefetch_block_indices = range(block_idx_to_cuda - 1, max(block_idx_to_cuda - 1 - self.disk_prefetch_depth, -1), -1)
+                self._submit_move_blocks(blocks, block_idx_to_cpu, block_idx_to_cuda, prefetch_block_indices)
             if waiting:
                 self._wait_blocks_move(block_idx_to_wait)
             return None
@@ -200,14 +633,32 @@ class ModelOffloader(Offloader):
 
         if self.debug:
             print("Prepare block devices before forward")
-
-        for b in blocks[0 : self.num_blocks - self.blocks_to_swap]:
+        if self.num_forwards > 0 and (self.debug or self.num_forwards >= self.stats_interval):
+            # the stats of the forwards (and backwards) since the last report
+            if self.num_waits > 0:
+                logger.info(f"Block swap stats: {self.get_stats_summary()}")
+            self.reset_stats()
+        self.num_forwards += 1
+
+        for i, b in enumerate(blocks[0 : self.num_blocks - self.blocks_to_swap]):
             b.to(self.device)
             weighs_to_device(b, self.device)  # make sure weights are on device
-
-        for b in blocks[self.num_blocks - self.blocks_to_swap :]:
-            b.to(self.device)  # move block to device first
-            weighs_to_device(b, "cpu")  # make sure weights are on cpu
+            if self.disk_store is not None:
+                self.disk_store.swap_in_block(i, b, self.device)  # for CPU device
+
+        for i, b in enumerate(blocks[self.num_blocks - self.blocks_to_swap :], self.num_blocks - self.blocks_to_swap):
+            if self.disk_store is not None:
+                # move other parameters and buffers to device without reading the weights from the disk
+                weights = [(m, m.weight.data) for m in b.modules() if hasattr(m, "weight") and m.weight is not None]
+                for m, weight in weights:
+                    m.weight.data = torch.empty(0, dtype=weight.dtype, device=self.device)
+                b.to(self.device)
+                for m, weight in weights:
+                    m.weight.data = weight
+                self.disk_store.swap_out_block(i, b)  # make sure weights are on disk
+            else:
+                b.to(self.device)  # move block to device first
+                weighs_to_device(b, "cpu")  # make sure weights are on cpu
 
         synchronize_device(self.device)
         clean_memory_on_device(self.device)
@@ -220,8 +671,11 @@ class ModelOffloader(Offloader):
     def submit_move_blocks(self, blocks: list[nn.Module], block_idx: int):
         if self.blocks_to_swap is None or self.blocks_to_swap == 0:
             return
+        self.scheduler.compute_ended(block_idx)
         if block_idx >= self.blocks_to_swap:
             return
         block_idx_to_cpu = block_idx
         block_idx_to_cuda = self.num_blocks - self.blocks_to_swap + block_idx
-        self._submit_move_blocks(blocks, block_idx_to_cpu, block_idx_to_cuda)
+        # the blocks to the device in the next calls: block_idx_to_cuda + 1, + 2, ...
+        prefetch_block_indices = range(block_idx_to_cuda + 1, min(block_idx_to_cuda + 1 + self.disk_prefetch_depth, self.num_blocks))
+        self._submit_move_blocks(blocks, block_idx_to_cpu, block_idx_to_cuda, prefetch_block_indices)
@@ -0,0 +1,264 @@
+# persistent dataset manifest to skip re-scanning directories and re-validating caches at startup
+# データセットのマニフェスト：起動時のディレクトリ走査とキャッシュ検証を省略する
+#
+# the manifest is a JSON file with these sections, all keyed by absolute path:
+#   dirs:           image directory -> {"mtime_ns", "images": [file names]}
+#   images:         image -> {"mtime_ns", "file_size", "size": [w, h], "bucket": [w, h] or None}
+#   captions:       image -> {"ext", "wildcard", "path": caption file or None, "mtime_ns", "caption"}
+#   latents_cache:  npz -> {"mtime_ns", "file_size", "valid": [condition keys validated for the file]}
+#   metadata_files: fine tuning metadata -> {"mtime_ns", "image_dir", "image_dir_mtime_ns", "images": {image key: [path, npz, npz_flip]}}
+#
+# every entry is validated with os.stat (mtime and file size), so files are not opened for unchanged entries.
+# adding or removing files changes the mtime of the directory, so unchanged directories are not globbed again.
+# the files are stat'ed one by one deliberately: editing a file in place doesn't change the mtime of the directory,
+# so the entries under an unchanged directory can't be trusted without stat. only missing captions are trusted by the
+# mtime of the directory, because adding a caption file changes it.
+#
+# only the entries added or changed in this run are written, merged with the file saved by other processes (ranks),
+# so an unchanged dataset doesn't rewrite the manifest and the entries of other processes are not overwritten.
+
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _stat(path: str) -> Optional[os.stat_result]:
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def _is_same_file_entry(entry: dict, other: dict) -> bool:
+    return entry["mtime_ns"] == other["mtime_ns"] and entry["file_size"] == other["file_size"]
+
+
+class DatasetManifest:
+    VERSION = 1
+    SECTIONS = ["dirs", "images", "captions", "latents_cache", "metadata_files"]
+
+    def __init__(self, manifest_path: str) -> None:
+        self.manifest_path = manifest_path
+        self._data: Dict[str, dict] = {section: {} for section in self.SECTIONS}
+        self._load(self._data)
+        self._changed: Dict[str, set] = {section: set() for section in self.SECTIONS}  # keys to write in save
+
+        self._dir_stats: Dict[str, os.stat_result] = {}  # stat of directories taken before globbing
+        self._unchanged_dirs = set()
+        self._validated_images = set()  # images whose entries are confirmed in this run
+
+    def _load(self, data: Dict[str, dict]):
+        if not os.path.isfile(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                loaded = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"failed to load dataset manifest, ignored / データセットのマニフェストの読み込みに失敗したため無視します: {e}")
+            return
+        if loaded.get("version") != self.VERSION:
+            logger.warning(f"dataset manifest version mismatch, ignored / データセットのマニフェストのバージョンが異なるため無視します")
+            return
+        for section in self.SECTIONS:
+            data[section].update(loaded.get(section, {}))
+
+    def save(self):
+        r"""
+        save the manifest atomically. entries written by other processes (e.g. other ranks) after loading are merged.
+        """
+        if not any(self._changed.values()):
+            return
+
+        data = {section: {} for section in self.SECTIONS}
+        self._load(data)
+        for section in self.SECTIONS:
+            for key in self._changed[section]:
+                entry = self._data[section][key]
+                saved_entry = data[section].get(key)
+                if section == "latents_cache" and saved_entry is not None and _is_same_file_entry(saved_entry, entry):
+                    # other processes may validate the same file for other conditions
+                    entry = {**entry, "valid": list(dict.fromkeys(saved_entry["valid"] + entry["valid"]))}
+                data[section][key] = entry
+
+        dirname = os.path.dirname(self.manifest_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": self.VERSION, **data}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+        self._data = data
+        self._changed = {section: set() for section in self.SECTIONS}
+        logger.info(f"dataset manifest saved / データセットのマニフェストを保存しました: {self.manifest_path}")
+
+    def _set_entry(self, section: str, key: str, entry: dict):
+        if self._data[section].get(key) == entry:
+            return  # unchanged, not to rewrite the manifest
+        self._data[section][key] = entry
+        self._changed[section].add(key)
+
+    # region directories
+
+    def get_image_paths(self, image_dir: str) -> Optional[List[str]]:
+        r"""
+        returns image paths in the directory if the directory is unchanged, otherwise None and the caller should glob it.
+        """
+        key = os.path.abspath(image_dir)
+        st = _stat(image_dir)
+        if st is None:
+            return None
+        self._dir_stats[key] = st
+
+        entry = self._data["dirs"].get(key)
+        if entry is None or entry["mtime_ns"] != st.st_mtime_ns:
+            return None
+        self._unchanged_dirs.add(key)
+        return [os.path.join(image_dir, name) for name in entry["images"]]
+
+    def set_image_paths(self, image_dir: str, image_paths: List[str]):
+        key = os.path.abspath(image_dir)
+        st = self._dir_stats.get(key) or _stat(image_dir)  # stat before globbing, so files added while globbing are found next time
+        if st is None:
+            return
+        self._set_entry("dirs", key, {"mtime_ns": st.st_mtime_ns, "images": [os.path.basename(path) for path in image_paths]})
+
+    # endregion
+
+    # region images
+
+    def get_image_size(self, image_path: str) -> Optional[Tuple[int, int]]:
+        key = os.path.abspath(image_path)
+        entry = self._data["images"].get(key)
+        if entry is None or entry.get("size") is None:
+            return None
+        st = _stat(image_path)
+        if st is None or entry["mtime_ns"] != st.st_mtime_ns or entry["file_size"] != st.st_size:
+            return None
+        self._validated_images.add(key)
+        return tuple(entry["size"])
+
+    def set_image_info(self, image_path: str, image_size: Tuple[int, int], bucket_reso: Optional[Tuple[int, int]]):
+        key = os.path.abspath(image_path)
+        size = list(image_size)
+        bucket = list(bucket_reso) if bucket_reso is not None else None
+
+        entry = self._data["images"].get(key)
+        if key in self._validated_images and entry["size"] == size and entry.get("bucket") == bucket:
+            return  # unchanged
+
+        st = _stat(image_path)
+        if st is None or image_size[0] <= 0 or image_size[1] <= 0:
+            return
+        self._set_entry("images", key, {"mtime_ns": st.st_mtime_ns, "file_size": st.st_size, "size": size, "bucket": bucket})
+        self._validated_images.add(key)
+
+    # endregion
+
+    # region captions
+
+    def get_caption(self, image_path: str, caption_extension: str, enable_wildcard: bool) -> Tuple[bool, Optional[str]]:
+        r"""
+        returns (found, caption). caption is None if the image has no caption file.
+        """
+        key = os.path.abspath(image_path)
+        entry = self._data["captions"].get(key)
+        if entry is None or entry["ext"] != caption_extension or entry["wildcard"] != enable_wildcard:
+            return False, None
+
+        if entry["path"] is None:
+            # a new caption file changes the mtime of the directory
+            return os.path.dirname(key) in self._unchanged_dirs, None
+
+        st = _stat(entry["path"])
+        if st is None or st.st_mtime_ns != entry["mtime_ns"]:
+            return False, None
+        return True, entry["caption"]
+
+    def set_caption(
+        self, image_path: str, caption_extension: str, enable_wildcard: bool, caption_path: Optional[str], caption: Optional[str]
+    ):
+        mtime_ns = None
+        if caption_path is not None:
+            st = _stat(caption_path)
+            if st is None:
+                return
+            mtime_ns = st.st_mtime_ns
+            caption_path = os.path.abspath(caption_path)
+
+        entry = {"ext": caption_extension, "wildcard": enable_wildcard, "path": caption_path, "mtime_ns": mtime_ns, "caption": caption}
+        self._set_entry("captions", os.path.abspath(image_path), entry)
+
+    # endregion
+
+    # region latents cache
+
+    def is_latents_cache_valid(self, npz_path: str, condition_key: str) -> bool:
+        entry = self._data["latents_cache"].get(os.path.abspath(npz_path))
+        if entry is None or condition_key not in entry["valid"]:
+            return False
+        st = _stat(npz_path)
+        return st is not None and st.st_mtime_ns == entry["mtime_ns"] and st.st_size == entry["file_size"]
+
+    def set_latents_cache_valid(self, npz_path: str, condition_key: str):
+        st = _stat(npz_path)
+        if st is None:
+            return  # not a file, e.g. in the sharded cache store
+
+        key = os.path.abspath(npz_path)
+        entry = {"mtime_ns": st.st_mtime_ns, "file_size": st.st_size, "valid": [condition_key]}
+        old_entry = self._data["latents_cache"].get(key)
+        if old_entry is not None and _is_same_file_entry(old_entry, entry):
+            if condition_key in old_entry["valid"]:
+                return  # unchanged
+            entry["valid"] = old_entry["valid"] + [condition_key]
+        self._set_entry("latents_cache", key, entry)
+
+    # endregion
+
+    # region fine tuning metadata
+
+    def _get_metadata_file_stats(self, metadata_file: str, image_dir: Optional[str]) -> Optional[Tuple[int, Optional[int]]]:
+        st = _stat(metadata_file)
+        if st is None:
+            return None
+        dir_st = _stat(image_dir) if image_dir is not None else None
+        return st.st_mtime_ns, dir_st.st_mtime_ns if dir_st is not None else None
+
+    def get_metadata_image_paths(
+        self, metadata_file: str, image_dir: Optional[str]
+    ) -> Optional[Dict[str, Tuple[str, Optional[str], Optional[str]]]]:
+        r"""
+        returns {image key: (image path, npz path, flipped npz path)} resolved in the previous run,
+        if both of the metadata file and the image directory are unchanged.
+        """
+        entry = self._data["metadata_files"].get(os.path.abspath(metadata_file))
+        if entry is None or entry["image_dir"] != image_dir:
+            return None
+        stats = self._get_metadata_file_stats(metadata_file, image_dir)
+        if stats is None or stats != (entry["mtime_ns"], entry["image_dir_mtime_ns"]):
+            return None
+        return {image_key: tuple(paths) for image_key, paths in entry["images"].items()}
+
+    def set_metadata_image_paths(
+        self, metadata_file: str, image_dir: Optional[str], image_paths: Dict[str, Tuple[str, Optional[str], Optional[str]]]
+    ):
+        stats = self._get_metadata_file_stats(metadata_file, image_dir)
+        if stats is None:
+            return
+        entry = {
+            "mtime_ns": stats[0],
+            "image_dir": image_dir,
+            "image_dir_mtime_ns": stats[1],
+            "images": {image_key: list(paths) for image_key, paths in image_paths.items()},
+        }
+        self._set_entry("metadata_files", os.path.abspath(metadata_file), entry)
+
+    # endregion
@@ -966,7 +966,15 @@ class Flux(nn.Module):
 
         print("FLUX: Gradient checkpointing disabled.")
 
-    def enable_block_swap(self, num_blocks: int, device: torch.device):
+    def enable_block_swap(
+        self,
+        num_blocks: int,
+        device: torch.device,
+        disk_offload_dir: Optional[str] = None,
+        disk_prefetch_depth: int = 2,
+        max_prefetch_depth: int = 1,
+        timeline_path: Optional[str] = None,
+    ):
         self.blocks_to_swap = num_blocks
         double_blocks_to_swap = num_blocks // 2
         single_blocks_to_swap = (num_blocks - double_blocks_to_swap) * 2
@@ -977,10 +985,24 @@ class Flux(nn.Module):
         )
 
         self.offloader_double = custom_offloading_utils.ModelOffloader(
-            self.double_blocks, self.num_double_blocks, double_blocks_to_swap, device  # , debug=True
+            self.double_blocks,
+            self.num_double_blocks,
+            double_blocks_to_swap,
+            device,  # debug=True,
+            disk_offload_dir=disk_offload_dir,
+            disk_prefetch_depth=disk_prefetch_depth,
+            max_prefetch_depth=max_prefetch_depth,
+            timeline_path=custom_offloading_utils.get_timeline_path(timeline_path, "double"),
         )
         self.offloader_single = custom_offloading_utils.ModelOffloader(
-            self.single_blocks, self.num_single_blocks, single_blocks_to_swap, device  # , debug=True
+            self.single_blocks,
+            self.num_single_blocks,
+            single_blocks_to_swap,
+            device,  # debug=True,
+            disk_offload_dir=disk_offload_dir,
+            disk_prefetch_depth=disk_prefetch_depth,
+            max_prefetch_depth=max_prefetch_depth,
+            timeline_path=custom_offloading_utils.get_timeline_path(timeline_path, "single"),
         )
         print(
             f"FLUX: Block swap enabled. Swapping {num_blocks} blocks, double blocks: {double_blocks_to_swap}, single blocks: {single_blocks_to_swap}."
@@ -1208,7 +1230,15 @@ class ControlNetFlux(nn.Module):
 
         print("FLUX: Gradient checkpointing disabled.")
 
-    def enable_block_swap(self, num_blocks: int, device: torch.device):
+    def enable_block_swap(
+        self,
+        num_blocks: int,
+        device: torch.device,
+        disk_offload_dir: Optional[str] = None,
+        disk_prefetch_depth: int = 2,
+        max_prefetch_depth: int = 1,
+        timeline_path: Optional[str] = None,
+    ):
         self.blocks_to_swap = num_blocks
         double_blocks_to_swap = num_blocks // 2
         single_blocks_to_swap = (num_blocks - double_blocks_to_swap) * 2
@@ -1219,10 +1249,24 @@ class ControlNetFlux(nn.Module):
         )
 
         self.offloader_double = custom_offloading_utils.ModelOffloader(
-            self.double_blocks, self.num_double_blocks, double_blocks_to_swap, device  # , debug=True
+            self.double_blocks,
+            self.num_double_blocks,
+            double_blocks_to_swap,
+            device,  # debug=True,
+            disk_offload_dir=disk_offload_dir,
+            disk_prefetch_depth=disk_prefetch_depth,
+            max_prefetch_depth=max_prefetch_depth,
+            timeline_path=custom_offloading_utils.get_timeline_path(timeline_path, "double"),
         )
         self.offloader_single = custom_offloading_utils.ModelOffloader(
-            self.single_blocks, self.num_single_blocks, single_blocks_to_swap, device  # , debug=True
+            self.single_blocks,
+            self.num_single_blocks,
+            single_blocks_to_swap,
+            device,  # debug=True,
+            disk_offload_dir=disk_offload_dir,
+            disk_prefetch_depth=disk_prefetch_depth,
+            max_prefetch_depth=max_prefetch_depth,
+            timeline_path=custom_offloading_utils.get_timeline_path(timeline_path, "single"),
         )
         print(
             f"FLUX: Block swap enabled. Swapping {num_blocks} blocks, double blocks: {double_blocks_to_swap}, single blocks: {single_blocks_to_swap}."
@@ -12,13 +12,13 @@ from accelerate import Accelerator, PartialState
 from transformers import CLIPTextModel
 from tqdm import tqdm
 from PIL import Image
-from safetensors.torch import save_file
 
 from library import flux_models, flux_utils, strategy_base, train_util
 from library.device_utils import init_ipex, clean_memory_on_device
 
 init_ipex()
 
+from .async_checkpoint import save_file
 from .utils import setup_logging, mem_eff_save_file
 
 setup_logging()
@@ -491,6 +491,11 @@ def save_models(
     save_dtype: Optional[torch.dtype] = None,
     use_mem_eff_save: bool = False,
 ):
+    if use_mem_eff_save:
+        # converted to save_dtype and copied to CPU chunk by chunk while writing
+        mem_eff_save_file(flux.state_dict(), ckpt_path, metadata=sai_metadata, dtype=save_dtype)
+        return
+
     state_dict = {}
 
     def update_sd(prefix, sd):
@@ -502,10 +507,7 @@ def save_models(
 
     update_sd("", flux.state_dict())
 
-    if not use_mem_eff_save:
-        save_file(state_dict, ckpt_path, metadata=sai_metadata)
-    else:
-        mem_eff_save_file(state_dict, ckpt_path, metadata=sai_metadata)
+    save_file(state_dict, ckpt_path, metadata=sai_metadata)
 
 
 def save_flux_model_on_train_end(
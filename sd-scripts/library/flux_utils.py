@@ -18,6 +18,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 from library import flux_models
+from library.content_addressed_cache import set_model_source
 from library.utils import load_safetensors
 
 MODEL_VERSION_FLUX_V1 = "flux1"
@@ -150,6 +151,7 @@ def load_ae(
     sd = load_safetensors(ckpt_path, device=str(device), disable_mmap=disable_mmap, dtype=dtype)
     info = ae.load_state_dict(sd, strict=False, assign=True)
     logger.info(f"Loaded AE: {info}")
+    set_model_source(ae, ckpt_path)
     return ae
 
 
@@ -274,6 +276,7 @@ def load_clip_l(
     else:
         logger.info(f"Loading state dict from {ckpt_path}")
         sd = load_safetensors(ckpt_path, device=str(device), disable_mmap=disable_mmap, dtype=dtype)
+        set_model_source(clip, ckpt_path)
     info = clip.load_state_dict(sd, strict=False, assign=True)
     logger.info(f"Loaded CLIP-L: {info}")
     return clip
@@ -329,6 +332,7 @@ def load_t5xxl(
     else:
         logger.info(f"Loading state dict from {ckpt_path}")
         sd = load_safetensors(ckpt_path, device=str(device), disable_mmap=disable_mmap, dtype=dtype)
+        set_model_source(t5xxl, ckpt_path)
     info = t5xxl.load_state_dict(sd, strict=False, assign=True)
     logger.info(f"Loaded T5xxl: {info}")
     return t5xxl
@@ -0,0 +1,126 @@
+# parallel image size probing with a persistent size index
+# 画像サイズの並列取得と永続的なサイズインデックス
+#
+# the index is a JSON file: {"/abs/path/to/image.png": [mtime_ns, file_size, width, height], ...}
+# an entry is used only if mtime and file size of the image are unchanged, so edited images are probed again.
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from tqdm import tqdm
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ImageSizeIndex:
+    def __init__(self, index_path: str) -> None:
+        self.index_path = index_path
+        self._entries: Dict[str, Tuple[int, int, int, int]] = {}  # abs path -> (mtime_ns, file size, width, height)
+        self._dirty = False
+        self._load(self._entries)
+
+    def _load(self, entries: dict):
+        if not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                loaded = {path: tuple(entry) for path, entry in json.load(f).items()}
+            if any(len(entry) != 4 for entry in loaded.values()):
+                raise ValueError("invalid entry")
+            entries.update(loaded)
+        except (OSError, ValueError, TypeError, AttributeError) as e:  # TypeError, AttributeError: unexpected JSON structure
+            logger.warning(f"failed to load image size index, ignored / 画像サイズインデックスの読み込みに失敗したため無視します: {e}")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, image_path: str, st: os.stat_result) -> Optional[Tuple[int, int]]:
+        entry = self._entries.get(os.path.abspath(image_path))
+        if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+            return None
+        return entry[2], entry[3]
+
+    def set(self, image_path: str, st: os.stat_result, image_size: Tuple[int, int]):
+        self._entries[os.path.abspath(image_path)] = (st.st_mtime_ns, st.st_size, image_size[0], image_size[1])
+        self._dirty = True
+
+    def save(self):
+        r"""
+        save the index atomically. entries written by other processes (e.g. other ranks) after loading are merged.
+        """
+        if not self._dirty:
+            return
+
+        entries = {}
+        self._load(entries)
+        entries.update(self._entries)
+
+        dirname = os.path.dirname(self.index_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({path: list(entry) for path, entry in entries.items()}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)  # atomic, so concurrent writers never leave a broken file
+
+        self._entries = entries
+        self._dirty = False
+
+
+def get_max_workers_for_io(num_items: int) -> int:
+    r"""
+    number of threads for I/O bound tasks in this process. the threads are divided among the processes on the node
+    because all ranks load the dataset at the same time.
+    """
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", "1"))
+    max_workers = min(32, (os.cpu_count() or 1) + 4)  # same as ThreadPoolExecutor default
+    max_workers = max(1, max_workers // max(1, local_world_size))
+    return max(1, min(max_workers, num_items))
+
+
+def probe_image_sizes(
+    image_paths: Sequence[str],
+    get_image_size: Callable[[str], Tuple[int, int]],
+    size_index: Optional[ImageSizeIndex] = None,
+    max_workers: Optional[int] = None,
+) -> List[Tuple[int, int]]:
+    r"""
+    get image sizes in parallel. get_image_size should read only the header of the image.
+    if size_index is given, sizes of unchanged images are taken from the index, and newly probed sizes are saved to it.
+    """
+    if len(image_paths) == 0:
+        return []
+    if max_workers is None:
+        max_workers = get_max_workers_for_io(len(image_paths))
+
+    def probe(image_path: str):
+        if size_index is None:
+            return None, get_image_size(image_path), False
+        st = os.stat(image_path)
+        image_size = size_index.get(image_path, st)
+        if image_size is not None:
+            return st, image_size, False
+        return st, get_image_size(image_path), True
+
+    sizes = []
+    num_probed = 0
+    with ThreadPoolExecutor(max_workers) as executor:
+        results = executor.map(probe, image_paths)  # keeps the order of image_paths
+        for image_path, (st, image_size, probed) in tqdm(zip(image_paths, results), total=len(image_paths)):
+            sizes.append(image_size)
+            if probed:
+                num_probed += 1
+                if image_size[0] > 0 and image_size[1] > 0:  # do not cache failures
+                    size_index.set(image_path, st, image_size)
+
+    if size_index is not None:
+        logger.info(f"image sizes from index: {len(image_paths) - num_probed}, probed: {num_probed}")
+        size_index.save()
+    return sizes
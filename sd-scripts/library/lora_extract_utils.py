@@ -0,0 +1,141 @@
+# extracting LoRA from the difference of two models by streaming
+# 2つのモデルの差分からストリーミングでLoRAを抽出する
+#
+# the weights are read one key at a time from the lazily opened safetensors files, and the difference and its truncated
+# SVD are computed in a pool of processes. each process opens the files by itself, so only the keys are sent to the
+# processes and only the small LoRA weights are sent back. the results are yielded in order of the keys while the
+# following keys are computed, and a few weights per process are in memory at most.
+
+import collections
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import torch
+from safetensors import safe_open
+
+from library.utils import MemoryEfficientSafeOpen
+
+RANDOMIZED_SVD_OVERSAMPLES = 10
+RANDOMIZED_SVD_NITER = 4
+
+
+def svd_extract(mat: torch.Tensor, rank: int, clamp_quantile: float = 0.99, svd_method: str = "randomized"):
+    r"""
+    extract LoRA weights (up, down) approximating mat, the weight of linear or conv2d, by the SVD truncated to rank.
+    svd_method: "randomized" uses torch.svd_lowrank if rank is small enough compared to the size of mat, "full" uses
+    torch.linalg.svd always.
+    """
+    weight_shape = mat.size()
+    out_dim, in_dim = weight_shape[0:2]
+    rank = min(rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
+    mat = mat.reshape(out_dim, -1)
+
+    num_q = rank + RANDOMIZED_SVD_OVERSAMPLES
+    if svd_method == "randomized" and num_q < min(mat.size()):
+        U, S, V = torch.svd_lowrank(mat, q=num_q, niter=RANDOMIZED_SVD_NITER)
+        Vh = V.T
+    else:
+        U, S, Vh = torch.linalg.svd(mat, full_matrices=False)
+
+    U = U[:, :rank] * S[:rank]
+    Vh = Vh[:rank, :]
+
+    dist = torch.cat([U.flatten(), Vh.flatten()])
+    hi_val = torch.quantile(dist, clamp_quantile)
+    low_val = -hi_val
+
+    U = U.clamp(low_val, hi_val)
+    Vh = Vh.clamp(low_val, hi_val)
+
+    if len(weight_shape) == 4:
+        U = U.reshape(out_dim, rank, 1, 1)
+        Vh = Vh.reshape(rank, *weight_shape[1:])
+    return U, Vh
+
+
+# files opened in this process: {path: file}
+_open_files = {}
+
+
+def _open_file(path: str, mem_eff_safe_open: bool):
+    if path not in _open_files:
+        _open_files[path] = MemoryEfficientSafeOpen(path) if mem_eff_safe_open else safe_open(path, framework="pt")
+    return _open_files[path]
+
+
+def _close_files():
+    for f in _open_files.values():
+        if isinstance(f, MemoryEfficientSafeOpen):
+            f.file.close()
+    _open_files.clear()
+
+
+def _extract_key(
+    model_org: str,
+    model_tuned: str,
+    key: str,
+    rank: int,
+    clamp_quantile: float,
+    svd_method: str,
+    device: Optional[str],
+    save_dtype: Optional[torch.dtype],
+    mem_eff_safe_open: bool,
+):
+    value_o = _open_file(model_org, mem_eff_safe_open).get_tensor(key)
+    value_t = _open_file(model_tuned, mem_eff_safe_open).get_tensor(key)
+    mat = value_t.to(device or "cpu", torch.float) - value_o.to(device or "cpu", torch.float)
+    del value_o, value_t
+
+    U, Vh = svd_extract(mat, rank, clamp_quantile, svd_method)
+    return U.to("cpu", dtype=save_dtype).contiguous(), Vh.to("cpu", dtype=save_dtype).contiguous()
+
+
+def _init_worker(num_threads: int):
+    torch.set_num_threads(num_threads)
+
+
+def extract_lora_weights_streaming(
+    model_org: str,
+    model_tuned: str,
+    targets: List[Tuple[str, int]],
+    clamp_quantile: float = 0.99,
+    svd_method: str = "randomized",
+    device: Optional[str] = None,
+    save_dtype: Optional[torch.dtype] = None,
+    num_workers: int = 0,
+    mem_eff_safe_open: bool = False,
+) -> Iterator[Tuple[str, torch.Tensor, torch.Tensor]]:
+    r"""
+    extract LoRA weights from the differences of the weights of two safetensors files: targets is [(key, rank), ...].
+    yields (key, up, down) in order of targets, up and down are on CPU in save_dtype.
+    num_workers: if more than 0, the keys are computed in a pool of the processes, 0 for this process.
+    """
+
+    def task_args(key, rank):
+        return (model_org, model_tuned, key, rank, clamp_quantile, svd_method, device, save_dtype, mem_eff_safe_open)
+
+    if num_workers <= 0:
+        try:
+            for key, rank in targets:
+                yield (key, *_extract_key(*task_args(key, rank)))
+        finally:
+            _close_files()
+        return
+
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    max_in_flight = num_workers * 2  # keep the processes busy while the results are written
+    # spawn: OpenMP of torch in the parent process may hang the forked processes
+    with ProcessPoolExecutor(
+        num_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker, initargs=(num_threads,)
+    ) as executor:
+        futures = collections.deque()
+        for key, rank in targets:
+            futures.append((key, executor.submit(_extract_key, *task_args(key, rank))))
+            if len(futures) >= max_in_flight:
+                key, future = futures.popleft()
+                yield (key, *future.result())
+        while futures:
+            key, future = futures.popleft()
+            yield (key, *future.result())
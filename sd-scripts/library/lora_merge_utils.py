@@ -0,0 +1,204 @@
+# merging LoRAs into a Stable Diffusion / SDXL checkpoint by streaming
+# LoRAをStable Diffusion/SDXLのチェックポイントにストリーミングでマージする
+#
+# the base checkpoint is read one tensor at a time from the memory-mapped safetensors file, the LoRAs for the tensor
+# are merged, and the tensor is written to the output while the next tensor is read. the models are not built, and
+# only the tensors being merged or written are kept in memory. the LoRAs are also memory-mapped.
+#
+# all LoRAs for the same module are merged by one matmul: W += concat(ratio * scale * ups) @ concat(downs).
+
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+from tqdm import tqdm
+
+from library import model_util, sdxl_model_util
+from library.utils import MemoryEfficientSafeOpen, mem_eff_save_file, setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+# same as networks.lora.LoRANetwork
+LORA_PREFIX_UNET = "lora_unet"
+LORA_PREFIX_TEXT_ENCODER = "lora_te"
+LORA_PREFIX_TEXT_ENCODER1 = "lora_te1"
+LORA_PREFIX_TEXT_ENCODER2 = "lora_te2"
+
+SDXL_UNET_KEY_PREFIX = "model.diffusion_model."
+SDXL_TEXT_ENCODER1_KEY_PREFIX = "conditioner.embedders.0.transformer."
+SDXL_TEXT_ENCODER2_KEY_PREFIX = "conditioner.embedders.1.model."
+
+
+def trace_key_conversion(keys: List[str], convert_fn: Callable[[Dict[str, torch.Tensor]], Dict[str, torch.Tensor]]):
+    r"""
+    run a state dict conversion on small placeholder tensors to find where the converted weights come from.
+    returns {converted key: (key in the checkpoint, index of the chunk or None)}. the conversions of SD/SDXL checkpoints
+    rename the keys and split the fused q/k/v weights of OpenCLIP into three chunks along the first dim.
+    """
+    placeholders = {key: torch.arange(i * 3, i * 3 + 3) for i, key in enumerate(keys)}
+    sources = {}
+    for converted_key, value in convert_fn(placeholders).items():
+        if not isinstance(value, torch.Tensor) or value.dtype != torch.int64:
+            continue  # made by the conversion, e.g. dummy weights
+        first = int(value.reshape(-1)[0])
+        sources[converted_key] = (keys[first // 3], None if value.numel() == 3 else first % 3)
+    return sources
+
+
+def make_lora_module_map(keys: List[str], is_sdxl: bool, v2: bool = False) -> Dict[str, Tuple[str, Optional[int]]]:
+    r"""
+    map the LoRA module names to the weights in the checkpoint: {lora_name: (key, index of q/k/v chunk or None)}.
+    the module names are the names of the models loaded by model_util/sdxl_model_util, so the keys are converted in
+    the same way as loading the models.
+    """
+    if is_sdxl:
+
+        def strip_prefix(prefix):
+            return lambda sd: {k[len(prefix) :]: v for k, v in sd.items() if k.startswith(prefix)}
+
+        def convert_text_encoder2(sd):
+            sd = {k: v for k, v in sd.items() if k.startswith(SDXL_TEXT_ENCODER2_KEY_PREFIX)}
+            return sdxl_model_util.convert_sdxl_text_encoder_2_checkpoint(sd, max_length=77)[0]
+
+        converters = [
+            (LORA_PREFIX_UNET, strip_prefix(SDXL_UNET_KEY_PREFIX)),  # U-Net of SDXL has the same module names as the checkpoint
+            (LORA_PREFIX_TEXT_ENCODER1, strip_prefix(SDXL_TEXT_ENCODER1_KEY_PREFIX)),
+            (LORA_PREFIX_TEXT_ENCODER2, convert_text_encoder2),
+        ]
+    else:
+        unet_config = model_util.create_unet_diffusers_config(v2, use_linear_projection_in_v2=True)
+
+        def convert_text_encoder(sd):
+            sd = model_util.replace_text_encoder_keys(sd)
+            return model_util.convert_ldm_clip_checkpoint_v2(sd, 77) if v2 else model_util.convert_ldm_clip_checkpoint_v1(sd)
+
+        converters = [
+            (LORA_PREFIX_UNET, lambda sd: model_util.convert_ldm_unet_checkpoint(v2, sd, unet_config)),
+            (LORA_PREFIX_TEXT_ENCODER, convert_text_encoder),
+        ]
+
+    module_map = {}
+    for prefix, convert_fn in converters:
+        for converted_key, source in trace_key_conversion(keys, convert_fn).items():
+            if converted_key.endswith(".weight"):
+                module_name = converted_key[: -len(".weight")]
+                module_map[prefix + "_" + module_name.replace(".", "_")] = source
+    return module_map
+
+
+def load_lora_state_dict(file_name: str) -> Dict[str, torch.Tensor]:
+    r"""
+    safetensors files are memory-mapped: the weights are read from the disk when merged.
+    """
+    if os.path.splitext(file_name)[1] == ".safetensors":
+        with MemoryEfficientSafeOpen(file_name, use_mmap=True) as f:
+            return {key: f.get_tensor(key) for key in f.keys()}
+    return torch.load(file_name, map_location="cpu")
+
+
+# (up, down, scale)
+LoRAWeights = Tuple[torch.Tensor, torch.Tensor, float]
+
+
+def collect_lora_weights(
+    models: List[str],
+    ratios: List[float],
+    module_map: Dict[str, Tuple[str, Optional[int]]],
+    multiplier_fns: Optional[List[Optional[Callable[[str], float]]]] = None,
+) -> Dict[str, Dict[Optional[int], List[LoRAWeights]]]:
+    r"""
+    group the LoRA weights by the key of the weight to merge into: {key: {chunk index: [(up, down, scale), ...]}}.
+    scale is ratio * alpha / dim * multiplier_fns[i](lora_name), the multiplier is e.g. the layer-wise ratio.
+    """
+    grouped = {}
+    for i, (model, ratio) in enumerate(zip(models, ratios)):
+        multiplier_fn = multiplier_fns[i] if multiplier_fns is not None else None
+        logger.info(f"loading: {model}")
+        lora_sd = load_lora_state_dict(model)
+
+        num_modules = 0
+        for key in lora_sd.keys():
+            if not key.endswith(".lora_down.weight"):
+                continue
+            lora_name = key[: -len(".lora_down.weight")]
+            if lora_name not in module_map:
+                logger.info(f"no module found for LoRA weight: {key}")
+                continue
+
+            down_weight = lora_sd[key]
+            up_weight = lora_sd[lora_name + ".lora_up.weight"]
+            dim = down_weight.size()[0]
+            alpha = lora_sd.get(lora_name + ".alpha", dim)
+            alpha = alpha.item() if isinstance(alpha, torch.Tensor) else alpha
+            scale = ratio * alpha / dim
+            if multiplier_fn is not None:
+                scale *= multiplier_fn(lora_name)
+
+            weight_key, chunk = module_map[lora_name]
+            grouped.setdefault(weight_key, {}).setdefault(chunk, []).append((up_weight, down_weight, scale))
+            num_modules += 1
+        logger.info(f"{num_modules} modules")
+    return grouped
+
+
+def compute_lora_delta(
+    weight_shape: torch.Size, loras: List[LoRAWeights], device: torch.device, dtype: torch.dtype
+) -> torch.Tensor:
+    r"""
+    sum of scale * up @ down of the LoRAs by one matmul: concat(scale * ups, dim=1) @ concat(downs, dim=0).
+    conv2d 3x3 (down: 3x3 kernel, up: 1x1 kernel) is also the matmul of the flattened kernels.
+    """
+    ups = torch.cat([up.to(device, dtype).flatten(1) * scale for up, _, scale in loras], dim=1)
+    downs = torch.cat([down.to(device, dtype).flatten(1) for _, down, _ in loras], dim=0)
+    return (ups @ downs).reshape(weight_shape)
+
+
+def merge_loras_to_checkpoint(
+    sd_model: str,
+    save_to: str,
+    models: List[str],
+    ratios: List[float],
+    is_sdxl: bool,
+    v2: bool = False,
+    merge_dtype: torch.dtype = torch.float,
+    save_dtype: Optional[torch.dtype] = None,
+    metadata: Optional[Dict[str, str]] = None,
+    device: Optional[torch.device] = None,
+    multiplier_fns: Optional[List[Optional[Callable[[str], float]]]] = None,
+):
+    r"""
+    merge LoRAs into a safetensors checkpoint and save it to a safetensors file, one tensor at a time.
+    floating point tensors are saved in save_dtype, the dtype of the checkpoint is kept if None.
+    """
+    device = device or torch.device("cpu")
+    with MemoryEfficientSafeOpen(sd_model, use_mmap=True) as f:
+        keys = f.keys()
+        module_map = make_lora_module_map(keys, is_sdxl, v2)
+        lora_weights = collect_lora_weights(models, ratios, module_map, multiplier_fns)
+        logger.info(f"merging {len(models)} LoRAs into {len(lora_weights)} weights of {sd_model}")
+
+        progress = tqdm(total=len(keys))
+
+        def merge_tensor(key):
+            tensor = f.get_tensor(key)  # a view of the mapped file
+            progress.update(1)
+            if key not in lora_weights:
+                return tensor  # converted chunk by chunk while writing
+
+            weight = tensor.to(device, merge_dtype, copy=True)
+            for chunk, loras in lora_weights[key].items():
+                if chunk is None:
+                    weight += compute_lora_delta(weight.shape, loras, device, merge_dtype)
+                else:
+                    # q, k or v of the fused weight
+                    size = weight.size(0) // 3
+                    target = weight[chunk * size : (chunk + 1) * size]
+                    target += compute_lora_delta(target.shape, loras, device, merge_dtype)
+            return weight if save_dtype is not None else weight.to(tensor.dtype)
+
+        logger.info(f"saving model to: {save_to}")
+        mem_eff_save_file([(key, lambda key=key: merge_tensor(key)) for key in keys], save_to, metadata, dtype=save_dtype)
+        progress.close()
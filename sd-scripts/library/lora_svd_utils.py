@@ -0,0 +1,95 @@
+# SVD of low-rank weights for resizing and merging LoRAs
+# LoRAのリサイズやマージのための低ランク行列のSVD
+#
+# the weight of a LoRA module W = up @ down has rank r (the dim of the LoRA) at most, and merged LoRAs are also
+# W = concat(ups) @ concat(downs). the SVD of W is computed from the QR decompositions of the factors and the SVD of
+# a small matrix, without making the out x in matrix:
+#
+#   up = Qu Ru, down^T = Qd Rd  ->  W = Qu (Ru Rd^T) Qd^T = (Qu Um) S (Vm^T Qd^T), where Ru Rd^T = Um S Vm^T
+#
+# this is exact, not an approximation. the factors of the modules of the same shape are stacked and decomposed at
+# once, and the batches can be computed in a process pool.
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+
+def low_rank_svd(up: torch.Tensor, down: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    r"""
+    SVD of up @ down. up: (..., out, r), down: (..., r, in), batched if more than 2 dims.
+    returns U (..., out, k), S (..., k), Vh (..., k, in) where k = min(out, r, in), S is in descending order.
+    """
+    q_up, r_up = torch.linalg.qr(up)
+    q_down, r_down = torch.linalg.qr(down.transpose(-2, -1))
+    u, s, vh = torch.linalg.svd(r_up @ r_down.transpose(-2, -1), full_matrices=False)
+    return q_up @ u, s, vh @ q_down.transpose(-2, -1)
+
+
+def pad_svd(U: torch.Tensor, S: torch.Tensor, Vh: torch.Tensor, rank: int):
+    r"""
+    pad U, S and Vh with zero singular values and vectors to rank, e.g. to the number of singular values of the
+    full SVD. the padded singular values are zero instead of the round-off errors of the full SVD.
+    """
+    num_pad = rank - S.size(-1)
+    if num_pad <= 0:
+        return U, S, Vh
+    return F.pad(U, (0, num_pad)), F.pad(S, (0, num_pad)), F.pad(Vh, (0, 0, 0, num_pad))
+
+
+def _low_rank_svd_batch(names: List[str], ups: torch.Tensor, downs: torch.Tensor, device: Optional[str]):
+    dtype = ups.dtype
+    if device is not None:
+        ups, downs = ups.to(device), downs.to(device)
+    U, S, Vh = low_rank_svd(ups.float(), downs.float())  # QR and SVD do not support half precision
+    U, S, Vh = U.to("cpu", dtype), S.to("cpu", torch.float), Vh.to("cpu", dtype)
+    return [(name, U[i], S[i], Vh[i]) for i, name in enumerate(names)]
+
+
+def _init_worker(num_threads: int):
+    torch.set_num_threads(num_threads)
+
+
+def batched_low_rank_svd(
+    factors: Dict[str, Tuple[torch.Tensor, torch.Tensor]],
+    device: Optional[str] = None,
+    num_workers: int = 0,
+    max_batch_elements: int = 2**26,
+) -> Iterator[Tuple[str, torch.Tensor, torch.Tensor, torch.Tensor]]:
+    r"""
+    low_rank_svd of many modules: factors is {name: (up (out, r), down (r, in))}. yields (name, U, S, Vh) on CPU, grouped
+    by the shape. the factors of the same shape are stacked into batches of at most max_batch_elements.
+    num_workers: if more than 0, the batches are computed in a pool of the processes (on CPU only).
+    """
+    groups: Dict[Tuple, List[str]] = {}
+    for name, (up, down) in factors.items():
+        groups.setdefault((up.shape, down.shape, up.dtype), []).append(name)
+
+    batches = []
+    for (up_shape, down_shape, _), names in groups.items():
+        batch_size = max(1, max_batch_elements // (up_shape.numel() + down_shape.numel()))
+        batches += [names[i : i + batch_size] for i in range(0, len(names), batch_size)]
+
+    def stack(batch_names):
+        ups = torch.stack([factors[name][0] for name in batch_names])
+        downs = torch.stack([factors[name][1] for name in batch_names])
+        return batch_names, ups, downs
+
+    if num_workers <= 0:
+        for batch_names in batches:
+            yield from _low_rank_svd_batch(*stack(batch_names), device)
+        return
+
+    assert device is None or torch.device(device).type == "cpu", "process pool is for CPU only / プロセスプールはCPUのみ対応です"
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    # spawn: OpenMP of torch in the parent process may hang the forked processes
+    with ProcessPoolExecutor(
+        num_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker, initargs=(num_threads,)
+    ) as executor:
+        futures = [executor.submit(_low_rank_svd_batch, *stack(batch_names), None) for batch_names in batches]
+        for future in futures:
+            yield from future.result()
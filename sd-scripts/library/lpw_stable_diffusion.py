@@ -540,6 +540,11 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
         if not hasattr(self, "vae_scale_factor"):
             setattr(self, "vae_scale_factor", 2 ** (len(self.vae.config.block_out_channels) - 1))
 
+    @property
+    def device(self) -> torch.device:
+        # the text encoder may stay offloaded while sampling with `prompt_conditioning`, so the U-Net decides the device
+        return self.unet.device
+
     @property
     def _execution_device(self):
         r"""
@@ -617,6 +622,16 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
 
         return text_embeddings
 
+    def encode_prompt_conditioning(
+        self, prompt, negative_prompt, do_classifier_free_guidance, max_embeddings_multiples=3
+    ) -> torch.FloatTensor:
+        r"""
+        Encodes the prompt into the conditioning for `prompt_conditioning` of `__call__`, to reuse it in multiple calls.
+        """
+        return self._encode_prompt(
+            prompt, self._execution_device, 1, do_classifier_free_guidance, negative_prompt, max_embeddings_multiples
+        )
+
     def check_inputs(self, prompt, height, width, strength, callback_steps):
         if not isinstance(prompt, str) and not isinstance(prompt, list):
             raise ValueError(f"`prompt` has to be of type `str` or `list` but is {type(prompt)}")
@@ -741,6 +756,7 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
         return_dict: bool = True,
         controlnet=None,
         controlnet_image=None,
+        prompt_conditioning: Optional[torch.FloatTensor] = None,
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         is_cancelled_callback: Optional[Callable[[], bool]] = None,
         callback_steps: int = 1,
@@ -806,6 +822,9 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
             controlnet_image (`torch.FloatTensor` or `PIL.Image.Image`, *optional*):
                 `Image`, or tensor representing an image batch, to be used as the starting point for the controlnet
                 inference.
+            prompt_conditioning (`torch.FloatTensor`, *optional*):
+                Pre-computed conditioning from `encode_prompt_conditioning` with the same prompt, negative prompt and
+                guidance. If provided, the text encoder is not called. Only for `num_images_per_prompt` of 1.
             callback (`Callable`, *optional*):
                 A function that will be called every `callback_steps` steps during inference. The function will be
                 called with the following arguments: `callback(step: int, timestep: int, latents: torch.FloatTensor)`.
@@ -843,14 +862,17 @@ class StableDiffusionLongPromptWeightingPipeline(StableDiffusionPipeline):
         do_classifier_free_guidance = guidance_scale > 1.0
 
         # 3. Encode input prompt
-        text_embeddings = self._encode_prompt(
-            prompt,
-            device,
-            num_images_per_prompt,
-            do_classifier_free_guidance,
-            negative_prompt,
-            max_embeddings_multiples,
-        )
+        if prompt_conditioning is not None:
+            text_embeddings = prompt_conditioning.to(device)
+        else:
+            text_embeddings = self._encode_prompt(
+                prompt,
+                device,
+                num_images_per_prompt,
+                do_classifier_free_guidance,
+                negative_prompt,
+                max_embeddings_multiples,
+            )
         dtype = text_embeddings.dtype
 
         # 4. Preprocess image and mask
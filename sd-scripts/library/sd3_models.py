@@ -1072,7 +1072,15 @@ class MMDiT(nn.Module):
         # )
         return spatial_pos_embed
 
-    def enable_block_swap(self, num_blocks: int, device: torch.device):
+    def enable_block_swap(
+        self,
+        num_blocks: int,
+        device: torch.device,
+        disk_offload_dir: Optional[str] = None,
+        disk_prefetch_depth: int = 2,
+        max_prefetch_depth: int = 1,
+        timeline_path: Optional[str] = None,
+    ):
         self.blocks_to_swap = num_blocks
 
         assert (
@@ -1080,7 +1088,14 @@ class MMDiT(nn.Module):
         ), f"Cannot swap more than {self.num_blocks - 2} blocks. Requested: {self.blocks_to_swap} blocks."
 
         self.offloader = custom_offloading_utils.ModelOffloader(
-            self.joint_blocks, self.num_blocks, self.blocks_to_swap, device  # , debug=True
+            self.joint_blocks,
+            self.num_blocks,
+            self.blocks_to_swap,
+            device,  # debug=True,
+            disk_offload_dir=disk_offload_dir,
+            disk_prefetch_depth=disk_prefetch_depth,
+            max_prefetch_depth=max_prefetch_depth,
+            timeline_path=timeline_path,
         )
         print(f"SD3: Block swap enabled. Swapping {num_blocks} blocks, total blocks: {self.num_blocks}, device: {device}.")
 
@@ -7,7 +7,6 @@ import time
 from typing import Dict, List, Optional, Tuple, Union
 
 import torch
-from safetensors.torch import save_file
 from accelerate import Accelerator, PartialState
 from tqdm import tqdm
 from PIL import Image
@@ -21,6 +20,7 @@ init_ipex()
 # from library import model_util
 # , sdxl_model_util, train_util, sdxl_original_unet
 # from library.sdxl_lpw_stable_diffusion import SdxlStableDiffusionLongPromptWeightingPipeline
+from .async_checkpoint import save_file
 from .utils import setup_logging
 
 setup_logging()
@@ -934,7 +934,11 @@ def get_noisy_model_input_and_timesteps(args, latents, noise, device, dtype) ->
     # weighting shift, value >1 will shift distribution to noisy side (focus more on overall structure), value <1 will shift towards less-noisy side (focus more on details)
     u = (u * shift) / (1 + (shift - 1) * u)
 
-    indices = (u * (t_max - t_min) + t_min).long()
+    if isinstance(t_min, (list, tuple)):
+        # fixed timesteps for the repeated batch, from the batched validation
+        indices = torch.tensor(t_min, dtype=torch.long).repeat_interleave(bsz // len(t_min))
+    else:
+        indices = (u * (t_max - t_min) + t_min).long()
     timesteps = indices.to(device=device, dtype=dtype)
 
     # sigmas according to flowmatching
@@ -23,6 +23,7 @@ from library import sdxl_model_util
 # region models
 
 # TODO remove dependency on flux_utils
+from library.content_addressed_cache import set_model_source
 from library.utils import load_safetensors
 from library.flux_utils import load_t5xxl as flux_utils_load_t5xxl
 
@@ -147,6 +148,7 @@ def load_clip_l(
     if clip_l_sd is None:
         logger.info(f"Loading state dict from {clip_l_path}")
         clip_l_sd = load_safetensors(clip_l_path, device=str(device), disable_mmap=disable_mmap, dtype=dtype)
+        set_model_source(clip, clip_l_path)
 
     if "text_projection.weight" not in clip_l_sd:
         logger.info("Adding text_projection.weight to clip_l_sd")
@@ -207,6 +209,7 @@ def load_clip_g(
     if clip_g_sd is None:
         logger.info(f"Loading state dict from {clip_g_path}")
         clip_g_sd = load_safetensors(clip_g_path, device=str(device), disable_mmap=disable_mmap, dtype=dtype)
+        set_model_source(clip, clip_g_path)
     info = clip.load_state_dict(clip_g_sd, strict=False, assign=True)
     logger.info(f"Loaded CLIP-G: {info}")
     return clip
@@ -261,6 +264,8 @@ def load_vae(
     info = vae.load_state_dict(vae_sd)
     logger.info(f"Loaded VAE: {info}")
     vae.to(device=device, dtype=vae_dtype)  # make sure it's in the right device and dtype
+    if vae_path:
+        set_model_source(vae, vae_path)
     return vae
 
 
@@ -3,7 +3,7 @@
 
 import inspect
 import re
-from typing import Callable, List, Optional, Union
+from typing import Callable, List, Optional, Tuple, Union
 
 import numpy as np
 import PIL.Image
@@ -602,6 +602,33 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
                 return torch.device(module._hf_hook.execution_device)
         return self.device
 
+    def encode_prompt_conditioning(
+        self, prompt, negative_prompt, do_classifier_free_guidance
+    ) -> Tuple[torch.FloatTensor, torch.FloatTensor, Optional[torch.FloatTensor], Optional[torch.FloatTensor]]:
+        r"""
+        Encodes the prompt into the conditioning for `prompt_conditioning` of `__call__`, to reuse it in multiple calls.
+        returns (text_embeddings, text_pool, uncond_embeddings, uncond_pool), uncond ones are None without guidance.
+        """
+        tokenize_strategy: strategy_sdxl.SdxlTokenizeStrategy = strategy_base.TokenizeStrategy.get_strategy()
+        encoding_strategy: strategy_sdxl.SdxlTextEncodingStrategy = strategy_base.TextEncodingStrategy.get_strategy()
+
+        text_input_ids, text_weights = tokenize_strategy.tokenize_with_weights(prompt)
+        hidden_states_1, hidden_states_2, text_pool = encoding_strategy.encode_tokens_with_weights(
+            tokenize_strategy, self.text_encoders, text_input_ids, text_weights
+        )
+        text_embeddings = torch.cat([hidden_states_1, hidden_states_2], dim=-1)
+
+        if do_classifier_free_guidance:
+            input_ids, weights = tokenize_strategy.tokenize_with_weights(negative_prompt or "")
+            hidden_states_1, hidden_states_2, uncond_pool = encoding_strategy.encode_tokens_with_weights(
+                tokenize_strategy, self.text_encoders, input_ids, weights
+            )
+            uncond_embeddings = torch.cat([hidden_states_1, hidden_states_2], dim=-1)
+        else:
+            uncond_embeddings = None
+            uncond_pool = None
+        return text_embeddings, text_pool, uncond_embeddings, uncond_pool
+
     def check_inputs(self, prompt, height, width, strength, callback_steps):
         if not isinstance(prompt, str) and not isinstance(prompt, list):
             raise ValueError(f"`prompt` has to be of type `str` or `list` but is {type(prompt)}")
@@ -734,6 +761,7 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
         return_dict: bool = True,
         controlnet: sdxl_original_control_net.SdxlControlNet = None,
         controlnet_image=None,
+        prompt_conditioning: Optional[Tuple[torch.FloatTensor, ...]] = None,
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         is_cancelled_callback: Optional[Callable[[], bool]] = None,
         callback_steps: int = 1,
@@ -799,6 +827,9 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
             controlnet_image (`torch.FloatTensor` or `PIL.Image.Image`, *optional*):
                 `Image`, or tensor representing an image batch, to be used as the starting point for the controlnet
                 inference.
+            prompt_conditioning (`Tuple[torch.FloatTensor, ...]`, *optional*):
+                Pre-computed conditioning from `encode_prompt_conditioning` with the same prompt, negative prompt and
+                guidance. If provided, the text encoders are not called.
             callback (`Callable`, *optional*):
                 A function that will be called every `callback_steps` steps during inference. The function will be
                 called with the following arguments: `callback(step: int, timestep: int, latents: torch.FloatTensor)`.
@@ -836,24 +867,9 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
         do_classifier_free_guidance = guidance_scale > 1.0
 
         # 3. Encode input prompt
-        tokenize_strategy: strategy_sdxl.SdxlTokenizeStrategy = strategy_base.TokenizeStrategy.get_strategy()
-        encoding_strategy: strategy_sdxl.SdxlTextEncodingStrategy = strategy_base.TextEncodingStrategy.get_strategy()
-
-        text_input_ids, text_weights = tokenize_strategy.tokenize_with_weights(prompt)
-        hidden_states_1, hidden_states_2, text_pool = encoding_strategy.encode_tokens_with_weights(
-            tokenize_strategy, self.text_encoders, text_input_ids, text_weights
-        )
-        text_embeddings = torch.cat([hidden_states_1, hidden_states_2], dim=-1)
-
-        if do_classifier_free_guidance:
-            input_ids, weights = tokenize_strategy.tokenize_with_weights(negative_prompt or "")
-            hidden_states_1, hidden_states_2, uncond_pool = encoding_strategy.encode_tokens_with_weights(
-                tokenize_strategy, self.text_encoders, input_ids, weights
-            )
-            uncond_embeddings = torch.cat([hidden_states_1, hidden_states_2], dim=-1)
-        else:
-            uncond_embeddings = None
-            uncond_pool = None
+        if prompt_conditioning is None:
+            prompt_conditioning = self.encode_prompt_conditioning(prompt, negative_prompt, do_classifier_free_guidance)
+        text_embeddings, text_pool, uncond_embeddings, uncond_pool = prompt_conditioning
 
         unet_dtype = self.unet.dtype
         dtype = unet_dtype
@@ -12,6 +12,7 @@ from accelerate import init_empty_weights
 from tqdm import tqdm
 from transformers import CLIPTokenizer
 from library import model_util, sdxl_model_util, train_util, sdxl_original_unet
+from library.content_addressed_cache import set_model_source
 from .utils import setup_logging
 
 setup_logging()
@@ -79,6 +80,8 @@ def _load_target_model(
             logit_scale,
             ckpt_info,
         ) = sdxl_model_util.load_models_from_sdxl_checkpoint(model_version, name_or_path, device, model_dtype, disable_mmap)
+        for model in [text_encoder1, text_encoder2, vae]:
+            set_model_source(model, name_or_path)
     else:
         # Diffusers model is loaded to CPU
         from diffusers import StableDiffusionXLPipeline
@@ -128,6 +131,7 @@ def _load_target_model(
     # VAEを読み込む
     if vae_path is not None:
         vae = model_util.load_vae(vae_path, weight_dtype)
+        set_model_source(vae, vae_path)
         logger.info("additional VAE loaded")
 
     return load_stable_diffusion_format, text_encoder1, text_encoder2, vae, unet, logit_scale, ckpt_info
@@ -335,6 +339,25 @@ def add_sdxl_training_arguments(parser: argparse.ArgumentParser, support_text_en
         action="store_true",
         help="cache text encoder outputs to disk / text encoderの出力をディスクにキャッシュする",
     )
+    parser.add_argument(
+        "--text_encoder_outputs_cache_dtype",
+        type=str,
+        default=None,
+        choices=["fp16", "bf16"],
+        help="store the cached text encoder outputs in half precision to reduce the size on disk and in memory (default: None,"
+        " float32). for FLUX.1 with --apply_t5_attn_mask, the padding of T5XXL outputs is also removed"
+        " / キャッシュするtext encoderの出力を半精度で保存し、ディスクとメモリの使用量を削減する（デフォルト: None、float32）。"
+        "FLUX.1で--apply_t5_attn_maskを指定した場合、T5XXLの出力のパディングも保存しない",
+    )
+    parser.add_argument(
+        "--text_encoder_outputs_cache_dir",
+        type=str,
+        default=None,
+        help="directory to cache text encoder outputs with --cache_text_encoder_outputs_to_disk, keyed by the caption and the"
+        " text encoders instead of the image. images with the same caption share one file, across datasets and runs"
+        " / --cache_text_encoder_outputs_to_disk指定時に、画像ではなくキャプションとtext encoderをキーとしてtext encoderの出力を"
+        "キャッシュするディレクトリ。同じキャプションの画像は、データセットや学習をまたいで一つのファイルを共有する",
+    )
     parser.add_argument(
         "--disable_mmap_load_safetensors",
         action="store_true",
@@ -0,0 +1,276 @@
+# sharded, append-only cache store for latents and other arrays
+# シャーディングされた追記型のキャッシュストア（latentsなどの配列用）
+#
+# layout of the store directory:
+#   shard-<writer id>-<seq>.bin  : raw array data, each array is aligned to ALIGN bytes
+#   shard-<writer id>-<seq>.idx  : index of the shard, one JSON line per record:
+#       {"key": "path/to/image_0512x0768_flux.npz", "arrays": {"latents_96x64": [offset, [4, 96, 64], "float32"], ...}}
+#
+# each process writes its own shards, so multiple processes (multi-GPU caching) can write to the same directory
+# without locking. a key can be written more than once; arrays in later records are merged into (and override) earlier ones.
+# keys are npz paths, normalized to absolute paths, so relative and absolute paths of the same file are the same key.
+
+import glob
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+SHARD_DATA_EXT = ".bin"
+SHARD_INDEX_EXT = ".idx"
+ALIGN = 64
+DEFAULT_MAX_SHARD_SIZE = 4 * 1024**3  # 4GB
+
+
+class ShardedCacheStore:
+    def __init__(self, store_dir: str, max_shard_size: int = DEFAULT_MAX_SHARD_SIZE) -> None:
+        self.store_dir = store_dir
+        self.max_shard_size = max_shard_size
+        os.makedirs(store_dir, exist_ok=True)
+
+        # key -> {array name: (shard name, offset, shape, dtype)}
+        self._index: Dict[str, Dict[str, Tuple[str, int, Tuple[int, ...], str]]] = {}
+        self._index_loaded = False
+        self._index_read_pos: Dict[str, int] = {}  # index file path -> bytes already read
+
+        self._maps: Dict[str, np.memmap] = {}  # shard name -> memmap, opened lazily
+        self._maps_pid = os.getpid()
+
+        self._lock = threading.Lock()
+        self._writer_id = f"{int(time.time() * 1000):x}-{os.getpid()}"
+        self._writer_seq = -1
+        self._data_file = None
+        self._index_file = None
+        self._shard_name = None
+
+    # region index
+
+    def _load_index(self):
+        if not self._index_loaded:
+            self.refresh()
+
+    def refresh(self):
+        r"""
+        read index files written after the last refresh, including the shards written by other processes.
+        """
+        for index_path in sorted(glob.glob(os.path.join(glob.escape(self.store_dir), "*" + SHARD_INDEX_EXT))):
+            shard_name = os.path.basename(index_path)[: -len(SHARD_INDEX_EXT)]
+            pos = self._index_read_pos.get(index_path, 0)
+            if pos >= os.path.getsize(index_path):
+                continue
+
+            with open(index_path, "rb") as f:
+                f.seek(pos)
+                data = f.read()
+
+            # the last line may be incomplete if the writer is still working or was interrupted
+            last_newline = data.rfind(b"\n")
+            if last_newline < 0:
+                continue
+            for line in data[: last_newline + 1].splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"broken record in cache index, ignored: {index_path}")
+                    continue
+                self._add_record(shard_name, record)
+            self._index_read_pos[index_path] = pos + last_newline + 1
+
+        self._index_loaded = True
+
+    @staticmethod
+    def normalize_key(key: str) -> str:
+        return os.path.abspath(key)
+
+    def _add_record(self, shard_name: str, record: dict):
+        entries = self._index.setdefault(self.normalize_key(record["key"]), {})
+        for name, (offset, shape, dtype) in record["arrays"].items():
+            entries[name] = (shard_name, offset, tuple(shape), dtype)
+
+    def __contains__(self, key: str) -> bool:
+        self._load_index()
+        return self.normalize_key(key) in self._index
+
+    def __len__(self) -> int:
+        self._load_index()
+        return len(self._index)
+
+    def keys(self) -> List[str]:
+        self._load_index()
+        return list(self._index.keys())
+
+    def array_names(self, key: str) -> List[str]:
+        self._load_index()
+        return list(self._index.get(self.normalize_key(key), {}).keys())
+
+    def has_arrays(self, key: str, names: Iterable[str]) -> bool:
+        self._load_index()
+        entries = self._index.get(self.normalize_key(key))
+        return entries is not None and all(name in entries for name in names)
+
+    def get_array_shape(self, key: str, name: str) -> Optional[Tuple[int, ...]]:
+        self._load_index()
+        entry = self._index.get(self.normalize_key(key), {}).get(name)
+        return None if entry is None else entry[2]
+
+    # endregion
+
+    # region read
+
+    def _get_map(self, shard_name: str, required_size: int) -> np.memmap:
+        if self._maps_pid != os.getpid():
+            # forked (e.g. DataLoader worker): do not share mappings with the parent process
+            self._maps = {}
+            self._maps_pid = os.getpid()
+
+        mm = self._maps.get(shard_name)
+        if mm is None or mm.shape[0] < required_size:
+            # copy-on-write mapping: arrays are writable, but changes are never written back to the shard
+            path = os.path.join(self.store_dir, shard_name + SHARD_DATA_EXT)
+            mm = np.memmap(path, dtype=np.uint8, mode="c")
+            self._maps[shard_name] = mm
+        return mm
+
+    def get_arrays(self, key: str, names: Optional[Iterable[str]] = None) -> Dict[str, np.ndarray]:
+        r"""
+        returns arrays for the key as zero-copy views of the memory-mapped shards.
+        if names is None, all arrays for the key are returned. missing names are not included in the result.
+        """
+        self._load_index()
+        key = self.normalize_key(key)
+        entries = self._index.get(key)
+        if entries is None:
+            # the key may be written by another process after the last refresh
+            self.refresh()
+            entries = self._index.get(key)
+            if entries is None:
+                raise KeyError(f"key not found in cache store: {key}")
+
+        if names is None:
+            names = entries.keys()
+
+        arrays = {}
+        for name in names:
+            entry = entries.get(name)
+            if entry is None:
+                continue
+            shard_name, offset, shape, dtype = entry
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            mm = self._get_map(shard_name, offset + nbytes)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=mm, offset=offset)
+        return arrays
+
+    # endregion
+
+    # region write
+
+    def _open_new_shard(self):
+        self._close_shard()
+        self._writer_seq += 1
+        self._shard_name = f"shard-{self._writer_id}-{self._writer_seq:05d}"
+        base = os.path.join(self.store_dir, self._shard_name)
+        self._data_file = open(base + SHARD_DATA_EXT, "ab")
+        self._index_file = open(base + SHARD_INDEX_EXT, "ab")
+
+    def _close_shard(self):
+        if self._data_file is not None:
+            self._data_file.close()
+            self._index_file.close()
+            self._data_file = None
+            self._index_file = None
+
+    def append(self, key: str, arrays: Dict[str, np.ndarray]):
+        r"""
+        append arrays for the key. existing arrays with the same names are overridden, other arrays are kept.
+        the data is flushed before the index record is written, so a partially written record is never visible.
+        """
+        with self._lock:
+            if self._data_file is None or self._data_file.tell() >= self.max_shard_size:
+                self._open_new_shard()
+
+            record_arrays = {}
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+
+                offset = self._data_file.tell()
+                padding = -offset % ALIGN
+                if padding:
+                    self._data_file.write(b"\0" * padding)
+                    offset += padding
+
+                self._data_file.write(array.tobytes())
+                record_arrays[name] = [offset, list(array.shape), array.dtype.str]
+            self._data_file.flush()
+
+            record = {"key": self.normalize_key(key), "arrays": record_arrays}
+            self._index_file.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+            self._index_file.flush()
+
+            self._load_index()
+            self._add_record(self._shard_name, record)
+
+    def close(self):
+        with self._lock:
+            self._close_shard()
+        self._maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # endregion
+
+
+def npz_to_store(npz_paths: Iterable[str], store: ShardedCacheStore, skip_existing: bool = True) -> int:
+    r"""
+    copy npz files into the store. the npz path is used as the key, normalized to an absolute path. the side-car files of the resolutions added
+    later are merged into the same key.
+    returns the number of converted files.
+    """
+    from library.strategy_base import glob_resolution_npz_paths  # import here to avoid circular import
+
+    count = 0
+    for npz_path in npz_paths:
+        if skip_existing and npz_path in store:
+            continue
+        with np.load(npz_path) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        for resolution_npz_path in glob_resolution_npz_paths(npz_path):
+            key_reso_suffix = os.path.splitext(resolution_npz_path)[0][len(os.path.splitext(npz_path)[0]) :]
+            with np.load(resolution_npz_path) as npz:
+                # other files with a similar name, e.g. the cache of "image_64x64.png" for "image.png", are not merged
+                arrays.update({name: npz[name] for name in npz.files if name.endswith(key_reso_suffix)})
+        store.append(npz_path, arrays)
+        count += 1
+    return count
+
+
+def store_to_npz(store: ShardedCacheStore, keys: Optional[Iterable[str]] = None, skip_existing: bool = True) -> int:
+    r"""
+    write arrays in the store to npz files. the key is used as the path of the npz file.
+    returns the number of written files.
+    """
+    count = 0
+    for key in keys if keys is not None else store.keys():
+        if skip_existing and os.path.exists(key):
+            continue
+        arrays = store.get_arrays(key)
+        np.savez(key, **arrays)
+        count += 1
+    return count
@@ -1,7 +1,10 @@
 # base class for platform strategies. this file defines the interface for strategies
 
+import glob
 import os
 import re
+import threading
+import zipfile
 from typing import Any, List, Optional, Tuple, Union
 
 import numpy as np
@@ -12,6 +15,8 @@ from transformers import CLIPTokenizer, CLIPTextModel, CLIPTextModelWithProjecti
 # TODO remove circular import by moving ImageInfo to a separate file
 # from library.train_util import ImageInfo
 
+from library.content_addressed_cache import ContentAddressedLatentsCache, ContentAddressedTextEncoderOutputsCache
+from library.sharded_cache import ShardedCacheStore
 from library.utils import setup_logging
 
 setup_logging()
@@ -20,6 +25,36 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def get_resolution_npz_path(npz_path: str, key_reso_suffix: str) -> str:
+    r"""
+    returns the side-car npz path for the arrays of another resolution, e.g. "image_1024x768_flux_96x128.npz" for
+    "image_1024x768_flux.npz" and "_96x128". arrays of a resolution which is added to an existing npz file are written to
+    the side-car file, so adding a resolution writes only its own bytes and the existing file is never rewritten.
+    """
+    return os.path.splitext(npz_path)[0] + key_reso_suffix + ".npz"
+
+
+def glob_resolution_npz_paths(npz_path: str) -> List[str]:
+    r"""
+    returns the side-car npz paths of all resolutions for npz_path
+    """
+    stem = os.path.splitext(npz_path)[0]
+    paths = glob.glob(glob.escape(stem) + "_*x*.npz")
+    return sorted(path for path in paths if re.fullmatch(r"_\d+x\d+\.npz", path[len(stem) :]))
+
+
+def get_npz_array_names(npz_path: str) -> Optional[List[str]]:
+    r"""
+    returns the names of the arrays in the npz file from the zip directory without reading the arrays,
+    or None if the file is not a valid npz file.
+    """
+    try:
+        with zipfile.ZipFile(npz_path, mode="r") as zf:
+            return [name[: -len(".npy")] for name in zf.namelist() if name.endswith(".npy")]
+    except zipfile.BadZipFile:
+        return None
+
+
 class TokenizeStrategy:
     _strategy = None  # strategy instance: actual strategy class
 
@@ -335,6 +370,8 @@ class TextEncoderOutputsCachingStrategy:
         self.skip_disk_cache_validity_check = skip_disk_cache_validity_check
         self._is_partial = is_partial
         self._is_weighted = is_weighted
+        self._cache_dtype: Optional[torch.dtype] = None
+        self._content_cache: Optional[ContentAddressedTextEncoderOutputsCache] = None
 
     @classmethod
     def set_strategy(cls, strategy):
@@ -362,6 +399,85 @@ class TextEncoderOutputsCachingStrategy:
     def is_weighted(self):
         return self._is_weighted
 
+    @property
+    def cache_dtype(self) -> Optional[torch.dtype]:
+        return self._cache_dtype
+
+    def set_cache_dtype(self, cache_dtype: Optional[torch.dtype]):
+        r"""
+        store the floating point outputs in cache_dtype (float16 or bfloat16) on disk and in memory. the outputs are
+        converted to float32 when loaded. None (default) stores float32 as before.
+        """
+        assert cache_dtype in [None, torch.float16, torch.bfloat16], f"unsupported cache dtype: {cache_dtype}"
+        self._cache_dtype = cache_dtype
+
+    @property
+    def content_cache(self) -> Optional[ContentAddressedTextEncoderOutputsCache]:
+        return self._content_cache
+
+    def set_content_cache(self, content_cache: Optional[ContentAddressedTextEncoderOutputsCache]):
+        r"""
+        store disk cache in the shared directory with the paths from the captions, instead of next to the images.
+        images with the same caption share one file.
+        """
+        self._content_cache = content_cache
+
+    @property
+    def cache_suffix(self) -> str:
+        raise NotImplementedError
+
+    def get_outputs_cache_params(self) -> str:
+        r"""
+        the options which change the outputs for the same caption and text encoders, for the keys of the content cache.
+        """
+        return f"{type(self).__name__},is_weighted={self.is_weighted}"
+
+    def encode_cache_array(self, output: torch.Tensor) -> np.ndarray:
+        r"""
+        convert the outputs of a batch to an array on CPU for the cache. bfloat16 is stored as its bits in uint16, because
+        numpy doesn't support bfloat16.
+        """
+        if self._cache_dtype is None:
+            return (output.float() if output.dtype == torch.bfloat16 else output).cpu().numpy()
+        output = output.to("cpu", self._cache_dtype)
+        if output.dtype == torch.bfloat16:
+            return output.view(torch.int16).numpy().view(np.uint16)
+        return output.numpy()
+
+    @staticmethod
+    def trim_padding(array: np.ndarray, attn_mask: np.ndarray) -> np.ndarray:
+        r"""
+        remove the positions after the last token of attn_mask from the array of a sample. use only if the padding is masked
+        in the model, decode_cache_array pads the array with zeros again.
+        """
+        indices = np.nonzero(attn_mask)[0]
+        length = int(indices[-1]) + 1 if len(indices) > 0 else 0
+        return array[:length].copy()  # copy not to keep the array of the batch
+
+    @staticmethod
+    def decode_cache_array(array: np.ndarray, length: Optional[int] = None) -> np.ndarray:
+        r"""
+        convert an array encoded by encode_cache_array to float32, and pad it with zeros to length along the first axis if it
+        is trimmed. float32 arrays of full length are returned as is.
+        """
+        if array.dtype == np.float32 and (length is None or len(array) == length):
+            return array
+
+        shape = (length if length is not None else len(array),) + array.shape[1:]
+        decoded = np.empty(shape, dtype=np.float32) if shape[0] == len(array) else np.zeros(shape, dtype=np.float32)
+        if array.dtype == np.uint16:
+            # bits of bfloat16 are the upper 16 bits of float32
+            np.left_shift(array, 16, out=decoded[: len(array)].view(np.uint32), dtype=np.uint32)
+        else:
+            decoded[: len(array)] = array
+        return decoded
+
+    def decode_outputs(self, outputs: List[np.ndarray]) -> List[np.ndarray]:
+        r"""
+        convert the outputs cached in memory to the same form as load_outputs_npz.
+        """
+        return outputs
+
     def get_outputs_npz_path(self, image_abs_path: str) -> str:
         raise NotImplementedError
 
@@ -386,6 +502,8 @@ class LatentsCachingStrategy:
         self._cache_to_disk = cache_to_disk
         self._batch_size = batch_size
         self.skip_disk_cache_validity_check = skip_disk_cache_validity_check
+        self._cache_store: Optional[ShardedCacheStore] = None
+        self._content_cache: Optional[ContentAddressedLatentsCache] = None
 
     @classmethod
     def set_strategy(cls, strategy):
@@ -409,6 +527,40 @@ class LatentsCachingStrategy:
     def cache_suffix(self):
         raise NotImplementedError
 
+    @property
+    def cache_store(self) -> Optional[ShardedCacheStore]:
+        return self._cache_store
+
+    def set_cache_store(self, cache_store: Optional[ShardedCacheStore]):
+        r"""
+        store disk cache in the sharded cache store instead of per-image npz files.
+        npz_path is used as the key in the store, and existing npz files are still readable.
+        """
+        self._cache_store = cache_store
+
+    @property
+    def content_cache(self) -> Optional[ContentAddressedLatentsCache]:
+        return self._content_cache
+
+    def set_content_cache(self, content_cache: Optional[ContentAddressedLatentsCache]):
+        r"""
+        store disk cache in the shared directory with the paths from the image contents, instead of next to the images.
+        """
+        self._content_cache = content_cache
+
+    def glob_disk_cache_paths(self, image_dir: str) -> List[str]:
+        r"""
+        returns npz paths (or the keys in the cache store) of the disk cache in the directory
+        """
+        npz_paths = glob.glob(os.path.join(image_dir, "*" + self.cache_suffix))
+        if self._cache_store is not None:
+            npz_paths_set = set(self._cache_store.normalize_key(path) for path in npz_paths)
+            key_dir = os.path.dirname(self._cache_store.normalize_key(os.path.join(image_dir, "_")))
+            for key in self._cache_store.keys():
+                if key not in npz_paths_set and key.endswith(self.cache_suffix) and os.path.dirname(key) == key_dir:
+                    npz_paths.append(key)
+        return npz_paths
+
     def get_image_size_from_disk_cache_path(self, absolute_path: str, npz_path: str) -> Tuple[Optional[int], Optional[int]]:
         w, h = os.path.splitext(npz_path)[0].split("_")[-2].split("x")
         return int(w), int(h)
@@ -422,6 +574,43 @@ class LatentsCachingStrategy:
         raise NotImplementedError
 
     def cache_batch_latents(self, model: Any, batch: List, flip_aug: bool, alpha_mask: bool, random_crop: bool):
+        r"""
+        cache latents of the batch. this runs the three stages of caching in order: prepare_batch_for_caching,
+        encode_batch_latents and save_batch_latents. the caching pipeline runs them in different threads instead.
+        """
+        img_tensor, alpha_masks, original_sizes, crop_ltrbs = self.prepare_batch_for_caching(batch, alpha_mask, random_crop)
+        latents, flipped_latents = self.encode_batch_latents(model, img_tensor, flip_aug)
+        self.save_batch_latents(batch, latents, flipped_latents, alpha_masks, original_sizes, crop_ltrbs)
+
+    def prepare_batch_for_caching(self, image_infos: List, alpha_mask: bool, random_crop: bool):
+        r"""
+        load and resize images of the batch. this is called from worker threads, so it must not use the model.
+        returns: img_tensor, alpha_masks, original_sizes, crop_ltrbs
+        """
+        from library import train_util  # import here to avoid circular import
+
+        return train_util.load_images_and_masks_for_caching(image_infos, alpha_mask, random_crop)
+
+    def encode_batch_latents(
+        self, model: Any, img_tensor: torch.Tensor, flip_aug: bool
+    ) -> Tuple[torch.Tensor, Union[torch.Tensor, List[None]]]:
+        r"""
+        encode images by the model. returns latents and flipped latents on CPU. flipped latents are Nones if flip_aug is False
+        """
+        raise NotImplementedError
+
+    def save_batch_latents(
+        self,
+        image_infos: List,
+        latents: torch.Tensor,
+        flipped_latents: Union[torch.Tensor, List[None]],
+        alpha_masks: List[Optional[torch.Tensor]],
+        original_sizes: List[Tuple[int, int]],
+        crop_ltrbs: List[Tuple[int, int, int, int]],
+    ):
+        r"""
+        save latents to disk, or set them to image_infos. this is called from writer threads.
+        """
         raise NotImplementedError
 
     def _default_is_disk_cached_latents_expected(
@@ -435,7 +624,9 @@ class LatentsCachingStrategy:
     ):
         if not self.cache_to_disk:
             return False
-        if not os.path.exists(npz_path):
+
+        in_store = self._cache_store is not None and npz_path in self._cache_store
+        if not in_store and not os.path.exists(npz_path):
             return False
         if self.skip_disk_cache_validity_check:
             return True
@@ -445,8 +636,16 @@ class LatentsCachingStrategy:
         # e.g. "_32x64", HxW
         key_reso_suffix = f"_{expected_latents_size[0]}x{expected_latents_size[1]}" if multi_resolution else ""
 
+        if in_store:
+            names = ["latents" + key_reso_suffix]
+            if flip_aug:
+                names.append("latents_flipped" + key_reso_suffix)
+            if alpha_mask:
+                names.append("alpha_mask" + key_reso_suffix)
+            return self._cache_store.has_arrays(npz_path, names)
+
         try:
-            npz = np.load(npz_path)
+            npz = self._load_npz_of_resolution(npz_path, key_reso_suffix)
             if "latents" + key_reso_suffix not in npz:
                 return False
             if flip_aug and "latents_flipped" + key_reso_suffix not in npz:
@@ -474,11 +673,13 @@ class LatentsCachingStrategy:
         """
         Default implementation for cache_batch_latents. Image loading, VAE, flipping, alpha mask handling are common.
         """
-        from library import train_util  # import here to avoid circular import
-
-        img_tensor, alpha_masks, original_sizes, crop_ltrbs = train_util.load_images_and_masks_for_caching(
-            image_infos, alpha_mask, random_crop
+        img_tensor, alpha_masks, original_sizes, crop_ltrbs = self.prepare_batch_for_caching(image_infos, alpha_mask, random_crop)
+        latents_tensors, flipped_latents = self._default_encode_batch_latents(encode_by_vae, vae_device, vae_dtype, img_tensor, flip_aug)
+        self._default_save_batch_latents(
+            image_infos, latents_tensors, flipped_latents, alpha_masks, original_sizes, crop_ltrbs, multi_resolution
         )
+
+    def _default_encode_batch_latents(self, encode_by_vae, vae_device, vae_dtype, img_tensor: torch.Tensor, flip_aug: bool):
         img_tensor = img_tensor.to(device=vae_device, dtype=vae_dtype)
 
         with torch.no_grad():
@@ -489,6 +690,19 @@ class LatentsCachingStrategy:
                 flipped_latents = encode_by_vae(img_tensor).to("cpu")
         else:
             flipped_latents = [None] * len(latents_tensors)
+        return latents_tensors, flipped_latents
+
+    def _default_save_batch_latents(
+        self,
+        image_infos: List,
+        latents_tensors: torch.Tensor,
+        flipped_latents: Union[torch.Tensor, List[None]],
+        alpha_masks: List[Optional[torch.Tensor]],
+        original_sizes: List[Tuple[int, int]],
+        crop_ltrbs: List[Tuple[int, int, int, int]],
+        multi_resolution: bool = False,
+    ):
+        flip_aug = flipped_latents[0] is not None
 
         # for info, latents, flipped_latent, alpha_mask in zip(image_infos, latents_tensors, flipped_latents, alpha_masks):
         for i in range(len(image_infos)):
@@ -531,7 +745,11 @@ class LatentsCachingStrategy:
             latents_size = (bucket_reso[1] // latents_stride, bucket_reso[0] // latents_stride)  # bucket_reso is (W, H)
             key_reso_suffix = f"_{latents_size[0]}x{latents_size[1]}"  # e.g. "_32x64", HxW
 
-        npz = np.load(npz_path)
+        if self._cache_store is not None and (npz_path in self._cache_store or not os.path.exists(npz_path)):
+            # zero-copy views of the memory-mapped shards
+            npz = self._cache_store.get_arrays(npz_path)
+        else:
+            npz = self._load_npz_of_resolution(npz_path, key_reso_suffix)
         if "latents" + key_reso_suffix not in npz:
             raise ValueError(f"latents{key_reso_suffix} not found in {npz_path}")
 
@@ -542,6 +760,17 @@ class LatentsCachingStrategy:
         alpha_mask = npz["alpha_mask" + key_reso_suffix] if "alpha_mask" + key_reso_suffix in npz else None
         return latents, original_size, crop_ltrb, flipped_latents, alpha_mask
 
+    @staticmethod
+    def _load_npz_of_resolution(npz_path: str, key_reso_suffix: str):
+        # the arrays of the resolution are in npz_path, or in the side-car file if they were added later
+        npz = np.load(npz_path)
+        if key_reso_suffix and "latents" + key_reso_suffix not in npz:
+            resolution_npz_path = get_resolution_npz_path(npz_path, key_reso_suffix)
+            if os.path.exists(resolution_npz_path):
+                npz.close()
+                npz = np.load(resolution_npz_path)
+        return npz
+
     def save_latents_to_disk(
         self,
         npz_path,
@@ -552,14 +781,19 @@ class LatentsCachingStrategy:
         alpha_mask=None,
         key_reso_suffix="",
     ):
-        kwargs = {}
-
-        if os.path.exists(npz_path):
-            # load existing npz and update it
-            npz = np.load(npz_path)
-            for key in npz.files:
-                kwargs[key] = npz[key]
+        if self._cache_store is not None:
+            # append to the store: arrays for other resolutions in the store are kept as is
+            arrays = {"latents" + key_reso_suffix: latents_tensor.float().cpu().numpy()}
+            arrays["original_size" + key_reso_suffix] = np.array(original_size)
+            arrays["crop_ltrb" + key_reso_suffix] = np.array(crop_ltrb)
+            if flipped_latents_tensor is not None:
+                arrays["latents_flipped" + key_reso_suffix] = flipped_latents_tensor.float().cpu().numpy()
+            if alpha_mask is not None:
+                arrays["alpha_mask" + key_reso_suffix] = alpha_mask.float().cpu().numpy()
+            self._cache_store.append(npz_path, arrays)
+            return
 
+        kwargs = {}
         kwargs["latents" + key_reso_suffix] = latents_tensor.float().cpu().numpy()
         kwargs["original_size" + key_reso_suffix] = np.array(original_size)
         kwargs["crop_ltrb" + key_reso_suffix] = np.array(crop_ltrb)
@@ -567,4 +801,23 @@ class LatentsCachingStrategy:
             kwargs["latents_flipped" + key_reso_suffix] = flipped_latents_tensor.float().cpu().numpy()
         if alpha_mask is not None:
             kwargs["alpha_mask" + key_reso_suffix] = alpha_mask.float().cpu().numpy()
-        np.savez(npz_path, **kwargs)
+
+        if os.path.exists(npz_path):
+            existing_names = get_npz_array_names(npz_path)
+            if existing_names is None:
+                logger.warning(f"invalid npz file, overwritten / 無効なnpzファイルのため上書きします: {npz_path}")
+            elif key_reso_suffix and "latents" + key_reso_suffix not in existing_names:
+                # another resolution: write it to the side-car file instead of rewriting the existing arrays
+                npz_path = get_resolution_npz_path(npz_path, key_reso_suffix)
+            else:
+                # some keys are overwritten: load existing npz and update it
+                npz = np.load(npz_path)
+                kwargs = {**{key: npz[key] for key in npz.files if key not in kwargs}, **kwargs}
+                npz.close()
+        elif self._content_cache is not None:
+            os.makedirs(os.path.dirname(npz_path), exist_ok=True)
+
+        # write to a temporary file and rename it, so other processes never read a partially written file
+        tmp_path = f"{npz_path}.{os.getpid()}-{threading.get_ident()}.tmp.npz"  # np.savez appends .npz if not ends with it
+        np.savez(tmp_path, **kwargs)
+        os.replace(tmp_path, npz_path)
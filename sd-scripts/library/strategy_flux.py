@@ -101,9 +101,16 @@ class FluxTextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
 
         self.warn_fp8_weights = False
 
+    @property
+    def cache_suffix(self) -> str:
+        return FluxTextEncoderOutputsCachingStrategy.FLUX_TEXT_ENCODER_OUTPUTS_NPZ_SUFFIX
+
     def get_outputs_npz_path(self, image_abs_path: str) -> str:
         return os.path.splitext(image_abs_path)[0] + FluxTextEncoderOutputsCachingStrategy.FLUX_TEXT_ENCODER_OUTPUTS_NPZ_SUFFIX
 
+    def get_outputs_cache_params(self) -> str:
+        return super().get_outputs_cache_params() + f",apply_t5_attn_mask={self.apply_t5_attn_mask}"
+
     def is_disk_cached_outputs_expected(self, npz_path: str):
         if not self.cache_to_disk:
             return False
@@ -140,6 +147,14 @@ class FluxTextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
         txt_ids = data["txt_ids"]
         t5_attn_mask = data["t5_attn_mask"]
         # apply_t5_attn_mask should be same as self.apply_t5_attn_mask
+        return self.decode_outputs([l_pooled, t5_out, txt_ids, t5_attn_mask])
+
+    def decode_outputs(self, outputs: List[np.ndarray]) -> List[np.ndarray]:
+        l_pooled, t5_out, txt_ids, t5_attn_mask = outputs
+        length = len(t5_attn_mask)  # t5_out and txt_ids may be trimmed
+        l_pooled = self.decode_cache_array(l_pooled)
+        t5_out = self.decode_cache_array(t5_out, length)
+        txt_ids = self.decode_cache_array(txt_ids, length)
         return [l_pooled, t5_out, txt_ids, t5_attn_mask]
 
     def cache_batch_outputs(
@@ -161,16 +176,9 @@ class FluxTextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
             # attn_mask is applied in text_encoding_strategy.encode_tokens if apply_t5_attn_mask is True
             l_pooled, t5_out, txt_ids, _ = flux_text_encoding_strategy.encode_tokens(tokenize_strategy, models, tokens_and_masks)
 
-        if l_pooled.dtype == torch.bfloat16:
-            l_pooled = l_pooled.float()
-        if t5_out.dtype == torch.bfloat16:
-            t5_out = t5_out.float()
-        if txt_ids.dtype == torch.bfloat16:
-            txt_ids = txt_ids.float()
-
-        l_pooled = l_pooled.cpu().numpy()
-        t5_out = t5_out.cpu().numpy()
-        txt_ids = txt_ids.cpu().numpy()
+        l_pooled = self.encode_cache_array(l_pooled)
+        t5_out = self.encode_cache_array(t5_out)
+        txt_ids = self.encode_cache_array(txt_ids)
         t5_attn_mask = tokens_and_masks[2].cpu().numpy()
 
         for i, info in enumerate(infos):
@@ -180,6 +188,11 @@ class FluxTextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
             t5_attn_mask_i = t5_attn_mask[i]
             apply_t5_attn_mask_i = self.apply_t5_attn_mask
 
+            if self.cache_dtype is not None and self.apply_t5_attn_mask:
+                # the padding is masked in the model, so it is not stored. padded with zeros when loaded
+                t5_out_i = self.trim_padding(t5_out_i, t5_attn_mask_i)
+                txt_ids_i = self.trim_padding(txt_ids_i, t5_attn_mask_i)
+
             if self.cache_to_disk:
                 np.savez(
                     info.text_encoder_outputs_npz,
@@ -219,18 +232,19 @@ class FluxLatentsCachingStrategy(LatentsCachingStrategy):
     ) -> Tuple[Optional[np.ndarray], Optional[List[int]], Optional[List[int]], Optional[np.ndarray], Optional[np.ndarray]]:
         return self._default_load_latents_from_disk(8, npz_path, bucket_reso)  # support multi-resolution
 
-    # TODO remove circular dependency for ImageInfo
-    def cache_batch_latents(self, vae, image_infos: List, flip_aug: bool, alpha_mask: bool, random_crop: bool):
+    def encode_batch_latents(self, vae, img_tensor: torch.Tensor, flip_aug: bool):
         encode_by_vae = lambda img_tensor: vae.encode(img_tensor).to("cpu")
-        vae_device = vae.device
-        vae_dtype = vae.dtype
-
-        self._default_cache_batch_latents(
-            encode_by_vae, vae_device, vae_dtype, image_infos, flip_aug, alpha_mask, random_crop, multi_resolution=True
-        )
+        latents, flipped_latents = self._default_encode_batch_latents(encode_by_vae, vae.device, vae.dtype, img_tensor, flip_aug)
 
         if not train_util.HIGH_VRAM:
             train_util.clean_memory_on_device(vae.device)
+        return latents, flipped_latents
+
+    # TODO remove circular dependency for ImageInfo
+    def save_batch_latents(self, image_infos: List, latents, flipped_latents, alpha_masks, original_sizes, crop_ltrbs):
+        self._default_save_batch_latents(
+            image_infos, latents, flipped_latents, alpha_masks, original_sizes, crop_ltrbs, multi_resolution=True
+        )
 
 
 if __name__ == "__main__":
@@ -159,13 +159,14 @@ class SdSdxlLatentsCachingStrategy(LatentsCachingStrategy):
     def is_disk_cached_latents_expected(self, bucket_reso: Tuple[int, int], npz_path: str, flip_aug: bool, alpha_mask: bool):
         return self._default_is_disk_cached_latents_expected(8, bucket_reso, npz_path, flip_aug, alpha_mask)
 
-    # TODO remove circular dependency for ImageInfo
-    def cache_batch_latents(self, vae, image_infos: List, flip_aug: bool, alpha_mask: bool, random_crop: bool):
+    def encode_batch_latents(self, vae, img_tensor: torch.Tensor, flip_aug: bool):
         encode_by_vae = lambda img_tensor: vae.encode(img_tensor).latent_dist.sample()
-        vae_device = vae.device
-        vae_dtype = vae.dtype
-
-        self._default_cache_batch_latents(encode_by_vae, vae_device, vae_dtype, image_infos, flip_aug, alpha_mask, random_crop)
+        latents, flipped_latents = self._default_encode_batch_latents(encode_by_vae, vae.device, vae.dtype, img_tensor, flip_aug)
 
         if not train_util.HIGH_VRAM:
             train_util.clean_memory_on_device(vae.device)
+        return latents, flipped_latents
+
+    # TODO remove circular dependency for ImageInfo
+    def save_batch_latents(self, image_infos: List, latents, flipped_latents, alpha_masks, original_sizes, crop_ltrbs):
+        self._default_save_batch_latents(image_infos, latents, flipped_latents, alpha_masks, original_sizes, crop_ltrbs)
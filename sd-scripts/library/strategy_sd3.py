@@ -269,9 +269,17 @@ class Sd3TextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
         self.apply_lg_attn_mask = apply_lg_attn_mask
         self.apply_t5_attn_mask = apply_t5_attn_mask
 
+    @property
+    def cache_suffix(self) -> str:
+        return Sd3TextEncoderOutputsCachingStrategy.SD3_TEXT_ENCODER_OUTPUTS_NPZ_SUFFIX
+
     def get_outputs_npz_path(self, image_abs_path: str) -> str:
         return os.path.splitext(image_abs_path)[0] + Sd3TextEncoderOutputsCachingStrategy.SD3_TEXT_ENCODER_OUTPUTS_NPZ_SUFFIX
 
+    def get_outputs_cache_params(self) -> str:
+        params = super().get_outputs_cache_params()
+        return params + f",apply_lg_attn_mask={self.apply_lg_attn_mask},apply_t5_attn_mask={self.apply_t5_attn_mask}"
+
     def is_disk_cached_outputs_expected(self, npz_path: str):
         if not self.cache_to_disk:
             return False
@@ -319,6 +327,14 @@ class Sd3TextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
         t5_attn_mask = data["t5_attn_mask"]
 
         # apply_t5_attn_mask and apply_lg_attn_mask are same as self.apply_t5_attn_mask and self.apply_lg_attn_mask
+        return self.decode_outputs([lg_out, t5_out, lg_pooled, l_attn_mask, g_attn_mask, t5_attn_mask])
+
+    def decode_outputs(self, outputs: List[np.ndarray]) -> List[np.ndarray]:
+        # the padding is not trimmed, because the model uses the outputs for the padding
+        lg_out, t5_out, lg_pooled, l_attn_mask, g_attn_mask, t5_attn_mask = outputs
+        lg_out = self.decode_cache_array(lg_out)
+        t5_out = self.decode_cache_array(t5_out)
+        lg_pooled = self.decode_cache_array(lg_pooled)
         return [lg_out, t5_out, lg_pooled, l_attn_mask, g_attn_mask, t5_attn_mask]
 
     def cache_batch_outputs(
@@ -339,16 +355,9 @@ class Sd3TextEncoderOutputsCachingStrategy(TextEncoderOutputsCachingStrategy):
                 enable_dropout=False,
             )
 
-        if lg_out.dtype == torch.bfloat16:
-            lg_out = lg_out.float()
-        if lg_pooled.dtype == torch.bfloat16:
-            lg_pooled = lg_pooled.float()
-        if t5_out.dtype == torch.bfloat16:
-            t5_out = t5_out.float()
-
-        lg_out = lg_out.cpu().numpy()
-        lg_pooled = lg_pooled.cpu().numpy()
-        t5_out = t5_out.cpu().numpy()
+        lg_out = self.encode_cache_array(lg_out)
+        lg_pooled = self.encode_cache_array(lg_pooled)
+        t5_out = self.encode_cache_array(t5_out)
 
         l_attn_mask = tokens_and_masks[3].cpu().numpy()
         g_attn_mask = tokens_and_masks[4].cpu().numpy()
@@ -406,15 +415,16 @@ class Sd3LatentsCachingStrategy(LatentsCachingStrategy):
     ) -> Tuple[Optional[np.ndarray], Optional[List[int]], Optional[List[int]], Optional[np.ndarray], Optional[np.ndarray]]:
         return self._default_load_latents_from_disk(8, npz_path, bucket_reso)  # support multi-resolution
 
-    # TODO remove circular dependency for ImageInfo
-    def cache_batch_latents(self, vae, image_infos: List, flip_aug: bool, alpha_mask: bool, random_crop: bool):
+    def encode_batch_latents(self, vae, img_tensor: torch.Tensor, flip_aug: bool):
         encode_by_vae = lambda img_tensor: vae.encode(img_tensor).to("cpu")
-        vae_device = vae.device
-        vae_dtype = vae.dtype
-
-        self._default_cache_batch_latents(
-            encode_by_vae, vae_device, vae_dtype, image_infos, flip_aug, alpha_mask, random_crop, multi_resolution=True
-        )
+        latents, flipped_latents = self._default_encode_batch_latents(encode_by_vae, vae.device, vae.dtype, img_tensor, flip_aug)
 
         if not train_util.HIGH_VRAM:
             train_util.clean_memory_on_device(vae.device)
+        return latents, flipped_latents
+
+    # TODO remove circular dependency for ImageInfo
+    def save_batch_latents(self, image_infos: List, latents, flipped_latents, alpha_masks, original_sizes, crop_ltrbs):
+        self._default_save_batch_latents(
+            image_infos, latents, flipped_latents, alpha_masks, original_sizes, crop_ltrbs, multi_resolution=True
+        )
@@ -3,7 +3,7 @@
 import argparse
 import ast
 import asyncio
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import importlib
 import json
@@ -15,13 +15,13 @@ import time
 import typing
 from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 from accelerate import Accelerator, InitProcessGroupKwargs, DistributedDataParallelKwargs, PartialState
+from accelerate.utils import DataLoaderConfiguration
 import glob
 import math
 import os
 import random
 import hashlib
 import subprocess
-from io import BytesIO
 import toml
 
 # from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -32,6 +32,17 @@ from packaging.version import Version
 import torch
 from library.device_utils import init_ipex, clean_memory_on_device
 from library.strategy_base import LatentsCachingStrategy, TokenizeStrategy, TextEncoderOutputsCachingStrategy, TextEncodingStrategy
+from library.sharded_cache import ShardedCacheStore
+from library.content_addressed_cache import (
+    ContentAddressedLatentsCache,
+    ContentAddressedTextEncoderOutputsCache,
+    normalize_caption,
+    set_model_source,
+)
+from library.image_size_index import ImageSizeIndex, probe_image_sizes
+from library.caching_pipeline import CachingPipeline
+from library import async_checkpoint
+from library.dataset_manifest import DatasetManifest
 
 init_ipex()
 
@@ -74,7 +85,7 @@ import library.model_util as model_util
 import library.huggingface_util as huggingface_util
 import library.sai_model_spec as sai_model_spec
 import library.deepspeed_utils as deepspeed_utils
-from library.utils import setup_logging, pil_resize
+from library.utils import setup_logging, pil_resize, get_safetensors_layout, tensor_to_uint8_array, str_to_dtype
 
 setup_logging()
 import logging
@@ -339,6 +350,86 @@ class BucketManager:
         ar_error = (reso[0] / reso[1]) - aspect_ratio
         return reso, resized_size, ar_error
 
+    def select_buckets(self, image_widths, image_heights) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        r"""
+        vectorized version of select_bucket for many images at once. the results are the same as select_bucket.
+        returns (bucket ids [N], resized sizes [N, 2] as (width, height), ar errors [N]).
+        new buckets are added in the order of the images, same as calling select_bucket for each image.
+        """
+        image_widths = np.asarray(image_widths, dtype=np.int64)
+        image_heights = np.asarray(image_heights, dtype=np.int64)
+        if len(image_widths) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.float64)
+        assert (image_widths > 0).all() and (image_heights > 0).all(), "image size must be positive / 画像サイズは正の値が必要です"
+
+        aspect_ratios = image_widths / image_heights
+
+        if not self.no_upscale:
+            # 拡大および縮小を行う
+            predefined_resos = list(self.predefined_resos)
+            predefined_resos_array = np.array(predefined_resos, dtype=np.int64)  # [M, 2]
+
+            # same resolution is preferred, otherwise the resolution with the least aspect ratio error
+            reso_indices = np.abs(self.predefined_aspect_ratios[None, :] - aspect_ratios[:, None]).argmin(axis=1)
+            predefined_keys = predefined_resos_array[:, 0] * (1 << 32) + predefined_resos_array[:, 1]
+            sorter = np.argsort(predefined_keys)
+            image_keys = image_widths * (1 << 32) + image_heights
+            pos = np.clip(np.searchsorted(predefined_keys, image_keys, sorter=sorter), 0, len(sorter) - 1)
+            exact = predefined_keys[sorter[pos]] == image_keys
+            reso_indices = np.where(exact, sorter[pos], reso_indices)
+
+            resos = predefined_resos_array[reso_indices]
+            ar_resos = resos[:, 0] / resos[:, 1]
+            scales = np.where(aspect_ratios > ar_resos, resos[:, 1] / image_heights, resos[:, 0] / image_widths)
+            resized_sizes = np.stack(
+                [(image_widths * scales + 0.5).astype(np.int64), (image_heights * scales + 0.5).astype(np.int64)], axis=1
+            )
+        else:
+            # 縮小のみを行う
+            resized_sizes = np.stack([image_widths, image_heights], axis=1)
+            too_large = image_widths * image_heights > self.max_area
+            if too_large.any():
+                ars = aspect_ratios[too_large]
+                resized_widths = np.sqrt(self.max_area * ars)
+                resized_heights = self.max_area / resized_widths
+                assert (np.abs(resized_widths / resized_heights - ars) < 1e-2).all(), "aspect is illegal"
+
+                def round_to_steps(x):
+                    x = (x + 0.5).astype(np.int64)
+                    return x - x % self.reso_steps
+
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    b_widths_rounded = round_to_steps(resized_widths)
+                    b_heights_in_wr = round_to_steps(b_widths_rounded / ars)
+                    ar_widths_rounded = b_widths_rounded / b_heights_in_wr
+
+                    b_heights_rounded = round_to_steps(resized_heights)
+                    b_widths_in_hr = round_to_steps(b_heights_rounded * ars)
+                    ar_heights_rounded = b_widths_in_hr / b_heights_rounded
+
+                use_width = np.abs(ar_widths_rounded - ars) < np.abs(ar_heights_rounded - ars)
+                resized_sizes[too_large] = np.where(
+                    use_width[:, None],
+                    np.stack([b_widths_rounded, (b_widths_rounded / ars + 0.5).astype(np.int64)], axis=1),
+                    np.stack([(b_heights_rounded * ars + 0.5).astype(np.int64), b_heights_rounded], axis=1),
+                )
+
+            # 画像のサイズ未満をbucketのサイズとする（paddingせずにcroppingする）
+            resos = resized_sizes - resized_sizes % self.reso_steps
+
+        # register new buckets in the order of appearance
+        reso_keys = resos[:, 0] * (1 << 32) + resos[:, 1]
+        unique_keys, first_indices, inverse = np.unique(reso_keys, return_index=True, return_inverse=True)
+        unique_bucket_ids = np.zeros(len(unique_keys), dtype=np.int64)
+        for i in np.argsort(first_indices):
+            reso = (int(unique_keys[i] >> 32), int(unique_keys[i] & 0xFFFFFFFF))
+            self.add_if_new_reso(reso)
+            unique_bucket_ids[i] = self.reso_to_id[reso]
+        bucket_ids = unique_bucket_ids[inverse.reshape(-1)]
+
+        ar_errors = resos[:, 0] / resos[:, 1] - aspect_ratios
+        return bucket_ids, resized_sizes, ar_errors
+
     @staticmethod
     def get_crop_ltrb(bucket_reso: Tuple[int, int], image_size: Tuple[int, int]):
         # Stability AIの前処理に合わせてcrop left/topを計算する。crop rightはflipのaugmentationのために求める
@@ -366,6 +457,193 @@ class BucketBatchIndex(NamedTuple):
     batch_index: int
 
 
+class BucketBatchScheduler:
+    r"""
+    decides how the images in the buckets are split into batches. the default scheduler makes
+    ceil(len(bucket) / batch_size) batches for each bucket, same as before.
+
+    subclasses can reassign images to other buckets in `merge_buckets` before the batches are made,
+    and change the batch size for each bucket in `get_bucket_batch_size`. the batch size must be same in a bucket,
+    because BucketBatchIndex specifies the batch by its index in the bucket.
+    """
+
+    def __init__(self, batch_size: int) -> None:
+        self.batch_size = batch_size
+
+    def merge_buckets(self, bucket_manager: BucketManager, image_data: Dict[str, "ImageInfo"]):
+        pass
+
+    def get_bucket_batch_size(self, reso: Tuple[int, int], max_pixels: int) -> int:
+        return self.batch_size
+
+    def make_batches(self, bucket_manager: BucketManager) -> List[BucketBatchIndex]:
+        max_pixels = max([w * h for (w, h), bucket in zip(bucket_manager.resos, bucket_manager.buckets) if len(bucket) > 0] or [0])
+
+        buckets_indices: List[BucketBatchIndex] = []
+        for bucket_index, (reso, bucket) in enumerate(zip(bucket_manager.resos, bucket_manager.buckets)):
+            if len(bucket) == 0:
+                continue
+            bucket_batch_size = self.get_bucket_batch_size(reso, max_pixels)
+            batch_count = int(math.ceil(len(bucket) / bucket_batch_size))
+            for batch_index in range(batch_count):
+                buckets_indices.append(BucketBatchIndex(bucket_index, bucket_batch_size, batch_index))
+        return buckets_indices
+
+    @staticmethod
+    def estimate_efficiency(
+        bucket_manager: BucketManager, buckets_indices: List[BucketBatchIndex], batch_size: int, world_size: int
+    ) -> Dict[str, float]:
+        r"""
+        estimate throughput efficiency of the batches:
+        - fill_efficiency: images / (batches * batch_size). partial batches lower it
+        - rank_balance_efficiency: mean / max of pixel loads of the batches processed at the same step on the ranks,
+          estimated with random groups of batches because the DataLoader shuffles them. slower ranks make others wait
+        - expected_efficiency: product of them
+        """
+        if len(buckets_indices) == 0:
+            return {"fill_efficiency": 1.0, "rank_balance_efficiency": 1.0, "expected_efficiency": 1.0}
+
+        loads = []
+        num_images = 0
+        num_slots = 0
+        for index in buckets_indices:
+            bucket_len = len(bucket_manager.buckets[index.bucket_index])
+            count = min(index.bucket_batch_size, bucket_len - index.batch_index * index.bucket_batch_size)
+            w, h = bucket_manager.resos[index.bucket_index]
+            loads.append(w * h * count)
+            num_images += count
+            num_slots += max(batch_size, index.bucket_batch_size)
+        fill_efficiency = num_images / num_slots
+
+        rank_balance_efficiency = 1.0
+        if world_size > 1:
+            loads = np.array(loads, dtype=np.float64)
+            rng = np.random.default_rng(0)
+            groups = loads[rng.integers(0, len(loads), size=(1024, world_size))]
+            rank_balance_efficiency = float(np.mean(groups.mean(axis=1) / groups.max(axis=1)))
+
+        return {
+            "fill_efficiency": fill_efficiency,
+            "rank_balance_efficiency": rank_balance_efficiency,
+            "expected_efficiency": fill_efficiency * rank_balance_efficiency,
+        }
+
+
+class MergeSmallBucketsScheduler(BucketBatchScheduler):
+    r"""
+    merges buckets which have fewer images than the batch size into the neighbor bucket with the nearer aspect ratio,
+    so they do not make partial batches. images are resized to cover the new bucket resolution and cropped,
+    same as select_bucket. buckets are merged only if the aspect ratios differ within max_log_ar_error in log scale,
+    which is about the difference of adjacent buckets at 1024x1024 with reso steps 64.
+    """
+
+    MAX_LOG_AR_ERROR = 0.15
+
+    def __init__(self, batch_size: int, max_log_ar_error: float = MAX_LOG_AR_ERROR) -> None:
+        super().__init__(batch_size)
+        self.max_log_ar_error = max_log_ar_error
+
+    def merge_buckets(self, bucket_manager: BucketManager, image_data: Dict[str, "ImageInfo"]):
+        if self.batch_size <= 1:
+            return
+
+        # sweep the buckets once in order of log aspect ratio. a small bucket is merged into the nearer of the previous
+        # surviving bucket and the next bucket, so the merge targets are the neighbors in the sorted order. merged
+        # buckets which are still small are merged again when the sweep reaches them
+        resos = bucket_manager.resos
+        buckets = bucket_manager.buckets
+        order = [i for i, bucket in enumerate(buckets) if len(bucket) > 0]
+        order.sort(key=lambda i: math.log(resos[i][0] / resos[i][1]))
+
+        num_merged = 0
+        survivors = []
+        for pos, src in enumerate(order):
+            if len(buckets[src]) >= self.batch_size:
+                survivors.append(src)
+                continue
+
+            neighbors = [survivors[-1]] if len(survivors) > 0 else []
+            if pos + 1 < len(order):
+                neighbors.append(order[pos + 1])
+            dst = self.find_merge_target(bucket_manager, image_data, src, neighbors)
+            if dst is None:
+                survivors.append(src)
+                continue
+
+            # move images to the target bucket
+            dst_reso = resos[dst]
+            for image_key in set(buckets[src]):
+                image_info = image_data[image_key]
+                image_info.bucket_reso = dst_reso
+                image_info.resized_size = self.get_resized_size(image_info.image_size, dst_reso)
+            buckets[dst].extend(buckets[src])
+            buckets[src] = []
+            num_merged += 1
+
+        if num_merged > 0:
+            logger.info(f"merged {num_merged} small buckets into neighbor buckets / 小さいbucketを{num_merged}個、近いbucketに統合しました")
+
+    def find_merge_target(
+        self, bucket_manager: BucketManager, image_data: Dict[str, "ImageInfo"], src: int, candidates: List[int]
+    ) -> Optional[int]:
+        src_w, src_h = bucket_manager.resos[src]
+        src_log_ar = math.log(src_w / src_h)
+        src_image_sizes = None
+
+        best, best_error = None, None
+        for dst in candidates:
+            dst_w, dst_h = bucket_manager.resos[dst]
+            ar_error = abs(math.log(dst_w / dst_h) - src_log_ar)
+            if ar_error > self.max_log_ar_error or (best_error is not None and ar_error >= best_error):
+                continue
+            if bucket_manager.no_upscale:
+                if src_image_sizes is None:
+                    src_image_sizes = [image_data[image_key].image_size for image_key in set(bucket_manager.buckets[src])]
+                if any(w < dst_w or h < dst_h for w, h in src_image_sizes):
+                    continue  # images would be upscaled
+            best, best_error = dst, ar_error
+        return best
+
+    @staticmethod
+    def get_resized_size(image_size: Tuple[int, int], reso: Tuple[int, int]) -> Tuple[int, int]:
+        # same as select_bucket: resize to cover the bucket, the overflow is cropped
+        image_width, image_height = image_size
+        if image_width / image_height > reso[0] / reso[1]:
+            scale = reso[1] / image_height
+        else:
+            scale = reso[0] / image_width
+        return int(image_width * scale + 0.5), int(image_height * scale + 0.5)
+
+
+class PixelBalancedScheduler(MergeSmallBucketsScheduler):
+    r"""
+    in addition to merging small buckets, uses larger batches for buckets with smaller resolutions, so all batches
+    have about the same number of pixels as a batch of the largest bucket. the ranks in multi-GPU training then take
+    about the same time for each step, regardless of which buckets they get. the batch size is at most
+    MAX_BATCH_SIZE_FACTOR times of the specified one.
+
+    note that the number of images in a step varies, so the number of steps per epoch is smaller than with the default.
+    """
+
+    MAX_BATCH_SIZE_FACTOR = 4
+
+    def get_bucket_batch_size(self, reso: Tuple[int, int], max_pixels: int) -> int:
+        pixels = reso[0] * reso[1]
+        bucket_batch_size = int(self.batch_size * max_pixels / pixels)  # round down not to exceed the pixel budget
+        return max(self.batch_size, min(bucket_batch_size, self.batch_size * self.MAX_BATCH_SIZE_FACTOR))
+
+
+BUCKET_BATCH_SCHEDULERS = {
+    "default": BucketBatchScheduler,
+    "merge_small_buckets": MergeSmallBucketsScheduler,
+    "pixel_balanced": PixelBalancedScheduler,
+}
+
+
+def register_bucket_batch_scheduler(name: str, scheduler_class: type):
+    BUCKET_BATCH_SCHEDULERS[name] = scheduler_class
+
+
 class AugHelper:
     # albumentationsへの依存をなくしたがとりあえず同じinterfaceを持たせる
 
@@ -665,6 +943,54 @@ class ControlNetSubset(BaseSubset):
         return self.image_dir == other.image_dir and self.conditioning_data_dir == other.conditioning_data_dir
 
 
+def stack_into_batch_tensor(
+    samples: List[Optional[Union[torch.Tensor, np.ndarray]]],
+    dtype: Optional[torch.dtype] = None,
+    shape: Optional[Tuple[int, ...]] = None,
+    fill_value: Optional[float] = None,
+) -> torch.Tensor:
+    r"""
+    stack samples of the same shape (samples in a bucket batch) into a batch tensor allocated once.
+    each sample is copied into the batch tensor in place, with dtype conversion and without intermediate tensors.
+    numpy arrays with negative strides (flipped) can be copied as is. None samples are filled with fill_value.
+    """
+    first = next(x for x in samples if x is not None)
+    if shape is None:
+        shape = tuple(first.shape)
+    if dtype is None:
+        dtype = first.dtype if isinstance(first, torch.Tensor) else torch.from_numpy(np.empty(0, dtype=first.dtype)).dtype
+
+    if fill_value is None:
+        batch = torch.empty((len(samples),) + tuple(shape), dtype=dtype)
+    else:
+        batch = torch.full((len(samples),) + tuple(shape), fill_value, dtype=dtype)
+
+    batch_np = batch.numpy() if dtype != torch.bfloat16 else None  # numpy doesn't support bf16
+    for i, x in enumerate(samples):
+        if x is None:
+            continue
+        if isinstance(x, np.ndarray) and batch_np is not None:
+            batch_np[i] = x  # handles dtype conversion and negative strides
+        else:
+            batch[i].copy_(torch.as_tensor(np.ascontiguousarray(x)) if isinstance(x, np.ndarray) else x)
+    return batch
+
+
+_io_executor: Optional[ThreadPoolExecutor] = None
+_io_executor_pid: Optional[int] = None
+
+
+def get_io_executor() -> ThreadPoolExecutor:
+    r"""
+    returns a thread pool for I/O in this process. it is created per process, because DataLoader workers may be forked.
+    """
+    global _io_executor, _io_executor_pid
+    if _io_executor is None or _io_executor_pid != os.getpid():
+        _io_executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="io")
+        _io_executor_pid = os.getpid()
+    return _io_executor
+
+
 class BaseDataset(torch.utils.data.Dataset):
     def __init__(
         self,
@@ -693,6 +1019,9 @@ class BaseDataset(torch.utils.data.Dataset):
         self.bucket_reso_steps = None
         self.bucket_no_upscale = None
         self.bucket_info = None  # for metadata
+        self.image_size_index_file: Optional[str] = None  # persistent index of image sizes, None to disable
+        self.manifest: Optional[DatasetManifest] = None  # persistent dataset manifest, None to disable
+        self.bucket_batch_scheduler: str = "default"  # name in BUCKET_BATCH_SCHEDULERS
 
         self.current_epoch: int = 0  # インスタンスがepochごとに新しく作られるようなので外側から渡さないとダメ
 
@@ -968,26 +1297,10 @@ class BaseDataset(torch.utils.data.Dataset):
         min_size and max_size are ignored when enable_bucket is False
         """
         logger.info("loading image sizes.")
-        for info in tqdm(self.image_data.values()):
-            if info.image_size is None:
-                info.image_size = self.get_image_size(info.absolute_path)
-
-        # # run in parallel
-        # max_workers = min(os.cpu_count(), len(self.image_data))  # TODO consider multi-gpu (processes)
-        # with ThreadPoolExecutor(max_workers) as executor:
-        #     futures = []
-        #     for info in tqdm(self.image_data.values(), desc="loading image sizes"):
-        #         if info.image_size is None:
-        #             def get_and_set_image_size(info):
-        #                 info.image_size = self.get_image_size(info.absolute_path)
-        #             futures.append(executor.submit(get_and_set_image_size, info))
-        #             # consume futures to reduce memory usage and prevent Ctrl-C hang
-        #             if len(futures) >= max_workers:
-        #                 for future in futures:
-        #                     future.result()
-        #                 futures = []
-        #     for future in futures:
-        #         future.result()
+        infos = [info for info in self.image_data.values() if info.image_size is None]
+        sizes = self.get_image_sizes([info.absolute_path for info in infos])
+        for info, size in zip(infos, sizes):
+            info.image_size = size
 
         if self.enable_bucket:
             logger.info("make buckets")
@@ -1011,28 +1324,32 @@ class BaseDataset(torch.utils.data.Dataset):
                         "min_bucket_reso and max_bucket_reso are ignored if bucket_no_upscale is set, because bucket reso is defined by image size automatically / bucket_no_upscaleが指定された場合は、bucketの解像度は画像サイズから自動計算されるため、min_bucket_resoとmax_bucket_resoは無視されます"
                     )
 
-            img_ar_errors = []
-            for image_info in self.image_data.values():
-                image_width, image_height = image_info.image_size
-                image_info.bucket_reso, image_info.resized_size, ar_error = self.bucket_manager.select_bucket(
-                    image_width, image_height
-                )
-
-                # logger.info(image_info.image_key, image_info.bucket_reso)
-                img_ar_errors.append(abs(ar_error))
-
+            img_ar_errors = self.assign_buckets()
             self.bucket_manager.sort()
         else:
             self.bucket_manager = BucketManager(False, (self.width, self.height), None, None, None)
             self.bucket_manager.set_predefined_resos([(self.width, self.height)])  # ひとつの固定サイズbucketのみ
-            for image_info in self.image_data.values():
-                image_width, image_height = image_info.image_size
-                image_info.bucket_reso, image_info.resized_size, _ = self.bucket_manager.select_bucket(image_width, image_height)
+            self.assign_buckets()
 
         for image_info in self.image_data.values():
             for _ in range(image_info.num_repeats):
                 self.bucket_manager.add_image(image_info.bucket_reso, image_info.image_key)
 
+        assert (
+            self.bucket_batch_scheduler in BUCKET_BATCH_SCHEDULERS
+        ), f"unknown bucket_batch_scheduler / 不明なbucket_batch_schedulerです: {self.bucket_batch_scheduler}"
+        scheduler = BUCKET_BATCH_SCHEDULERS[self.bucket_batch_scheduler](self.batch_size)
+        if self.enable_bucket:
+            if any(image_info.latents_npz is not None for image_info in self.image_data.values()):
+                # latents in npz files specified by metadata have fixed resolutions
+                if self.bucket_batch_scheduler != "default":
+                    logger.warning(
+                        "buckets are not merged because latents are already cached with fixed resolutions"
+                        + " / latentsが固定の解像度でキャッシュ済みのため、bucketは統合されません"
+                    )
+            else:
+                scheduler.merge_buckets(self.bucket_manager, self.image_data)
+
         # bucket情報を表示、格納する
         if self.enable_bucket:
             self.bucket_info = {"buckets": {}}
@@ -1043,21 +1360,44 @@ class BaseDataset(torch.utils.data.Dataset):
                     self.bucket_info["buckets"][i] = {"resolution": reso, "count": len(bucket)}
                     logger.info(f"bucket {i}: resolution {reso}, count: {len(bucket)}")
 
-            img_ar_errors = np.array(img_ar_errors)
             mean_img_ar_error = np.mean(np.abs(img_ar_errors))
             self.bucket_info["mean_img_ar_error"] = mean_img_ar_error
             logger.info(f"mean ar error (without repeats): {mean_img_ar_error}")
 
         # データ参照用indexを作る。このindexはdatasetのshuffleに用いられる
-        self.buckets_indices: List[BucketBatchIndex] = []
-        for bucket_index, bucket in enumerate(self.bucket_manager.buckets):
-            batch_count = int(math.ceil(len(bucket) / self.batch_size))
-            for batch_index in range(batch_count):
-                self.buckets_indices.append(BucketBatchIndex(bucket_index, self.batch_size, batch_index))
+        self.buckets_indices: List[BucketBatchIndex] = scheduler.make_batches(self.bucket_manager)
+
+        world_size = int(os.environ.get("WORLD_SIZE", "1"))
+        efficiency = BucketBatchScheduler.estimate_efficiency(self.bucket_manager, self.buckets_indices, self.batch_size, world_size)
+        if self.bucket_info is not None:
+            self.bucket_info["scheduler"] = {"name": self.bucket_batch_scheduler, **efficiency}
+        logger.info(
+            f"bucket batch scheduler: {self.bucket_batch_scheduler}, batches: {len(self.buckets_indices)}"
+            + f", fill efficiency: {efficiency['fill_efficiency']:.3f}"
+            + f", rank balance efficiency (world size {world_size}): {efficiency['rank_balance_efficiency']:.3f}"
+            + f", expected throughput efficiency: {efficiency['expected_efficiency']:.3f}"
+        )
 
         self.shuffle_buckets()
         self._length = len(self.buckets_indices)
 
+        if self.manifest is not None:
+            for image_info in self.image_data.values():
+                self.manifest.set_image_info(image_info.absolute_path, image_info.image_size, image_info.bucket_reso)
+            self.manifest.save()
+
+    def assign_buckets(self) -> np.ndarray:
+        # assign all images to buckets at once, and returns ar errors
+        image_infos = list(self.image_data.values())
+        image_sizes = np.array([info.image_size for info in image_infos], dtype=np.int64).reshape(-1, 2)
+        bucket_ids, resized_sizes, ar_errors = self.bucket_manager.select_buckets(image_sizes[:, 0], image_sizes[:, 1])
+
+        resos = self.bucket_manager.resos
+        for image_info, bucket_id, resized_size in zip(image_infos, bucket_ids.tolist(), resized_sizes.tolist()):
+            image_info.bucket_reso = resos[bucket_id]
+            image_info.resized_size = tuple(resized_size)
+        return ar_errors
+
     def shuffle_buckets(self):
         # set random seed for this epoch
         random.seed(self.seed + self.current_epoch)
@@ -1115,6 +1455,7 @@ class BaseDataset(torch.utils.data.Dataset):
                     and self.random_crop == other.random_crop
                 )
 
+        batches: List[Tuple[Condition, List[ImageInfo]]] = []
         batch: List[ImageInfo] = []
         current_condition = None
 
@@ -1122,26 +1463,15 @@ class BaseDataset(torch.utils.data.Dataset):
         num_processes = accelerator.num_processes
         process_index = accelerator.process_index
 
-        # define a function to submit a batch to cache
-        def submit_batch(batch, cond):
-            for info in batch:
-                if info.image is not None and isinstance(info.image, Future):
-                    info.image = info.image.result()  # future to image
-            caching_strategy.cache_batch_latents(model, batch, cond.flip_aug, cond.alpha_mask, cond.random_crop)
-
-            # remove image from memory
-            for info in batch:
-                info.image = None
-
-        # define ThreadPoolExecutor to load images in parallel
-        max_workers = min(os.cpu_count(), len(image_infos))
-        max_workers = max(1, max_workers // num_processes)  # consider multi-gpu
-        max_workers = min(max_workers, caching_strategy.batch_size)  # max_workers should be less than batch_size
-        executor = ThreadPoolExecutor(max_workers)
+        # content-addressed cache: same images are cached once, in the shared cache directory
+        content_cache = caching_strategy.content_cache if caching_strategy.cache_to_disk else None
+        if content_cache is not None:
+            content_cache.set_model(model)
+            content_cache.prepare_content_hashes([info.absolute_path for info in image_infos if info.latents_npz is None])
+        npz_paths_to_cache = set()
 
         try:
-            # iterate images
-            logger.info("caching latents...")
+            logger.info("checking cache validity...")
             for i, info in enumerate(tqdm(image_infos)):
                 subset = self.image_to_subset[info.image_key]
 
@@ -1150,46 +1480,91 @@ class BaseDataset(torch.utils.data.Dataset):
 
                 # check disk cache exists and size of latents
                 if caching_strategy.cache_to_disk:
-                    # info.latents_npz = os.path.splitext(info.absolute_path)[0] + file_suffix
-                    info.latents_npz = caching_strategy.get_latents_npz_path(info.absolute_path, info.image_size)
+                    if content_cache is not None:
+                        info.latents_npz = content_cache.get_latents_npz_path(
+                            info.absolute_path,
+                            info.image_size,
+                            info.bucket_reso,
+                            info.resized_size,
+                            subset.flip_aug,
+                            subset.alpha_mask,
+                            caching_strategy.cache_suffix,
+                        )
+                        if info.latents_npz in npz_paths_to_cache:
+                            continue  # same image is already in the batches
+                        cache_process_index = content_cache.get_process_index(info.latents_npz, num_processes)
+                    else:
+                        # info.latents_npz = os.path.splitext(info.absolute_path)[0] + file_suffix
+                        info.latents_npz = caching_strategy.get_latents_npz_path(info.absolute_path, info.image_size)
+                        cache_process_index = i % num_processes
 
                     # if the modulo of num_processes is not equal to process_index, skip caching
                     # this makes each process cache different latents
-                    if i % num_processes != process_index:
+                    if cache_process_index != process_index:
                         continue
 
                     # print(f"{process_index}/{num_processes} {i}/{len(image_infos)} {info.latents_npz}")
 
-                    cache_available = caching_strategy.is_disk_cached_latents_expected(
-                        info.bucket_reso, info.latents_npz, subset.flip_aug, subset.alpha_mask
-                    )
+                    if self.manifest is not None:
+                        condition_key = f"{info.bucket_reso[0]}x{info.bucket_reso[1]},{subset.flip_aug},{subset.alpha_mask}"
+                        cache_available = self.manifest.is_latents_cache_valid(info.latents_npz, condition_key)
+                    else:
+                        cache_available = False
+                    if not cache_available:
+                        cache_available = caching_strategy.is_disk_cached_latents_expected(
+                            info.bucket_reso, info.latents_npz, subset.flip_aug, subset.alpha_mask
+                        )
+                        if cache_available and self.manifest is not None:
+                            self.manifest.set_latents_cache_valid(info.latents_npz, condition_key)
                     if cache_available:  # do not add to batch
+                        if content_cache is not None:
+                            content_cache.touch(info.latents_npz)
                         continue
+                    npz_paths_to_cache.add(info.latents_npz)
 
                 # if batch is not empty and condition is changed, flush the batch. Note that current_condition is not None if batch is not empty
                 condition = Condition(info.bucket_reso, subset.flip_aug, subset.alpha_mask, subset.random_crop)
                 if len(batch) > 0 and current_condition != condition:
-                    submit_batch(batch, current_condition)
+                    batches.append((current_condition, batch))
                     batch = []
 
-                if info.image is None:
-                    # load image in parallel
-                    info.image = executor.submit(load_image, info.absolute_path, condition.alpha_mask)
-
                 batch.append(info)
                 current_condition = condition
 
                 # if number of data in batch is enough, flush the batch
                 if len(batch) >= caching_strategy.batch_size:
-                    submit_batch(batch, current_condition)
+                    batches.append((current_condition, batch))
                     batch = []
                     current_condition = None
 
             if len(batch) > 0:
-                submit_batch(batch, current_condition)
-
+                batches.append((current_condition, batch))
         finally:
-            executor.shutdown()
+            if self.manifest is not None:
+                self.manifest.save()
+
+        # load images in worker threads, encode them by the model in this thread, and save latents in writer threads
+        def prepare(item):
+            cond, batch = item
+            return caching_strategy.prepare_batch_for_caching(batch, cond.alpha_mask, cond.random_crop)
+
+        def process(item, prepared):
+            cond, batch = item
+            img_tensor, alpha_masks, original_sizes, crop_ltrbs = prepared
+            latents, flipped_latents = caching_strategy.encode_batch_latents(model, img_tensor, cond.flip_aug)
+            return latents, flipped_latents, alpha_masks, original_sizes, crop_ltrbs
+
+        def write(item, processed):
+            cond, batch = item
+            caching_strategy.save_batch_latents(batch, *processed)
+
+            # remove image from memory
+            for info in batch:
+                info.image = None
+
+        logger.info("caching latents...")
+        pipeline = CachingPipeline(prepare, process, write, get_num_items=lambda item: len(item[1]))
+        pipeline.run(batches)
 
     def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True, file_suffix=".npz"):
         # マルチGPUには対応していないので、そちらはtools/cache_latents.pyを使うこと
@@ -1286,21 +1661,51 @@ class BaseDataset(torch.utils.data.Dataset):
         num_processes = accelerator.num_processes
         process_index = accelerator.process_index
 
+        # content-addressed cache: same captions are cached once, in the shared cache directory
+        content_cache = caching_strategy.content_cache if caching_strategy.cache_to_disk else None
+        if content_cache is not None:
+            content_cache.set_models(models)
+            tokens_shape = str([tuple(tokens.shape) for tokens in tokenize_strategy.tokenize("") if tokens is not None])
+            cache_params = caching_strategy.get_outputs_cache_params()
+        npz_paths_to_cache = set()
+
+        # in memory, images with the same caption share the outputs of the first image
+        infos_with_same_caption: Dict[str, List[ImageInfo]] = {}
+
         logger.info("checking cache validity...")
         for i, info in enumerate(tqdm(image_infos)):
             # check disk cache exists and size of text encoder outputs
             if caching_strategy.cache_to_disk:
-                te_out_npz = caching_strategy.get_outputs_npz_path(info.absolute_path)
-                info.text_encoder_outputs_npz = te_out_npz  # set npz filename regardless of cache availability
+                if content_cache is not None:
+                    te_out_npz = content_cache.get_outputs_npz_path(
+                        info.caption, tokens_shape, cache_params, caching_strategy.cache_suffix
+                    )
+                    info.text_encoder_outputs_npz = te_out_npz
+                    if te_out_npz in npz_paths_to_cache:
+                        continue  # same caption is already in the batches
+                    cache_process_index = content_cache.get_process_index(te_out_npz, num_processes)
+                else:
+                    te_out_npz = caching_strategy.get_outputs_npz_path(info.absolute_path)
+                    info.text_encoder_outputs_npz = te_out_npz  # set npz filename regardless of cache availability
+                    cache_process_index = i % num_processes
 
                 # if the modulo of num_processes is not equal to process_index, skip caching
                 # this makes each process cache different text encoder outputs
-                if i % num_processes != process_index:
+                if cache_process_index != process_index:
                     continue
 
                 cache_available = caching_strategy.is_disk_cached_outputs_expected(te_out_npz)
                 if cache_available:  # do not add to batch
                     continue
+                npz_paths_to_cache.add(te_out_npz)
+                if content_cache is not None:
+                    os.makedirs(os.path.dirname(te_out_npz), exist_ok=True)
+            else:
+                caption_key = normalize_caption(info.caption)
+                if caption_key in infos_with_same_caption:
+                    infos_with_same_caption[caption_key].append(info)
+                    continue
+                infos_with_same_caption[caption_key] = [info]
 
             batch.append(info)
 
@@ -1312,6 +1717,15 @@ class BaseDataset(torch.utils.data.Dataset):
         if len(batch) > 0:
             batches.append(batch)
 
+        if content_cache is not None or not caching_strategy.cache_to_disk:
+            if content_cache is not None:
+                num_unique = len(set(info.text_encoder_outputs_npz for info in image_infos))
+            else:
+                num_unique = len(infos_with_same_caption)
+            logger.info(
+                f"{num_unique} unique captions in {len(image_infos)} images / {len(image_infos)}枚の画像に{num_unique}個の重複しないキャプション"
+            )
+
         if len(batches) == 0:
             logger.info("no Text Encoder outputs to cache")
             return
@@ -1322,6 +1736,10 @@ class BaseDataset(torch.utils.data.Dataset):
             # cache_batch_latents(vae, cache_to_disk, batch, subset.flip_aug, subset.alpha_mask, subset.random_crop)
             caching_strategy.cache_batch_outputs(tokenize_strategy, models, text_encoding_strategy, batch)
 
+        for infos in infos_with_same_caption.values():
+            for info in infos[1:]:
+                info.text_encoder_outputs = infos[0].text_encoder_outputs
+
     # if weight_dtype is specified, Text Encoder itself and output will be converted to the dtype
     # this method is only for SDXL, but it should be implemented here because it needs to be a method of dataset
     # to support SD1/2, it needs a flag for v2, but it is postponed
@@ -1447,18 +1865,21 @@ class BaseDataset(torch.utils.data.Dataset):
                     output_dtype,
                 )
 
+    def get_image_sizes(self, image_paths: List[str]) -> List[Tuple[int, int]]:
+        # read image headers in parallel, and skip unchanged images if the size index or the manifest is specified
+        sizes = [None] * len(image_paths)
+        if self.manifest is not None:
+            sizes = [self.manifest.get_image_size(image_path) for image_path in image_paths]
+
+        indices = [i for i, size in enumerate(sizes) if size is None]
+        size_index = ImageSizeIndex(self.image_size_index_file) if self.image_size_index_file else None
+        probed_sizes = probe_image_sizes([image_paths[i] for i in indices], self.get_image_size, size_index)
+        for i, size in zip(indices, probed_sizes):
+            sizes[i] = size
+        return sizes
+
     def get_image_size(self, image_path):
-        # return imagesize.get(image_path)
-        image_size = imagesize.get(image_path)
-        if image_size[0] <= 0:
-            # imagesize doesn't work for some images, so use PIL as a fallback
-            try:
-                with Image.open(image_path) as img:
-                    image_size = img.size
-            except Exception as e:
-                logger.warning(f"failed to get image size: {image_path}, error: {e}")
-                image_size = (0, 0)
-        return image_size
+        return read_image_size(image_path)
 
     def load_image_with_face_info(self, subset: BaseSubset, image_path: str, alpha_mask=False):
         img = load_image(image_path, alpha_mask)
@@ -1546,7 +1967,22 @@ class BaseDataset(torch.utils.data.Dataset):
         text_encoder_outputs_list = []
         custom_attributes = []
 
-        for image_key in bucket[image_index : image_index + bucket_batch_size]:
+        # load disk cached latents of the batch in parallel, to hide the latency of the storage
+        latents_futures = {}
+        image_keys = bucket[image_index : image_index + bucket_batch_size]
+        npz_image_infos = [
+            self.image_data[key]
+            for key in image_keys
+            if self.image_data[key].latents is None and self.image_data[key].latents_npz is not None
+        ]
+        if len(npz_image_infos) > 1:
+            executor = get_io_executor()
+            for image_info in npz_image_infos:
+                latents_futures[image_info.image_key] = executor.submit(
+                    self.latents_caching_strategy.load_latents_from_disk, image_info.latents_npz, image_info.bucket_reso
+                )
+
+        for image_key in image_keys:
             image_info = self.image_data[image_key]
             subset = self.image_to_subset[image_key]
 
@@ -1570,16 +2006,16 @@ class BaseDataset(torch.utils.data.Dataset):
 
                 image = None
             elif image_info.latents_npz is not None:  # FineTuningDatasetまたはcache_latents_to_disk=Trueの場合
-                latents, original_size, crop_ltrb, flipped_latents, alpha_mask = (
-                    self.latents_caching_strategy.load_latents_from_disk(image_info.latents_npz, image_info.bucket_reso)
-                )
+                if image_key in latents_futures:
+                    latents, original_size, crop_ltrb, flipped_latents, alpha_mask = latents_futures.pop(image_key).result()
+                else:
+                    latents, original_size, crop_ltrb, flipped_latents, alpha_mask = (
+                        self.latents_caching_strategy.load_latents_from_disk(image_info.latents_npz, image_info.bucket_reso)
+                    )
                 if flipped:
                     latents = flipped_latents
-                    alpha_mask = None if alpha_mask is None else alpha_mask[:, ::-1].copy()  # copy to avoid negative stride problem
+                    alpha_mask = None if alpha_mask is None else alpha_mask[:, ::-1]  # copied into the batch tensor later
                     del flipped_latents
-                latents = torch.FloatTensor(latents)
-                if alpha_mask is not None:
-                    alpha_mask = torch.FloatTensor(alpha_mask)
 
                 image = None
             else:
@@ -1670,7 +2106,7 @@ class BaseDataset(torch.utils.data.Dataset):
 
             if image_info.text_encoder_outputs is not None:
                 # cached
-                text_encoder_outputs = image_info.text_encoder_outputs
+                text_encoder_outputs = self.text_encoder_output_caching_strategy.decode_outputs(image_info.text_encoder_outputs)
             elif image_info.text_encoder_outputs_npz is not None:
                 # on disk
                 text_encoder_outputs = self.text_encoder_output_caching_strategy.load_outputs_npz(
@@ -1712,49 +2148,39 @@ class BaseDataset(torch.utils.data.Dataset):
             input_ids_list.append(input_ids)
             captions.append(caption)
 
-        def none_or_stack_elements(tensors_list, converter):
-            # [[clip_l, clip_g, t5xxl], [clip_l, clip_g, t5xxl], ...] -> [torch.stack(clip_l), torch.stack(clip_g), torch.stack(t5xxl)]
+        def none_or_stack_elements(tensors_list, dtype=None):
+            # [[clip_l, clip_g, t5xxl], [clip_l, clip_g, t5xxl], ...] -> [stack(clip_l), stack(clip_g), stack(t5xxl)]
             if len(tensors_list) == 0 or tensors_list[0] == None or len(tensors_list[0]) == 0 or tensors_list[0][0] is None:
                 return None
-            return [torch.stack([converter(x[i]) for x in tensors_list]) for i in range(len(tensors_list[0]))]
+            return [
+                stack_into_batch_tensor([x[i] for x in tensors_list], dtype) if tensors_list[0][i] is not None else None
+                for i in range(len(tensors_list[0]))
+            ]
 
         # set example
         example = {}
         example["custom_attributes"] = custom_attributes  # may be list of empty dict
         example["loss_weights"] = torch.FloatTensor(loss_weights)
-        example["text_encoder_outputs_list"] = none_or_stack_elements(text_encoder_outputs_list, torch.FloatTensor)
-        example["input_ids_list"] = none_or_stack_elements(input_ids_list, lambda x: x)
+        example["text_encoder_outputs_list"] = none_or_stack_elements(text_encoder_outputs_list, torch.float32)
+        example["input_ids_list"] = none_or_stack_elements(input_ids_list)
 
         # if one of alpha_masks is not None, we need to replace None with ones
-        none_or_not = [x is None for x in alpha_mask_list]
-        if all(none_or_not):
+        if all(x is None for x in alpha_mask_list):
             example["alpha_masks"] = None
-        elif any(none_or_not):
-            for i in range(len(alpha_mask_list)):
-                if alpha_mask_list[i] is None:
-                    if images[i] is not None:
-                        alpha_mask_list[i] = torch.ones((images[i].shape[1], images[i].shape[2]), dtype=torch.float32)
-                    else:
-                        alpha_mask_list[i] = torch.ones(
-                            (latents_list[i].shape[1] * 8, latents_list[i].shape[2] * 8), dtype=torch.float32
-                        )
-            example["alpha_masks"] = torch.stack(alpha_mask_list)
-        else:
-            example["alpha_masks"] = torch.stack(alpha_mask_list)
-
-        if images[0] is not None:
-            images = torch.stack(images)
-            images = images.to(memory_format=torch.contiguous_format).float()
         else:
-            images = None
-        example["images"] = images
+            if images[0] is not None:
+                mask_shape = (images[0].shape[1], images[0].shape[2])
+            else:
+                mask_shape = (latents_list[0].shape[1] * 8, latents_list[0].shape[2] * 8)
+            example["alpha_masks"] = stack_into_batch_tensor(alpha_mask_list, torch.float32, mask_shape, fill_value=1.0)
 
-        example["latents"] = torch.stack(latents_list) if latents_list[0] is not None else None
+        example["images"] = stack_into_batch_tensor(images, torch.float32) if images[0] is not None else None
+        example["latents"] = stack_into_batch_tensor(latents_list) if latents_list[0] is not None else None
         example["captions"] = captions
 
-        example["original_sizes_hw"] = torch.stack([torch.LongTensor(x) for x in original_sizes_hw])
-        example["crop_top_lefts"] = torch.stack([torch.LongTensor(x) for x in crop_top_lefts])
-        example["target_sizes_hw"] = torch.stack([torch.LongTensor(x) for x in target_sizes_hw])
+        example["original_sizes_hw"] = torch.tensor(original_sizes_hw, dtype=torch.long)
+        example["crop_top_lefts"] = torch.tensor(crop_top_lefts, dtype=torch.long)
+        example["target_sizes_hw"] = torch.tensor(target_sizes_hw, dtype=torch.long)
         example["flippeds"] = flippeds
 
         example["network_multipliers"] = torch.FloatTensor([self.network_multiplier] * len(captions))
@@ -1852,6 +2278,9 @@ class DreamBoothDataset(BaseDataset):
         debug_dataset: bool,
         validation_split: float,
         validation_seed: Optional[int],
+        image_size_index_file: Optional[str] = None,
+        dataset_manifest_file: Optional[str] = None,
+        bucket_batch_scheduler: str = "default",
     ) -> None:
         super().__init__(resolution, network_multiplier, debug_dataset)
 
@@ -1860,6 +2289,9 @@ class DreamBoothDataset(BaseDataset):
         self.batch_size = batch_size
         self.size = min(self.width, self.height)  # 短いほう
         self.prior_loss_weight = prior_loss_weight
+        self.image_size_index_file = image_size_index_file
+        self.manifest = DatasetManifest(dataset_manifest_file) if dataset_manifest_file else None
+        self.bucket_batch_scheduler = bucket_batch_scheduler
         self.latents_cache = None
         self.is_training_dataset = is_training_dataset
         self.validation_seed = validation_seed
@@ -1890,8 +2322,10 @@ class DreamBoothDataset(BaseDataset):
             cap_paths = [base_name + caption_extension, base_name_face_det + caption_extension]
 
             caption = None
+            caption_path = None
             for cap_path in cap_paths:
                 if os.path.isfile(cap_path):
+                    caption_path = cap_path
                     with open(cap_path, "rt", encoding="utf-8") as f:
                         try:
                             lines = f.readlines()
@@ -1904,6 +2338,16 @@ class DreamBoothDataset(BaseDataset):
                         else:
                             caption = lines[0].strip()
                     break
+            return caption, caption_path
+
+        def read_caption_with_manifest(img_path, caption_extension, enable_wildcard):
+            if self.manifest is None:
+                return read_caption(img_path, caption_extension, enable_wildcard)[0]
+
+            found, caption = self.manifest.get_caption(img_path, caption_extension, enable_wildcard)
+            if not found:
+                caption, caption_path = read_caption(img_path, caption_extension, enable_wildcard)
+                self.manifest.set_caption(img_path, caption_extension, enable_wildcard, caption_path, caption)
             return caption
 
         def load_dreambooth_dir(subset: DreamBoothSubset):
@@ -1933,7 +2377,13 @@ class DreamBoothDataset(BaseDataset):
 
                 # we may need to check image size and existence of image files, but it takes time, so user should check it before training
             else:
-                img_paths = glob_images(subset.image_dir, "*")
+                img_paths = None
+                if self.manifest is not None:
+                    img_paths = self.manifest.get_image_paths(subset.image_dir)
+                if img_paths is None:
+                    img_paths = glob_images(subset.image_dir, "*")
+                    if self.manifest is not None:
+                        self.manifest.set_image_paths(subset.image_dir, img_paths)
                 sizes: List[Optional[Tuple[int, int]]] = [None] * len(img_paths)
 
                 # new caching: get image size from cache files
@@ -1942,7 +2392,7 @@ class DreamBoothDataset(BaseDataset):
                     logger.info("get image size from name of cache files")
 
                     # make image path to npz path mapping
-                    npz_paths = glob.glob(os.path.join(subset.image_dir, "*" + strategy.cache_suffix))
+                    npz_paths = strategy.glob_disk_cache_paths(subset.image_dir)
                     npz_paths.sort(
                         key=lambda item: item.rsplit("_", maxsplit=2)[0]
                     )  # sort by name excluding resolution and cache_suffix
@@ -2003,7 +2453,7 @@ class DreamBoothDataset(BaseDataset):
                 captions = []
                 missing_captions = []
                 for img_path in tqdm(img_paths, desc="read caption"):
-                    cap_for_img = read_caption(img_path, subset.caption_extension, subset.enable_wildcard)
+                    cap_for_img = read_caption_with_manifest(img_path, subset.caption_extension, subset.enable_wildcard)
                     if cap_for_img is None and subset.class_tokens is None:
                         logger.warning(
                             f"neither caption file nor class tokens are found. use empty caption for {img_path} / キャプションファイルもclass tokenも見つかりませんでした。空のキャプションを使用します: {img_path}"
@@ -2035,7 +2485,7 @@ class DreamBoothDataset(BaseDataset):
 
             if not use_cached_info_for_subset and subset.cache_info:
                 logger.info(f"cache image info for / 画像情報をキャッシュします : {info_cache_file}")
-                sizes = [self.get_image_size(img_path) for img_path in tqdm(img_paths, desc="get image size")]
+                sizes = self.get_image_sizes(img_paths)
                 matas = {}
                 for img_path, caption, size in zip(img_paths, captions, sizes):
                     matas[img_path] = {"caption": caption, "resolution": list(size)}
@@ -2133,10 +2583,16 @@ class FineTuningDataset(BaseDataset):
         debug_dataset: bool,
         validation_seed: int,
         validation_split: float,
+        image_size_index_file: Optional[str] = None,
+        dataset_manifest_file: Optional[str] = None,
+        bucket_batch_scheduler: str = "default",
     ) -> None:
         super().__init__(resolution, network_multiplier, debug_dataset)
 
         self.batch_size = batch_size
+        self.image_size_index_file = image_size_index_file
+        self.manifest = DatasetManifest(dataset_manifest_file) if dataset_manifest_file else None
+        self.bucket_batch_scheduler = bucket_batch_scheduler
 
         self.num_train_images = 0
         self.num_reg_images = 0
@@ -2168,30 +2624,23 @@ class FineTuningDataset(BaseDataset):
                 )
                 continue
 
+            # paths resolved in the previous run can be used if the metadata file and the image directory are unchanged
+            resolved_paths = None
+            if self.manifest is not None:
+                resolved_paths = self.manifest.get_metadata_image_paths(subset.metadata_file, subset.image_dir)
+                if resolved_paths is not None:
+                    logger.info(f"using image paths in dataset manifest / データセットのマニフェストの画像パスを使用します")
+            new_resolved_paths = {}
+
             tags_list = []
             for image_key, img_md in metadata.items():
-                # path情報を作る
-                abs_path = None
-
-                # まず画像を優先して探す
-                if os.path.exists(image_key):
-                    abs_path = image_key
+                if resolved_paths is not None and image_key in resolved_paths:
+                    abs_path, npz_file_norm, npz_file_flip = resolved_paths[image_key]
                 else:
-                    # わりといい加減だがいい方法が思いつかん
-                    paths = glob_images(subset.image_dir, image_key)
-                    if len(paths) > 0:
-                        abs_path = paths[0]
-
-                # なければnpzを探す
-                if abs_path is None:
-                    if os.path.exists(os.path.splitext(image_key)[0] + ".npz"):
-                        abs_path = os.path.splitext(image_key)[0] + ".npz"
-                    else:
-                        npz_path = os.path.join(subset.image_dir, image_key + ".npz")
-                        if os.path.exists(npz_path):
-                            abs_path = npz_path
-
-                assert abs_path is not None, f"no image / 画像がありません: {image_key}"
+                    abs_path = self.image_key_to_path(subset, image_key)
+                    assert abs_path is not None, f"no image / 画像がありません: {image_key}"
+                    npz_file_norm, npz_file_flip = self.image_key_to_npz_file(subset, image_key)
+                new_resolved_paths[image_key] = (abs_path, npz_file_norm, npz_file_flip)
 
                 caption = img_md.get("caption")
                 tags = img_md.get("tags")
@@ -2223,10 +2672,13 @@ class FineTuningDataset(BaseDataset):
 
                 if not subset.color_aug and not subset.random_crop:
                     # if npz exists, use them
-                    image_info.latents_npz, image_info.latents_npz_flipped = self.image_key_to_npz_file(subset, image_key)
+                    image_info.latents_npz, image_info.latents_npz_flipped = npz_file_norm, npz_file_flip
 
                 self.register_image(image_info, subset)
 
+            if self.manifest is not None and resolved_paths is None:
+                self.manifest.set_metadata_image_paths(subset.metadata_file, subset.image_dir, new_resolved_paths)
+
             self.num_train_images += len(metadata) * subset.num_repeats
 
             # TODO do not record tag freq when no tag
@@ -2318,6 +2770,24 @@ class FineTuningDataset(BaseDataset):
             for image_info in self.image_data.values():
                 image_info.latents_npz = image_info.latents_npz_flipped = None
 
+    def image_key_to_path(self, subset: FineTuningSubset, image_key) -> Optional[str]:
+        # まず画像を優先して探す
+        if os.path.exists(image_key):
+            return image_key
+
+        # わりといい加減だがいい方法が思いつかん
+        paths = glob_images(subset.image_dir, image_key)
+        if len(paths) > 0:
+            return paths[0]
+
+        # なければnpzを探す
+        if os.path.exists(os.path.splitext(image_key)[0] + ".npz"):
+            return os.path.splitext(image_key)[0] + ".npz"
+        npz_path = os.path.join(subset.image_dir, image_key + ".npz")
+        if os.path.exists(npz_path):
+            return npz_path
+        return None
+
     def image_key_to_npz_file(self, subset: FineTuningSubset, image_key):
         base_name = os.path.splitext(image_key)[0]
         npz_file_norm = base_name + ".npz"
@@ -2361,6 +2831,9 @@ class ControlNetDataset(BaseDataset):
         debug_dataset: bool,
         validation_split: float,
         validation_seed: Optional[int],
+        image_size_index_file: Optional[str] = None,
+        dataset_manifest_file: Optional[str] = None,
+        bucket_batch_scheduler: str = "default",
     ) -> None:
         super().__init__(resolution, network_multiplier, debug_dataset)
 
@@ -2412,6 +2885,9 @@ class ControlNetDataset(BaseDataset):
             debug_dataset,
             validation_split,
             validation_seed,
+            image_size_index_file,
+            dataset_manifest_file,
+            bucket_batch_scheduler,
         )
 
         # config_util等から参照される値をいれておく（若干微妙なのでなんとかしたい）
@@ -2586,6 +3062,12 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
             dataset.new_cache_latents(model, accelerator)
         accelerator.wait_for_everyone()
 
+        caching_strategy = LatentsCachingStrategy.get_strategy()
+        if accelerator.is_main_process and caching_strategy.cache_to_disk and caching_strategy.content_cache is not None:
+            # keep the files used in this training
+            npz_paths = [info.latents_npz for dataset in self.datasets for info in dataset.image_data.values()]
+            caching_strategy.content_cache.evict([npz_path for npz_path in npz_paths if npz_path is not None])
+
     def cache_text_encoder_outputs(
         self, tokenizers, text_encoders, device, weight_dtype, cache_to_disk=False, is_main_process=True
     ):
@@ -2680,6 +3162,49 @@ def is_disk_cached_latents_is_expected(reso, npz_path: str, flip_aug: bool, alph
     return True
 
 
+def set_latents_cache_store_if_specified(args: argparse.Namespace, latents_caching_strategy: LatentsCachingStrategy):
+    if args.latents_cache_shard_dir is None and args.latents_cache_dir is None:
+        return
+    if not args.cache_latents_to_disk:
+        logger.warning(
+            "latents_cache_shard_dir and latents_cache_dir are ignored because cache_latents_to_disk is not specified"
+            + " / cache_latents_to_diskが指定されていないため、latents_cache_shard_dirとlatents_cache_dirは無視されます"
+        )
+        return
+
+    if args.latents_cache_dir is not None:
+        logger.info(f"use content-addressed latents cache / 画像の内容をキーとするlatentキャッシュを使用します: {args.latents_cache_dir}")
+        max_size = int(args.latents_cache_max_size * 1024**3) if args.latents_cache_max_size is not None else None
+        latents_caching_strategy.set_content_cache(ContentAddressedLatentsCache(args.latents_cache_dir, max_size))
+
+    if args.latents_cache_shard_dir is not None:
+        logger.info(f"use sharded latents cache store / シャード化されたlatentキャッシュを使用します: {args.latents_cache_shard_dir}")
+        store = ShardedCacheStore(args.latents_cache_shard_dir, args.latents_cache_shard_size * 1024 * 1024)
+        latents_caching_strategy.set_cache_store(store)
+
+
+def set_text_encoder_outputs_cache_options_if_specified(
+    args: argparse.Namespace, text_encoder_outputs_caching_strategy: TextEncoderOutputsCachingStrategy
+):
+    cache_dtype = getattr(args, "text_encoder_outputs_cache_dtype", None)
+    if cache_dtype is not None:
+        logger.info(f"cache text encoder outputs in / text encoderの出力を次の精度でキャッシュします: {cache_dtype}")
+        text_encoder_outputs_caching_strategy.set_cache_dtype(str_to_dtype(cache_dtype))
+
+    cache_dir = getattr(args, "text_encoder_outputs_cache_dir", None)
+    if cache_dir is not None:
+        if not args.cache_text_encoder_outputs_to_disk:
+            logger.warning(
+                "text_encoder_outputs_cache_dir is ignored because cache_text_encoder_outputs_to_disk is not specified"
+                + " / cache_text_encoder_outputs_to_diskが指定されていないため、text_encoder_outputs_cache_dirは無視されます"
+            )
+        else:
+            logger.info(
+                f"use caption-addressed text encoder outputs cache / キャプションをキーとするtext encoder出力キャッシュを使用します: {cache_dir}"
+            )
+            text_encoder_outputs_caching_strategy.set_content_cache(ContentAddressedTextEncoderOutputsCache(cache_dir))
+
+
 # 戻り値は、latents_tensor, (original_size width, original_size height), (crop left, crop top)
 # TODO update to use CachingStrategy
 # def load_latents_from_disk(
@@ -2802,6 +3327,20 @@ def debug_dataset(train_dataset, show_input_ids=False):
         epoch += 1
 
 
+def read_image_size(image_path) -> Tuple[int, int]:
+    # read only the header of the image. returns (0, 0) if failed
+    image_size = imagesize.get(image_path)
+    if image_size[0] <= 0:
+        # imagesize doesn't work for some images, so use PIL as a fallback
+        try:
+            with Image.open(image_path) as img:
+                image_size = img.size
+        except Exception as e:
+            logger.warning(f"failed to get image size: {image_path}, error: {e}")
+            image_size = (0, 0)
+    return image_size
+
+
 def glob_images(directory, base="*"):
     img_paths = []
     for ext in IMAGE_EXTENSIONS:
@@ -3214,21 +3753,93 @@ def calculate_sha256(filename):
         return "IsADirectory"
 
 
-def precalculate_safetensors_hashes(tensors, metadata):
-    """Precalculate the model hashes needed by sd-webui-additional-networks to
-    save time on indexing the model later."""
+class AddnetHasher:
+    r"""
+    computes addnet_hash_safetensors and addnet_hash_legacy of a safetensors file from its bytes in order,
+    without keeping the file in memory. feed the header by update_header and the tensor data by update.
+    """
+
+    LEGACY_OFFSET = 0x100000
+    LEGACY_SIZE = 0x10000
 
+    def __init__(self) -> None:
+        self._sha256 = hashlib.sha256()  # of the data after the header
+        self._legacy_bytes = bytearray()  # bytes in [LEGACY_OFFSET, LEGACY_OFFSET + LEGACY_SIZE) of the file
+        self._pos = 0
+
+    def _update_legacy(self, data):
+        start = max(self.LEGACY_OFFSET - self._pos, 0)
+        end = min(self.LEGACY_OFFSET + self.LEGACY_SIZE - self._pos, len(data))
+        if start < end:
+            self._legacy_bytes += memoryview(data)[start:end]
+        self._pos += len(data)
+
+    def update_header(self, header: bytes):
+        self._update_legacy(header)
+
+    def update(self, data):
+        self._sha256.update(data)
+        self._update_legacy(data)
+
+    def hexdigests(self) -> Tuple[str, str]:
+        # model_hash, legacy_hash
+        return self._sha256.hexdigest(), hashlib.sha256(self._legacy_bytes).hexdigest()[0:8]
+
+
+def _get_metadata_for_hash(metadata):
     # Because writing user metadata to the file can change the result of
     # sd_models.model_hash(), only retain the training metadata for purposes of
     # calculating the hash, as they are meant to be immutable
-    metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
+    return {k: v for k, v in metadata.items() if k.startswith("ss_")}
+
+
+def precalculate_safetensors_hashes(tensors, metadata):
+    """Precalculate the model hashes needed by sd-webui-additional-networks to
+    save time on indexing the model later."""
+
+    # hash the bytes of safetensors.torch.save(tensors, metadata) tensor by tensor, without serializing all of them
+    header, ordered_tensors = get_safetensors_layout(tensors, _get_metadata_for_hash(metadata))
+    hasher = AddnetHasher()
+    hasher.update_header(header)
+    for _, tensor in ordered_tensors:
+        hasher.update(tensor_to_uint8_array(tensor))
+    return hasher.hexdigests()
+
+
+def save_safetensors_with_hashes(tensors, filename, metadata):
+    r"""
+    save tensors to a safetensors file with sshs_model_hash and sshs_legacy_hash in the metadata, same as
+    precalculate_safetensors_hashes and safetensors.torch.save_file. the hashes are computed while writing the tensors,
+    and the header is rewritten with them at last. metadata is updated with the hashes.
+
+    within async_checkpoint.deferred_writes, the file is written in the background and metadata is not updated.
+    """
+    writer = async_checkpoint.get_deferring_writer()
+    if writer is not None:
+        writer.save_file(tensors, filename, metadata, with_hashes=True)
+        return
+
+    hash_header, _ = get_safetensors_layout(tensors, _get_metadata_for_hash(metadata))
+
+    # the hashes have fixed lengths, so the header with placeholders has the same length as the final one
+    metadata["sshs_model_hash"] = "0" * 64
+    metadata["sshs_legacy_hash"] = "0" * 8
+    header, ordered_tensors = get_safetensors_layout(tensors, metadata)
 
-    bytes = safetensors.torch.save(tensors, metadata)
-    b = BytesIO(bytes)
+    hasher = AddnetHasher()
+    hasher.update_header(hash_header)
+    with open(filename, "wb") as f:
+        f.write(header)
+        for _, tensor in ordered_tensors:
+            data = tensor_to_uint8_array(tensor)
+            f.write(data)
+            hasher.update(data)
 
-    model_hash = addnet_hash_safetensors(b)
-    legacy_hash = addnet_hash_legacy(b)
-    return model_hash, legacy_hash
+        metadata["sshs_model_hash"], metadata["sshs_legacy_hash"] = hasher.hexdigests()
+        final_header, _ = get_safetensors_layout(tensors, metadata)
+        assert len(final_header) == len(header), "internal error: header size is changed"
+        f.seek(0)
+        f.write(final_header)
 
 
 def addnet_hash_legacy(b):
@@ -3745,6 +4356,19 @@ def add_training_arguments(parser: argparse.ArgumentParser, support_dreambooth:
         default=None,
         help="save states until N steps elapsed (remove older states if N steps elapsed, overrides --save_last_n_steps) / 指定ステップごとにstateを保存するとき、このステップ数経過するまで保存する（このステップ数経過したら削除する。--save_last_n_stepsを上書きする）",
     )
+    parser.add_argument(
+        "--async_checkpoint_save",
+        action="store_true",
+        help="save safetensors checkpoints in background while training continues, the weights are copied to pinned CPU memory"
+        + " / 学習を続けながらsafetensorsのチェックポイントをバックグラウンドで保存する。重みはpinned CPUメモリにコピーされる",
+    )
+    parser.add_argument(
+        "--async_checkpoint_max_pending",
+        type=int,
+        default=1,
+        help="max number of checkpoints being saved in background, each uses CPU memory of the model size (default 1)"
+        + " / バックグラウンドで保存中のチェックポイントの最大数。それぞれモデルのサイズのCPUメモリを使用する（デフォルト1）",
+    )
     parser.add_argument(
         "--save_state",
         action="store_true",
@@ -3827,6 +4451,19 @@ def add_training_arguments(parser: argparse.ArgumentParser, support_dreambooth:
         action="store_true",
         help="persistent DataLoader workers (useful for reduce time gap between epoch, but may use more memory) / DataLoader のワーカーを持続させる (エポック間の時間差を少なくするのに有効だが、より多くのメモリを消費する可能性がある)",
     )
+    parser.add_argument(
+        "--data_loader_prefetch_batches",
+        type=int,
+        default=None,
+        help="number of batches loaded in advance by each DataLoader worker (default 2 in PyTorch)"
+        + " / DataLoaderの各ワーカーが先読みするバッチ数（PyTorchのデフォルトは2）",
+    )
+    parser.add_argument(
+        "--pin_data_loader_memory",
+        action="store_true",
+        help="load batches into pinned host memory and transfer them to GPU asynchronously"
+        + " / バッチをピン留めされたメモリに読み込み、GPUへ非同期に転送する",
+    )
     parser.add_argument("--seed", type=int, default=None, help="random seed for training / 学習時の乱数のseed")
     parser.add_argument(
         "--gradient_checkpointing", action="store_true", help="enable gradient checkpointing / gradient checkpointingを有効にする"
@@ -4141,6 +4778,25 @@ def add_dit_training_arguments(parser: argparse.ArgumentParser):
         action="store_true",
         help="cache text encoder outputs to disk / text encoderの出力をディスクにキャッシュする",
     )
+    parser.add_argument(
+        "--text_encoder_outputs_cache_dtype",
+        type=str,
+        default=None,
+        choices=["fp16", "bf16"],
+        help="store the cached text encoder outputs in half precision to reduce the size on disk and in memory (default: None,"
+        " float32). for FLUX.1 with --apply_t5_attn_mask, the padding of T5XXL outputs is also removed"
+        " / キャッシュするtext encoderの出力を半精度で保存し、ディスクとメモリの使用量を削減する（デフォルト: None、float32）。"
+        "FLUX.1で--apply_t5_attn_maskを指定した場合、T5XXLの出力のパディングも保存しない",
+    )
+    parser.add_argument(
+        "--text_encoder_outputs_cache_dir",
+        type=str,
+        default=None,
+        help="directory to cache text encoder outputs with --cache_text_encoder_outputs_to_disk, keyed by the caption and the"
+        " text encoders instead of the image. images with the same caption share one file, across datasets and runs"
+        " / --cache_text_encoder_outputs_to_disk指定時に、画像ではなくキャプションとtext encoderをキーとしてtext encoderの出力を"
+        "キャッシュするディレクトリ。同じキャプションの画像は、データセットや学習をまたいで一つのファイルを共有する",
+    )
     parser.add_argument(
         "--text_encoder_batch_size",
         type=int,
@@ -4195,6 +4851,37 @@ def add_dit_training_arguments(parser: argparse.ArgumentParser):
         " / 順伝播および逆伝播中にスワップするブロックの数を設定します。"
         "この数を増やすと、トレーニング中のVRAM使用量が減りますが、トレーニング速度（s/it）も低下します。",
     )
+    parser.add_argument(
+        "--blocks_to_swap_disk_dir",
+        type=str,
+        default=None,
+        help="[EXPERIMENTAL] back the weights of the swapped blocks by a memory-mapped file in this directory instead of CPU RAM"
+        " / スワップするブロックの重みをCPU RAMではなくこのディレクトリのメモリマップファイルに置く",
+    )
+    parser.add_argument(
+        "--blocks_to_swap_disk_prefetch_depth",
+        type=int,
+        default=2,
+        help="number of blocks to read from the disk ahead of use with --blocks_to_swap_disk_dir (default 2)"
+        " / --blocks_to_swap_disk_dir指定時に、使用前にディスクから先読みするブロック数（デフォルト2）",
+    )
+    parser.add_argument(
+        "--blocks_to_swap_max_prefetch",
+        type=int,
+        default=1,
+        help="[EXPERIMENTAL] max number of block transfers in flight with --blocks_to_swap. the number is adjusted by the measured"
+        " compute and transfer times of the blocks (default 1, one transfer at a time)"
+        " / --blocks_to_swap指定時に同時に転送するブロックの最大数。ブロックの計算時間と転送時間の計測値により調整される（デフォルト1）",
+    )
+    parser.add_argument(
+        "--blocks_to_swap_timeline",
+        type=str,
+        default=None,
+        help="write the timeline of compute, transfer and wait times of --blocks_to_swap to this JSON file at exit (Chrome trace event"
+        " format, viewable in chrome://tracing or Perfetto) to tune the number of blocks to swap"
+        " / --blocks_to_swapの計算・転送・待ち時間のタイムラインを終了時にこのJSONファイルに出力する（Chrome trace形式、chrome://tracingや"
+        "Perfettoで表示可能）。スワップするブロック数の調整用",
+    )
 
 
 def get_sanitized_config_or_none(args: argparse.Namespace):
@@ -4368,6 +5055,32 @@ def add_dataset_arguments(
         help="cache meta information (caption and image size) for faster dataset loading. only available for DreamBooth"
         + " / メタ情報（キャプションとサイズ）をキャッシュしてデータセット読み込みを高速化する。DreamBooth方式のみ有効",
     )
+    parser.add_argument(
+        "--image_size_index_file",
+        type=str,
+        default=None,
+        help="file to keep image sizes across runs. sizes of unchanged images (same mtime and file size) are not read again"
+        + " / 画像サイズを保存するファイル。変更されていない画像（更新日時とファイルサイズが同じ）のサイズは再取得しない",
+    )
+    parser.add_argument(
+        "--dataset_manifest_file",
+        type=str,
+        default=None,
+        help="file to keep image lists, captions, image sizes, buckets and validity of latents cache across runs."
+        + " unchanged files (same mtime) are not read again at startup"
+        + " / 画像一覧、キャプション、画像サイズ、bucket、latentsキャッシュの有効性を保存するファイル。変更されていないファイル（更新日時が同じ）は起動時に再読み込みしない",
+    )
+    parser.add_argument(
+        "--bucket_batch_scheduler",
+        type=str,
+        default=None,
+        choices=list(BUCKET_BATCH_SCHEDULERS.keys()),
+        help="how to make batches from buckets: default, merge_small_buckets (merge buckets smaller than the batch size into"
+        + " the bucket with the nearest aspect ratio to avoid partial batches), pixel_balanced (merge_small_buckets, and larger"
+        + " batches for smaller resolutions to balance pixels per step across GPUs)"
+        + " / bucketからバッチを作る方法：default、merge_small_buckets（バッチサイズ未満のbucketをアスペクト比が最も近いbucketに統合し、"
+        + "端数のバッチを減らす）、pixel_balanced（merge_small_bucketsに加え、小さい解像度ではバッチを大きくしてGPU間のステップごとのピクセル数を揃える）",
+    )
     parser.add_argument(
         "--shuffle_caption", action="store_true", help="shuffle separated caption / 区切られたcaptionの各要素をshuffleする"
     )
@@ -4465,6 +5178,37 @@ def add_dataset_arguments(
         help="skip the content validation of cache (latent and text encoder output). Cache file existence check is always performed, and cache processing is performed if the file does not exist"
         " / cacheの内容の検証をスキップする（latentとテキストエンコーダの出力）。キャッシュファイルの存在確認は常に行われ、ファイルがなければキャッシュ処理が行われる",
     )
+    parser.add_argument(
+        "--latents_cache_shard_dir",
+        type=str,
+        default=None,
+        help="store disk-cached latents in sharded files in this directory instead of per-image npz files. existing npz files are still used"
+        " / ディスクにキャッシュするlatentを画像ごとのnpzファイルではなく、このディレクトリのシャードファイルに保存する。既存のnpzファイルも引き続き使用される",
+    )
+    parser.add_argument(
+        "--latents_cache_shard_size",
+        type=int,
+        default=4096,
+        help="max size of each shard file in MB for --latents_cache_shard_dir (default: 4096)"
+        " / --latents_cache_shard_dir のシャードファイルごとの最大サイズ（MB、デフォルト4096）",
+    )
+    parser.add_argument(
+        "--latents_cache_dir",
+        type=str,
+        default=None,
+        help="store disk-cached latents in this shared directory, keyed by the image content, resolution, crop, flip and VAE."
+        " same images in other subsets, datasets or trainings are not encoded again, and moving datasets keeps the cache"
+        " / ディスクにキャッシュするlatentを、画像の内容、解像度、crop、flip、VAEをキーとしてこの共有ディレクトリに保存する。"
+        "他のサブセット、データセット、学習の同じ画像は再エンコードされず、データセットを移動してもキャッシュが使われる",
+    )
+    parser.add_argument(
+        "--latents_cache_max_size",
+        type=float,
+        default=None,
+        help="max total size of --latents_cache_dir in GB. least recently used files not used by the current training are removed"
+        " after caching (default: unlimited)"
+        " / --latents_cache_dir の最大合計サイズ（GB）。キャッシュ後、現在の学習で使われない最近使われていないファイルから削除される（デフォルト：無制限）",
+    )
     parser.add_argument(
         "--enable_bucket",
         action="store_true",
@@ -5306,6 +6050,55 @@ def prepare_dataset_args(args: argparse.Namespace, support_metadata: bool):
             )
 
 
+def get_data_loader_kwargs(args: argparse.Namespace, num_workers: int) -> Dict[str, Any]:
+    r"""
+    returns optional kwargs of DataLoader for prefetching and pinned memory
+    """
+    kwargs = {"pin_memory": args.pin_data_loader_memory}
+    if num_workers > 0 and args.data_loader_prefetch_batches is not None:
+        kwargs["prefetch_factor"] = args.data_loader_prefetch_batches
+    return kwargs
+
+
+class DataLoaderWaitTimer:
+    r"""
+    measures how long the training loop waits for the next batch from the DataLoader
+    """
+
+    def __init__(self):
+        self.last_wait_time = 0.0
+        self.total_wait_time = 0.0
+        self.total_time = 0.0
+        self.num_batches = 0
+
+    def __call__(self, iterable):
+        # wrap the iterable: batches are not read ahead here, so the state of accelerate's DataLoader is not affected
+        start_time = last_time = time.perf_counter()
+        for item in iterable:
+            now = time.perf_counter()
+            self.last_wait_time = now - last_time
+            self.total_wait_time += self.last_wait_time
+            self.num_batches += 1
+            yield item
+            last_time = time.perf_counter()
+            self.total_time += last_time - start_time
+            start_time = last_time
+
+    def get_logs(self) -> Dict[str, float]:
+        return {
+            "data/wait_time": self.last_wait_time,
+            "data/wait_ratio": self.total_wait_time / self.total_time if self.total_time > 0 else 0.0,
+        }
+
+    def log_summary(self):
+        if self.num_batches == 0:
+            return
+        logger.info(
+            f"waited for data loading: {self.total_wait_time:.1f}s in total, {self.total_wait_time / self.num_batches * 1000:.1f}ms per batch,"
+            + f" {self.total_wait_time / max(self.total_time, 1e-6) * 100:.1f}% of the time"
+        )
+
+
 def prepare_accelerator(args: argparse.Namespace):
     """
     this function also prepares deepspeed plugin
@@ -5376,6 +6169,7 @@ def prepare_accelerator(args: argparse.Namespace):
         kwargs_handlers=kwargs_handlers,
         dynamo_backend=dynamo_backend,
         deepspeed_plugin=deepspeed_plugin,
+        dataloader_config=DataLoaderConfiguration(non_blocking=True) if args.pin_data_loader_memory else None,
     )
     print("accelerator device:", accelerator.device)
     return accelerator
@@ -5408,6 +6202,8 @@ def _load_target_model(args: argparse.Namespace, weight_dtype, device="cpu", une
         text_encoder, vae, unet = model_util.load_models_from_stable_diffusion_checkpoint(
             args.v2, name_or_path, device, unet_use_linear_projection_in_v2=unet_use_linear_projection_in_v2
         )
+        set_model_source(text_encoder, name_or_path)
+        set_model_source(vae, name_or_path)
     else:
         # Diffusers model is loaded to CPU
         logger.info(f"load Diffusers pretrained models: {name_or_path}")
@@ -5440,6 +6236,7 @@ def _load_target_model(args: argparse.Namespace, weight_dtype, device="cpu", une
     # VAEを読み込む
     if args.vae is not None:
         vae = model_util.load_vae(args.vae, weight_dtype)
+        set_model_source(vae, args.vae)
         logger.info("additional VAE loaded")
 
     return text_encoder, vae, unet, load_stable_diffusion_format
@@ -5747,6 +6544,7 @@ def save_sd_model_on_epoch_end_or_stepwise_common(
         remove_no = get_remove_step_no(args, global_step)
 
     os.makedirs(args.output_dir, exist_ok=True)
+    writer = async_checkpoint.get_checkpoint_writer(args)
     if save_stable_diffusion_format:
         ext = ".safetensors" if use_safetensors else ".ckpt"
 
@@ -5758,10 +6556,14 @@ def save_sd_model_on_epoch_end_or_stepwise_common(
         ckpt_file = os.path.join(args.output_dir, ckpt_name)
         logger.info("")
         logger.info(f"saving checkpoint: {ckpt_file}")
-        sd_saver(ckpt_file, epoch_no, global_step)
+        with async_checkpoint.deferred_writes(writer):
+            sd_saver(ckpt_file, epoch_no, global_step)
 
         if args.huggingface_repo_id is not None:
-            huggingface_util.upload(args, ckpt_file, "/" + ckpt_name)
+            if writer is not None:
+                writer.submit(huggingface_util.upload, args, ckpt_file, "/" + ckpt_name)
+            else:
+                huggingface_util.upload(args, ckpt_file, "/" + ckpt_name)
 
         # remove older checkpoints
         if remove_no is not None:
@@ -5771,7 +6573,9 @@ def save_sd_model_on_epoch_end_or_stepwise_common(
                 remove_ckpt_name = get_step_ckpt_name(args, ext, remove_no)
 
             remove_ckpt_file = os.path.join(args.output_dir, remove_ckpt_name)
-            if os.path.exists(remove_ckpt_file):
+            if writer is not None:
+                writer.remove(remove_ckpt_file)  # after the new checkpoint is written
+            elif os.path.exists(remove_ckpt_file):
                 logger.info(f"removing old checkpoint: {remove_ckpt_file}")
                 os.remove(remove_ckpt_file)
 
@@ -5783,10 +6587,13 @@ def save_sd_model_on_epoch_end_or_stepwise_common(
 
         logger.info("")
         logger.info(f"saving model: {out_dir}")
-        diffusers_saver(out_dir)
+        diffusers_saver(out_dir)  # Diffusers format is always saved synchronously
 
         if args.huggingface_repo_id is not None:
-            huggingface_util.upload(args, out_dir, "/" + model_name)
+            if writer is not None:
+                writer.submit(huggingface_util.upload, args, out_dir, "/" + model_name)
+            else:
+                huggingface_util.upload(args, out_dir, "/" + model_name)
 
         # remove older checkpoints
         if remove_no is not None:
@@ -5795,7 +6602,9 @@ def save_sd_model_on_epoch_end_or_stepwise_common(
             else:
                 remove_out_dir = os.path.join(args.output_dir, STEP_DIFFUSERS_DIR_NAME.format(model_name, remove_no))
 
-            if os.path.exists(remove_out_dir):
+            if writer is not None:
+                writer.remove(remove_out_dir)
+            elif os.path.exists(remove_out_dir):
                 logger.info(f"removing old model: {remove_out_dir}")
                 shutil.rmtree(remove_out_dir)
 
@@ -5908,6 +6717,9 @@ def save_sd_model_on_train_end_common(
 ):
     model_name = default_if_none(args.output_name, DEFAULT_LAST_OUTPUT_NAME)
 
+    # wait for the checkpoints saved in background, and save the last model synchronously
+    async_checkpoint.close_checkpoint_writer()
+
     if save_stable_diffusion_format:
         os.makedirs(args.output_dir, exist_ok=True)
 
@@ -5930,7 +6742,37 @@ def save_sd_model_on_train_end_common(
             huggingface_util.upload(args, out_dir, "/" + model_name, force_sync_upload=True)
 
 
-def get_timesteps(min_timestep: int, max_timestep: int, b_size: int, device: torch.device) -> torch.Tensor:
+def repeat_batch(batch: Any, num_repeats: int, batch_size: Optional[int] = None) -> Any:
+    r"""
+    repeat the samples of the batch from the dataset num_repeats times along the batch dimension, e.g. to evaluate several
+    timesteps in one forward. the batch becomes [batch, batch, ...]. values which are not per sample are not repeated.
+    """
+    if batch_size is None:
+        batch_size = len(batch["loss_weights"])
+
+    if isinstance(batch, dict):
+        return {key: repeat_batch(value, num_repeats, batch_size) for key, value in batch.items()}
+    if isinstance(batch, torch.Tensor):
+        if batch.dim() == 0 or batch.size(0) != batch_size:
+            return batch
+        return batch.repeat(num_repeats, *([1] * (batch.dim() - 1)))
+    if isinstance(batch, (list, tuple)):
+        if all(value is None or isinstance(value, torch.Tensor) for value in batch):
+            # outputs or input_ids of each text encoder
+            return type(batch)(repeat_batch(value, num_repeats, batch_size) for value in batch)
+        if len(batch) == batch_size:
+            return type(batch)(list(batch) * num_repeats)  # captions, custom_attributes, flippeds etc.
+    return batch
+
+
+def get_timesteps(
+    min_timestep: Union[int, List[int]], max_timestep: Union[int, List[int]], b_size: int, device: torch.device
+) -> torch.Tensor:
+    if isinstance(min_timestep, (list, tuple)):
+        # fixed timesteps for the repeated batch, from the batched validation
+        assert list(min_timestep) == list(max_timestep), "timesteps must be fixed / タイムステップは固定である必要があります"
+        timesteps = torch.tensor(min_timestep, dtype=torch.long).repeat_interleave(b_size // len(min_timestep))
+        return timesteps.to(device)
     if min_timestep < max_timestep:
         timesteps = torch.randint(min_timestep, max_timestep, (b_size,), device="cpu")
     else:
@@ -6204,6 +7046,68 @@ def load_prompts(prompt_file: str) -> List[Dict]:
     return prompts
 
 
+class SamplePromptConditioningCache:
+    r"""
+    conditioning of the sample prompts for SD/SDXL pipelines, reused across the sampling calls. the text encoders are
+    called only for the new prompts, so they can stay offloaded while sampling. use this only if the text encoders are
+    not trained, otherwise the cached conditioning becomes stale. the conditionings are kept on CPU.
+    """
+
+    def __init__(self) -> None:
+        self.conditionings: Dict[Tuple[str, Optional[str], Optional[int], bool], Any] = {}
+
+    @staticmethod
+    def _to(conditioning, device):
+        if isinstance(conditioning, (list, tuple)):
+            return tuple(None if c is None else c.to(device) for c in conditioning)
+        return conditioning.to(device)
+
+    def prepare(self, pipeline, keys: List[Tuple[str, Optional[str], Optional[int], bool]], text_encoders, device):
+        r"""
+        encode the prompts of keys which are not cached. the text encoders are moved to device only if there is a new
+        prompt, and moved back to the original devices after encoding.
+        """
+        new_keys = [key for key in dict.fromkeys(keys) if key not in self.conditionings]
+        if len(new_keys) == 0:
+            return
+
+        org_devices = [text_encoder.device for text_encoder in text_encoders]
+        for text_encoder in text_encoders:
+            text_encoder.to(device)
+        try:
+            for prompt, negative_prompt, clip_skip, guidance in new_keys:
+                conditioning = pipeline.encode_prompt_conditioning(prompt, negative_prompt, guidance)
+                self.conditionings[(prompt, negative_prompt, clip_skip, guidance)] = self._to(conditioning, "cpu")
+        finally:
+            for text_encoder, org_device in zip(text_encoders, org_devices):
+                text_encoder.to(org_device)
+
+    def get_conditioning(
+        self, pipeline, prompt: str, negative_prompt: Optional[str], clip_skip: Optional[int], guidance: bool, device=None
+    ):
+        key = (prompt, negative_prompt, clip_skip, guidance)
+        if key not in self.conditionings:
+            conditioning = pipeline.encode_prompt_conditioning(prompt, negative_prompt, guidance)
+            self.conditionings[key] = self._to(conditioning, "cpu")
+        return self._to(self.conditionings[key], device or "cpu")
+
+    def clear(self):
+        self.conditionings.clear()
+
+
+def get_sample_prompts(prompt_dict: dict, prompt_replacement=None) -> Tuple[str, Optional[str]]:
+    r"""
+    returns (prompt, negative_prompt) of prompt_dict with prompt_replacement applied.
+    """
+    prompt: str = prompt_dict.get("prompt", "")
+    negative_prompt = prompt_dict.get("negative_prompt")
+    if prompt_replacement is not None:
+        prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
+        if negative_prompt is not None:
+            negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
+    return prompt, negative_prompt
+
+
 def sample_images_common(
     pipe_class,
     accelerator: Accelerator,
@@ -6217,10 +7121,12 @@ def sample_images_common(
     unet,
     prompt_replacement=None,
     controlnet=None,
+    conditioning_cache: Optional[SamplePromptConditioningCache] = None,
 ):
     """
     StableDiffusionLongPromptWeightingPipelineの改造版を使うようにしたので、clip skipおよびプロンプトの重みづけに対応した
     TODO Use strategies here
+    conditioning_cache: if specified, the conditioning of the prompts is reused across the calls
     """
 
     if steps == 0:
@@ -6281,7 +7187,11 @@ def sample_images_common(
         requires_safety_checker=False,
         clip_skip=args.clip_skip,
     )
-    pipeline.to(distributed_state.device)
+    if conditioning_cache is None:
+        pipeline.to(distributed_state.device)
+    else:
+        # the text encoders are not moved here: they are moved to the device only to encode the new prompts below
+        unet.to(distributed_state.device)
     save_dir = args.output_dir + "/sample"
     os.makedirs(save_dir, exist_ok=True)
 
@@ -6297,6 +7207,16 @@ def sample_images_common(
         prompt_dict["enum"] = i
         prompt_dict.pop("subset", None)
 
+    if conditioning_cache is not None:
+        keys = []
+        for prompt_dict in prompts:
+            prompt, negative_prompt = get_sample_prompts(prompt_dict, prompt_replacement)
+            guidance = prompt_dict.get("scale", 7.5) > 1.0  # same as do_classifier_free_guidance
+            keys.append((prompt, negative_prompt, args.clip_skip, guidance))
+        text_encoders = text_encoder if isinstance(text_encoder, (list, tuple)) else [text_encoder]
+        with torch.no_grad(), accelerator.autocast():
+            conditioning_cache.prepare(pipeline, keys, text_encoders, distributed_state.device)
+
     # save random state to restore later
     rng_state = torch.get_rng_state()
     cuda_rng_state = None
@@ -6310,7 +7230,16 @@ def sample_images_common(
         with torch.no_grad():
             for prompt_dict in prompts:
                 sample_image_inference(
-                    accelerator, args, pipeline, save_dir, prompt_dict, epoch, steps, prompt_replacement, controlnet=controlnet
+                    accelerator,
+                    args,
+                    pipeline,
+                    save_dir,
+                    prompt_dict,
+                    epoch,
+                    steps,
+                    prompt_replacement,
+                    controlnet=controlnet,
+                    conditioning_cache=conditioning_cache,
                 )
     else:
         # Creating list with N elements, where each element is a list of prompt_dicts, and N is the number of processes available (number of devices available)
@@ -6323,7 +7252,16 @@ def sample_images_common(
             with distributed_state.split_between_processes(per_process_prompts) as prompt_dict_lists:
                 for prompt_dict in prompt_dict_lists[0]:
                     sample_image_inference(
-                        accelerator, args, pipeline, save_dir, prompt_dict, epoch, steps, prompt_replacement, controlnet=controlnet
+                        accelerator,
+                        args,
+                        pipeline,
+                        save_dir,
+                        prompt_dict,
+                        epoch,
+                        steps,
+                        prompt_replacement,
+                        controlnet=controlnet,
+                        conditioning_cache=conditioning_cache,
                     )
 
     # clear pipeline and cache to reduce vram usage
@@ -6347,23 +7285,18 @@ def sample_image_inference(
     steps,
     prompt_replacement,
     controlnet=None,
+    conditioning_cache: Optional[SamplePromptConditioningCache] = None,
 ):
     assert isinstance(prompt_dict, dict)
-    negative_prompt = prompt_dict.get("negative_prompt")
+    prompt, negative_prompt = get_sample_prompts(prompt_dict, prompt_replacement)
     sample_steps = prompt_dict.get("sample_steps", 30)
     width = prompt_dict.get("width", 512)
     height = prompt_dict.get("height", 512)
     scale = prompt_dict.get("scale", 7.5)
     seed = prompt_dict.get("seed")
     controlnet_image = prompt_dict.get("controlnet_image")
-    prompt: str = prompt_dict.get("prompt", "")
     sampler_name: str = prompt_dict.get("sample_sampler", args.sample_sampler)
 
-    if prompt_replacement is not None:
-        prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
-        if negative_prompt is not None:
-            negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
-
     if seed is not None:
         torch.manual_seed(seed)
         if torch.cuda.is_available():
@@ -6396,6 +7329,13 @@ def sample_image_inference(
     if seed is not None:
         logger.info(f"seed: {seed}")
     with accelerator.autocast():
+        prompt_conditioning = None
+        if conditioning_cache is not None:
+            guidance = scale > 1.0  # same as do_classifier_free_guidance
+            prompt_conditioning = conditioning_cache.get_conditioning(
+                pipeline, prompt, negative_prompt, args.clip_skip, guidance, accelerator.device
+            )
+
         latents = pipeline(
             prompt=prompt,
             height=height,
@@ -6405,6 +7345,7 @@ def sample_image_inference(
             negative_prompt=negative_prompt,
             controlnet=controlnet,
             controlnet_image=controlnet_image,
+            prompt_conditioning=prompt_conditioning,
         )
 
     if torch.cuda.is_available():
@@ -2,8 +2,12 @@ import logging
 import sys
 import threading
 from typing import *
+import collections
 import json
+import mmap
+import os
 import struct
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
@@ -189,26 +193,73 @@ def str_to_dtype(s: Optional[str], default_dtype: Optional[torch.dtype] = None)
         raise ValueError(f"Unsupported dtype: {s}")
 
 
-def mem_eff_save_file(tensors: Dict[str, torch.Tensor], filename: str, metadata: Dict[str, Any] = None):
+_MEM_EFF_SAVE_ALIGN = 256  # the data starts at a multiple of this
+_MEM_EFF_SAVE_DEFAULT_HEADER_RESERVE = 1024 * 1024  # for iterables of unknown keys
+
+
+def _mem_eff_header_json(entries: List[Tuple[str, str, List[int], int, int]], metadata: Optional[Dict[str, str]]) -> bytes:
+    header = {}
+    if metadata:
+        header["__metadata__"] = metadata
+    for key, dtype_str, shape, start, end in entries:
+        header[key] = {"dtype": dtype_str, "shape": shape, "data_offsets": [start, end]}
+    return json.dumps(header).encode("utf-8")
+
+
+def _mem_eff_header_capacity(hjson_size: int) -> int:
+    # size of the header (without the 8 bytes of its length) to align the data
+    return -(-(hjson_size + 8) // _MEM_EFF_SAVE_ALIGN) * _MEM_EFF_SAVE_ALIGN - 8
+
+
+def _write_at(fd: int, filename: str, offset: int, data: np.ndarray):
+    view = memoryview(data).cast("B")
+    if hasattr(os, "pwrite"):
+        while len(view) > 0:
+            n = os.pwrite(fd, view, offset)
+            view = view[n:]
+            offset += n
+    else:
+        # no positional write on Windows: each call opens the file, so it is thread safe
+        with open(filename, "r+b") as f:
+            f.seek(offset)
+            f.write(view)
+
+
+def _shift_file_data(fd: int, filename: str, start: int, end: int, delta: int, chunk_size: int):
+    # move bytes [start, end) to [start + delta, end + delta), from the end not to overwrite unmoved data
+    pos = end
+    with open(filename, "rb") as f:
+        while pos > start:
+            size = min(chunk_size, pos - start)
+            pos -= size
+            f.seek(pos)
+            _write_at(fd, filename, pos + delta, np.frombuffer(f.read(size), dtype=np.uint8))
+
+
+def mem_eff_save_file(
+    tensors: Union[Dict[str, torch.Tensor], Iterable[Tuple[str, Union[torch.Tensor, Callable[[], torch.Tensor]]]]],
+    filename: str,
+    metadata: Dict[str, Any] = None,
+    dtype: Optional[torch.dtype] = None,
+    num_workers: Optional[int] = None,
+    chunk_size: int = 64 * 1024 * 1024,
+    max_pending_tensors: Optional[int] = None,
+):
     """
     memory efficient save file
-    """
 
-    _TYPES = {
-        torch.float64: "F64",
-        torch.float32: "F32",
-        torch.float16: "F16",
-        torch.bfloat16: "BF16",
-        torch.int64: "I64",
-        torch.int32: "I32",
-        torch.int16: "I16",
-        torch.int8: "I8",
-        torch.uint8: "U8",
-        torch.bool: "BOOL",
-        getattr(torch, "float8_e5m2", None): "F8_E5M2",
-        getattr(torch, "float8_e4m3fn", None): "F8_E4M3",
-    }
-    _ALIGN = 256
+    tensors: dict of tensors, or iterable of (key, tensor or function to produce the tensor). the functions are called
+        lazily in order, so tensors can be produced (e.g. loaded and merged) one by one while writing.
+    dtype: floating point tensors are converted to this dtype chunk by chunk while writing, no converted copy of
+        the whole tensor is made. tensors on GPU are also copied to CPU chunk by chunk.
+
+    chunks of chunk_size bytes are converted and written with positional writes by num_workers threads, and at most
+    max_pending_tensors produced tensors are kept until written.
+
+    the tensors are written in order of the iteration and the header is written at last. space for the header is
+    reserved before the data: exact if all tensors are given, otherwise estimated from the keys (or 1MB if the keys
+    are unknown). if the header is larger than the space, the data is moved.
+    """
 
     def validate_metadata(metadata: Dict[str, Any]) -> Dict[str, str]:
         validated = {}
@@ -224,52 +275,174 @@ def mem_eff_save_file(tensors: Dict[str, torch.Tensor], filename: str, metadata:
 
     print(f"Using memory efficient save file: {filename}")
 
-    header = {}
-    offset = 0
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+    if max_pending_tensors is None:
+        max_pending_tensors = num_workers + 1
     if metadata:
-        header["__metadata__"] = validate_metadata(metadata)
-    for k, v in tensors.items():
-        if v.numel() == 0:  # empty tensor
-            header[k] = {"dtype": _TYPES[v.dtype], "shape": list(v.shape), "data_offsets": [offset, offset]}
-        else:
-            size = v.numel() * v.element_size()
-            header[k] = {"dtype": _TYPES[v.dtype], "shape": list(v.shape), "data_offsets": [offset, offset + size]}
-            offset += size
+        metadata = validate_metadata(metadata)
+
+    def get_save_dtype(tensor: torch.Tensor) -> torch.dtype:
+        return dtype if dtype is not None and tensor.dtype.is_floating_point else tensor.dtype
+
+    # reserve space for the header
+    items = list(tensors.items()) if isinstance(tensors, dict) else tensors
+    total_size = None
+    if isinstance(items, (list, tuple)) and all(isinstance(v, torch.Tensor) for _, v in items):
+        entries = []
+        total_size = 0
+        for key, tensor in items:
+            size = tensor.numel() * torch.empty(0, dtype=get_save_dtype(tensor)).element_size()
+            entries.append((key, _SAFETENSORS_DTYPES[get_save_dtype(tensor)], list(tensor.shape), total_size, total_size + size))
+            total_size += size
+        header_capacity = _mem_eff_header_capacity(len(_mem_eff_header_json(entries, metadata)))
+    elif isinstance(items, (list, tuple)):
+        # estimate with large enough shapes and offsets
+        large = 10**15
+        entries = [(key, "F8_E4M3", [large] * 4, large, large) for key, _ in items]
+        header_capacity = _mem_eff_header_capacity(len(_mem_eff_header_json(entries, metadata)))
+    else:
+        header_capacity = _mem_eff_header_capacity(_MEM_EFF_SAVE_DEFAULT_HEADER_RESERVE)
+    data_start = 8 + header_capacity
 
-    hjson = json.dumps(header).encode("utf-8")
-    hjson += b" " * (-(len(hjson) + 8) % _ALIGN)
+    def write_chunk(fd: int, flat: torch.Tensor, save_dtype: torch.dtype, start: int, end: int, file_offset: int):
+        chunk = flat[start:end].to("cpu", dtype=save_dtype).contiguous()
+        _write_at(fd, filename, file_offset, chunk.view(torch.uint8).numpy())
 
     with open(filename, "wb") as f:
-        f.write(struct.pack("<Q", len(hjson)))
-        f.write(hjson)
-
-        for k, v in tensors.items():
-            if v.numel() == 0:
-                continue
-            if v.is_cuda:
-                # Direct GPU to disk save
-                with torch.cuda.device(v.device):
-                    if v.dim() == 0:  # if scalar, need to add a dimension to work with view
-                        v = v.unsqueeze(0)
-                    tensor_bytes = v.contiguous().view(torch.uint8)
-                    tensor_bytes.cpu().numpy().tofile(f)
-            else:
-                # CPU tensor save
-                if v.dim() == 0:  # if scalar, need to add a dimension to work with view
-                    v = v.unsqueeze(0)
-                v.contiguous().view(torch.uint8).numpy().tofile(f)
+        if total_size is not None:
+            f.truncate(data_start + total_size)  # preallocate
+
+    fd = os.open(filename, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    try:
+        entries = []
+        offset = 0
+        pending = collections.deque()  # futures of the tensors being written
+        with ThreadPoolExecutor(num_workers) as executor:
+            for key, producer in items:
+                tensor = producer() if callable(producer) else producer
+                save_dtype = get_save_dtype(tensor)
+                element_size = torch.empty(0, dtype=save_dtype).element_size()
+                numel = tensor.numel()
+                size = numel * element_size
+                entries.append((key, _SAFETENSORS_DTYPES[save_dtype], list(tensor.shape), offset, offset + size))
+
+                if numel > 0:
+                    flat = tensor.detach().reshape(-1)
+                    step = max(chunk_size // element_size, 1)
+                    futures = [
+                        executor.submit(write_chunk, fd, flat, save_dtype, i, min(i + step, numel), data_start + offset + i * element_size)
+                        for i in range(0, numel, step)
+                    ]
+                    pending.append(futures)
+                    del flat
+                del tensor
+                offset += size
+
+                while len(pending) >= max_pending_tensors:
+                    for future in pending.popleft():
+                        future.result()
+
+            while len(pending) > 0:
+                for future in pending.popleft():
+                    future.result()
+
+        hjson = _mem_eff_header_json(entries, metadata)
+        if len(hjson) > header_capacity:
+            new_header_capacity = _mem_eff_header_capacity(len(hjson))
+            print(f"Warning: header is larger than reserved, moving data: {len(hjson)} > {header_capacity}")
+            _shift_file_data(fd, filename, data_start, data_start + offset, new_header_capacity - header_capacity, chunk_size)
+            header_capacity = new_header_capacity
+            data_start = 8 + header_capacity
+
+        hjson += b" " * (header_capacity - len(hjson))
+        _write_at(fd, filename, 0, np.frombuffer(struct.pack("<Q", len(hjson)) + hjson, dtype=np.uint8))
+        os.ftruncate(fd, data_start + offset)
+    finally:
+        os.close(fd)
+
+
+# same order as the dtypes in the safetensors library: tensors are sorted by dtype in descending order, then by name
+_SAFETENSORS_DTYPE_ORDER = [
+    "BOOL", "U8", "I8", "F8_E5M2", "F8_E4M3", "I16", "U16", "F16", "BF16", "I32", "U32", "F32", "F64", "I64", "U64"
+]  # fmt: skip
+_SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+    getattr(torch, "uint16", None): "U16",
+    getattr(torch, "uint32", None): "U32",
+    getattr(torch, "uint64", None): "U64",
+    getattr(torch, "float8_e5m2", None): "F8_E5M2",
+    getattr(torch, "float8_e4m3fn", None): "F8_E4M3",
+}
+
+
+def get_safetensors_layout(
+    tensors: Dict[str, torch.Tensor], metadata: Optional[Dict[str, str]] = None
+) -> Tuple[bytes, List[Tuple[str, torch.Tensor]]]:
+    r"""
+    returns the header (including the 8 bytes of its length) and the tensors in the order of the data,
+    which are the same as safetensors.torch.save. the order of metadata entries may differ, but the length is the same.
+    """
+    ordered = sorted(tensors.items(), key=lambda kv: (-_SAFETENSORS_DTYPE_ORDER.index(_SAFETENSORS_DTYPES[kv[1].dtype]), kv[0]))
+
+    header = {}
+    if metadata is not None:
+        for key, value in metadata.items():
+            if not isinstance(value, str):
+                raise ValueError(f"Metadata value for key '{key}' must be a string, got {type(value)}")
+        header["__metadata__"] = metadata
+    offset = 0
+    for key, tensor in ordered:
+        size = tensor.numel() * tensor.element_size()
+        header[key] = {"dtype": _SAFETENSORS_DTYPES[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + size]}
+        offset += size
+
+    hjson = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    hjson += b" " * (-len(hjson) % 8)
+    return struct.pack("<Q", len(hjson)) + hjson, ordered
+
+
+def tensor_to_uint8_array(tensor: torch.Tensor) -> np.ndarray:
+    r"""
+    raw bytes of the tensor as a uint8 numpy array, without copying if the tensor is contiguous and on CPU.
+    """
+    tensor = tensor.detach()
+    if tensor.device.type != "cpu":
+        tensor = tensor.to("cpu")
+    return tensor.contiguous().reshape(-1).view(torch.uint8).numpy()
 
 
 class MemoryEfficientSafeOpen:
-    def __init__(self, filename):
+    r"""
+    reader of safetensors files without safetensors.safe_open.
+
+    use_mmap=False: get_tensor reads the data of the tensor into a new buffer, the file is not mapped.
+    use_mmap=True: the file is mapped once and get_tensor returns tensors viewing the mapping without copying.
+    the mapping is copy-on-write: writing to the tensors does not change the file, and the pages are copied only when
+    written. the tensors are valid after closing the reader.
+    """
+
+    def __init__(self, filename, use_mmap: bool = False):
         self.filename = filename
         self.file = open(filename, "rb")
         self.header, self.header_size = self._read_header()
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY) if use_mmap else None
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        # the mapping is not closed here, because the tensors may still view it. it is unmapped when they are freed
+        self.mmap = None
         self.file.close()
 
     def keys(self):
@@ -287,10 +460,16 @@ class MemoryEfficientSafeOpen:
 
         if offset_start == offset_end:
             tensor_bytes = None
+        elif self.mmap is not None:
+            # view of the mapping, no copy
+            tensor_bytes = torch.frombuffer(
+                self.mmap, dtype=torch.uint8, count=offset_end - offset_start, offset=self.header_size + 8 + offset_start
+            )
         else:
             # adjust offset by header size
             self.file.seek(self.header_size + 8 + offset_start)
-            tensor_bytes = self.file.read(offset_end - offset_start)
+            tensor_bytes = bytearray(offset_end - offset_start)  # writable, read without an intermediate bytes object
+            self.file.readinto(tensor_bytes)
 
         return self._deserialize_tensor(tensor_bytes, metadata)
 
@@ -305,8 +484,9 @@ class MemoryEfficientSafeOpen:
 
         if tensor_bytes is None:
             byte_tensor = torch.empty(0, dtype=torch.uint8)
+        elif isinstance(tensor_bytes, torch.Tensor):
+            byte_tensor = tensor_bytes
         else:
-            tensor_bytes = bytearray(tensor_bytes)  # make it writable
             byte_tensor = torch.frombuffer(tensor_bytes, dtype=torch.uint8)
 
         # process float8 types
@@ -350,18 +530,107 @@ class MemoryEfficientSafeOpen:
             raise ValueError(f"Unsupported float8 type: {dtype_str} (upgrade PyTorch to support float8 types)")
 
 
+def _read_into(path: str, offset: int, buffer: torch.Tensor):
+    # read len(buffer) bytes at offset into a contiguous uint8 tensor. each call opens the file, so it is thread safe
+    view = memoryview(buffer.numpy())
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while len(view) > 0:
+            n = f.readinto(view)
+            if not n:
+                raise EOFError(f"unexpected end of file: {path}")
+            view = view[n:]
+
+
+def load_safetensors_parallel(
+    path: str,
+    device: Union[str, torch.device] = "cpu",
+    dtype: Optional[torch.dtype] = None,
+    num_workers: Optional[int] = None,
+    chunk_size: int = 64 * 1024 * 1024,
+    max_window_size: int = 2 * 1024**3,
+) -> Dict[str, torch.Tensor]:
+    r"""
+    load all tensors of a safetensors file without mmap, by reading byte ranges of chunk_size in a thread pool.
+
+    if the dtype of a tensor is the same as dtype (or dtype is None), the data is read directly into the tensor.
+    otherwise each chunk is read into a per-chunk buffer and converted to dtype, so the whole tensor in the original
+    dtype is never in memory. for devices other than CPU, tensors are loaded in windows of max_window_size bytes
+    and moved to the device after each window, to limit CPU memory usage.
+    """
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+    device = torch.device(device)
+
+    with MemoryEfficientSafeOpen(path) as f:
+        header, header_size = f.header, f.header_size
+        keys = sorted(f.keys(), key=lambda k: header[k]["data_offsets"][0])
+    data_start = header_size + 8
+
+    def read_chunk(key: str, out: torch.Tensor, src_dtype: torch.dtype, start: int, end: int):
+        # start, end: byte offsets in the tensor
+        file_offset = data_start + header[key]["data_offsets"][0] + start
+        if out.dtype == src_dtype:
+            _read_into(path, file_offset, out.view(-1).view(torch.uint8)[start:end])
+        else:
+            buffer = torch.empty(end - start, dtype=torch.uint8)
+            _read_into(path, file_offset, buffer)
+            chunk = buffer.view(src_dtype)
+            element_size = chunk.element_size()
+            out.view(-1)[start // element_size : end // element_size].copy_(chunk)
+
+    def load_window(window_keys: List[str]) -> Dict[str, torch.Tensor]:
+        state_dict = {}
+        jobs = []
+        for key in window_keys:
+            metadata = header[key]
+            src_dtype = MemoryEfficientSafeOpen._get_torch_dtype(metadata["dtype"])
+            if src_dtype is None:
+                raise ValueError(f"Unsupported dtype: {metadata['dtype']} (upgrade PyTorch to support float8 types)")
+            out = torch.empty(metadata["shape"], dtype=dtype if dtype is not None else src_dtype)
+            state_dict[key] = out
+
+            offset_start, offset_end = metadata["data_offsets"]
+            num_bytes = offset_end - offset_start
+            element_size = torch.empty(0, dtype=src_dtype).element_size()
+            step = max(chunk_size // element_size, 1) * element_size  # chunks are aligned to elements
+            for start in range(0, num_bytes, step):
+                jobs.append((key, out, src_dtype, start, min(start + step, num_bytes)))
+
+        # larger chunks first for load balancing
+        jobs.sort(key=lambda job: job[4] - job[3], reverse=True)
+        with ThreadPoolExecutor(num_workers) as executor:
+            for _ in executor.map(lambda job: read_chunk(*job), jobs):
+                pass
+
+        if device.type != "cpu":
+            state_dict = {key: tensor.to(device) for key, tensor in state_dict.items()}
+        return state_dict
+
+    state_dict = {}
+    window_keys = []
+    window_size = 0
+    for key in keys:
+        offset_start, offset_end = header[key]["data_offsets"]
+        window_keys.append(key)
+        window_size += offset_end - offset_start
+        if device.type != "cpu" and window_size >= max_window_size:
+            state_dict.update(load_window(window_keys))
+            window_keys = []
+            window_size = 0
+    if len(window_keys) > 0:
+        state_dict.update(load_window(window_keys))
+
+    return {key: state_dict[key] for key in header.keys() if key != "__metadata__"}  # same order as the header
+
+
 def load_safetensors(
     path: str, device: Union[str, torch.device], disable_mmap: bool = False, dtype: Optional[torch.dtype] = torch.float32
 ) -> dict[str, torch.Tensor]:
     if disable_mmap:
         # return safetensors.torch.load(open(path, "rb").read())
-        # use experimental loader
-        # logger.info(f"Loading without mmap (experimental)")
-        state_dict = {}
-        with MemoryEfficientSafeOpen(path) as f:
-            for key in f.keys():
-                state_dict[key] = f.get_tensor(key).to(device, dtype=dtype)
-        return state_dict
+        # use experimental loader: read in parallel without mmap
+        return load_safetensors_parallel(path, device, dtype)
     else:
         try:
             state_dict = load_file(path, device=device)
@@ -9,7 +9,7 @@ import time
 import torch
 from safetensors.torch import load_file, save_file
 from tqdm import tqdm
-from library import sai_model_spec, model_util, sdxl_model_util
+from library import lora_extract_utils, sai_model_spec, model_util, sdxl_model_util
 import lora
 from library.utils import setup_logging
 setup_logging()
@@ -49,6 +49,7 @@ def svd(
     load_precision=None,
     load_original_model_to=None,
     load_tuned_model_to=None,
+    svd_method="randomized",
 ):
     def str_to_dtype(p):
         if p == "float":
@@ -183,38 +184,11 @@ def svd(
             conv2d_3x3 = conv2d and kernel_size != (1, 1)
 
             rank = dim if not conv2d_3x3 or conv_dim is None else conv_dim
-            out_dim, in_dim = mat.size()[0:2]
 
             if device:
                 mat = mat.to(device)
 
-            # logger.info(lora_name, mat.size(), mat.device, rank, in_dim, out_dim)
-            rank = min(rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
-
-            if conv2d:
-                if conv2d_3x3:
-                    mat = mat.flatten(start_dim=1)
-                else:
-                    mat = mat.squeeze()
-
-            U, S, Vh = torch.linalg.svd(mat)
-
-            U = U[:, :rank]
-            S = S[:rank]
-            U = U @ torch.diag(S)
-
-            Vh = Vh[:rank, :]
-
-            dist = torch.cat([U.flatten(), Vh.flatten()])
-            hi_val = torch.quantile(dist, clamp_quantile)
-            low_val = -hi_val
-
-            U = U.clamp(low_val, hi_val)
-            Vh = Vh.clamp(low_val, hi_val)
-
-            if conv2d:
-                U = U.reshape(out_dim, rank, 1, 1)
-                Vh = Vh.reshape(rank, in_dim, kernel_size[0], kernel_size[1])
+            U, Vh = lora_extract_utils.svd_extract(mat, rank, clamp_quantile, svd_method)
 
             U = U.to(work_device, dtype=save_dtype).contiguous()
             Vh = Vh.to(work_device, dtype=save_dtype).contiguous()
@@ -318,6 +292,14 @@ def setup_parser() -> argparse.ArgumentParser:
         help="dimension (rank) of LoRA for Conv2d-3x3 (default None, disabled) / LoRAのConv2d-3x3の次元数（rank）（デフォルトNone、適用なし）",
     )
     parser.add_argument("--device", type=str, default=None, help="device to use, cuda for GPU / 計算を行うデバイス、cuda でGPUを使う")
+    parser.add_argument(
+        "--svd_method",
+        type=str,
+        default="randomized",
+        choices=["randomized", "full"],
+        help="randomized: randomized SVD truncated to the rank (fast), full: full SVD"
+        " / randomized: rankで打ち切ったランダム化SVD（高速）、full: 完全なSVD",
+    )
     parser.add_argument(
         "--clamp_quantile",
         type=float,
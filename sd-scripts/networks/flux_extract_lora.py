@@ -10,9 +10,9 @@ import torch
 from safetensors.torch import load_file, save_file
 from safetensors import safe_open
 from tqdm import tqdm
-from library import flux_utils, sai_model_spec, model_util, sdxl_model_util
+from library import flux_utils, lora_extract_utils, sai_model_spec, model_util, sdxl_model_util
 import lora
-from library.utils import MemoryEfficientSafeOpen
+from library.utils import MemoryEfficientSafeOpen, mem_eff_save_file
 from library.utils import setup_logging
 from networks import lora_flux
 
@@ -25,15 +25,6 @@ logger = logging.getLogger(__name__)
 # MIN_DIFF = 1e-1
 
 
-def save_to_file(file_name, state_dict, metadata, dtype):
-    if dtype is not None:
-        for key in list(state_dict.keys()):
-            if type(state_dict[key]) == torch.Tensor:
-                state_dict[key] = state_dict[key].to(dtype)
-
-    save_file(state_dict, file_name, metadata=metadata)
-
-
 def svd(
     model_org=None,
     model_tuned=None,
@@ -45,6 +36,8 @@ def svd(
     min_diff=0.01,
     no_metadata=False,
     mem_eff_safe_open=False,
+    svd_method="randomized",
+    num_workers=0,
 ):
     def str_to_dtype(p):
         if p == "float":
@@ -55,12 +48,9 @@ def svd(
             return torch.bfloat16
         return None
 
-    calc_dtype = torch.float
     save_dtype = str_to_dtype(save_precision)
-    store_device = "cpu"
 
     # open models
-    lora_weights = {}
     if not mem_eff_safe_open:
         # use original safetensors.safe_open
         open_fn = lambda fn: safe_open(fn, framework="pt")
@@ -80,52 +70,27 @@ def svd(
                 continue
             keys.append(key)
 
-        with open_fn(model_tuned) as f_tuned:
-            for key in tqdm(keys):
-                # get tensors and calculate difference
-                value_o = f_org.get_tensor(key)
-                value_t = f_tuned.get_tensor(key)
-                mat = value_t.to(calc_dtype) - value_o.to(calc_dtype)
-                del value_o, value_t
-
-                # extract LoRA weights
-                if device:
-                    mat = mat.to(device)
-                out_dim, in_dim = mat.size()[0:2]
-                rank = min(dim, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
-
-                mat = mat.squeeze()
-
-                U, S, Vh = torch.linalg.svd(mat)
-
-                U = U[:, :rank]
-                S = S[:rank]
-                U = U @ torch.diag(S)
-
-                Vh = Vh[:rank, :]
-
-                dist = torch.cat([U.flatten(), Vh.flatten()])
-                hi_val = torch.quantile(dist, clamp_quantile)
-                low_val = -hi_val
-
-                U = U.clamp(low_val, hi_val)
-                Vh = Vh.clamp(low_val, hi_val)
-
-                U = U.to(store_device, dtype=save_dtype).contiguous()
-                Vh = Vh.to(store_device, dtype=save_dtype).contiguous()
-
-                # print(f"key: {key}, U: {U.size()}, Vh: {Vh.size()}")
-                lora_weights[key] = (U, Vh)
-                del mat, U, S, Vh
+    # the weights are read, extracted and written one by one: the models are not loaded into memory
+    lora_weights = lora_extract_utils.extract_lora_weights_streaming(
+        model_org,
+        model_tuned,
+        [(key, dim) for key in keys],
+        clamp_quantile,
+        svd_method,
+        device,
+        save_dtype,
+        num_workers,
+        mem_eff_safe_open,
+    )
 
-    # make state dict for LoRA
-    lora_sd = {}
-    for key, (up_weight, down_weight) in lora_weights.items():
-        lora_name = key.replace(".weight", "").replace(".", "_")
-        lora_name = lora_flux.LoRANetwork.LORA_PREFIX_FLUX + "_" + lora_name
-        lora_sd[lora_name + ".lora_up.weight"] = up_weight
-        lora_sd[lora_name + ".lora_down.weight"] = down_weight
-        lora_sd[lora_name + ".alpha"] = torch.tensor(down_weight.size()[0])  # same as rank
+    def lora_sd():
+        # make state dict for LoRA
+        for key, up_weight, down_weight in tqdm(lora_weights, total=len(keys)):
+            lora_name = key.replace(".weight", "").replace(".", "_")
+            lora_name = lora_flux.LoRANetwork.LORA_PREFIX_FLUX + "_" + lora_name
+            yield lora_name + ".lora_up.weight", up_weight
+            yield lora_name + ".lora_down.weight", down_weight
+            yield lora_name + ".alpha", torch.tensor(down_weight.size()[0])  # same as rank
 
     # minimum metadata
     net_kwargs = {}
@@ -140,10 +105,10 @@ def svd(
 
     if not no_metadata:
         title = os.path.splitext(os.path.basename(save_to))[0]
-        sai_metadata = sai_model_spec.build_metadata(lora_sd, False, False, False, True, False, time.time(), title, flux="dev")
+        sai_metadata = sai_model_spec.build_metadata(None, False, False, False, True, False, time.time(), title, flux="dev")
         metadata.update(sai_metadata)
 
-    save_to_file(save_to, lora_sd, metadata, save_dtype)
+    mem_eff_save_file(lora_sd(), save_to, metadata, dtype=save_dtype)
 
     logger.info(f"LoRA weights saved to {save_to}")
 
@@ -190,6 +155,21 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--device", type=str, default=None, help="device to use, cuda for GPU / 計算を行うデバイス、cuda でGPUを使う"
     )
+    parser.add_argument(
+        "--svd_method",
+        type=str,
+        default="randomized",
+        choices=["randomized", "full"],
+        help="randomized: randomized SVD truncated to the rank (fast), full: full SVD"
+        " / randomized: rankで打ち切ったランダム化SVD（高速）、full: 完全なSVD",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=0,
+        help="number of processes to read the weights and compute the SVD in parallel, 0 for this process"
+        " / 重みの読み込みとSVDを並列に行うプロセス数、0でこのプロセスのみ",
+    )
     parser.add_argument(
         "--clamp_quantile",
         type=float,
@@ -36,6 +36,12 @@ def load_state_dict(file_name, dtype):
 
 
 def save_to_file(file_name, state_dict: Dict[str, Union[Any, torch.Tensor]], dtype, metadata, mem_eff_save=False):
+    if mem_eff_save:
+        # converted chunk by chunk while writing, without a converted copy of the state dict
+        logger.info(f"saving to: {file_name}")
+        mem_eff_save_file(state_dict, file_name, metadata=metadata, dtype=dtype)
+        return
+
     if dtype is not None:
         logger.info(f"converting to {dtype}...")
         for key in tqdm(list(state_dict.keys())):
@@ -43,10 +49,7 @@ def save_to_file(file_name, state_dict: Dict[str, Union[Any, torch.Tensor]], dty
                 state_dict[key] = state_dict[key].to(dtype)
 
     logger.info(f"saving to: {file_name}")
-    if mem_eff_save:
-        mem_eff_save_file(state_dict, file_name, metadata=metadata)
-    else:
-        save_file(state_dict, file_name, metadata=metadata)
+    save_file(state_dict, file_name, metadata=metadata)
 
 
 def merge_to_flux_model(
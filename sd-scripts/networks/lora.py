@@ -3,8 +3,10 @@
 # https://github.com/microsoft/LoRA/blob/main/loralib/layers.py
 # https://github.com/cloneofsimo/lora/blob/master/lora_diffusion/lora.py
 
+import hashlib
 import math
 import os
+from collections import OrderedDict
 from typing import Dict, List, Optional, Tuple, Type, Union
 from diffusers import AutoencoderKL
 from transformers import CLIPTextModel
@@ -202,18 +204,18 @@ class LoRAInfModule(LoRAModule):
         # pre-calculated weight
         if len(down_weight.size()) == 2:
             # linear
-            weight = self.multiplier * (up_weight @ down_weight) * self.scale
+            weight = multiplier * (up_weight @ down_weight) * self.scale
         elif down_weight.size()[2:4] == (1, 1):
             # conv2d 1x1
             weight = (
-                self.multiplier
+                multiplier
                 * (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
                 * self.scale
             )
         else:
             # conv2d 3x3
             conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
-            weight = self.multiplier * conved * self.scale
+            weight = multiplier * conved * self.scale
 
         return weight
 
@@ -386,6 +388,31 @@ class LoRAInfModule(LoRAModule):
         return out
 
 
+class LoRADeltaCache:
+    """
+    LRU cache of the weight deltas for LoRANetwork.fuse_weights: {(hash of LoRA weights, multiplier): {lora_name: delta}}.
+    the deltas are kept on device (CPU by default, to save VRAM) and moved to the device of the original weights when fused.
+    if device is None, the deltas are kept on the device of the original weights.
+    """
+
+    def __init__(self, max_entries: int = 4, device: Optional[Union[str, torch.device]] = "cpu"):
+        self.max_entries = max_entries
+        self.device = device
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, key: Tuple[str, float]) -> Optional[Dict[str, torch.Tensor]]:
+        deltas = self.entries.get(key, None)
+        if deltas is not None:
+            self.entries.move_to_end(key)
+        return deltas
+
+    def put(self, key: Tuple[str, float], deltas: Dict[str, torch.Tensor]):
+        self.entries[key] = deltas
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
 def parse_block_lr_kwargs(is_sdxl: bool, nw_kwargs: Dict) -> Optional[List[float]]:
     down_lr_weight = nw_kwargs.get("down_lr_weight", None)
     mid_lr_weight = nw_kwargs.get("mid_lr_weight", None)
@@ -1265,17 +1292,12 @@ class LoRANetwork(torch.nn.Module):
                 state_dict[key] = v
 
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
             from library import train_util
 
-            # Precalculate model hashes to save time on indexing
+            # Precalculate model hashes to save time on indexing: computed while writing the file
             if metadata is None:
                 metadata = {}
-            model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-            metadata["sshs_model_hash"] = model_hash
-            metadata["sshs_legacy_hash"] = legacy_hash
-
-            save_file(state_dict, file, metadata)
+            train_util.save_safetensors_with_hashes(state_dict, file, metadata)
         else:
             torch.save(state_dict, file)
 
@@ -1366,6 +1388,67 @@ class LoRANetwork(torch.nn.Module):
             org_module._lora_restored = False
             lora.enabled = False
 
+    def get_content_hash(self) -> str:
+        # LoRAの重みのハッシュ、初回のみ計算する
+        if getattr(self, "_content_hash", None) is None:
+            sha256 = hashlib.sha256()
+            for key, value in sorted(self.state_dict().items()):
+                sha256.update(key.encode("utf-8"))
+                sha256.update(value.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+            self._content_hash = sha256.hexdigest()
+        return self._content_hash
+
+    def fuse_weights(self, multiplier: Optional[float] = None, cache: Optional[LoRADeltaCache] = None):
+        """
+        add the weight deltas of LoRA to the original weights in place and disable LoRA modules, so forward has no overhead.
+        unfuse_weights subtracts the deltas. the deltas are cached by the hash of LoRA weights and the multiplier in cache,
+        so switching between networks and multipliers costs one pass over the weights.
+        the weights may differ slightly from the original after unfusing in half precision, use backup_weights and
+        restore_weights if exactly same weights are needed.
+        """
+        if multiplier is None:
+            multiplier = self.multiplier
+        fused = getattr(self, "_fused", None)
+        if fused is not None:
+            if fused[0] == multiplier:
+                return
+            self.unfuse_weights()
+
+        loras: List[LoRAInfModule] = self.text_encoder_loras + self.unet_loras
+        key = (self.get_content_hash(), float(multiplier))
+        deltas = cache.get(key) if cache is not None else None
+        if deltas is None:
+            deltas = {}
+            with torch.no_grad():
+                for lora in loras:
+                    org_weight = lora.org_module_ref[0].weight
+                    device = cache.device if cache is not None and cache.device is not None else org_weight.device
+                    deltas[lora.lora_name] = lora.get_weight(multiplier).to(device, dtype=org_weight.dtype)
+            if cache is not None:
+                cache.put(key, deltas)
+
+        with torch.no_grad():
+            for lora in loras:
+                org_weight = lora.org_module_ref[0].weight
+                org_weight.add_(deltas[lora.lora_name].to(org_weight.device))
+                lora.enabled = False
+        self._fused = (multiplier, deltas)
+
+    def unfuse_weights(self):
+        # fuse_weightsで加算した差分を減算して、LoRAモジュールを有効に戻す
+        fused = getattr(self, "_fused", None)
+        if fused is None:
+            return
+
+        loras: List[LoRAInfModule] = self.text_encoder_loras + self.unet_loras
+        deltas = fused[1]
+        with torch.no_grad():
+            for lora in loras:
+                org_weight = lora.org_module_ref[0].weight
+                org_weight.sub_(deltas[lora.lora_name].to(org_weight.device))
+                lora.enabled = True
+        self._fused = None
+
     def apply_max_norm_regularization(self, max_norm_value, device):
         downkeys = []
         upkeys = []
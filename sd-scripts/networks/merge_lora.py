@@ -4,7 +4,7 @@ import os
 import time
 import torch
 from safetensors.torch import load_file, save_file
-from library import sai_model_spec, train_util
+from library import lora_merge_utils, sai_model_spec, train_util
 import library.model_util as model_util
 import lora
 from library.utils import setup_logging
@@ -242,11 +242,13 @@ def merge(args):
         save_dtype = merge_dtype
 
     if args.sd_model is not None:
-        logger.info(f"loading SD model: {args.sd_model}")
+        streaming = model_util.is_safetensors(args.sd_model) and model_util.is_safetensors(args.save_to)
+        if not streaming:
+            logger.info(f"loading SD model: {args.sd_model}")
 
-        text_encoder, vae, unet = model_util.load_models_from_stable_diffusion_checkpoint(args.v2, args.sd_model)
+            text_encoder, vae, unet = model_util.load_models_from_stable_diffusion_checkpoint(args.v2, args.sd_model)
 
-        merge_to_sd_model(text_encoder, unet, args.models, args.ratios, merge_dtype)
+            merge_to_sd_model(text_encoder, unet, args.models, args.ratios, merge_dtype)
 
         if args.no_metadata:
             sai_metadata = None
@@ -271,10 +273,25 @@ def merge(args):
                     "Cannot determine if model is for v-prediction, so save metadata as v-prediction / modelがv-prediction用か否か不明なため、仮にv-prediction用としてmetadataを保存します"
                 )
 
-        logger.info(f"saving SD model to: {args.save_to}")
-        model_util.save_stable_diffusion_checkpoint(
-            args.v2, args.save_to, text_encoder, unet, args.sd_model, 0, 0, sai_metadata, save_dtype, vae
-        )
+        if streaming:
+            # merge tensor by tensor without loading the models
+            lora_merge_utils.merge_loras_to_checkpoint(
+                args.sd_model,
+                args.save_to,
+                args.models,
+                args.ratios,
+                False,
+                args.v2,
+                merge_dtype,
+                save_dtype,
+                sai_metadata,
+                args.device,
+            )
+        else:
+            logger.info(f"saving SD model to: {args.save_to}")
+            model_util.save_stable_diffusion_checkpoint(
+                args.v2, args.save_to, text_encoder, unet, args.sd_model, 0, 0, sai_metadata, save_dtype, vae
+            )
     else:
         state_dict, metadata, v2 = merge_lora_models(args.models, args.ratios, merge_dtype, args.concat, args.shuffle)
 
@@ -327,6 +344,12 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--save_to", type=str, default=None, help="destination file name: ckpt or safetensors file / 保存先のファイル名、ckptまたはsafetensors"
     )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=None,
+        help="device to merge LoRAs into a safetensors model, e.g. cuda. CPU if omitted / safetensorsのモデルにマージする際の計算デバイス、例: cuda。省略時はCPU",
+    )
     parser.add_argument(
         "--models", type=str, nargs="*", help="LoRA models to merge: ckpt or safetensors file / マージするLoRAモデル、ckptまたはsafetensors"
     )
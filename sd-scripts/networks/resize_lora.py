@@ -11,6 +11,7 @@ import numpy as np
 
 from library import train_util
 from library import model_util
+from library import lora_svd_utils
 from library.utils import setup_logging
 
 setup_logging()
@@ -115,6 +116,29 @@ def extract_linear(weight, lora_rank, dynamic_method, dynamic_param, device, sca
     return param_dict
 
 
+def extract_from_svd(U, S, Vh, weight_shape, lora_rank, dynamic_method, dynamic_param, scale=1):
+    # same as extract_conv/extract_linear, with the SVD of lora_svd_utils.low_rank_svd
+    out_size = weight_shape[0]
+    in_size_flat = weight_shape[1:].numel()
+
+    # the same number of singular values as the full SVD for the dynamic methods
+    U, S, Vh = lora_svd_utils.pad_svd(U, S, Vh, min(out_size, in_size_flat))
+
+    param_dict = rank_resize(S, lora_rank, dynamic_method, dynamic_param, scale)
+    lora_rank = param_dict["new_rank"]
+
+    U = U[:, :lora_rank] * S[:lora_rank]
+    Vh = Vh[:lora_rank, :]
+
+    if len(weight_shape) == 4:
+        param_dict["lora_down"] = Vh.reshape(lora_rank, *weight_shape[1:])
+        param_dict["lora_up"] = U.reshape(out_size, lora_rank, 1, 1)
+    else:
+        param_dict["lora_down"] = Vh.reshape(lora_rank, weight_shape[1])
+        param_dict["lora_up"] = U.reshape(out_size, lora_rank)
+    return param_dict
+
+
 def merge_conv(lora_down, lora_up, device):
     in_rank, in_size, kernel_size, k_ = lora_down.shape
     out_size, out_rank, _, _ = lora_up.shape
@@ -191,7 +215,18 @@ def rank_resize(S, rank, dynamic_method, dynamic_param, scale=1):
     return param_dict
 
 
-def resize_lora_model(lora_sd, new_rank, new_conv_rank, save_dtype, device, dynamic_method, dynamic_param, verbose):
+def resize_lora_model(
+    lora_sd,
+    new_rank,
+    new_conv_rank,
+    save_dtype,
+    device,
+    dynamic_method,
+    dynamic_param,
+    verbose,
+    svd_method="lowrank",
+    num_workers=0,
+):
     network_alpha = None
     network_dim = None
     verbose_str = "\n"
@@ -222,6 +257,23 @@ def resize_lora_model(lora_sd, new_rank, new_conv_rank, save_dtype, device, dyna
     block_down_name = None
     block_up_name = None
 
+    svds = {}
+    if svd_method == "lowrank":
+        # SVD of up @ down from the factors, the modules of the same shape at once
+        factors = {}
+        for key, value in lora_sd.items():
+            if "lora_down" in key:
+                up_key = key.replace("lora_down", "lora_up")
+                if up_key in lora_sd:
+                    factors[key] = (lora_sd[up_key].reshape(lora_sd[up_key].size(0), -1), value.reshape(value.size(0), -1))
+        logger.info(f"computing SVD of {len(factors)} modules...")
+        with torch.no_grad():
+            for key, U, S, Vh in tqdm(
+                lora_svd_utils.batched_low_rank_svd(factors, device, num_workers), total=len(factors)
+            ):
+                svds[key] = (U, S, Vh)
+        del factors
+
     with torch.no_grad():
         for key, value in tqdm(lora_sd.items()):
             weight_name = None
@@ -247,7 +299,13 @@ def resize_lora_model(lora_sd, new_rank, new_conv_rank, save_dtype, device, dyna
                 else:
                     scale = lora_alpha / lora_down_weight.size()[0]
 
-                if conv2d:
+                if svd_method == "lowrank":
+                    U, S, Vh = svds.pop(key)
+                    weight_shape = (lora_up_weight.size(0), *lora_down_weight.size()[1:])
+                    param_dict = extract_from_svd(
+                        U, S, Vh, torch.Size(weight_shape), new_conv_rank if conv2d else new_rank, dynamic_method, dynamic_param, scale
+                    )
+                elif conv2d:
                     full_weight_matrix = merge_conv(lora_down_weight, lora_up_weight, device)
                     param_dict = extract_conv(full_weight_matrix, new_conv_rank, dynamic_method, dynamic_param, device, scale)
                 else:
@@ -323,7 +381,16 @@ def resize(args):
 
     logger.info("Resizing Lora...")
     state_dict, old_dim, new_alpha = resize_lora_model(
-        lora_sd, args.new_rank, args.new_conv_rank, save_dtype, args.device, args.dynamic_method, args.dynamic_param, args.verbose
+        lora_sd,
+        args.new_rank,
+        args.new_conv_rank,
+        save_dtype,
+        args.device,
+        args.dynamic_method,
+        args.dynamic_param,
+        args.verbose,
+        args.svd_method,
+        args.num_workers,
     )
 
     # update metadata
@@ -401,6 +468,21 @@ def setup_parser() -> argparse.ArgumentParser:
         help="Specify dynamic resizing method, --new_rank is used as a hard limit for max rank",
     )
     parser.add_argument("--dynamic_param", type=float, default=None, help="Specify target for dynamic reduction")
+    parser.add_argument(
+        "--svd_method",
+        type=str,
+        default="lowrank",
+        choices=["lowrank", "full"],
+        help="lowrank: exact SVD from the QR of lora_up and lora_down, batched by the shape (fast), full: SVD of the full weight"
+        " / lowrank: lora_upとlora_downのQR分解から厳密なSVDを形状ごとにまとめて計算する（高速）、full: 重み全体のSVD",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=0,
+        help="number of processes to compute the SVD with --svd_method lowrank on CPU, 0 for this process"
+        " / --svd_method lowrankでCPUでSVDを計算するプロセス数、0でこのプロセスのみ",
+    )
 
     return parser
 
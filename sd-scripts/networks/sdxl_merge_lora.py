@@ -7,7 +7,7 @@ import concurrent.futures
 import torch
 from safetensors.torch import load_file, save_file
 from tqdm import tqdm
-from library import sai_model_spec, sdxl_model_util, train_util
+from library import lora_merge_utils, sai_model_spec, sdxl_model_util, train_util
 import library.model_util as model_util
 import lora
 import oft
@@ -234,6 +234,24 @@ def merge_to_sd_model(text_encoder1, text_encoder2, unet, models, ratios, lbws,
                 list(tqdm(executor.map(merge_to, lora_sd.keys()), total=len(lora_sd.keys())))
 
 
+def get_lbw_multiplier_fns(lbws):
+    lbws, _, LBW_TARGET_IDX = format_lbws(lbws)
+
+    multiplier_fns = []
+    for lbw in lbws:
+        lbw_weights = [1] * 26
+        for index, value in zip(LBW_TARGET_IDX, lbw):
+            lbw_weights[index] = value
+        logger.info(f"lbw: {dict(zip(LAYER26.keys(), lbw_weights))}")
+
+        def multiplier_fn(lora_name, lbw_weights=lbw_weights):
+            index = get_lbw_block_index(lora_name, True)
+            return lbw_weights[index] if index in LBW_TARGET_IDX else 1  # keyがlbwの対象であれば、lbwの重みを掛ける
+
+        multiplier_fns.append(multiplier_fn)
+    return multiplier_fns
+
+
 def merge_lora_models(models, ratios, lbws, merge_dtype, concat=False, shuffle=False):
     base_alphas = {}  # alpha for merged model
     base_dims = {}
@@ -396,18 +414,25 @@ def merge(args):
         save_dtype = merge_dtype
 
     if args.sd_model is not None:
-        logger.info(f"loading SD model: {args.sd_model}")
+        # OFT is merged to the models
+        streaming = (
+            model_util.is_safetensors(args.sd_model)
+            and model_util.is_safetensors(args.save_to)
+            and detect_method_from_training_model(args.models, merge_dtype) == "LoRA"
+        )
+        if not streaming:
+            logger.info(f"loading SD model: {args.sd_model}")
 
-        (
-            text_model1,
-            text_model2,
-            vae,
-            unet,
-            logit_scale,
-            ckpt_info,
-        ) = sdxl_model_util.load_models_from_sdxl_checkpoint(sdxl_model_util.MODEL_VERSION_SDXL_BASE_V1_0, args.sd_model, "cpu")
+            (
+                text_model1,
+                text_model2,
+                vae,
+                unet,
+                logit_scale,
+                ckpt_info,
+            ) = sdxl_model_util.load_models_from_sdxl_checkpoint(sdxl_model_util.MODEL_VERSION_SDXL_BASE_V1_0, args.sd_model, "cpu")
 
-        merge_to_sd_model(text_model1, text_model2, unet, args.models, args.ratios, args.lbws, merge_dtype)
+            merge_to_sd_model(text_model1, text_model2, unet, args.models, args.ratios, args.lbws, merge_dtype)
 
         if args.no_metadata:
             sai_metadata = None
@@ -418,10 +443,25 @@ def merge(args):
                 None, False, False, True, False, False, time.time(), title=title, merged_from=merged_from
             )
 
-        logger.info(f"saving SD model to: {args.save_to}")
-        sdxl_model_util.save_stable_diffusion_checkpoint(
-            args.save_to, text_model1, text_model2, unet, 0, 0, ckpt_info, vae, logit_scale, sai_metadata, save_dtype
-        )
+        if streaming:
+            # merge tensor by tensor without loading the models
+            lora_merge_utils.merge_loras_to_checkpoint(
+                args.sd_model,
+                args.save_to,
+                args.models,
+                args.ratios,
+                True,
+                merge_dtype=merge_dtype,
+                save_dtype=save_dtype,
+                metadata=sai_metadata,
+                device=args.device,
+                multiplier_fns=get_lbw_multiplier_fns(args.lbws) if args.lbws else None,
+            )
+        else:
+            logger.info(f"saving SD model to: {args.save_to}")
+            sdxl_model_util.save_stable_diffusion_checkpoint(
+                args.save_to, text_model1, text_model2, unet, 0, 0, ckpt_info, vae, logit_scale, sai_metadata, save_dtype
+            )
     else:
         state_dict, metadata = merge_lora_models(args.models, args.ratios, args.lbws, merge_dtype, args.concat, args.shuffle)
 
@@ -477,6 +517,12 @@ def setup_parser() -> argparse.ArgumentParser:
         default=None,
         help="destination file name: ckpt or safetensors file / 保存先のファイル名、ckptまたはsafetensors",
     )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=None,
+        help="device to merge LoRAs into a safetensors model, e.g. cuda. CPU if omitted / safetensorsのモデルにマージする際の計算デバイス、例: cuda。省略時はCPU",
+    )
     parser.add_argument(
         "--models",
         type=str,
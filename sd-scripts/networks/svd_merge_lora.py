@@ -7,7 +7,7 @@ import time
 import torch
 from safetensors.torch import load_file, save_file
 from tqdm import tqdm
-from library import sai_model_spec, train_util
+from library import lora_svd_utils, sai_model_spec, train_util
 import library.model_util as model_util
 import lora
 from library.utils import setup_logging
@@ -250,9 +250,10 @@ def format_lbws(lbws):
     return lbws, is_sdxl, LBW_TARGET_IDX
 
 
-def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, merge_dtype):
+def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, merge_dtype, svd_method="lowrank", num_workers=0):
     logger.info(f"new rank: {new_rank}, new conv rank: {new_conv_rank}")
     merged_sd = {}
+    merged_factors = {}  # lora_module_name: (shape of weight, [ratio * scale * up], [down]) for lowrank
     v2 = None  # This is meaning LoRA Metadata v2, Not meaning SD2
     base_model = None
 
@@ -298,6 +299,22 @@ def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, mer
             kernel_size = None if not conv2d else down_weight.size()[2:4]
             # logger.info(lora_module_name, network_dim, alpha, in_dim, out_dim, kernel_size)
 
+            if svd_method == "lowrank":
+                # keep the factors: the merged weight is concat(ratio * scale * ups) @ concat(downs)
+                scale = alpha / network_dim
+                if lbw:
+                    index = get_lbw_block_index(key, is_sdxl)
+                    if index in LBW_TARGET_IDX:
+                        scale *= lbw_weights[index]  # keyがlbwの対象であれば、lbwの重みを掛ける
+
+                weight_shape = (out_dim, *down_weight.size()[1:])
+                if lora_module_name not in merged_factors:
+                    merged_factors[lora_module_name] = (weight_shape, [], [])
+                assert merged_factors[lora_module_name][0] == weight_shape, f"weight shape mismatch: {lora_module_name}"
+                merged_factors[lora_module_name][1].append(up_weight.reshape(out_dim, -1) * (ratio * scale))
+                merged_factors[lora_module_name][2].append(down_weight.reshape(network_dim, -1))
+                continue
+
             # make original weight if not exist
             if lora_module_name not in merged_sd:
                 weight = torch.zeros((out_dim, in_dim, *kernel_size) if conv2d else (out_dim, in_dim), dtype=merge_dtype)
@@ -341,26 +358,43 @@ def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, mer
     # extract from merged weights
     logger.info("extract new lora...")
     merged_lora_sd = {}
-    with torch.no_grad():
-        for lora_module_name, mat in tqdm(list(merged_sd.items())):
-            if device:
-                mat = mat.to(device)
+    svds = {}
+    shapes = {lora_module_name: mat.size() for lora_module_name, mat in merged_sd.items()}
+    if svd_method == "lowrank":
+        # SVD from the factors, the modules of the same shape at once
+        factors = {name: (torch.cat(ups, dim=1), torch.cat(downs, dim=0)) for name, (_, ups, downs) in merged_factors.items()}
+        shapes = {name: torch.Size(shape) for name, (shape, _, _) in merged_factors.items()}
+        del merged_factors
+        with torch.no_grad():
+            for name, U, S, Vh in tqdm(lora_svd_utils.batched_low_rank_svd(factors, device, num_workers), total=len(factors)):
+                svds[name] = (U, S, Vh)
+        del factors
 
-            conv2d = len(mat.size()) == 4
-            kernel_size = None if not conv2d else mat.size()[2:4]
+    with torch.no_grad():
+        for lora_module_name, shape in tqdm(list(shapes.items())):
+            conv2d = len(shape) == 4
+            kernel_size = None if not conv2d else shape[2:4]
             conv2d_3x3 = conv2d and kernel_size != (1, 1)
-            out_dim, in_dim = mat.size()[0:2]
-
-            if conv2d:
-                if conv2d_3x3:
-                    mat = mat.flatten(start_dim=1)
-                else:
-                    mat = mat.squeeze()
+            out_dim, in_dim = shape[0:2]
 
             module_new_rank = new_conv_rank if conv2d_3x3 else new_rank
             module_new_rank = min(module_new_rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
 
-            U, S, Vh = torch.linalg.svd(mat)
+            if svd_method == "lowrank":
+                U, S, Vh = lora_svd_utils.pad_svd(*svds.pop(lora_module_name), module_new_rank)
+                U, S, Vh = U.to(device or "cpu"), S.to(device or "cpu", U.dtype), Vh.to(device or "cpu")
+            else:
+                mat = merged_sd.pop(lora_module_name)
+                if device:
+                    mat = mat.to(device)
+
+                if conv2d:
+                    if conv2d_3x3:
+                        mat = mat.flatten(start_dim=1)
+                    else:
+                        mat = mat.squeeze()
+
+                U, S, Vh = torch.linalg.svd(mat)
 
             U = U[:, :module_new_rank]
             S = S[:module_new_rank]
@@ -425,7 +459,15 @@ def merge(args):
 
     new_conv_rank = args.new_conv_rank if args.new_conv_rank is not None else args.new_rank
     state_dict, metadata, v2, base_model = merge_lora_models(
-        args.models, args.ratios, args.lbws, args.new_rank, new_conv_rank, args.device, merge_dtype
+        args.models,
+        args.ratios,
+        args.lbws,
+        args.new_rank,
+        new_conv_rank,
+        args.device,
+        merge_dtype,
+        args.svd_method,
+        args.num_workers,
     )
 
     # cast to save_dtype before calculating hashes
@@ -498,6 +540,22 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--device", type=str, default=None, help="device to use, cuda for GPU / 計算を行うデバイス、cuda でGPUを使う"
     )
+    parser.add_argument(
+        "--svd_method",
+        type=str,
+        default="lowrank",
+        choices=["lowrank", "full"],
+        help="lowrank: exact SVD from the QR of the concatenated lora_up and lora_down, batched by the shape (fast),"
+        " full: SVD of the merged full weight"
+        " / lowrank: 結合したlora_upとlora_downのQR分解から厳密なSVDを形状ごとにまとめて計算する（高速）、full: マージした重み全体のSVD",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=0,
+        help="number of processes to compute the SVD with --svd_method lowrank on CPU, 0 for this process"
+        " / --svd_method lowrankでCPUでSVDを計算するプロセス数、0でこのプロセスのみ",
+    )
     parser.add_argument(
         "--no_metadata",
         action="store_true",
@@ -107,7 +107,14 @@ class Sd3NetworkTrainer(train_network.NetworkTrainer):
         if self.is_swapping_blocks:
             # Swap blocks between CPU and GPU to reduce memory usage, in forward and backward passes.
             logger.info(f"enable block swap: blocks_to_swap={args.blocks_to_swap}")
-            mmdit.enable_block_swap(args.blocks_to_swap, accelerator.device)
+            mmdit.enable_block_swap(
+                args.blocks_to_swap,
+                accelerator.device,
+                args.blocks_to_swap_disk_dir,
+                args.blocks_to_swap_disk_prefetch_depth,
+                args.blocks_to_swap_max_prefetch,
+                args.blocks_to_swap_timeline,
+            )
 
         clip_l = sd3_utils.load_clip_l(
             args.clip_l, weight_dtype, "cpu", disable_mmap=args.disable_mmap_load_safetensors, state_dict=state_dict
@@ -133,6 +133,7 @@ def train(args):
         latents_caching_strategy = strategy_sd.SdSdxlLatentsCachingStrategy(
             False, args.cache_latents_to_disk, args.vae_batch_size, args.skip_cache_check
         )
+        train_util.set_latents_cache_store_if_specified(args, latents_caching_strategy)
         strategy_base.LatentsCachingStrategy.set_strategy(latents_caching_strategy)
 
     # データセットを準備する
@@ -324,6 +325,7 @@ def train(args):
             text_encoder_output_caching_strategy = strategy_sdxl.SdxlTextEncoderOutputsCachingStrategy(
                 args.cache_text_encoder_outputs_to_disk, None, False, is_weighted=args.weighted_captions
             )
+            train_util.set_text_encoder_outputs_cache_options_if_specified(args, text_encoder_output_caching_strategy)
             strategy_base.TextEncoderOutputsCachingStrategy.set_strategy(text_encoder_output_caching_strategy)
 
             text_encoder1.to(accelerator.device)
@@ -432,6 +434,7 @@ def train(args):
         collate_fn=collator,
         num_workers=n_workers,
         persistent_workers=args.persistent_data_loader_workers,
+        **train_util.get_data_loader_kwargs(args, n_workers),
     )
 
     # 学習ステップ数を計算する
@@ -623,6 +626,7 @@ def train(args):
         accelerator.log({}, step=0)
 
     loss_recorder = train_util.LossRecorder()
+    data_wait_timer = train_util.DataLoaderWaitTimer()
     for epoch in range(num_train_epochs):
         accelerator.print(f"\nepoch {epoch+1}/{num_train_epochs}")
         current_epoch.value = epoch + 1
@@ -630,7 +634,7 @@ def train(args):
         for m in training_models:
             m.train()
 
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(data_wait_timer(train_dataloader)):
             current_step.value = global_step
 
             if args.fused_optimizer_groups:
@@ -805,6 +809,8 @@ def train(args):
                 else:
                     append_block_lr_to_logs(block_lrs, logs, lr_scheduler, args.optimizer_type)  # U-Net is included in block_lrs
 
+                logs.update(data_wait_timer.get_logs())
+
                 accelerator.log(logs, step=global_step)
 
             loss_recorder.add(epoch=epoch, step=step, loss=current_loss)
@@ -815,6 +821,8 @@ def train(args):
             if global_step >= args.max_train_steps:
                 break
 
+        data_wait_timer.log_summary()
+
         if len(accelerator.trackers) > 0:
             logs = {"loss/epoch": loss_recorder.moving_average}
             accelerator.log(logs, step=epoch + 1)
@@ -0,0 +1,50 @@
+import os
+import threading
+
+import pytest
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file
+
+from library import async_checkpoint, train_util
+
+
+def test_deferred_save_is_same_as_sync_save(tmp_path):
+    state_dict = {"a": torch.randn(64, 32), "b": torch.randn(8, dtype=torch.float16)}
+    sync_path = str(tmp_path / "sync.safetensors")
+    async_path = str(tmp_path / "async.safetensors")
+
+    sync_metadata = {"ss_network_dim": "4"}
+    train_util.save_safetensors_with_hashes(state_dict, sync_path, sync_metadata)
+
+    writer = async_checkpoint.AsyncCheckpointWriter(max_pending=2)
+    release = threading.Event()
+    writer.submit(release.wait)  # block the writer until the weights are modified
+    with async_checkpoint.deferred_writes(writer):
+        train_util.save_safetensors_with_hashes(state_dict, async_path, {"ss_network_dim": "4"})
+        async_checkpoint.save_file(state_dict, str(tmp_path / "plain.safetensors"))
+    state_dict["a"].zero_()  # the snapshot is not changed
+    release.set()
+    writer.remove(sync_path)
+    writer.close()
+
+    assert not os.path.exists(sync_path)  # removed after the previous job
+    with safe_open(async_path, framework="pt") as f:
+        assert f.metadata() == sync_metadata
+        assert not torch.equal(f.get_tensor("a"), state_dict["a"])
+    assert torch.equal(load_file(str(tmp_path / "plain.safetensors"))["b"], state_dict["b"])
+
+
+def test_failed_write_skips_following_jobs(tmp_path):
+    writer = async_checkpoint.AsyncCheckpointWriter()
+    keep_path = str(tmp_path / "old.safetensors")
+    open(keep_path, "wb").close()
+
+    release = threading.Event()
+    writer.submit(release.wait)
+    writer.save_file({"a": torch.zeros(4)}, str(tmp_path / "missing_dir" / "new.safetensors"))
+    writer.remove(keep_path)
+    release.set()
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    assert os.path.exists(keep_path)
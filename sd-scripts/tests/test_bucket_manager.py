@@ -0,0 +1,78 @@
+import numpy as np
+
+from library.train_util import BucketManager, ImageInfo, MergeSmallBucketsScheduler, PixelBalancedScheduler
+
+
+def assert_same_as_select_bucket(no_upscale, widths, heights):
+    bm_single = BucketManager(no_upscale, (1024, 1024), 256, 2048, 64)
+    bm_bulk = BucketManager(no_upscale, (1024, 1024), 256, 2048, 64)
+    if not no_upscale:
+        bm_single.make_buckets()
+        bm_bulk.make_buckets()
+
+    bucket_ids, resized_sizes, ar_errors = bm_bulk.select_buckets(widths, heights)
+    for i, (w, h) in enumerate(zip(widths, heights)):
+        reso, resized_size, ar_error = bm_single.select_bucket(int(w), int(h))
+        assert bm_bulk.resos[bucket_ids[i]] == reso, (w, h)
+        assert tuple(resized_sizes[i]) == resized_size, (w, h)
+        assert ar_errors[i] == ar_error, (w, h)
+    assert bm_bulk.resos == bm_single.resos  # same order of new buckets
+
+
+def test_select_buckets():
+    rng = np.random.default_rng(42)
+    widths = rng.integers(64, 4096, size=2000)
+    heights = rng.integers(64, 4096, size=2000)
+    widths[:3], heights[:3] = [1024, 832, 1216], [1024, 1216, 832]  # exact match with predefined resolutions
+
+    assert_same_as_select_bucket(False, widths, heights)
+    assert_same_as_select_bucket(True, widths, heights)
+
+
+def make_bucket_manager_with_images(sizes):
+    bm = BucketManager(False, (1024, 1024), 256, 2048, 64)
+    bm.make_buckets()
+    image_data = {}
+    for i, (w, h) in enumerate(sizes):
+        info = ImageInfo(str(i), 1, "", False, f"{i}.png")
+        info.image_size = (w, h)
+        info.bucket_reso, info.resized_size, _ = bm.select_bucket(w, h)
+        bm.add_image(info.bucket_reso, info.image_key)
+        image_data[info.image_key] = info
+    bm.sort()
+    return bm, image_data
+
+
+def test_merge_small_buckets():
+    # 6 square images and one slightly wide image, which makes a partial batch without merging
+    bm, image_data = make_bucket_manager_with_images([(1024, 1024)] * 6 + [(1088, 960)])
+    scheduler = MergeSmallBucketsScheduler(batch_size=4)
+    scheduler.merge_buckets(bm, image_data)
+    assert [len(bucket) for bucket in bm.buckets if len(bucket) > 0] == [7]
+    assert image_data["6"].bucket_reso == (1024, 1024)
+    assert image_data["6"].resized_size == (1161, 1024)  # covers the bucket, cropped later
+    assert len(scheduler.make_batches(bm)) == 2
+
+    # too different aspect ratio is not merged
+    bm, image_data = make_bucket_manager_with_images([(1024, 1024)] * 6 + [(2048, 512)])
+    MergeSmallBucketsScheduler(batch_size=4).merge_buckets(bm, image_data)
+    assert sorted(len(bucket) for bucket in bm.buckets if len(bucket) > 0) == [1, 6]
+
+
+def test_merge_small_buckets_in_one_sweep():
+    # small buckets with gradually changing aspect ratios are merged into the neighbor buckets in a chain
+    sizes = [(1088, 960)] * 2 + [(1152, 896)] * 2 + [(1216, 832)] + [(512, 2048)] * 4
+    bm, image_data = make_bucket_manager_with_images(sizes)
+    MergeSmallBucketsScheduler(batch_size=4).merge_buckets(bm, image_data)
+
+    buckets = {reso: len(bucket) for reso, bucket in zip(bm.resos, bm.buckets) if len(bucket) > 0}
+    assert buckets == {(1152, 896): 5, (512, 2048): 4}
+    for reso, bucket in zip(bm.resos, bm.buckets):
+        assert all(image_data[image_key].bucket_reso == reso for image_key in bucket)
+
+
+def test_pixel_balanced_batch_size():
+    scheduler = PixelBalancedScheduler(batch_size=2)
+    assert scheduler.get_bucket_batch_size((1024, 1024), 1024 * 1024) == 2
+    assert scheduler.get_bucket_batch_size((512, 512), 1024 * 1024) == 8
+    assert scheduler.get_bucket_batch_size((256, 256), 1024 * 1024) == 8  # capped
@@ -0,0 +1,92 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+from diffusers import AutoencoderKL
+from PIL import Image
+
+from library.caching_pipeline import CachingPipeline
+from library.strategy_sd import SdSdxlLatentsCachingStrategy
+from library.train_util import ImageInfo
+
+
+def test_caching_pipeline_order_and_stages():
+    main_thread = threading.get_ident()
+    written = []
+
+    def prepare(batch):
+        assert threading.get_ident() != main_thread
+        return [x * 2 for x in batch]
+
+    def process(batch, prepared):
+        assert threading.get_ident() == main_thread
+        return sum(prepared)
+
+    def write(batch, processed):
+        written.append((batch[0], processed))
+
+    batches = [[i, i + 1] for i in range(0, 40, 2)]
+    pipeline = CachingPipeline(prepare, process, write, num_prepare_workers=3, num_write_workers=2)
+    pipeline.run(batches, show_progress=False)
+
+    assert sorted(written) == [(b[0], (b[0] + b[1]) * 2) for b in batches]
+    assert pipeline.prepare_stats.num_items == pipeline.process_stats.num_items == pipeline.write_stats.num_items == 40
+
+
+def test_caching_pipeline_raises_exception_in_worker():
+    def write(batch, processed):
+        if batch[0] == 3:
+            raise ValueError("write failed")
+
+    pipeline = CachingPipeline(lambda b: b, lambda b, p: p, write, num_prepare_workers=2)
+    with pytest.raises(ValueError):
+        pipeline.run([[i] for i in range(8)], show_progress=False)
+
+
+def test_cache_latents_with_tiny_vae(tmp_path):
+    # tiny VAE with 8x downsampling, runs on CPU
+    vae = AutoencoderKL(
+        down_block_types=["DownEncoderBlock2D"] * 4,
+        up_block_types=["UpDecoderBlock2D"] * 4,
+        block_out_channels=[8, 8, 8, 8],
+        layers_per_block=1,
+        norm_num_groups=4,
+    ).eval()
+    strategy = SdSdxlLatentsCachingStrategy(True, True, 2, False)
+
+    infos = []
+    for i in range(5):
+        path = os.path.join(tmp_path, f"{i}.png")
+        Image.fromarray(np.full((80, 72, 3), i * 40, np.uint8)).save(path)
+        info = ImageInfo(str(i), 1, "", False, path)
+        info.image_size = (72, 80)
+        info.bucket_reso = (64, 64)
+        info.resized_size = (64, 71)
+        info.latents_npz = strategy.get_latents_npz_path(path, info.image_size)
+        infos.append(info)
+    batches = [infos[0:2], infos[2:4], infos[4:5]]
+
+    def prepare(batch):
+        return strategy.prepare_batch_for_caching(batch, False, False)
+
+    def process(batch, prepared):
+        img_tensor, alpha_masks, original_sizes, crop_ltrbs = prepared
+        latents, flipped_latents = strategy.encode_batch_latents(vae, img_tensor, True)
+        return latents, flipped_latents, alpha_masks, original_sizes, crop_ltrbs
+
+    def write(batch, processed):
+        strategy.save_batch_latents(batch, *processed)
+
+    CachingPipeline(prepare, process, write, num_prepare_workers=2).run(batches, show_progress=False)
+
+    for info in infos:
+        assert strategy.is_disk_cached_latents_expected(info.bucket_reso, info.latents_npz, True, False)
+        latents, original_size, crop_ltrb, flipped_latents, _ = strategy.load_latents_from_disk(info.latents_npz, info.bucket_reso)
+        assert latents.shape == (4, 8, 8) and flipped_latents.shape == (4, 8, 8)
+        assert tuple(original_size) == (72, 80)
+
+    # caching to memory without the pipeline
+    strategy_mem = SdSdxlLatentsCachingStrategy(True, False, 2, False)
+    strategy_mem.cache_batch_latents(vae, infos[:2], False, False, False)
+    assert infos[0].latents.shape == (4, 8, 8)
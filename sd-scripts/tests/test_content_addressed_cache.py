@@ -0,0 +1,111 @@
+import copy
+import os
+import shutil
+import time
+
+import torch
+
+from library.content_addressed_cache import (
+    ContentAddressedLatentsCache,
+    ContentAddressedTextEncoderOutputsCache,
+    get_model_identity,
+    set_model_source,
+)
+
+
+def test_latents_npz_path_is_keyed_by_content(tmp_path):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    image_path = str(image_dir / "a.png")
+    with open(image_path, "wb") as f:
+        f.write(b"image data")
+    moved_path = str(tmp_path / "moved.png")
+    shutil.copy(image_path, moved_path)
+
+    cache = ContentAddressedLatentsCache(str(tmp_path / "cache"))
+    cache.set_model(torch.nn.Linear(2, 2))
+    args = ((100, 80), (64, 64), (80, 64), False, False, "_sd.npz")
+    npz_path = cache.get_latents_npz_path(image_path, *args)
+    assert npz_path.startswith(str(tmp_path / "cache")) and npz_path.endswith("_sd.npz")
+    assert cache.get_latents_npz_path(moved_path, *args) == npz_path
+
+    flipped_args = ((100, 80), (64, 64), (80, 64), True, False, "_sd.npz")
+    assert cache.get_latents_npz_path(image_path, *flipped_args) != npz_path
+
+    cache.set_model(torch.nn.Linear(2, 2))  # different weights
+    assert cache.get_latents_npz_path(image_path, *args) != npz_path
+
+
+def test_model_identity_from_checkpoint_file(tmp_path, monkeypatch):
+    ckpt_path = tmp_path / "vae.safetensors"
+    ckpt_path.write_bytes(b"weights")
+    model = torch.nn.Linear(2, 2)
+    weights_identity = get_model_identity(model)
+
+    set_model_source(model, str(ckpt_path))
+    monkeypatch.setattr(torch.Tensor, "numpy", None)  # the weights are not read
+    identity = get_model_identity(model)
+    assert identity != weights_identity
+    assert get_model_identity(model) == identity
+    monkeypatch.undo()
+
+    os.utime(ckpt_path, ns=(time.time_ns(), time.time_ns() + 10**9))  # the file is updated
+    assert get_model_identity(model) != identity
+    identity = get_model_identity(model)
+    assert get_model_identity(copy.deepcopy(model).to(torch.float16)) != identity  # dtype changes the outputs
+
+    # the weights are hashed if the file is unknown or removed, e.g. networks are merged to the model
+    set_model_source(model, None)
+    assert get_model_identity(model) == weights_identity
+    set_model_source(model, str(tmp_path / "removed.safetensors"))
+    assert get_model_identity(model) == weights_identity
+
+
+def test_text_encoder_outputs_npz_path_is_keyed_by_caption(tmp_path):
+    cache = ContentAddressedTextEncoderOutputsCache(str(tmp_path))
+    text_encoders = [torch.nn.Linear(2, 2), torch.nn.Linear(2, 2)]
+    cache.set_models(text_encoders)
+    args = ("[(1, 77), (1, 512)]", "Flux,is_weighted=False", "_flux_te.npz")
+    npz_path = cache.get_outputs_npz_path("a photo of a cat", *args)
+    assert npz_path.startswith(str(tmp_path)) and npz_path.endswith("_flux_te.npz")
+    assert cache.get_outputs_npz_path("  a photo  of a cat ", *args) == npz_path
+    assert cache.get_outputs_npz_path("a photo of a dog", *args) != npz_path
+    assert cache.get_outputs_npz_path("a photo of a cat", "[(1, 77), (1, 256)]", *args[1:]) != npz_path
+
+    cache.set_models(text_encoders[::-1])
+    assert cache.get_outputs_npz_path("a photo of a cat", *args) != npz_path
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = ContentAddressedLatentsCache(str(tmp_path), max_size=250)
+    paths = []
+    for i in range(4):
+        path = os.path.join(tmp_path, "00", f"{i:032x}_sd.npz")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"\0" * 100)
+        os.utime(path, ns=(time.time_ns(), i * 10**9))
+        paths.append(path)
+
+    cache.evict(keep=[paths[0]])
+    assert [os.path.exists(path) for path in paths] == [True, False, False, True]
+
+
+def test_text_encoders_identity_from_checkpoint_files(tmp_path, monkeypatch):
+    text_encoders = [torch.nn.Linear(2, 2), torch.nn.Linear(2, 2)]
+    for i, text_encoder in enumerate(text_encoders):
+        ckpt_path = tmp_path / f"te{i}.safetensors"
+        ckpt_path.write_bytes(b"weights")
+        set_model_source(text_encoder, str(ckpt_path))
+
+    cache = ContentAddressedTextEncoderOutputsCache(str(tmp_path / "cache"))
+    monkeypatch.setattr(torch.Tensor, "numpy", None)  # the weights are not read
+    cache.set_models(text_encoders + [None])
+    args = ("[(1, 77), (1, 512)]", "Flux,is_weighted=False", "_flux_te.npz")
+    npz_path = cache.get_outputs_npz_path("a photo of a cat", *args)
+    monkeypatch.undo()
+
+    os.utime(tmp_path / "te1.safetensors", ns=(time.time_ns(), time.time_ns() + 10**9))
+    cache = ContentAddressedTextEncoderOutputsCache(str(tmp_path / "cache"))
+    cache.set_models(text_encoders + [None])
+    assert cache.get_outputs_npz_path("a photo of a cat", *args) != npz_path
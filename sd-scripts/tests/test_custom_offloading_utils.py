@@ -0,0 +1,115 @@
+import copy
+import json
+import logging
+import os
+import time
+
+import pytest
+import torch
+import torch.nn as nn
+
+from library.custom_offloading_utils import ModelOffloader
+
+
+def make_blocks(num_blocks):
+    torch.manual_seed(0)
+    return nn.ModuleList([nn.Sequential(nn.Linear(16, 16), nn.LayerNorm(16), nn.GELU()) for _ in range(num_blocks)])
+
+
+def forward(blocks, offloader, x):
+    for block_idx, block in enumerate(blocks):
+        if offloader is not None:
+            offloader.wait_for_block(block_idx)
+        x = block(x)
+        if offloader is not None:
+            offloader.submit_move_blocks(blocks, block_idx)
+    return x
+
+
+@pytest.mark.parametrize("disk,max_prefetch_depth", [(False, 1), (True, 1), (False, 3), (True, 3)])
+def test_block_swap_on_cpu_device(tmp_path, disk, max_prefetch_depth):
+    num_blocks, blocks_to_swap = 6, 2
+    reference = make_blocks(num_blocks)
+    blocks = copy.deepcopy(reference)
+    offloader = ModelOffloader(
+        blocks,
+        num_blocks,
+        blocks_to_swap,
+        torch.device("cpu"),
+        disk_offload_dir=str(tmp_path / "disk") if disk else None,
+        max_prefetch_depth=max_prefetch_depth,
+    )
+
+    for step in range(3):
+        x = torch.randn(4, 16, requires_grad=True)
+        x_ref = x.detach().clone().requires_grad_(True)
+
+        offloader.prepare_block_devices_before_forward(blocks)
+        forward(blocks, offloader, x).sum().backward()
+        forward(reference, None, x_ref).sum().backward()
+        assert torch.allclose(x.grad, x_ref.grad)
+
+        # training step on the weights, including the weights backed by the disk
+        with torch.no_grad():
+            for p, p_ref in zip(blocks.parameters(), reference.parameters()):
+                assert torch.allclose(p.grad, p_ref.grad)
+                p -= 0.1 * p.grad
+                p_ref -= 0.1 * p_ref.grad
+                p.grad = p_ref.grad = None
+
+    offloader.prepare_block_devices_before_forward(blocks)
+    for p, p_ref in zip(blocks.parameters(), reference.parameters()):
+        assert torch.allclose(p, p_ref)
+    assert offloader.num_forwards == 4 and offloader.num_waits > 0  # stats are accumulated until the interval
+    if disk:
+        assert offloader.disk_store is not None and len(list((tmp_path / "disk").iterdir())) == 0  # the file is removed after mapping
+
+
+def test_prefetch_depth_follows_transfer_time(tmp_path):
+    num_blocks, blocks_to_swap = 8, 4
+    blocks = make_blocks(num_blocks)
+    timeline_path = str(tmp_path / "timeline.json")
+    offloader = ModelOffloader(
+        blocks, num_blocks, blocks_to_swap, torch.device("cpu"), max_prefetch_depth=4, timeline_path=timeline_path
+    )
+
+    # transfers much slower than the compute of a block
+    swap_weight_devices = offloader.swap_weight_devices
+
+    def slow_swap_weight_devices(*args):
+        time.sleep(0.05)
+        swap_weight_devices(*args)
+
+    offloader.swap_weight_devices = slow_swap_weight_devices
+
+    for _ in range(2):
+        offloader.prepare_block_devices_before_forward(blocks)
+        forward(blocks, offloader, torch.randn(4, 16)).sum().backward()
+
+    scheduler = offloader.scheduler
+    assert scheduler.transfer_time > scheduler.compute_time
+    assert scheduler.depth == 4 and scheduler.max_in_flight > 1
+
+    offloader.prepare_block_devices_before_forward(blocks)
+    assert not os.path.exists(timeline_path)  # not written in the training loop
+
+    offloader.export_timeline()  # at exit
+    with open(timeline_path) as f:
+        events = json.load(f)["traceEvents"]
+    categories = {e.get("cat") for e in events}
+    assert {"compute", "transfer", "wait"} <= categories
+    assert len([e for e in events if e.get("cat") == "transfer"]) == 2 * 2 * blocks_to_swap
+
+
+def test_stats_are_logged_every_interval(caplog):
+    num_blocks, blocks_to_swap = 6, 2
+    blocks = make_blocks(num_blocks)
+    offloader = ModelOffloader(blocks, num_blocks, blocks_to_swap, torch.device("cpu"), stats_interval=3)
+
+    with caplog.at_level(logging.INFO, logger="library.custom_offloading_utils"):
+        for _ in range(7):
+            offloader.prepare_block_devices_before_forward(blocks)
+            forward(blocks, offloader, torch.randn(4, 16)).sum().backward()
+    stats = [r.getMessage() for r in caplog.records if r.getMessage().startswith("Block swap stats")]
+    assert len(stats) == 2 and all(message.startswith("Block swap stats: 3 forwards") for message in stats)
+    assert offloader.num_forwards == 1  # reset after logging
@@ -0,0 +1,119 @@
+import os
+import time
+
+from library.dataset_manifest import DatasetManifest
+
+
+def make_dataset(tmp_path):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    image_paths = []
+    for i in range(2):
+        image_path = image_dir / f"{i}.png"
+        image_path.write_bytes(b"image" * (i + 1))
+        (image_dir / f"{i}.txt").write_text(f"caption {i}", encoding="utf-8")
+        image_paths.append(str(image_path))
+    npz_path = image_dir / "0_0064x0064_sd.npz"
+    npz_path.write_bytes(b"latents")
+    return str(image_dir), image_paths, str(npz_path)
+
+
+def scan(manifest, image_dir, image_paths, npz_path):
+    # same calls as the dataset at startup
+    if manifest.get_image_paths(image_dir) is None:
+        manifest.set_image_paths(image_dir, image_paths)
+    for i, image_path in enumerate(image_paths):
+        if manifest.get_image_size(image_path) is None:
+            manifest.set_image_info(image_path, (64 * (i + 1), 64), (64, 64))
+        found, _ = manifest.get_caption(image_path, ".txt", False)
+        if not found:
+            caption_path = os.path.splitext(image_path)[0] + ".txt"
+            with open(caption_path, "r", encoding="utf-8") as f:
+                manifest.set_caption(image_path, ".txt", False, caption_path, f.read())
+    if not manifest.is_latents_cache_valid(npz_path, "sd"):
+        manifest.set_latents_cache_valid(npz_path, "sd")
+    manifest.save()
+
+
+def touch(path):
+    os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns + 10**9))
+
+
+def test_round_trip(tmp_path):
+    image_dir, image_paths, npz_path = make_dataset(tmp_path)
+    manifest_path = str(tmp_path / "manifest.json")
+    scan(DatasetManifest(manifest_path), image_dir, image_paths, npz_path)
+
+    manifest = DatasetManifest(manifest_path)
+    assert manifest.get_image_paths(image_dir) == image_paths
+    assert manifest.get_image_size(image_paths[1]) == (128, 64)
+    assert manifest.get_caption(image_paths[0], ".txt", False) == (True, "caption 0")
+    assert manifest.get_caption(image_paths[0], ".caption", False) == (False, None)
+    assert manifest.is_latents_cache_valid(npz_path, "sd")
+    assert not manifest.is_latents_cache_valid(npz_path, "sd_flip")
+
+
+def test_changed_files_are_invalidated(tmp_path):
+    image_dir, image_paths, npz_path = make_dataset(tmp_path)
+    manifest_path = str(tmp_path / "manifest.json")
+    scan(DatasetManifest(manifest_path), image_dir, image_paths, npz_path)
+
+    touch(image_paths[0])  # mtime
+    with open(image_paths[1], "ab") as f:
+        f.write(b"more")  # size
+    touch(os.path.splitext(image_paths[0])[0] + ".txt")
+    touch(npz_path)
+
+    manifest = DatasetManifest(manifest_path)
+    assert manifest.get_image_size(image_paths[0]) is None
+    assert manifest.get_image_size(image_paths[1]) is None
+    assert manifest.get_caption(image_paths[0], ".txt", False) == (False, None)
+    assert manifest.get_caption(image_paths[1], ".txt", False) == (True, "caption 1")
+    assert not manifest.is_latents_cache_valid(npz_path, "sd")
+
+    (tmp_path / "images" / "2.png").write_bytes(b"new image")  # changes the mtime of the directory
+    touch(image_dir)
+    assert manifest.get_image_paths(image_dir) is None
+
+
+def test_unchanged_dataset_does_not_rewrite_manifest(tmp_path, monkeypatch):
+    image_dir, image_paths, npz_path = make_dataset(tmp_path)
+    manifest_path = str(tmp_path / "manifest.json")
+    scan(DatasetManifest(manifest_path), image_dir, image_paths, npz_path)
+
+    def replace(*args):
+        raise AssertionError("the manifest is rewritten")
+
+    monkeypatch.setattr(os, "replace", replace)
+    for _ in range(2):  # e.g. two ranks
+        scan(DatasetManifest(manifest_path), image_dir, image_paths, npz_path)
+
+    # setting the same entries again doesn't rewrite the manifest
+    manifest = DatasetManifest(manifest_path)
+    caption_path = os.path.splitext(image_paths[0])[0] + ".txt"
+    manifest.set_caption(image_paths[0], ".txt", False, caption_path, "caption 0")
+    manifest.set_latents_cache_valid(npz_path, "sd")
+    manifest.set_image_paths(image_dir, image_paths)
+    manifest.save()
+
+
+def test_entries_of_other_processes_are_kept(tmp_path):
+    image_dir, image_paths, npz_path = make_dataset(tmp_path)
+    manifest_path = str(tmp_path / "manifest.json")
+    scan(DatasetManifest(manifest_path), image_dir, image_paths, npz_path)
+
+    # two processes load the manifest, and update different entries
+    manifest_1 = DatasetManifest(manifest_path)
+    manifest_2 = DatasetManifest(manifest_path)
+    touch(image_paths[0])
+    manifest_1.set_image_info(image_paths[0], (32, 32), (32, 32))
+    manifest_1.set_latents_cache_valid(npz_path, "sd_flip")
+    manifest_1.save()
+    manifest_2.set_image_info(image_paths[1], (16, 16), (16, 16))
+    manifest_2.set_latents_cache_valid(npz_path, "sd_alpha")
+    manifest_2.save()
+
+    manifest = DatasetManifest(manifest_path)
+    assert manifest.get_image_size(image_paths[0]) == (32, 32)
+    assert manifest.get_image_size(image_paths[1]) == (16, 16)
+    assert all(manifest.is_latents_cache_valid(npz_path, key) for key in ["sd", "sd_flip", "sd_alpha"])
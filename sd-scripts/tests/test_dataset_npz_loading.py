@@ -0,0 +1,77 @@
+import random
+from types import SimpleNamespace
+
+import torch
+
+from library import train_util
+from library.strategy_base import LatentsCachingStrategy
+from library.train_util import BaseDataset, ImageInfo
+
+
+def make_dataset(tmp_path, num_images):
+    strategy = LatentsCachingStrategy(True, 1, False)
+    subset = SimpleNamespace(custom_attributes={}, flip_aug=True, alpha_mask=False)
+    image_data = {}
+    for i in range(num_images):
+        image_info = ImageInfo(f"image_{i}", 1, f"caption {i}", False, str(tmp_path / f"image_{i}.png"))
+        image_info.bucket_reso = (64, 32)
+        image_info.latents_npz = str(tmp_path / f"image_{i}.npz")
+        image_info.text_encoder_outputs = [torch.randn(77, 8)]
+        alpha_mask = torch.rand(32, 64) if i % 2 == 0 else None  # mixed None and tensors in a batch
+        strategy.save_latents_to_disk(
+            image_info.latents_npz, torch.randn(4, 4, 8), (64, 32), (0, 0, 64, 32), torch.randn(4, 4, 8), alpha_mask
+        )
+        image_data[image_info.image_key] = image_info
+
+    return SimpleNamespace(
+        bucket_manager=SimpleNamespace(buckets=[list(image_data.keys())]),
+        buckets_indices=[train_util.BucketBatchIndex(0, num_images, 0)],
+        caching_mode=None,
+        image_data=image_data,
+        image_to_subset={key: subset for key in image_data},
+        prior_loss_weight=1.0,
+        latents_caching_strategy=strategy,
+        text_encoder_output_caching_strategy=SimpleNamespace(is_partial=False, decode_outputs=lambda outputs: outputs),
+        network_multiplier=1.0,
+        debug_dataset=False,
+        batch_size=num_images,
+    )
+
+
+def load_batch(dataset, num_batches):
+    random.seed(42)  # flip_aug
+    examples = [BaseDataset.__getitem__(dataset, i) for i in range(num_batches)]
+    for example in examples:
+        if example["alpha_masks"] is None:  # no alpha mask in the batch
+            example["alpha_masks"] = torch.ones((len(example["flippeds"]),) + example["latents"].shape[2:]).repeat(1, 8, 8)
+    tensors = {key: torch.cat([example[key] for example in examples]) for key in ["latents", "alpha_masks", "crop_top_lefts"]}
+    return tensors, [flipped for example in examples for flipped in example["flippeds"]]
+
+
+def test_parallel_npz_loading_matches_serial(tmp_path, monkeypatch):
+    num_images = 4
+    parallel = make_dataset(tmp_path, num_images)
+
+    submitted = []
+    get_io_executor = train_util.get_io_executor
+
+    def get_io_executor_spy():
+        submitted.append(True)
+        return get_io_executor()
+
+    monkeypatch.setattr(train_util, "get_io_executor", get_io_executor_spy)
+    tensors, flippeds = load_batch(parallel, 1)
+    assert submitted  # loaded in parallel
+
+    # batch size 1 loads each npz in the same thread
+    serial = SimpleNamespace(**vars(parallel))
+    serial.buckets_indices = [train_util.BucketBatchIndex(0, 1, batch_index) for batch_index in range(num_images)]
+    serial.batch_size = 1
+    submitted.clear()
+    expected_tensors, expected_flippeds = load_batch(serial, num_images)
+    assert not submitted
+
+    assert flippeds == expected_flippeds and any(flippeds) and not all(flippeds)
+    for key, expected in expected_tensors.items():
+        assert tensors[key].dtype == expected.dtype
+        assert torch.equal(tensors[key], expected), key
@@ -0,0 +1,26 @@
+from gen_img import BatchData, BatchDataBase, BatchDataExt, BatchPacker
+
+
+def make_batch_data(step, width, network_muls=None):
+    base = BatchDataBase(step, f"prompt {step}", "", step, None, None, None, None, f"prompt {step}", None)
+    ext = BatchDataExt(width, 512, None, None, None, None, 0, 0, 30, 7.5, None, 0.8, network_muls, None)
+    return BatchData(False, base, ext)
+
+
+def test_prompts_with_same_params_are_packed():
+    packer = BatchPacker(batch_size=3)
+    params = [(512, None), (768, None), (512, None), (512, (0.5,)), (768, None), (512, None), (768, None), (512, (0.5,))]
+
+    batches = []
+    for step, (width, network_muls) in enumerate(params):
+        batch = packer.add(make_batch_data(step, width, network_muls))
+        if batch is not None:
+            batches.append(batch)
+    assert len(packer) == 2
+    batches.extend(packer.flush())
+    assert len(packer) == 0
+
+    # without packing, the prompts are split into 7 batches because the params change at almost every prompt
+    assert [[bd.base.step for bd in batch] for batch in batches] == [[0, 2, 5], [1, 4, 6], [3, 7]]
+    for batch in batches:
+        assert all(bd.ext == batch[0].ext for bd in batch)
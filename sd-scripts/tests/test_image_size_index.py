@@ -0,0 +1,59 @@
+import os
+import time
+
+from library.image_size_index import ImageSizeIndex, probe_image_sizes
+
+
+class SizeProber:
+    def __init__(self):
+        self.probed = []
+
+    def __call__(self, image_path):
+        self.probed.append(os.path.basename(image_path))
+        return (64, 32) if image_path.endswith("a.png") else (16, 48)
+
+
+def make_images(tmp_path):
+    image_paths = []
+    for name in ["a.png", "b.png"]:
+        image_path = tmp_path / name
+        image_path.write_bytes(b"image")
+        image_paths.append(str(image_path))
+    return image_paths
+
+
+def test_sizes_are_taken_from_index(tmp_path):
+    image_paths = make_images(tmp_path)
+    index_path = str(tmp_path / "index" / "sizes.json")
+
+    prober = SizeProber()
+    assert probe_image_sizes(image_paths, prober, ImageSizeIndex(index_path), max_workers=2) == [(64, 32), (16, 48)]
+    assert sorted(prober.probed) == ["a.png", "b.png"]
+
+    # next run: hit
+    prober = SizeProber()
+    size_index = ImageSizeIndex(index_path)
+    assert len(size_index) == 2
+    assert probe_image_sizes(image_paths, prober, size_index, max_workers=2) == [(64, 32), (16, 48)]
+    assert prober.probed == []
+
+    # miss: the image is changed
+    os.utime(image_paths[1], ns=(time.time_ns(), os.stat(image_paths[1]).st_mtime_ns + 10**9))
+    prober = SizeProber()
+    assert probe_image_sizes(image_paths, prober, ImageSizeIndex(index_path), max_workers=2) == [(64, 32), (16, 48)]
+    assert prober.probed == ["b.png"]
+
+
+def test_corrupt_index_is_ignored_and_rewritten(tmp_path):
+    image_paths = make_images(tmp_path)
+    index_path = tmp_path / "sizes.json"
+
+    for content in ['{"a.png": [1, 2', '["a.png"]', '{"a.png": 5}', '{"a.png": [1, 2, 3]}']:
+        index_path.write_text(content, encoding="utf-8")
+        size_index = ImageSizeIndex(str(index_path))
+        assert len(size_index) == 0
+
+        prober = SizeProber()
+        assert probe_image_sizes(image_paths, prober, size_index, max_workers=1) == [(64, 32), (16, 48)]
+        assert len(prober.probed) == 2
+        assert len(ImageSizeIndex(str(index_path))) == 2  # recovered
@@ -0,0 +1,70 @@
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from library import lora_extract_utils
+
+
+def relative_error(actual, expected):
+    # the quantile clamping cuts a few values
+    return (torch.linalg.norm(actual - expected) / torch.linalg.norm(expected)).item()
+
+
+@pytest.mark.parametrize("svd_method", ["randomized", "full"])
+def test_svd_extract_low_rank_difference(svd_method):
+    torch.manual_seed(0)
+    diff = torch.randn(96, 4) @ torch.randn(4, 64) * 1e-3
+    up, down = lora_extract_utils.svd_extract(diff, 4, clamp_quantile=1.0, svd_method=svd_method)
+    assert up.shape == (96, 4) and down.shape == (4, 64)
+    assert relative_error(up @ down, diff) < 0.05
+
+    diff = (torch.randn(32, 4) @ torch.randn(4, 16 * 9) * 1e-3).reshape(32, 16, 3, 3)
+    up, down = lora_extract_utils.svd_extract(diff, 8, clamp_quantile=1.0, svd_method=svd_method)
+    assert up.shape == (32, 8, 1, 1) and down.shape == (8, 16, 3, 3)
+    assert relative_error((up.flatten(1) @ down.flatten(1)).reshape(diff.shape), diff) < 0.05
+
+
+def extract_by_full_svd(mat, rank, clamp_quantile):
+    # same as the previous svd of extract_lora_from_models.py
+    U, S, Vh = torch.linalg.svd(mat)
+    U = U[:, :rank] @ torch.diag(S[:rank])
+    Vh = Vh[:rank, :]
+    hi_val = torch.quantile(torch.cat([U.flatten(), Vh.flatten()]), clamp_quantile)
+    return U.clamp(-hi_val, hi_val), Vh.clamp(-hi_val, hi_val)
+
+
+def test_full_svd_is_same_as_before():
+    torch.manual_seed(0)
+    mat = torch.randn(64, 48)
+    up, down = lora_extract_utils.svd_extract(mat, 8, svd_method="full")
+    expected_up, expected_down = extract_by_full_svd(mat, 8, 0.99)
+    assert torch.allclose(up, expected_up, atol=1e-5) and torch.allclose(down, expected_down, atol=1e-5)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_streaming_extraction(tmp_path, num_workers):
+    torch.manual_seed(0)
+    org, diffs = {}, {}
+    for i in range(5):
+        org[f"blocks.{i}.weight"] = torch.randn(64, 48)
+        diffs[f"blocks.{i}.weight"] = torch.randn(64, 2) @ torch.randn(2, 48) * 1e-3
+    tuned = {k: v + diffs[k] for k, v in org.items()}
+    save_file(org, str(tmp_path / "org.safetensors"))
+    save_file(tuned, str(tmp_path / "tuned.safetensors"))
+
+    targets = [(key, 4) for key in reversed(list(org.keys()))]
+    results = list(
+        lora_extract_utils.extract_lora_weights_streaming(
+            str(tmp_path / "org.safetensors"),
+            str(tmp_path / "tuned.safetensors"),
+            targets,
+            clamp_quantile=1.0,
+            save_dtype=torch.float16,
+            num_workers=num_workers,
+        )
+    )
+
+    assert [key for key, _, _ in results] == [key for key, _ in targets]
+    for key, up, down in results:
+        assert up.dtype == torch.float16 and up.shape == (64, 4) and down.shape == (4, 48)
+        assert relative_error(up.float() @ down.float(), diffs[key]) < 0.05, key
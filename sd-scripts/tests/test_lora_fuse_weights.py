@@ -0,0 +1,101 @@
+import pytest
+import torch
+
+from networks import lora
+
+
+class Transformer2DModel(torch.nn.Module):
+    # same class name as the target of LoRANetwork
+    def __init__(self):
+        super().__init__()
+        self.proj_in = torch.nn.Linear(16, 32)
+        self.conv = torch.nn.Conv2d(32, 32, 1)
+        self.proj_out = torch.nn.Linear(32, 16)
+
+    def forward(self, x):
+        x = self.proj_in(x)
+        x = self.conv(x.transpose(1, 2).unsqueeze(-1)).squeeze(-1).transpose(1, 2)
+        return self.proj_out(x)
+
+
+class UNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.block = Transformer2DModel()
+
+    def forward(self, x):
+        return self.block(x)
+
+
+def make_weights_sd(seed):
+    torch.manual_seed(seed)
+    weights_sd = {}
+    for name, (out_dim, in_dim, conv) in {"proj_in": (32, 16, False), "conv": (32, 32, True), "proj_out": (16, 32, False)}.items():
+        lora_name = f"lora_unet_block_{name}"
+        shape = (1, 1) if conv else ()
+        weights_sd[f"{lora_name}.lora_down.weight"] = torch.randn(4, in_dim, *shape) * 0.1
+        weights_sd[f"{lora_name}.lora_up.weight"] = torch.randn(out_dim, 4, *shape) * 0.1
+        weights_sd[f"{lora_name}.alpha"] = torch.tensor(2.0)
+    return weights_sd
+
+
+def create_network(unet, seed):
+    network, weights_sd = lora.create_network_from_weights(
+        1.0, None, None, [], unet, weights_sd=make_weights_sd(seed), for_inference=True
+    )
+    network.apply_to([], unet, apply_text_encoder=False)
+    network.load_state_dict(weights_sd, False)
+    return network
+
+
+def test_fuse_weights_is_same_as_forward_and_reversible():
+    torch.manual_seed(0)
+    unet = UNet()
+    org_state_dict = {k: v.clone() for k, v in unet.state_dict().items()}
+    networks = [create_network(unet, 1), create_network(unet, 2)]
+    x = torch.randn(2, 8, 16)
+
+    cache = lora.LoRADeltaCache(max_entries=2)
+    for multipliers in [(1.0, 0.5), (-0.7, 0.5), (1.0, 0.5), (0.3, 0.0)]:
+        for network, multiplier in zip(networks, multipliers):
+            network.set_multiplier(multiplier)
+        with torch.no_grad():
+            expected = unet(x)
+
+            for network in networks:
+                network.fuse_weights(cache=cache)
+            assert not any(lora_module.enabled for network in networks for lora_module in network.unet_loras)
+            actual = unet(x)
+        assert torch.allclose(actual, expected, atol=1e-5), multipliers
+
+        for network in networks:
+            network.unfuse_weights()
+
+    # LRU: the last two (network, multiplier) are cached
+    assert list(cache.entries.keys()) == [(networks[0].get_content_hash(), 0.3), (networks[1].get_content_hash(), 0.0)]
+    assert all(delta.device.type == "cpu" for deltas in cache.entries.values() for delta in deltas.values())
+
+    for key, value in unet.state_dict().items():
+        assert torch.allclose(value, org_state_dict[key], atol=1e-6), key
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+def test_deltas_are_cached_on_cpu():
+    torch.manual_seed(0)
+    unet = UNet().to("cuda")
+    network = create_network(unet, 1).to("cuda")
+    x = torch.randn(2, 8, 16, device="cuda")
+    with torch.no_grad():
+        expected = unet(x)
+
+    cache = lora.LoRADeltaCache(max_entries=2)  # CPU by default
+    network.fuse_weights(cache=cache)
+    with torch.no_grad():
+        assert torch.allclose(unet(x), expected, atol=1e-5)
+    assert all(delta.device.type == "cpu" for deltas in cache.entries.values() for delta in deltas.values())
+    assert unet.block.proj_in.weight.device.type == "cuda"
+    network.unfuse_weights()
+
+    cache = lora.LoRADeltaCache(max_entries=2, device=None)  # on the device of the weights
+    network.fuse_weights(cache=cache)
+    assert all(delta.device.type == "cuda" for deltas in cache.entries.values() for delta in deltas.values())
@@ -0,0 +1,109 @@
+import torch
+from accelerate import init_empty_weights
+from safetensors.torch import load_file, save_file
+
+from library import lora_merge_utils, model_util
+from library.original_unet import UNet2DConditionModel
+
+
+def make_lora(modules, rank, seed):
+    torch.manual_seed(seed)
+    lora_sd = {}
+    for lora_name, (out_dim, in_dim, kernel_size) in modules.items():
+        if kernel_size is None:
+            lora_sd[lora_name + ".lora_down.weight"] = torch.randn(rank, in_dim, dtype=torch.float16)
+            lora_sd[lora_name + ".lora_up.weight"] = torch.randn(out_dim, rank, dtype=torch.float16)
+        else:
+            lora_sd[lora_name + ".lora_down.weight"] = torch.randn(rank, in_dim, kernel_size, kernel_size, dtype=torch.float16)
+            lora_sd[lora_name + ".lora_up.weight"] = torch.randn(out_dim, rank, 1, 1, dtype=torch.float16)
+        lora_sd[lora_name + ".alpha"] = torch.tensor(rank / 2)
+    return lora_sd
+
+
+def merge_by_loop(weight, up, down, scale):
+    # same as merge_to_sd_model of sdxl_merge_lora.py
+    if len(weight.size()) == 2:
+        return weight + (up @ down) * scale
+    conved = torch.nn.functional.conv2d(down.permute(1, 0, 2, 3), up).permute(1, 0, 2, 3)
+    return weight + conved * scale
+
+
+def test_streaming_merge_is_same_as_merge_by_loop(tmp_path):
+    torch.manual_seed(0)
+    dim = 32
+    checkpoint = {
+        "model.diffusion_model.input_blocks.4.1.proj_in.weight": torch.randn(dim, dim),
+        "model.diffusion_model.input_blocks.1.0.in_layers.2.weight": torch.randn(dim, dim, 3, 3),
+        "model.diffusion_model.input_blocks.1.0.in_layers.2.bias": torch.randn(dim),
+        "conditioner.embedders.0.transformer.text_model.encoder.layers.0.self_attn.q_proj.weight": torch.randn(dim, dim),
+        "conditioner.embedders.1.model.transformer.resblocks.0.attn.in_proj_weight": torch.randn(dim * 3, dim),
+        "conditioner.embedders.1.model.transformer.resblocks.0.attn.in_proj_bias": torch.randn(dim * 3),
+        "conditioner.embedders.1.model.logit_scale": torch.tensor(4.0),
+        "first_stage_model.decoder.conv_in.weight": torch.randn(dim, 4, 3, 3),
+    }
+    sd_path = str(tmp_path / "sdxl.safetensors")
+    save_file(checkpoint, sd_path)
+
+    modules = {
+        "lora_unet_input_blocks_4_1_proj_in": (dim, dim, None),
+        "lora_unet_input_blocks_1_0_in_layers_2": (dim, dim, 3),
+        "lora_te1_text_model_encoder_layers_0_self_attn_q_proj": (dim, dim, None),
+        "lora_te2_text_model_encoder_layers_0_self_attn_q_proj": (dim, dim, None),
+        "lora_te2_text_model_encoder_layers_0_self_attn_v_proj": (dim, dim, None),
+    }
+    models, ratios = [], [0.7, -0.4, 1.2]
+    for i, rank in enumerate([4, 8, 2]):
+        lora_sd = make_lora(modules, rank, seed=i + 1)
+        lora_sd.update(make_lora({"lora_unet_no_such_module": (dim, dim, None)}, rank, seed=0))
+        models.append(str(tmp_path / f"lora{i}.safetensors"))
+        save_file(lora_sd, models[-1])
+
+    save_to = str(tmp_path / "merged.safetensors")
+    lora_merge_utils.merge_loras_to_checkpoint(sd_path, save_to, models, ratios, True, metadata={"title": "merged"})
+    merged = load_file(save_to)
+
+    te2_key = "conditioner.embedders.1.model.transformer.resblocks.0.attn.in_proj_weight"
+    targets = {  # lora_name: (key, rows)
+        "lora_unet_input_blocks_4_1_proj_in": ("model.diffusion_model.input_blocks.4.1.proj_in.weight", slice(None)),
+        "lora_unet_input_blocks_1_0_in_layers_2": ("model.diffusion_model.input_blocks.1.0.in_layers.2.weight", slice(None)),
+        "lora_te1_text_model_encoder_layers_0_self_attn_q_proj": (
+            "conditioner.embedders.0.transformer.text_model.encoder.layers.0.self_attn.q_proj.weight",
+            slice(None),
+        ),
+        "lora_te2_text_model_encoder_layers_0_self_attn_q_proj": (te2_key, slice(0, dim)),
+        "lora_te2_text_model_encoder_layers_0_self_attn_v_proj": (te2_key, slice(dim * 2, dim * 3)),
+    }
+    expected = {k: v.clone() for k, v in checkpoint.items()}
+    for model, ratio in zip(models, ratios):
+        lora_sd = {k: v.float() for k, v in load_file(model).items()}
+        for lora_name, (key, rows) in targets.items():
+            up, down = lora_sd[lora_name + ".lora_up.weight"], lora_sd[lora_name + ".lora_down.weight"]
+            scale = ratio * lora_sd[lora_name + ".alpha"].item() / down.size(0)
+            expected[key][rows] = merge_by_loop(expected[key][rows], up, down, scale)
+
+    assert merged.keys() == expected.keys()
+    for key, value in expected.items():
+        assert merged[key].dtype == value.dtype
+        assert torch.allclose(merged[key], value, atol=1e-3), key
+    # the k chunk and the other weights are not changed
+    assert torch.equal(merged[te2_key][dim : dim * 2], checkpoint[te2_key][dim : dim * 2])
+    assert torch.equal(merged["first_stage_model.decoder.conv_in.weight"], checkpoint["first_stage_model.decoder.conv_in.weight"])
+
+
+def test_module_map_covers_sd_unet_modules():
+    unet_config = model_util.create_unet_diffusers_config(False)
+    with init_empty_weights():
+        unet = UNet2DConditionModel(**unet_config)
+    diffusers_keys = list(unet.state_dict().keys())
+    sd_keys = model_util.convert_unet_state_dict_to_sd(False, {k: torch.zeros(1) for k in diffusers_keys}).keys()
+    module_map = lora_merge_utils.make_lora_module_map(["model.diffusion_model." + k for k in sd_keys], False)
+
+    num_modules = 0
+    for name, module in unet.named_modules():
+        if module.__class__.__name__ in ["Linear", "Conv2d"]:
+            lora_name = "lora_unet_" + name.replace(".", "_")
+            assert lora_name in module_map, lora_name
+            key, chunk = module_map[lora_name]
+            assert key.startswith("model.diffusion_model.") and chunk is None
+            num_modules += 1
+    assert num_modules > 200
@@ -0,0 +1,60 @@
+import pytest
+import torch
+
+from library import lora_svd_utils
+from networks import resize_lora
+
+
+def test_low_rank_svd_is_same_as_full_svd():
+    torch.manual_seed(0)
+    up, down = torch.randn(3, 64, 8, dtype=torch.float64), torch.randn(3, 8, 96, dtype=torch.float64)
+    U, S, Vh = lora_svd_utils.low_rank_svd(up, down)
+
+    assert U.shape == (3, 64, 8) and S.shape == (3, 8) and Vh.shape == (3, 8, 96)
+    assert torch.allclose((U * S.unsqueeze(1)) @ Vh, up @ down)
+    assert torch.allclose(S, torch.linalg.svdvals(up @ down)[:, :8])
+
+
+@pytest.mark.parametrize("num_workers", [0, 1])
+def test_batched_low_rank_svd(num_workers):
+    torch.manual_seed(0)
+    factors = {f"linear{i}": (torch.randn(32, 4), torch.randn(4, 48)) for i in range(5)}
+    factors.update({f"conv{i}": (torch.randn(16, 8), torch.randn(8, 16 * 9)) for i in range(3)})
+
+    results = list(lora_svd_utils.batched_low_rank_svd(factors, num_workers=num_workers, max_batch_elements=1000))
+    assert sorted(name for name, _, _, _ in results) == sorted(factors.keys())
+    for name, U, S, Vh in results:
+        up, down = factors[name]
+        assert torch.allclose((U * S) @ Vh, up @ down, atol=1e-4), name
+
+
+def make_lora(rank):
+    torch.manual_seed(0)
+    lora_sd = {}
+    for i in range(4):
+        lora_sd[f"lora_unet_linear{i}.lora_down.weight"] = torch.randn(rank, 64)
+        lora_sd[f"lora_unet_linear{i}.lora_up.weight"] = torch.randn(48, rank) * (i + 1)
+        lora_sd[f"lora_unet_linear{i}.alpha"] = torch.tensor(rank / 2)
+    lora_sd["lora_unet_conv.lora_down.weight"] = torch.randn(rank, 16, 3, 3)
+    lora_sd["lora_unet_conv.lora_up.weight"] = torch.randn(32, rank, 1, 1)
+    lora_sd["lora_unet_conv.alpha"] = torch.tensor(float(rank))
+    return lora_sd
+
+
+@pytest.mark.parametrize("dynamic_method,dynamic_param", [(None, None), ("sv_fro", 0.9), ("sv_ratio", 2.0)])
+def test_resize_lowrank_is_same_as_full(dynamic_method, dynamic_param):
+    lora_sd = make_lora(16)
+    args = (8, 4, torch.float, "cpu", dynamic_method, dynamic_param, False)
+    lowrank_sd, _, _ = resize_lora.resize_lora_model(dict(lora_sd), *args, svd_method="lowrank")
+    full_sd, _, _ = resize_lora.resize_lora_model(dict(lora_sd), *args, svd_method="full")
+
+    assert lowrank_sd.keys() == full_sd.keys()
+    for key in lowrank_sd.keys():
+        if key.endswith(".alpha"):
+            assert lowrank_sd[key] == full_sd[key], key
+        elif key.endswith(".lora_down.weight"):
+            name = key[: -len(".lora_down.weight")]
+            up, down = lowrank_sd[name + ".lora_up.weight"], lowrank_sd[key]
+            assert up.size(1) == full_sd[name + ".lora_up.weight"].size(1), name
+            expected = full_sd[name + ".lora_up.weight"].flatten(1) @ full_sd[key].flatten(1)
+            assert torch.allclose(up.flatten(1) @ down.flatten(1), expected, atol=1e-3), name
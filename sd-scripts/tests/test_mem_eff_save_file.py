@@ -0,0 +1,51 @@
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file
+
+from library import utils
+
+
+def make_tensors():
+    torch.manual_seed(0)
+    return {
+        "a": torch.randn(300, 70),
+        "b": torch.randn(1000, dtype=torch.bfloat16),
+        "c": torch.arange(10),
+        "scalar": torch.tensor(2.0),
+        "empty": torch.zeros(0, 3),
+    }
+
+
+def test_convert_dtype_while_writing(tmp_path):
+    tensors = make_tensors()
+    path = str(tmp_path / "test.safetensors")
+    # small chunks to write tensors with multiple workers
+    utils.mem_eff_save_file(tensors, path, {"ss_test": "1"}, dtype=torch.float16, num_workers=3, chunk_size=1000)
+
+    loaded = load_file(path)
+    for key, tensor in tensors.items():
+        expected = tensor.to(torch.float16) if tensor.dtype.is_floating_point else tensor
+        assert loaded[key].dtype == expected.dtype and torch.equal(loaded[key], expected)
+    with open(path, "rb") as f:
+        assert (int.from_bytes(f.read(8), "little") + 8) % 256 == 0  # aligned data
+
+
+def test_lazy_producers(tmp_path, monkeypatch):
+    tensors = make_tensors()
+    produced = []
+
+    def producer(key):
+        produced.append(key)
+        return tensors[key]
+
+    path = str(tmp_path / "test.safetensors")
+    utils.mem_eff_save_file([(key, lambda key=key: producer(key)) for key in tensors], path)
+    assert produced == list(tensors.keys())
+    assert all(torch.equal(load_file(path)[key], tensor) for key, tensor in tensors.items())
+
+    # unknown keys and too small space for the header: the data is moved
+    monkeypatch.setattr(utils, "_MEM_EFF_SAVE_DEFAULT_HEADER_RESERVE", 16)
+    utils.mem_eff_save_file(((key, tensor) for key, tensor in tensors.items()), path, {"long": "x" * 1000})
+    with safe_open(path, framework="pt") as f:
+        assert f.metadata() == {"long": "x" * 1000}
+        assert all(torch.equal(f.get_tensor(key), tensor) for key, tensor in tensors.items())
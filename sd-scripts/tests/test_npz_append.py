@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import torch
+
+from library.sharded_cache import ShardedCacheStore, npz_to_store
+from library.strategy_base import LatentsCachingStrategy, get_resolution_npz_path
+
+
+def save_latents(strategy, npz_path, latents, key_reso_suffix):
+    strategy.save_latents_to_disk(npz_path, latents, (64, 32), (0, 0, 64, 32), key_reso_suffix=key_reso_suffix)
+
+
+def load_latents(strategy, npz_path, bucket_reso):
+    return strategy._default_load_latents_from_disk(8, npz_path, bucket_reso)[0]
+
+
+def test_second_resolution_is_added(tmp_path):
+    strategy = LatentsCachingStrategy(True, 1, False)
+    npz_path = str(tmp_path / "image_0064x0032_flux.npz")
+    latents_1, latents_2 = torch.randn(4, 4, 8), torch.randn(4, 8, 4)
+
+    save_latents(strategy, npz_path, latents_1, "_4x8")
+    save_latents(strategy, npz_path, latents_2, "_8x4")
+
+    assert sorted(os.listdir(tmp_path)) == ["image_0064x0032_flux.npz", "image_0064x0032_flux_8x4.npz"]
+    with np.load(npz_path) as npz:
+        assert sorted(npz.files) == ["crop_ltrb_4x8", "latents_4x8", "original_size_4x8"]
+    with np.load(get_resolution_npz_path(npz_path, "_8x4")) as npz:
+        assert sorted(npz.files) == ["crop_ltrb_8x4", "latents_8x4", "original_size_8x4"]
+
+    assert np.array_equal(load_latents(strategy, npz_path, (64, 32)), latents_1.numpy())
+    assert np.array_equal(load_latents(strategy, npz_path, (32, 64)), latents_2.numpy())
+    assert strategy._default_is_disk_cached_latents_expected(8, (64, 32), npz_path, False, False, multi_resolution=True)
+    assert strategy._default_is_disk_cached_latents_expected(8, (32, 64), npz_path, False, False, multi_resolution=True)
+    assert not strategy._default_is_disk_cached_latents_expected(8, (64, 64), npz_path, False, False, multi_resolution=True)
+
+
+def test_bytes_written_per_resolution_do_not_grow_with_file_size(tmp_path):
+    strategy = LatentsCachingStrategy(True, 1, False)
+    added_sizes = []
+    for i, size in enumerate([8, 256]):
+        npz_path = str(tmp_path / f"image_{i}_flux.npz")
+        save_latents(strategy, npz_path, torch.randn(4, size, size), f"_{size}x{size}")
+        st = os.stat(npz_path)
+
+        save_latents(strategy, npz_path, torch.randn(4, 8, 4), "_8x4")
+        assert os.stat(npz_path).st_mtime_ns == st.st_mtime_ns and os.stat(npz_path).st_size == st.st_size  # not rewritten
+        added_sizes.append(os.path.getsize(get_resolution_npz_path(npz_path, "_8x4")))
+    assert added_sizes[0] == added_sizes[1]
+
+
+def test_existing_resolution_is_overwritten(tmp_path):
+    strategy = LatentsCachingStrategy(True, 1, False)
+    npz_path = str(tmp_path / "image_flux.npz")
+    latents_1, latents_2, latents_3, latents_4 = [torch.randn(4, 4, 8) for _ in range(2)] + [torch.randn(4, 8, 4) for _ in range(2)]
+    save_latents(strategy, npz_path, latents_1, "_4x8")
+    save_latents(strategy, npz_path, latents_3, "_8x4")
+
+    save_latents(strategy, npz_path, latents_2, "_4x8")  # in the main file
+    save_latents(strategy, npz_path, latents_4, "_8x4")  # in the side-car file
+    assert sorted(os.listdir(tmp_path)) == ["image_flux.npz", "image_flux_8x4.npz"]
+    assert np.array_equal(load_latents(strategy, npz_path, (64, 32)), latents_2.numpy())
+    assert np.array_equal(load_latents(strategy, npz_path, (32, 64)), latents_4.numpy())
+
+
+def test_side_car_files_are_merged_into_store(tmp_path):
+    strategy = LatentsCachingStrategy(True, 1, False)
+    npz_path = str(tmp_path / "image_flux.npz")
+    latents_1, latents_2 = torch.randn(4, 4, 8), torch.randn(4, 8, 4)
+    save_latents(strategy, npz_path, latents_1, "_4x8")
+    save_latents(strategy, npz_path, latents_2, "_8x4")
+    np.savez(str(tmp_path / "image_flux_2x2.npz"), latents=np.zeros(1))  # not a side-car file, e.g. another image
+
+    with ShardedCacheStore(str(tmp_path / "store")) as store:
+        assert npz_to_store([npz_path], store) == 1
+        assert sorted(store.array_names(npz_path)) == sorted(
+            f"{name}_{reso}" for name in ["latents", "original_size", "crop_ltrb"] for reso in ["4x8", "8x4"]
+        )
+        assert np.array_equal(store.get_arrays(npz_path)["latents_8x4"], latents_2.numpy())
@@ -0,0 +1,43 @@
+import io
+
+import safetensors.torch
+import torch
+
+from library import train_util
+
+
+def hashes_by_bytesio(tensors, metadata):
+    # the previous implementation of precalculate_safetensors_hashes
+    metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
+    b = io.BytesIO(safetensors.torch.save(tensors, metadata))
+    return train_util.addnet_hash_safetensors(b), train_util.addnet_hash_legacy(b)
+
+
+def make_tensors():
+    torch.manual_seed(0)
+    tensors = {}
+    for i in range(40):
+        tensors[f"lora_unet_{i}.lora_down.weight"] = torch.randn(16, 640, dtype=torch.bfloat16)
+        tensors[f"lora_unet_{i}.lora_up.weight"] = torch.randn(640, 16, dtype=torch.float16)
+        tensors[f"lora_unet_{i}.alpha"] = torch.tensor(8.0)
+    tensors["empty"] = torch.zeros(0, 4)
+    return tensors
+
+
+def test_hashes_are_unchanged(tmp_path):
+    tensors = make_tensors()
+    for metadata in [{}, {"ss_network_dim": "16", "ss_tag": "é\n\"", "modelspec.title": "x"}, {"ss_long": "x" * 0x100000}]:
+        expected = hashes_by_bytesio(tensors, metadata)
+        assert train_util.precalculate_safetensors_hashes(tensors, metadata) == expected
+
+        path = str(tmp_path / "test.safetensors")
+        saved_metadata = dict(metadata)
+        train_util.save_safetensors_with_hashes(tensors, path, saved_metadata)
+        assert (saved_metadata["sshs_model_hash"], saved_metadata["sshs_legacy_hash"]) == expected
+
+        with safetensors.safe_open(path, framework="pt") as f:
+            assert f.metadata() == saved_metadata
+            for key, tensor in tensors.items():
+                assert torch.equal(f.get_tensor(key), tensor)
+        with open(path, "rb") as f:
+            assert train_util.addnet_hash_safetensors(f) == expected[0]
@@ -0,0 +1,47 @@
+import torch
+from safetensors.torch import load_file, save_file
+
+from library.utils import MemoryEfficientSafeOpen, load_safetensors_parallel
+
+
+def make_file(path):
+    torch.manual_seed(0)
+    tensors = {
+        "a": torch.randn(300, 70, dtype=torch.bfloat16),
+        "b": torch.randn(1000),
+        "c": torch.arange(10, dtype=torch.int64),
+        "scalar": torch.tensor(3.0, dtype=torch.float16),
+        "empty": torch.zeros(0, 4),
+    }
+    save_file(tensors, path, {"ss_test": "1"})
+    return load_file(path)
+
+
+def test_mmap_reader_returns_copy_on_write_views(tmp_path):
+    path = str(tmp_path / "test.safetensors")
+    expected = make_file(path)
+
+    with MemoryEfficientSafeOpen(path, use_mmap=True) as f:
+        assert f.metadata() == {"ss_test": "1"}
+        tensors = {key: f.get_tensor(key) for key in f.keys()}
+    for key, tensor in expected.items():
+        assert tensors[key].dtype == tensor.dtype and torch.equal(tensors[key], tensor)
+
+    tensors["b"].zero_()  # the file is not changed
+    assert torch.equal(load_file(path)["b"], expected["b"])
+
+    with MemoryEfficientSafeOpen(path) as f:
+        assert torch.equal(f.get_tensor("a"), expected["a"])
+
+
+def test_parallel_loader(tmp_path):
+    path = str(tmp_path / "test.safetensors")
+    expected = make_file(path)
+
+    for dtype in [None, torch.float32, torch.float16]:
+        # small chunks to split tensors into multiple chunks
+        state_dict = load_safetensors_parallel(path, dtype=dtype, num_workers=3, chunk_size=1000)
+        assert sorted(state_dict.keys()) == sorted(expected.keys())
+        for key, tensor in expected.items():
+            tensor = tensor.to(dtype) if dtype is not None else tensor
+            assert state_dict[key].dtype == tensor.dtype and torch.equal(state_dict[key], tensor)
@@ -0,0 +1,111 @@
+import argparse
+import contextlib
+from types import SimpleNamespace
+
+import torch
+from PIL import Image
+
+from library.train_util import SamplePromptConditioningCache, sample_images_common
+
+
+class FakePipeline:
+    def __init__(self):
+        self.encoded = []
+
+    def encode_prompt_conditioning(self, prompt, negative_prompt, do_classifier_free_guidance):
+        self.encoded.append((prompt, negative_prompt, do_classifier_free_guidance))
+        return torch.randn(2 if do_classifier_free_guidance else 1, 77, 8)
+
+
+def test_conditioning_is_encoded_once_for_each_key():
+    cache = SamplePromptConditioningCache()
+    pipeline = FakePipeline()
+
+    conditioning = cache.get_conditioning(pipeline, "a cat", "blurry", None, True)
+    for _ in range(3):  # sampling calls at the following steps
+        assert cache.get_conditioning(pipeline, "a cat", "blurry", None, True) is conditioning
+    assert len(pipeline.encoded) == 1
+
+    cache.get_conditioning(pipeline, "a cat", None, None, True)
+    cache.get_conditioning(pipeline, "a cat", "blurry", 2, True)
+    cache.get_conditioning(pipeline, "a cat", "blurry", None, False)
+    assert len(pipeline.encoded) == 4
+
+    cache.clear()
+    cache.get_conditioning(pipeline, "a cat", "blurry", None, True)
+    assert len(pipeline.encoded) == 5
+
+
+class FakeModel(torch.nn.Linear):
+    def __init__(self):
+        super().__init__(2, 2)
+
+    @property
+    def device(self):
+        return self.weight.device
+
+
+class FakeTextEncoder(FakeModel):
+    # records the devices which the text encoder is moved to
+    def __init__(self):
+        super().__init__()
+        self.moved_to = []
+
+    def to(self, *args, **kwargs):
+        self.moved_to.append(args[0] if args else kwargs.get("device"))
+        return super().to(*args, **kwargs)
+
+
+class FakeSamplingPipeline(FakePipeline):
+    instances = []
+
+    def __init__(self, text_encoder, vae, unet, **kwargs):
+        super().__init__()
+        self.text_encoder = text_encoder
+        self.moved_to = []
+        FakeSamplingPipeline.instances.append(self)
+
+    def to(self, device):
+        self.moved_to.append(device)  # a real pipeline moves the text encoder too
+
+    def __call__(self, prompt_conditioning=None, **kwargs):
+        assert prompt_conditioning is not None
+        return torch.zeros(1, 4, 8, 8)
+
+    def latents_to_image(self, latents):
+        return [Image.new("RGB", (8, 8))]
+
+
+def test_text_encoders_stay_offloaded_when_cache_hits(tmp_path):
+    prompt_file = tmp_path / "prompts.txt"
+    prompt_file.write_text("a cat --n blurry\na dog --l 1.0\n", encoding="utf-8")
+    args = argparse.Namespace(
+        sample_at_first=True,
+        sample_prompts=str(prompt_file),
+        sample_sampler="ddim",
+        v_parameterization=False,
+        clip_skip=None,
+        output_dir=str(tmp_path),
+        output_name=None,
+    )
+    accelerator = SimpleNamespace(
+        unwrap_model=lambda model: model, autocast=contextlib.nullcontext, device=torch.device("cpu"), trackers=[]
+    )
+    text_encoder = FakeTextEncoder()
+    vae, unet = FakeModel(), FakeModel()
+    cache = SamplePromptConditioningCache()
+
+    def sample():
+        sample_images_common(
+            FakeSamplingPipeline, accelerator, args, None, 0, "cpu", vae, None, text_encoder, unet, conditioning_cache=cache
+        )
+
+    sample()  # cache miss: the text encoder is moved to the device and back
+    assert len(text_encoder.moved_to) == 2
+    assert len(FakeSamplingPipeline.instances[-1].encoded) == 2
+
+    text_encoder.moved_to.clear()
+    sample()  # cache hit
+    assert text_encoder.moved_to == []
+    assert FakeSamplingPipeline.instances[-1].encoded == [] and FakeSamplingPipeline.instances[-1].moved_to == []
+    assert all(conditioning.device.type == "cpu" for conditioning in cache.conditionings.values())
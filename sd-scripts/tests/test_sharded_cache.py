@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import torch
+
+from library.sharded_cache import ShardedCacheStore, npz_to_store, store_to_npz
+from library.strategy_sd import SdSdxlLatentsCachingStrategy
+from tools.convert_latents_cache import convert, setup_parser
+
+
+def test_sharded_cache_store(tmp_path):
+    store_dir = str(tmp_path / "store")
+    latents = np.random.rand(4, 8, 8).astype(np.float32)
+    flipped = np.random.rand(4, 8, 8).astype(np.float32)
+
+    with ShardedCacheStore(store_dir, max_shard_size=1) as store:
+        store.append("a.npz", {"latents_8x8": latents, "original_size": np.array([64, 64])})
+        store.append("a.npz", {"latents_flipped_8x8": flipped})  # merged into the existing key, new shard
+        assert "a.npz" in store and "b.npz" not in store
+        assert store.has_arrays("a.npz", ["latents_8x8", "latents_flipped_8x8"])
+        arrays = store.get_arrays("a.npz")
+        assert np.array_equal(arrays["latents_8x8"], latents)
+        assert np.array_equal(arrays["latents_flipped_8x8"], flipped)
+
+    # another instance (process) sees the same entries
+    store = ShardedCacheStore(store_dir)
+    assert store.get_array_shape("a.npz", "latents_8x8") == (4, 8, 8)
+    assert np.array_equal(store.get_arrays("a.npz", ["original_size"])["original_size"], [64, 64])
+    store.close()
+
+
+def test_npz_round_trip(tmp_path):
+    npz_path = str(tmp_path / "img_0064x0064_sd.npz")
+    latents = np.random.rand(4, 8, 8).astype(np.float32)
+    np.savez(npz_path, latents=latents)
+
+    with ShardedCacheStore(str(tmp_path / "store")) as store:
+        assert npz_to_store([npz_path], store) == 1
+        assert npz_to_store([npz_path], store) == 0  # already converted
+        os.remove(npz_path)
+        assert store_to_npz(store) == 1
+
+    with np.load(npz_path) as npz:
+        assert np.array_equal(npz["latents"], latents)
+
+
+def test_relative_npz_dir_is_found_by_strategy(tmp_path, monkeypatch):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    npz_path = str(image_dir / "img_0064x0064_sd.npz")
+    latents = torch.randn(4, 8, 8)
+    SdSdxlLatentsCachingStrategy(True, True, 1, False).save_latents_to_disk(npz_path, latents, (64, 64), (0, 0, 64, 64))
+
+    # convert with a relative directory
+    monkeypatch.chdir(tmp_path)
+    convert(setup_parser().parse_args(["--npz_dir", "images", "--shard_dir", "store", "--suffix", "_sd.npz"]))
+    os.remove(npz_path)
+
+    # the dataset looks up the absolute path built from the image path
+    strategy = SdSdxlLatentsCachingStrategy(True, True, 1, False)
+    with ShardedCacheStore(str(tmp_path / "store")) as store:
+        strategy.set_cache_store(store)
+        assert store.keys() == [npz_path]
+        assert strategy.glob_disk_cache_paths(str(image_dir)) == [npz_path]
+        assert strategy.glob_disk_cache_paths("images") == [npz_path]
+        assert strategy.is_disk_cached_latents_expected((64, 64), npz_path, False, False)
+        assert np.array_equal(strategy.load_latents_from_disk(npz_path, (64, 64))[0], latents.numpy())
+        assert os.path.join("images", "img_0064x0064_sd.npz") in store  # relative paths are the same key
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+import torch
+
+from library.train_util import stack_into_batch_tensor
+
+
+def test_same_as_torch_stack():
+    samples = [torch.randn(4, 8, 6) for _ in range(3)]
+    batch = stack_into_batch_tensor(samples)
+    assert batch.dtype == torch.float32 and batch.device.type == "cpu"
+    assert torch.equal(batch, torch.stack(samples))
+
+    # numpy arrays, including flipped arrays with negative strides
+    arrays = [np.random.randn(4, 8, 6).astype(np.float32) for _ in range(3)]
+    arrays[1] = arrays[1][:, :, ::-1]
+    batch = stack_into_batch_tensor(arrays)
+    assert torch.equal(batch, torch.stack([torch.from_numpy(x.copy()) for x in arrays]))
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16])
+def test_dtype_conversion(dtype):
+    samples = [torch.randn(2, 3, dtype=torch.float64), np.random.randn(2, 3), np.random.randn(2, 3)[:, ::-1]]
+    batch = stack_into_batch_tensor(samples, dtype)
+    expected = torch.stack([x if isinstance(x, torch.Tensor) else torch.from_numpy(x.copy()) for x in samples]).to(dtype)
+    assert batch.dtype == dtype
+    assert torch.equal(batch, expected)
+
+    # dtype of the first sample is used by default
+    assert stack_into_batch_tensor([np.zeros(3, dtype=np.float16)]).dtype == torch.float16
+    assert stack_into_batch_tensor([torch.zeros(3, dtype=torch.bfloat16)]).dtype == torch.bfloat16
+
+
+def test_none_samples_are_filled():
+    mask = torch.rand(8, 6)
+    samples = [None, mask, None, mask.numpy()]
+    batch = stack_into_batch_tensor(samples, torch.float32, (8, 6), fill_value=1.0)
+    ones = torch.ones(8, 6)
+    assert torch.equal(batch, torch.stack([ones, mask, ones, mask]))
+
+    # the shape of the first non-None sample is used by default
+    batch = stack_into_batch_tensor([None, mask], fill_value=0.0)
+    assert torch.equal(batch, torch.stack([torch.zeros(8, 6), mask]))
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is not available")
+def test_cuda_samples_are_stacked_on_cpu():
+    samples = [torch.randn(4, 8, device="cuda") for _ in range(2)]
+    batch = stack_into_batch_tensor(samples, torch.float16)
+    assert batch.device.type == "cpu"  # moved to the device later with the whole batch
+    assert torch.equal(batch, torch.stack(samples).to(torch.float16).cpu())
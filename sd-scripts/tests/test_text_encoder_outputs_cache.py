@@ -0,0 +1,124 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from library import strategy_flux
+from library.content_addressed_cache import ContentAddressedTextEncoderOutputsCache
+from library.strategy_base import TextEncoderOutputsCachingStrategy, TextEncodingStrategy, TokenizeStrategy
+from library.train_util import BaseDataset, ImageInfo
+
+
+@pytest.mark.parametrize("cache_dtype", [torch.float16, torch.bfloat16])
+def test_encode_trim_decode(cache_dtype):
+    torch.manual_seed(0)
+    strategy = TextEncoderOutputsCachingStrategy(False, None, False)
+    strategy.set_cache_dtype(cache_dtype)
+    output = torch.randn(2, 8, 4, dtype=torch.bfloat16)
+
+    encoded = strategy.encode_cache_array(output)
+    assert encoded.dtype == (np.float16 if cache_dtype == torch.float16 else np.uint16)
+    attn_mask = np.array([1, 1, 1, 0, 0, 0, 0, 0])
+    trimmed = strategy.trim_padding(encoded[0], attn_mask)
+    assert trimmed.shape == (3, 4)
+
+    decoded = strategy.decode_cache_array(trimmed, len(attn_mask))
+    assert decoded.dtype == np.float32 and decoded.shape == (8, 4)
+    expected = output[0, :3].to(cache_dtype).float().numpy()
+    assert np.array_equal(decoded[:3], expected)
+    assert not decoded[3:].any()
+
+    # float32 caches of previous versions are returned as is
+    array = np.ones((8, 4), dtype=np.float32)
+    assert strategy.decode_cache_array(array, 8) is array
+
+
+class FakeTokenizeStrategy:
+    def tokenize(self, captions):
+        lengths = [len(caption.split()) for caption in captions]
+        t5_attn_mask = torch.tensor([[1] * length + [0] * (6 - length) for length in lengths])
+        return [None, None, t5_attn_mask]
+
+
+class FakeTextEncodingStrategy:
+    def __init__(self):
+        self.num_encoded = 0
+
+    def encode_tokens(self, tokenize_strategy, models, tokens_and_masks):
+        t5_attn_mask = tokens_and_masks[2]
+        batch_size = len(t5_attn_mask)
+        self.num_encoded += batch_size
+        t5_out = torch.randn(batch_size, 6, 4, dtype=torch.bfloat16) * t5_attn_mask.unsqueeze(-1)  # masked by apply_t5_attn_mask
+        txt_ids = torch.zeros(batch_size, 6, 3, dtype=torch.bfloat16)
+        return torch.randn(batch_size, 5, dtype=torch.bfloat16), t5_out, txt_ids, t5_attn_mask
+
+
+@pytest.mark.parametrize("cache_to_disk", [False, True])
+def test_flux_compact_cache_is_same_as_float32_cache(tmp_path, cache_to_disk):
+    infos = []
+    for cache_dtype in [None, torch.bfloat16]:
+        strategy = strategy_flux.FluxTextEncoderOutputsCachingStrategy(cache_to_disk, None, False, apply_t5_attn_mask=True)
+        strategy.set_cache_dtype(cache_dtype)
+        strategy.warn_fp8_weights = True  # no models
+
+        dtype_infos = []
+        for i, caption in enumerate(["a photo", "a photo of a cat"]):
+            npz_path = str(tmp_path / f"{cache_dtype}_{i}.npz")
+            dtype_infos.append(SimpleNamespace(caption=caption, text_encoder_outputs_npz=npz_path, text_encoder_outputs=None))
+        torch.manual_seed(0)
+        strategy.cache_batch_outputs(FakeTokenizeStrategy(), [None, None], FakeTextEncodingStrategy(), dtype_infos)
+
+        if cache_to_disk:
+            outputs = [strategy.load_outputs_npz(info.text_encoder_outputs_npz) for info in dtype_infos]
+        else:
+            outputs = [strategy.decode_outputs(info.text_encoder_outputs) for info in dtype_infos]
+        infos.append((dtype_infos, outputs))
+
+    (_, expected_outputs), (compact_infos, compact_outputs) = infos
+    if cache_to_disk:
+        assert np.load(compact_infos[0].text_encoder_outputs_npz)["t5_out"].shape == (2, 4)  # padding is trimmed
+    for expected, actual in zip(expected_outputs, compact_outputs):
+        for expected_array, actual_array in zip(expected, actual):
+            assert actual_array.dtype == expected_array.dtype and actual_array.shape == expected_array.shape
+            assert np.array_equal(actual_array, expected_array)
+
+
+@pytest.mark.parametrize("cache_to_disk", [False, True])
+def test_same_captions_are_encoded_once(tmp_path, monkeypatch, cache_to_disk):
+    text_encoding_strategy = FakeTextEncodingStrategy()
+    caching_strategy = strategy_flux.FluxTextEncoderOutputsCachingStrategy(cache_to_disk, None, False, apply_t5_attn_mask=True)
+    caching_strategy.warn_fp8_weights = True  # no models
+    if cache_to_disk:
+        caching_strategy.set_content_cache(ContentAddressedTextEncoderOutputsCache(str(tmp_path / "cache")))
+    monkeypatch.setattr(TokenizeStrategy, "_strategy", FakeTokenizeStrategy())
+    monkeypatch.setattr(TextEncodingStrategy, "_strategy", text_encoding_strategy)
+    monkeypatch.setattr(TextEncoderOutputsCachingStrategy, "_strategy", caching_strategy)
+
+    captions = ["a photo of a dog", "a photo", " a  photo of a dog ", "a photo", "a cat"]
+    image_data = {}
+    for i, caption in enumerate(captions):
+        image_data[str(i)] = ImageInfo(str(i), 1, caption, False, str(tmp_path / f"{i}.png"))
+    dataset = SimpleNamespace(image_data=image_data, batch_size=2)
+    accelerator = SimpleNamespace(num_processes=1, process_index=0)
+    models = [torch.nn.Linear(2, 2), None]
+
+    torch.manual_seed(0)
+    BaseDataset.new_cache_text_encoder_outputs(dataset, models, accelerator)
+    assert text_encoding_strategy.num_encoded == 3
+
+    infos = list(image_data.values())
+    if cache_to_disk:
+        npz_paths = [info.text_encoder_outputs_npz for info in infos]
+        assert npz_paths[0] == npz_paths[2] and npz_paths[1] == npz_paths[3] and len(set(npz_paths)) == 3
+        assert all(os.path.dirname(os.path.dirname(path)) == str(tmp_path / "cache") for path in npz_paths)
+        assert all(caching_strategy.is_disk_cached_outputs_expected(path) for path in npz_paths)
+
+        # second run: all captions are cached
+        BaseDataset.new_cache_text_encoder_outputs(dataset, models, accelerator)
+        assert text_encoding_strategy.num_encoded == 3
+    else:
+        assert infos[0].text_encoder_outputs is infos[2].text_encoder_outputs
+        assert infos[1].text_encoder_outputs is infos[3].text_encoder_outputs
+        assert infos[0].text_encoder_outputs is not infos[1].text_encoder_outputs
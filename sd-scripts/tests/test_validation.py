@@ -1,4 +1,10 @@
+from types import SimpleNamespace
+
+import torch
+
+from library import train_util
 from library.train_util import split_train_val
+from train_network import NetworkTrainer
 
 
 def test_split_train_val():
@@ -13,5 +19,58 @@ def test_split_train_val():
     assert result_sizes == [None], result_sizes
 
 
+def test_repeat_batch():
+    batch = {
+        "loss_weights": torch.tensor([1.0, 2.0]),
+        "latents": torch.randn(2, 4, 8, 8),
+        "text_encoder_outputs_list": [torch.randn(2, 77, 16), None],
+        "captions": ["a", "b"],
+        "custom_attributes": [{}, {"diff_output_preservation": True}],
+        "alpha_masks": None,
+    }
+    repeated = train_util.repeat_batch(batch, 3)
+    assert torch.equal(repeated["loss_weights"], torch.tensor([1.0, 2.0] * 3))
+    assert torch.equal(repeated["latents"], torch.cat([batch["latents"]] * 3))
+    assert repeated["text_encoder_outputs_list"][0].shape == (6, 77, 16) and repeated["text_encoder_outputs_list"][1] is None
+    assert repeated["captions"] == ["a", "b"] * 3 and len(repeated["custom_attributes"]) == 6
+    assert repeated["alpha_masks"] is None
+
+    timesteps = train_util.get_timesteps([200, 400, 600], [200, 400, 600], 6, torch.device("cpu"))
+    assert timesteps.tolist() == [200, 200, 400, 400, 600, 600]
+
+
+class FakeTrainer(NetworkTrainer):
+    def __init__(self):
+        super().__init__()
+        self.num_forwards = 0
+
+    def process_batch(self, batch, *args, reduce_loss=True, **kwargs):
+        # loss of each sample: timestep * loss weight
+        self.num_forwards += 1
+        loss_weights = batch["loss_weights"]
+        train_args = args[8]
+        timesteps = train_util.get_timesteps(train_args.min_timestep, train_args.max_timestep, len(loss_weights), "cpu")
+        loss = timesteps.float() * loss_weights
+        return loss.mean() if reduce_loss else loss
+
+
+def test_batched_validation_losses_are_same_as_sequential():
+    trainer = FakeTrainer()
+    batch = {"loss_weights": torch.tensor([1.0, 3.0]), "latents": torch.randn(2, 4, 8, 8)}
+    args = SimpleNamespace(min_timestep=None, max_timestep=None)
+    models = [None] * 7  # text_encoders, unet, network, vae, noise_scheduler, vae_dtype, weight_dtype
+    validation_timesteps = [200, 400, 600, 800]
+
+    sequential = []
+    for timestep in validation_timesteps:
+        sequential += trainer.process_validation_batch(batch, [timestep], *models, None, args, None, None)
+    assert trainer.num_forwards == 4
+
+    batched = trainer.process_validation_batch(batch, validation_timesteps[:3], *models, None, args, None, None)
+    batched += trainer.process_validation_batch(batch, validation_timesteps[3:], *models, None, args, None, None)
+    assert trainer.num_forwards == 6
+    assert batched == sequential == [timestep * 2.0 for timestep in validation_timesteps]
+
+
 if __name__ == "__main__":
     test_split_train_val()
@@ -0,0 +1,98 @@
+# benchmark of saving a network with the addnet hashes: precalculated with safetensors.torch.save + save_file (old),
+# streaming precalculation + save_file, and hashing while writing in one pass
+# addnetハッシュ付きのネットワーク保存のベンチマーク
+
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import torch
+from safetensors.torch import save, save_file
+
+from library import train_util
+
+METHODS = ["bytesio", "streaming", "one_pass"]
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is KB on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024**2 if sys.platform == "darwin" else maxrss / 1024
+
+
+def make_state_dict(size_gb: float, dtype: torch.dtype):
+    # LoRA-like state dict: pairs of down/up weights and alphas. same weights in all processes to compare the hashes
+    torch.manual_seed(0)
+    rank, dim = 64, 3072
+    pair_bytes = 2 * rank * dim * torch.finfo(dtype).bits // 8
+    state_dict = {}
+    for i in range(max(1, int(size_gb * 1024**3 / pair_bytes))):
+        state_dict[f"lora_unet_{i}.lora_down.weight"] = torch.randn(rank, dim, dtype=dtype)
+        state_dict[f"lora_unet_{i}.lora_up.weight"] = torch.randn(dim, rank, dtype=dtype)
+        state_dict[f"lora_unet_{i}.alpha"] = torch.tensor(float(rank))
+    return state_dict
+
+
+def run(method: str, size_gb: float, dtype: torch.dtype, output: str, queue):
+    state_dict = make_state_dict(size_gb, dtype)
+    metadata = {"ss_network_module": "networks.lora", "ss_network_dim": "64"}
+    base_rss = get_peak_rss_mb()
+
+    start_time = time.perf_counter()
+    if method == "bytesio":
+        # same as the previous precalculate_safetensors_hashes
+        b = io.BytesIO(save(state_dict, metadata))
+        metadata["sshs_model_hash"] = train_util.addnet_hash_safetensors(b)
+        metadata["sshs_legacy_hash"] = train_util.addnet_hash_legacy(b)
+        del b
+        save_file(state_dict, output, metadata)
+    elif method == "streaming":
+        metadata["sshs_model_hash"], metadata["sshs_legacy_hash"] = train_util.precalculate_safetensors_hashes(state_dict, metadata)
+        save_file(state_dict, output, metadata)
+    else:
+        train_util.save_safetensors_with_hashes(state_dict, output, metadata)
+    elapsed = time.perf_counter() - start_time
+
+    queue.put((elapsed, get_peak_rss_mb() - base_rss, metadata["sshs_model_hash"], metadata["sshs_legacy_hash"]))
+
+
+def main(args: argparse.Namespace):
+    dtype = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}[args.dtype]
+    os.makedirs(args.output_dir, exist_ok=True)
+    output = os.path.join(args.output_dir, "benchmark.safetensors")
+
+    # run each method in a fresh process to measure its own peak memory
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{'size':>6} {'method':>10} {'time (s)':>9} {'peak extra RSS (MB)':>20}  hashes")
+    for size_gb in args.sizes:
+        for method in args.methods:
+            queue = ctx.Queue()
+            process = ctx.Process(target=run, args=(method, size_gb, dtype, output, queue))
+            process.start()
+            elapsed, peak_mb, model_hash, legacy_hash = queue.get()
+            process.join()
+            print(f"{size_gb:>5}G {method:>10} {elapsed:>9.2f} {peak_mb:>20.0f}  {model_hash[:16]} {legacy_hash}")
+    os.remove(output)
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=float, nargs="+", default=[1, 2, 4], help="sizes of networks in GB / ネットワークのサイズ（GB）"
+    )
+    parser.add_argument("--methods", type=str, nargs="+", default=METHODS, choices=METHODS, help="methods to run / 実行する方法")
+    parser.add_argument("--dtype", type=str, default="bf16", choices=["fp16", "bf16", "fp32"], help="dtype of weights / 重みの型")
+    parser.add_argument(
+        "--output_dir", type=str, default=".", help="directory to write the benchmark file / ベンチマーク用ファイルを書き込むディレクトリ"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,125 @@
+# benchmark of loading a safetensors file: safetensors.load_file, MemoryEfficientSafeOpen (read and mmap),
+# and the parallel loader of load_safetensors(disable_mmap=True)
+# safetensorsファイルの読み込みのベンチマーク
+#
+# the file is read once before the benchmark, so the results are for the file in the page cache.
+# use --drop_caches (requires root on Linux) to measure reading from the disk.
+
+import argparse
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from library.utils import MemoryEfficientSafeOpen, load_safetensors_parallel, str_to_dtype
+
+METHODS = ["load_file", "mem_eff_read", "mem_eff_mmap", "parallel"]
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is KB on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024**2 if sys.platform == "darwin" else maxrss / 1024
+
+
+def make_file(path: str, size_gb: float):
+    # Flux-like blocks of bf16 weights
+    dim = 3072
+    state_dict = {}
+    for i in range(max(1, int(size_gb * 1024**3 / (dim * dim * 4 * 2)))):
+        state_dict[f"blocks.{i}.mlp.0.weight"] = torch.randn(dim * 4, dim, dtype=torch.bfloat16)
+        state_dict[f"blocks.{i}.mlp.0.bias"] = torch.randn(dim * 4, dtype=torch.bfloat16)
+    save_file(state_dict, path)
+
+
+def run(method: str, path: str, dtype: torch.dtype, num_workers: int, queue):
+    base_rss = get_peak_rss_mb()
+
+    start_time = time.perf_counter()
+    if method == "load_file":
+        state_dict = load_file(path)
+        if dtype is not None:
+            state_dict = {k: v.to(dtype) for k, v in state_dict.items()}
+    elif method in ["mem_eff_read", "mem_eff_mmap"]:
+        # same as the previous load_safetensors(disable_mmap=True)
+        with MemoryEfficientSafeOpen(path, use_mmap=method == "mem_eff_mmap") as f:
+            state_dict = {k: f.get_tensor(k).to(dtype=dtype) for k in f.keys()}
+    else:
+        state_dict = load_safetensors_parallel(path, dtype=dtype, num_workers=num_workers)
+
+    # touch all data to include the page faults of lazily loaded tensors
+    checksum = sum(v.float().sum().item() for v in state_dict.values())
+    elapsed = time.perf_counter() - start_time
+
+    queue.put((elapsed, get_peak_rss_mb() - base_rss, checksum))
+
+
+def main(args: argparse.Namespace):
+    dtype = str_to_dtype(args.dtype) if args.dtype is not None else None
+    if args.file is not None:
+        path = args.file
+    else:
+        path = os.path.join(args.output_dir, "benchmark.safetensors")
+    file_size_mb = os.path.getsize(path) / 1024**2 if args.file is not None else None
+
+    # run each method in a fresh process to measure its own peak memory. the random file is also made in another process,
+    # because the peak memory of this process is inherited by the child processes
+    ctx = multiprocessing.get_context("spawn")
+    if args.file is None:
+        process = ctx.Process(target=make_file, args=(path, args.size))
+        process.start()
+        process.join()
+        file_size_mb = os.path.getsize(path) / 1024**2
+
+    print(f"file: {path} ({file_size_mb:.0f}MB), dtype: {dtype}")
+    print(f"{'method':>13} {'time (s)':>9} {'MB/s':>7} {'peak extra RSS (MB)':>20}  checksum")
+    for method in args.methods:
+        if args.drop_caches:
+            subprocess.run(["sh", "-c", "sync; echo 3 > /proc/sys/vm/drop_caches"], check=True)
+        else:
+            with open(path, "rb") as f:
+                while f.read(64 * 1024 * 1024):
+                    pass
+
+        queue = ctx.Queue()
+        process = ctx.Process(target=run, args=(method, path, dtype, args.num_workers, queue))
+        process.start()
+        elapsed, peak_mb, checksum = queue.get()
+        process.join()
+        print(f"{method:>13} {elapsed:>9.2f} {file_size_mb / elapsed:>7.0f} {peak_mb:>20.0f}  {checksum:.6e}")
+
+    if args.file is None:
+        os.remove(path)
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file", type=str, default=None, help="safetensors file to load, a random file is made if omitted / 読み込むsafetensorsファイル。省略時はランダムなファイルを作成する"
+    )
+    parser.add_argument("--size", type=float, default=2, help="size of the random file in GB / ランダムなファイルのサイズ（GB）")
+    parser.add_argument("--methods", type=str, nargs="+", default=METHODS, choices=METHODS, help="methods to run / 実行する方法")
+    parser.add_argument(
+        "--dtype", type=str, default=None, help="dtype to convert to, e.g. fp16, fp32. no conversion if omitted / 変換後の型。省略時は変換しない"
+    )
+    parser.add_argument("--num_workers", type=int, default=8, help="number of threads of the parallel loader / 並列読み込みのスレッド数")
+    parser.add_argument(
+        "--drop_caches",
+        action="store_true",
+        help="drop the page cache before each method to read from the disk (Linux, root) / 各方法の前にページキャッシュを破棄する（Linux、root）",
+    )
+    parser.add_argument(
+        "--output_dir", type=str, default=".", help="directory to write the random file / ランダムなファイルを書き込むディレクトリ"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    main(args)
@@ -72,6 +72,7 @@ def cache_to_disk(args: argparse.Namespace) -> None:
         latents_caching_strategy = strategy_sd.SdSdxlLatentsCachingStrategy(is_sd, True, args.vae_batch_size, args.skip_cache_check)
     else:
         latents_caching_strategy = strategy_flux.FluxLatentsCachingStrategy(True, args.vae_batch_size, args.skip_cache_check)
+    train_util.set_latents_cache_store_if_specified(args, latents_caching_strategy)
     strategy_base.LatentsCachingStrategy.set_strategy(latents_caching_strategy)
 
     # データセットを準備する
@@ -148,8 +149,7 @@ def cache_to_disk(args: argparse.Namespace) -> None:
     vae.requires_grad_(False)
     vae.eval()
 
-    # cache latents with dataset
-    # TODO use DataLoader to speed up
+    # cache latents with dataset: images are loaded and latents are saved in parallel with the VAE
     train_dataset_group.new_cache_latents(vae, accelerator)
 
     accelerator.wait_for_everyone()
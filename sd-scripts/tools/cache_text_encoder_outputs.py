@@ -167,6 +167,7 @@ def cache_to_disk(args: argparse.Namespace) -> None:
             is_partial=False,
             apply_t5_attn_mask=args.apply_t5_attn_mask,
         )
+    train_util.set_text_encoder_outputs_cache_options_if_specified(args, text_encoder_outputs_caching_strategy)
     strategy_base.TextEncoderOutputsCachingStrategy.set_strategy(text_encoder_outputs_caching_strategy)
 
     # build text encoding strategy
@@ -0,0 +1,86 @@
+# convert latents cache between per-image .npz files and the sharded cache store
+# latentsキャッシュを画像ごとの.npzファイルとシャーディングされたキャッシュストアの間で変換する
+
+import argparse
+import glob
+import os
+import re
+
+from library.sharded_cache import DEFAULT_MAX_SHARD_SIZE, ShardedCacheStore, npz_to_store, store_to_npz
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def convert(args: argparse.Namespace):
+    max_shard_size = args.shard_size * 1024 * 1024 if args.shard_size is not None else DEFAULT_MAX_SHARD_SIZE
+    with ShardedCacheStore(args.shard_dir, max_shard_size) as store:
+        if args.direction == "npz_to_shard":
+            pattern = os.path.join(glob.escape(args.npz_dir), "**" if args.recursive else "", "*" + args.suffix)
+            npz_paths = sorted(glob.glob(pattern, recursive=args.recursive))
+            # side-car files of added resolutions are merged into the main file's entry
+            npz_paths_set = set(npz_paths)
+            main_npz_paths = [re.sub(r"_\d+x\d+\.npz$", ".npz", path) for path in npz_paths]
+            npz_paths = [path for path, main in zip(npz_paths, main_npz_paths) if main == path or main not in npz_paths_set]
+            logger.info(f"found {len(npz_paths)} npz files in {args.npz_dir}")
+            count = npz_to_store(npz_paths, store, skip_existing=not args.overwrite)
+            logger.info(f"converted {count} npz files to {args.shard_dir}")
+        else:
+            keys = [key for key in store.keys() if key.endswith(args.suffix)]
+            if args.npz_dir is not None:
+                npz_dir = os.path.abspath(args.npz_dir)
+                keys = [key for key in keys if os.path.abspath(key).startswith(npz_dir + os.sep)]
+                if not args.recursive:
+                    keys = [key for key in keys if os.path.dirname(os.path.abspath(key)) == npz_dir]
+            logger.info(f"found {len(keys)} entries in {args.shard_dir}")
+            count = store_to_npz(store, keys, skip_existing=not args.overwrite)
+            logger.info(f"wrote {count} npz files")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--direction",
+        type=str,
+        default="npz_to_shard",
+        choices=["npz_to_shard", "shard_to_npz"],
+        help="conversion direction / 変換の方向",
+    )
+    parser.add_argument(
+        "--npz_dir",
+        type=str,
+        default=None,
+        help="directory of npz files. required for npz_to_shard, used as a filter for shard_to_npz"
+        " / npzファイルのディレクトリ。npz_to_shardでは必須、shard_to_npzでは絞り込みに使用",
+    )
+    parser.add_argument(
+        "--shard_dir", type=str, required=True, help="directory of the sharded cache store / シャーディングされたキャッシュストアのディレクトリ"
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=None,
+        help="max size of a shard file in MB (default 4096) / シャードファイルの最大サイズ（MB、デフォルト4096）",
+    )
+    parser.add_argument(
+        "--suffix",
+        type=str,
+        default=".npz",
+        help="suffix of cache files to convert, e.g. _sdxl.npz (default .npz) / 変換するキャッシュファイルのサフィックス（例：_sdxl.npz、デフォルト.npz）",
+    )
+    parser.add_argument("--recursive", action="store_true", help="search subdirectories / サブディレクトリも検索する")
+    parser.add_argument(
+        "--overwrite", action="store_true", help="overwrite existing entries or files / 既存のエントリまたはファイルを上書きする"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    if args.direction == "npz_to_shard" and args.npz_dir is None:
+        parser.error("--npz_dir is required for npz_to_shard")
+    convert(args)
@@ -24,10 +24,11 @@ from accelerate.utils import set_seed
 from accelerate import Accelerator
 from diffusers import DDPMScheduler
 from diffusers.models.autoencoders.autoencoder_kl import AutoencoderKL
-from library import deepspeed_utils, model_util, strategy_base, strategy_sd
+from library import async_checkpoint, deepspeed_utils, model_util, strategy_base, strategy_sd
 
 import library.train_util as train_util
 from library.train_util import DreamBoothDataset
+from library.content_addressed_cache import set_model_source
 import library.config_util as config_util
 from library.config_util import (
     ConfigSanitizer,
@@ -56,6 +57,7 @@ class NetworkTrainer:
     def __init__(self):
         self.vae_scale_factor = 0.18215
         self.is_sdxl = False
+        self.sample_prompt_conditioning_cache: Optional[train_util.SamplePromptConditioningCache] = None
 
     # TODO 他のスクリプトと共通化する
     def generate_step_logs(
@@ -224,7 +226,18 @@ class NetworkTrainer:
                 param.grad = accelerator.reduce(param.grad, reduction="mean")
 
     def sample_images(self, accelerator, args, epoch, global_step, device, vae, tokenizers, text_encoder, unet):
-        train_util.sample_images(accelerator, args, epoch, global_step, device, vae, tokenizers[0], text_encoder, unet)
+        train_util.sample_images(
+            accelerator,
+            args,
+            epoch,
+            global_step,
+            device,
+            vae,
+            tokenizers[0],
+            text_encoder,
+            unet,
+            conditioning_cache=self.sample_prompt_conditioning_cache,
+        )
 
     # region SD/SDXL
 
@@ -373,9 +386,10 @@ class NetworkTrainer:
         is_train=True,
         train_text_encoder=True,
         train_unet=True,
+        reduce_loss=True,
     ) -> torch.Tensor:
         """
-        Process a batch for the network
+        Process a batch for the network. returns the loss of each sample if reduce_loss is False
         """
         with torch.no_grad():
             if "latents" in batch and batch["latents"] is not None:
@@ -455,7 +469,59 @@ class NetworkTrainer:
 
         loss = self.post_process_loss(loss, args, timesteps, noise_scheduler)
 
-        return loss.mean()
+        return loss.mean() if reduce_loss else loss
+
+    def process_validation_batch(
+        self,
+        batch,
+        timesteps,
+        text_encoders,
+        unet,
+        network,
+        vae,
+        noise_scheduler,
+        vae_dtype,
+        weight_dtype,
+        accelerator,
+        args,
+        text_encoding_strategy: strategy_base.TextEncodingStrategy,
+        tokenize_strategy: strategy_base.TokenizeStrategy,
+        train_text_encoder=True,
+        train_unet=True,
+    ) -> List[float]:
+        """
+        Process a validation batch at the fixed timesteps, returns the loss for each timestep.
+        multiple timesteps are processed in one forward by repeating the batch for each timestep.
+        """
+        if len(timesteps) > 1:
+            batch = train_util.repeat_batch(batch, len(timesteps))
+
+        self.on_step_start(args, accelerator, network, text_encoders, unet, batch, weight_dtype, is_train=False)
+
+        # dirty hack to change timestep. a list of timesteps is for the repeated batch
+        args.min_timestep = args.max_timestep = timesteps[0] if len(timesteps) == 1 else [int(t) for t in timesteps]
+
+        loss = self.process_batch(
+            batch,
+            text_encoders,
+            unet,
+            network,
+            vae,
+            noise_scheduler,
+            vae_dtype,
+            weight_dtype,
+            accelerator,
+            args,
+            text_encoding_strategy,
+            tokenize_strategy,
+            is_train=False,
+            train_text_encoder=train_text_encoder,  # this is needed for validation because Text Encoders must be called if train_text_encoder is True
+            train_unet=train_unet,
+            reduce_loss=False,
+        )
+
+        self.on_validation_step_end(args, accelerator, network, text_encoders, unet, batch, weight_dtype)
+        return loss.detach().view(len(timesteps), -1).mean(dim=1).tolist()
 
     def train(self, args):
         session_id = random.randint(0, 2**32)
@@ -479,6 +545,7 @@ class NetworkTrainer:
 
         # prepare caching strategy: this must be set before preparing dataset. because dataset may use this strategy for initialization.
         latents_caching_strategy = self.get_latents_caching_strategy(args)
+        train_util.set_latents_cache_store_if_specified(args, latents_caching_strategy)
         strategy_base.LatentsCachingStrategy.set_strategy(latents_caching_strategy)
 
         # データセットを準備する
@@ -595,6 +662,10 @@ class NetworkTrainer:
 
             accelerator.print(f"all weights merged: {', '.join(args.base_weights)}")
 
+            # the weights of the text encoders are not same as their checkpoint files anymore
+            for t_enc in text_encoders:
+                set_model_source(t_enc, None)
+
         # 学習を準備する
         if cache_latents:
             vae.to(accelerator.device, dtype=vae_dtype)
@@ -617,6 +688,7 @@ class NetworkTrainer:
 
         text_encoder_outputs_caching_strategy = self.get_text_encoder_outputs_caching_strategy(args)
         if text_encoder_outputs_caching_strategy is not None:
+            train_util.set_text_encoder_outputs_cache_options_if_specified(args, text_encoder_outputs_caching_strategy)
             strategy_base.TextEncoderOutputsCachingStrategy.set_strategy(text_encoder_outputs_caching_strategy)
         self.cache_text_encoder_outputs_if_needed(args, accelerator, unet, vae, text_encoders, train_dataset_group, weight_dtype)
         if val_dataset_group is not None:
@@ -666,6 +738,10 @@ class NetworkTrainer:
         train_text_encoder = self.is_train_text_encoder(args)
         network.apply_to(text_encoder, unet, train_text_encoder, train_unet)
 
+        # the conditioning of the sample prompts doesn't change if the text encoders are not trained
+        if not train_text_encoder:
+            self.sample_prompt_conditioning_cache = train_util.SamplePromptConditioningCache()
+
         if args.network_weights is not None:
             # FIXME consider alpha of weights: this assumes that the alpha is not changed
             info = network.load_weights(args.network_weights)
@@ -742,6 +818,7 @@ class NetworkTrainer:
             collate_fn=collator,
             num_workers=n_workers,
             persistent_workers=args.persistent_data_loader_workers,
+            **train_util.get_data_loader_kwargs(args, n_workers),
         )
 
         val_dataloader = torch.utils.data.DataLoader(
@@ -751,6 +828,7 @@ class NetworkTrainer:
             collate_fn=collator,
             num_workers=n_workers,
             persistent_workers=args.persistent_data_loader_workers,
+            **train_util.get_data_loader_kwargs(args, n_workers),
         )
 
         # 学習ステップ数を計算する
@@ -1246,6 +1324,8 @@ class NetworkTrainer:
             on_step_start_for_network = lambda *args, **kwargs: None
 
         # function for saving/removing
+        checkpoint_writer = async_checkpoint.get_checkpoint_writer(args) if is_main_process else None
+
         def save_model(ckpt_name, unwrapped_nw, steps, epoch_no, force_sync_upload=False):
             os.makedirs(args.output_dir, exist_ok=True)
             ckpt_file = os.path.join(args.output_dir, ckpt_name)
@@ -1259,13 +1339,19 @@ class NetworkTrainer:
             sai_metadata = self.get_sai_model_spec(args)
             metadata_to_save.update(sai_metadata)
 
-            unwrapped_nw.save_weights(ckpt_file, save_dtype, metadata_to_save)
+            with async_checkpoint.deferred_writes(checkpoint_writer):
+                unwrapped_nw.save_weights(ckpt_file, save_dtype, metadata_to_save)
             if args.huggingface_repo_id is not None:
-                huggingface_util.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
+                if checkpoint_writer is not None:
+                    checkpoint_writer.submit(huggingface_util.upload, args, ckpt_file, "/" + ckpt_name)
+                else:
+                    huggingface_util.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
 
         def remove_model(old_ckpt_name):
             old_ckpt_file = os.path.join(args.output_dir, old_ckpt_name)
-            if os.path.exists(old_ckpt_file):
+            if checkpoint_writer is not None:
+                checkpoint_writer.remove(old_ckpt_file)  # after the new checkpoint is written
+            elif os.path.exists(old_ckpt_file):
                 accelerator.print(f"removing old checkpoint: {old_ckpt_file}")
                 os.remove(old_ckpt_file)
 
@@ -1320,6 +1406,13 @@ class NetworkTrainer:
         original_args_min_timestep = args.min_timestep
         original_args_max_timestep = args.max_timestep
 
+        def get_validation_timestep_groups(batch) -> List[List[int]]:
+            # timesteps processed in one forward: the batch is repeated for each timestep up to validation_max_batch_size
+            if args.validation_max_batch_size is None:
+                return [[timestep] for timestep in validation_timesteps]
+            num_timesteps = max(1, args.validation_max_batch_size // len(batch["loss_weights"]))
+            return [list(validation_timesteps[i : i + num_timesteps]) for i in range(0, len(validation_timesteps), num_timesteps)]
+
         def switch_rng_state(seed: int) -> tuple[torch.ByteTensor, Optional[torch.ByteTensor], tuple]:
             cpu_rng_state = torch.get_rng_state()
             if accelerator.device.type == "cuda":
@@ -1349,6 +1442,7 @@ class NetworkTrainer:
                     torch.cuda.set_rng_state(gpu_rng_state)
             random.setstate(python_rng_state)
 
+        data_wait_timer = train_util.DataLoaderWaitTimer()
         for epoch in range(epoch_to_start, num_train_epochs):
             accelerator.print(f"\nepoch {epoch+1}/{num_train_epochs}\n")
             current_epoch.value = epoch + 1
@@ -1363,7 +1457,7 @@ class NetworkTrainer:
                 skipped_dataloader = accelerator.skip_first_batches(train_dataloader, initial_step - 1)
                 initial_step = 1
 
-            for step, batch in enumerate(skipped_dataloader or train_dataloader):
+            for step, batch in enumerate(data_wait_timer(skipped_dataloader or train_dataloader)):
                 current_step.value = global_step
                 if initial_step > 0:
                     initial_step -= 1
@@ -1451,6 +1545,7 @@ class NetworkTrainer:
                     logs = self.generate_step_logs(
                         args, current_loss, avr_loss, lr_scheduler, lr_descriptions, optimizer, keys_scaled, mean_norm, maximum_norm
                     )
+                    logs.update(data_wait_timer.get_logs())
                     self.step_logging(accelerator, logs, global_step, epoch + 1)
 
                 # VALIDATION PER STEP: global_step is already incremented
@@ -1472,13 +1567,10 @@ class NetworkTrainer:
                         if val_step >= validation_steps:
                             break
 
-                        for timestep in validation_timesteps:
-                            self.on_step_start(args, accelerator, network, text_encoders, unet, batch, weight_dtype, is_train=False)
-
-                            args.min_timestep = args.max_timestep = timestep  # dirty hack to change timestep
-
-                            loss = self.process_batch(
+                        for timesteps in get_validation_timestep_groups(batch):
+                            losses = self.process_validation_batch(
                                 batch,
+                                timesteps,
                                 text_encoders,
                                 unet,
                                 network,
@@ -1490,24 +1582,22 @@ class NetworkTrainer:
                                 args,
                                 text_encoding_strategy,
                                 tokenize_strategy,
-                                is_train=False,
-                                train_text_encoder=train_text_encoder,  # this is needed for validation because Text Encoders must be called if train_text_encoder is True
+                                train_text_encoder=train_text_encoder,
                                 train_unet=train_unet,
                             )
 
-                            current_loss = loss.detach().item()
-                            val_step_loss_recorder.add(epoch=epoch, step=val_timesteps_step, loss=current_loss)
-                            val_progress_bar.update(1)
-                            val_progress_bar.set_postfix(
-                                {"val_avg_loss": val_step_loss_recorder.moving_average, "timestep": timestep}
-                            )
+                            for timestep, current_loss in zip(timesteps, losses):
+                                val_step_loss_recorder.add(epoch=epoch, step=val_timesteps_step, loss=current_loss)
+                                val_progress_bar.update(1)
+                                val_progress_bar.set_postfix(
+                                    {"val_avg_loss": val_step_loss_recorder.moving_average, "timestep": timestep}
+                                )
 
-                            # if is_tracking:
-                            #     logs = {f"loss/validation/step_current_{timestep}": current_loss}
-                            #     self.val_logging(accelerator, logs, global_step, epoch + 1, val_step)
+                                # if is_tracking:
+                                #     logs = {f"loss/validation/step_current_{timestep}": current_loss}
+                                #     self.val_logging(accelerator, logs, global_step, epoch + 1, val_step)
 
-                            self.on_validation_step_end(args, accelerator, network, text_encoders, unet, batch, weight_dtype)
-                            val_timesteps_step += 1
+                                val_timesteps_step += 1
 
                     if is_tracking:
                         loss_validation_divergence = val_step_loss_recorder.moving_average - loss_recorder.moving_average
@@ -1549,14 +1639,10 @@ class NetworkTrainer:
                     if val_step >= validation_steps:
                         break
 
-                    for timestep in validation_timesteps:
-                        args.min_timestep = args.max_timestep = timestep
-
-                        # temporary, for batch processing
-                        self.on_step_start(args, accelerator, network, text_encoders, unet, batch, weight_dtype, is_train=False)
-
-                        loss = self.process_batch(
+                    for timesteps in get_validation_timestep_groups(batch):
+                        losses = self.process_validation_batch(
                             batch,
+                            timesteps,
                             text_encoders,
                             unet,
                             network,
@@ -1568,24 +1654,22 @@ class NetworkTrainer:
                             args,
                             text_encoding_strategy,
                             tokenize_strategy,
-                            is_train=False,
                             train_text_encoder=train_text_encoder,
                             train_unet=train_unet,
                         )
 
-                        current_loss = loss.detach().item()
-                        val_epoch_loss_recorder.add(epoch=epoch, step=val_timesteps_step, loss=current_loss)
-                        val_progress_bar.update(1)
-                        val_progress_bar.set_postfix(
-                            {"val_epoch_avg_loss": val_epoch_loss_recorder.moving_average, "timestep": timestep}
-                        )
+                        for timestep, current_loss in zip(timesteps, losses):
+                            val_epoch_loss_recorder.add(epoch=epoch, step=val_timesteps_step, loss=current_loss)
+                            val_progress_bar.update(1)
+                            val_progress_bar.set_postfix(
+                                {"val_epoch_avg_loss": val_epoch_loss_recorder.moving_average, "timestep": timestep}
+                            )
 
-                        # if is_tracking:
-                        #     logs = {f"loss/validation/epoch_current_{timestep}": current_loss}
-                        #     self.val_logging(accelerator, logs, global_step, epoch + 1, val_step)
+                            # if is_tracking:
+                            #     logs = {f"loss/validation/epoch_current_{timestep}": current_loss}
+                            #     self.val_logging(accelerator, logs, global_step, epoch + 1, val_step)
 
-                        self.on_validation_step_end(args, accelerator, network, text_encoders, unet, batch, weight_dtype)
-                        val_timesteps_step += 1
+                            val_timesteps_step += 1
 
                 if is_tracking:
                     avr_loss: float = val_epoch_loss_recorder.moving_average
@@ -1604,6 +1688,7 @@ class NetworkTrainer:
                 progress_bar.unpause()
 
             # END OF EPOCH
+            data_wait_timer.log_summary()
             if is_tracking:
                 logs = {"loss/epoch_average": loss_recorder.moving_average}
                 self.epoch_logging(accelerator, logs, global_step, epoch + 1)
@@ -1644,6 +1729,10 @@ class NetworkTrainer:
             train_util.save_state_on_train_end(args, accelerator)
 
         if is_main_process:
+            # wait for the checkpoints saved in background, and save the last model synchronously
+            async_checkpoint.close_checkpoint_writer()
+            checkpoint_writer = None
+
             ckpt_name = train_util.get_last_ckpt_name(args, "." + args.save_model_as)
             save_model(ckpt_name, network, global_step, num_train_epochs, force_sync_upload=True)
 
@@ -1819,6 +1908,15 @@ def setup_parser() -> argparse.ArgumentParser:
         default=None,
         help="Max number of validation dataset items processed. By default, validation will run the entire validation dataset / 処理される検証データセット項目の最大数。デフォルトでは、検証は検証データセット全体を実行します",
     )
+    parser.add_argument(
+        "--validation_max_batch_size",
+        type=int,
+        default=None,
+        help="Max batch size of the validation forward. The validation timesteps of a batch are processed together by repeating the"
+        " batch up to this size, instead of one forward for each timestep. By default, one timestep per forward"
+        " / 検証のforwardの最大バッチサイズ。タイムステップごとにforwardする代わりに、このサイズまでバッチを繰り返して複数の検証タイムステップを"
+        "まとめて処理する。デフォルトではforwardごとに一つのタイムステップ",
+    )
     return parser
 
 
@@ -202,6 +202,7 @@ class TextualInversionTrainer:
 
         # prepare caching strategy: this must be set before preparing dataset. because dataset may use this strategy for initialization.
         latents_caching_strategy = self.get_latents_caching_strategy(args)
+        train_util.set_latents_cache_store_if_specified(args, latents_caching_strategy)
         strategy_base.LatentsCachingStrategy.set_strategy(latents_caching_strategy)
 
         # acceleratorを準備する
@@ -413,6 +414,7 @@ class TextualInversionTrainer:
             collate_fn=collator,
             num_workers=n_workers,
             persistent_workers=args.persistent_data_loader_workers,
+            **train_util.get_data_loader_kwargs(args, n_workers),
         )
 
         # 学習ステップ数を計算する
@@ -559,6 +561,7 @@ class TextualInversionTrainer:
             accelerator.log({}, step=0)
 
         # training loop
+        data_wait_timer = train_util.DataLoaderWaitTimer()
         for epoch in range(num_train_epochs):
             accelerator.print(f"\nepoch {epoch+1}/{num_train_epochs}")
             current_epoch.value = epoch + 1
@@ -568,7 +571,7 @@ class TextualInversionTrainer:
 
             loss_total = 0
 
-            for step, batch in enumerate(train_dataloader):
+            for step, batch in enumerate(data_wait_timer(train_dataloader)):
                 current_step.value = global_step
                 with accelerator.accumulate(text_encoders[0]):
                     with torch.no_grad():
@@ -698,6 +701,7 @@ class TextualInversionTrainer:
                         logs["lr/d*lr"] = (
                             lr_scheduler.optimizers[0].param_groups[0]["d"] * lr_scheduler.optimizers[0].param_groups[0]["lr"]
                         )
+                    logs.update(data_wait_timer.get_logs())
                     accelerator.log(logs, step=global_step)
 
                 loss_total += current_loss
@@ -708,6 +712,8 @@ class TextualInversionTrainer:
                 if global_step >= args.max_train_steps:
                     break
 
+            data_wait_timer.log_summary()
+
             if len(accelerator.trackers) > 0:
                 logs = {"loss/epoch": loss_total / len(train_dataloader)}
                 accelerator.log(logs, step=epoch + 1)
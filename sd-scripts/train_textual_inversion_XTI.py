@@ -317,6 +317,7 @@ def train(args):
         collate_fn=collator,
         num_workers=n_workers,
         persistent_workers=args.persistent_data_loader_workers,
+        **train_util.get_data_loader_kwargs(args, n_workers),
     )
 
     # 学習ステップ数を計算する
@@ -430,6 +431,7 @@ def train(args):
             os.remove(old_ckpt_file)
 
     # training loop
+    data_wait_timer = train_util.DataLoaderWaitTimer()
     for epoch in range(num_train_epochs):
         logger.info("")
         logger.info(f"epoch {epoch+1}/{num_train_epochs}")
@@ -439,7 +441,7 @@ def train(args):
 
         loss_total = 0
 
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(data_wait_timer(train_dataloader)):
             current_step.value = global_step
             with accelerator.accumulate(text_encoder):
                 with torch.no_grad():
@@ -549,6 +551,7 @@ def train(args):
                     logs["lr/d*lr"] = (
                         lr_scheduler.optimizers[0].param_groups[0]["d"] * lr_scheduler.optimizers[0].param_groups[0]["lr"]
                     )
+                logs.update(data_wait_timer.get_logs())
                 accelerator.log(logs, step=global_step)
 
             loss_total += current_loss
@@ -559,6 +562,8 @@ def train(args):
             if global_step >= args.max_train_steps:
                 break
 
+        data_wait_timer.log_summary()
+
         if len(accelerator.trackers) > 0:
             logs = {"loss/epoch": loss_total / len(train_dataloader)}
             accelerator.log(logs, step=epoch + 1)